@@ -0,0 +1,279 @@
+from decimal import Decimal
+from opnreco.api.internalrecoapi import get_internal_recos_query
+from opnreco.api.internalrecoapi import load_reco_movements
+from opnreco.api.recoreportapi import get_outstanding_query
+from opnreco.api.transactionsapi import get_order_by
+from opnreco.api.transactionsapi import get_transactions_query
+from opnreco.api.transactionsapi import iter_records
+from opnreco.export import export_formats
+from opnreco.export import get_export_format
+from opnreco.export import get_export_headers
+from opnreco.export import get_period_header_rows
+from opnreco.models import perms
+from opnreco.models.site import PeriodResource
+from opnreco.streaming import iter_row_batches
+from opnreco.streaming import iter_rows
+from opnreco.streaming import make_stream_response
+from opnreco.viewcommon import compute_period_totals
+from pyramid.view import view_config
+import itertools
+
+zero = Decimal()
+
+sign_titles = {-1: 'Decrease', 1: 'Increase'}
+
+
+def make_export_response(
+        request, period, export_format, name, title, make_rows):
+    """Stream an export of a period.
+
+    make_rows(dbsession, connection) computes the header rows through
+    dbsession and returns an iterable of all the rows, reading the rest
+    through connection. Both read the same snapshot.
+    """
+    _ext, content_type, charset, encode = export_formats[export_format]
+
+    def make_chunks(dbsession, connection):
+        return encode(make_rows(dbsession, connection), title)
+
+    return make_stream_response(
+        request,
+        make_chunks,
+        content_type=content_type,
+        charset=charset,
+        headers=get_export_headers(period, name, export_format))
+
+
+@view_config(
+    name='reco-report-export',
+    context=PeriodResource,
+    permission=perms.view_period)
+def reco_report_export_api(context, request):
+    """Export the outstanding movements of the reconciliation report."""
+    export_format = get_export_format(request.params)
+    period = context.period
+    owner_id = request.owner.id
+
+    def make_rows(dbsession, connection):
+        totals = compute_period_totals(
+            dbsession=dbsession,
+            owner_id=owner_id,
+            period_ids=[period.id])[period.id]
+
+        header_rows = get_period_header_rows(
+            period, "Reconciliation Report", [
+                ('Start', totals['start']),
+                ('Reconciled Total', totals['reconciled_total']),
+                ('Outstanding Total', totals['end']),
+            ])
+        header_rows.append([
+            'Direction',
+            'Workflow Type',
+            'Transfer ID',
+            'Timestamp (UTC)',
+            'Circulation',
+            'Surplus',
+            'Combined',
+            'Movement ID',
+        ])
+
+        statement = get_outstanding_query(
+            dbsession=dbsession,
+            owner_id=owner_id,
+            period_id=period.id).statement
+
+        return itertools.chain(
+            header_rows, iter_outstanding_rows(connection, statement))
+
+    return make_export_response(
+        request=request,
+        period=period,
+        export_format=export_format,
+        name='reco-report',
+        title="Reconciliation Report",
+        make_rows=make_rows)
+
+
+def iter_outstanding_rows(connection, statement):
+    for row in iter_rows(connection, statement):
+        yield [
+            sign_titles[row.sign],
+            row.workflow_type,
+            row.transfer_id,
+            row.ts,
+            row.circ_delta,
+            row.surplus_delta,
+            row.circ_delta + row.surplus_delta,
+            str(row.movement_id),
+        ]
+
+
+@view_config(
+    name='transactions-export',
+    context=PeriodResource,
+    permission=perms.view_period)
+def transactions_export_api(context, request):
+    """Export the transactions of a period.
+
+    List each movement and account entry on its own row, grouped by reco.
+    """
+    export_format = get_export_format(request.params)
+    period = context.period
+    owner_id = request.owner.id
+
+    def make_rows(dbsession, connection):
+        totals = compute_period_totals(
+            dbsession=dbsession,
+            owner_id=owner_id,
+            period_ids=[period.id])[period.id]
+
+        header_rows = get_period_header_rows(
+            period, "Transactions", [
+                ('Start', totals['start']),
+                ('Reconciled', totals['reconciled_delta']),
+                ('Unreconciled Movements', totals['unreco_movements_delta']),
+                ('Unreconciled Account Entries',
+                    totals['unreco_entries_delta']),
+                ('End', totals['end']),
+            ])
+        header_rows.append([
+            'Direction',
+            'Reco ID',
+            'Item',
+            'Item ID',
+            'Date',
+            'Timestamp (UTC)',
+            'Transfer ID',
+            'Workflow Type',
+            'Movement Delta',
+            'Reco Movement Delta',
+            'Account Delta',
+        ])
+
+        query = get_transactions_query(
+            dbsession=dbsession, owner_id=owner_id, period_id=period.id)
+        subq = query.subquery('subq')
+        statement = (
+            dbsession.query(subq)
+            .order_by(*get_order_by(subq))
+            .statement)
+
+        return itertools.chain(
+            header_rows,
+            iter_transaction_rows(connection, owner_id, statement))
+
+    return make_export_response(
+        request=request,
+        period=period,
+        export_format=export_format,
+        name='transactions',
+        title="Transactions",
+        make_rows=make_rows)
+
+
+def iter_transaction_rows(connection, owner_id, statement):
+    records = iter_records(
+        connection=connection,
+        owner_id=owner_id,
+        statement=statement)
+    for inc, record in records:
+        direction = 'Increase' if inc else 'Decrease'
+        reco_id = record['reco_id']
+        for m in record['movements']:
+            yield [
+                direction,
+                reco_id,
+                'Movement',
+                m['id'],
+                None,
+                m['ts'],
+                m['transfer_id'],
+                m['workflow_type'],
+                Decimal(m['movement_delta']),
+                Decimal(m['reco_movement_delta']),
+                None,
+            ]
+        for e in record['account_entries']:
+            yield [
+                direction,
+                reco_id,
+                'Account Entry',
+                e['id'],
+                e['entry_date'],
+                None,
+                None,
+                None,
+                None,
+                None,
+                e['account_delta'],
+            ]
+
+
+@view_config(
+    name='internal-export',
+    context=PeriodResource,
+    permission=perms.view_period)
+def internal_recos_export_api(context, request):
+    """Export the movements of the internal recos of a period."""
+    export_format = get_export_format(request.params)
+    period = context.period
+    owner_id = request.owner.id
+
+    def make_rows(dbsession, connection):
+        totals = compute_period_totals(
+            dbsession=dbsession,
+            owner_id=owner_id,
+            period_ids=[period.id])[period.id]
+
+        header_rows = get_period_header_rows(
+            period, "Internal Reconciliations", [
+                ('Start', totals['start']),
+                ('Internal Reconciled', totals['internal_reconciled_delta']),
+                ('End', totals['end']),
+            ])
+        header_rows.append([
+            'Reco ID',
+            'Movement ID',
+            'Timestamp (UTC)',
+            'Transfer ID',
+            'Workflow Type',
+            'Vault Delta',
+            'Wallet Delta',
+        ])
+
+        query = get_internal_recos_query(
+            dbsession=dbsession, owner_id=owner_id, period_id=period.id)
+        subq = query.subquery('subq')
+        statement = (
+            dbsession.query(subq)
+            .order_by(subq.c.ts, subq.c.reco_id)
+            .statement)
+
+        return itertools.chain(
+            header_rows,
+            iter_internal_reco_rows(connection, owner_id, statement))
+
+    return make_export_response(
+        request=request,
+        period=period,
+        export_format=export_format,
+        name='internal-recos',
+        title="Internal Reconciliations",
+        make_rows=make_rows)
+
+
+def iter_internal_reco_rows(connection, owner_id, statement):
+    for main_rows in iter_row_batches(connection, statement):
+        reco_movements_map = load_reco_movements(
+            executor=connection, owner_id=owner_id, main_rows=main_rows)
+        for main_row in main_rows:
+            for row in reco_movements_map[main_row.reco_id]:
+                yield [
+                    str(main_row.reco_id),
+                    str(row.movement_id),
+                    row.ts,
+                    row.transfer_id,
+                    row.workflow_type,
+                    row.vault_delta or zero,
+                    row.wallet_delta or zero,
+                ]
@@ -8,9 +8,11 @@ from opnreco.models.db import TransferRecord
 from opnreco.models.site import PeriodResource
 from opnreco.param import get_offset_limit
 from pyramid.view import view_config
+from sqlalchemy import and_
 from sqlalchemy import BigInteger
 from sqlalchemy import cast
 from sqlalchemy import func
+from sqlalchemy import select
 from sqlalchemy import String
 import collections
 
@@ -34,59 +36,8 @@ def internal_recos_api(context, request):
     owner = request.owner
     owner_id = owner.id
 
-    ts_c = (
-        dbsession.query(func.min(FileMovement.ts))
-        .filter(FileMovement.reco_id == Reco.id)
-        .correlate(Reco)
-        .as_scalar()
-        .label('ts')
-    )
-
-    vault_delta_c = (
-        dbsession.query(func.sum(FileMovement.vault_delta))
-        .filter(FileMovement.reco_id == Reco.id)
-        .correlate(Reco)
-        .as_scalar()
-        .label('vault_delta')
-    )
-
-    wallet_delta_c = (
-        dbsession.query(func.sum(FileMovement.wallet_delta))
-        .filter(FileMovement.reco_id == Reco.id)
-        .correlate(Reco)
-        .as_scalar()
-        .label('wallet_delta')
-    )
-
-    movement_count_c = (
-        dbsession.query(func.count(FileMovement.movement_id))
-        .filter(FileMovement.reco_id == Reco.id)
-        .correlate(Reco)
-        .as_scalar()
-        .label('movement_count')
-    )
-
-    # List the internal reconciliations in the period.
-    # Since recos can contain any number of account entries and movements,
-    # list just the reco IDs, delta totals, and dates. Get the reco-specific
-    # account entries and movements after ordering and pagination.
-    query = (
-        dbsession.query(
-            Reco.id.label('reco_id'),
-            cast(None, BigInteger).label('movement_id'),
-            ts_c,
-            vault_delta_c,
-            wallet_delta_c,
-            cast(None, String).label('workflow_type'),
-            cast(None, String).label('transfer_id'),
-        )
-        .filter(
-            Reco.owner_id == owner_id,
-            Reco.period_id == period_id,
-            Reco.internal,
-            movement_count_c > 0,
-        )
-    )
+    query = get_internal_recos_query(
+        dbsession=dbsession, owner_id=owner_id, period_id=period_id)
 
     total_cte = query.cte('total_cte')
     totals_row = (
@@ -116,34 +67,8 @@ def internal_recos_api(context, request):
 
     # Now main_rows contains the rows for the table.
 
-    query_reco_ids = [r.reco_id for r in main_rows if r.reco_id is not None]
-    # reco_movements_map: {reco_id: [Movement]}
-    reco_movements_map = collections.defaultdict(list)
-
-    if query_reco_ids:
-        # Most of the rows contain multiple movements.
-        # Fill reco_movements_map.
-        rows = (
-            dbsession.query(
-                FileMovement.reco_id,
-                FileMovement.movement_id,
-                FileMovement.ts,
-                FileMovement.vault_delta,
-                FileMovement.wallet_delta,
-                TransferRecord.workflow_type,
-                TransferRecord.transfer_id,
-            )
-            .join(
-                TransferRecord,
-                TransferRecord.id == FileMovement.transfer_record_id)
-            .filter(
-                FileMovement.owner_id == owner_id,
-                FileMovement.reco_id.in_(query_reco_ids),
-            )
-            .order_by(FileMovement.ts, FileMovement.movement_id)
-            .all())
-        for row in rows:
-            reco_movements_map[row.reco_id].append(row)
+    reco_movements_map = load_reco_movements(
+        executor=dbsession, owner_id=owner_id, main_rows=main_rows)
 
     page_records = []
     page_totals = {'vault_delta': zero, 'wallet_delta': zero}
@@ -188,3 +113,98 @@ def internal_recos_api(context, request):
         },
         'show_vault': context.period.file.has_vault,
     }
+
+
+def get_internal_recos_query(dbsession, owner_id, period_id):
+    """Query the internal recos of a period and their delta totals."""
+    ts_c = (
+        dbsession.query(func.min(FileMovement.ts))
+        .filter(FileMovement.reco_id == Reco.id)
+        .correlate(Reco)
+        .as_scalar()
+        .label('ts')
+    )
+
+    vault_delta_c = (
+        dbsession.query(func.sum(FileMovement.vault_delta))
+        .filter(FileMovement.reco_id == Reco.id)
+        .correlate(Reco)
+        .as_scalar()
+        .label('vault_delta')
+    )
+
+    wallet_delta_c = (
+        dbsession.query(func.sum(FileMovement.wallet_delta))
+        .filter(FileMovement.reco_id == Reco.id)
+        .correlate(Reco)
+        .as_scalar()
+        .label('wallet_delta')
+    )
+
+    movement_count_c = (
+        dbsession.query(func.count(FileMovement.movement_id))
+        .filter(FileMovement.reco_id == Reco.id)
+        .correlate(Reco)
+        .as_scalar()
+        .label('movement_count')
+    )
+
+    # List the internal reconciliations in the period.
+    # Since recos can contain any number of account entries and movements,
+    # list just the reco IDs, delta totals, and dates. Get the reco-specific
+    # account entries and movements after ordering and pagination.
+    query = (
+        dbsession.query(
+            Reco.id.label('reco_id'),
+            cast(None, BigInteger).label('movement_id'),
+            ts_c,
+            vault_delta_c,
+            wallet_delta_c,
+            cast(None, String).label('workflow_type'),
+            cast(None, String).label('transfer_id'),
+        )
+        .filter(
+            Reco.owner_id == owner_id,
+            Reco.period_id == period_id,
+            Reco.internal,
+            movement_count_c > 0,
+        )
+    )
+
+    return query
+
+
+def load_reco_movements(executor, owner_id, main_rows):
+    """Get the movements of the recos in main_rows.
+
+    executor is a session or connection. Return {reco_id: [movement row]}.
+    """
+    reco_movements_map = collections.defaultdict(list)
+
+    query_reco_ids = [r.reco_id for r in main_rows if r.reco_id is not None]
+    if not query_reco_ids:
+        return reco_movements_map
+
+    # Most of the rows contain multiple movements.
+    statement = (
+        select([
+            FileMovement.reco_id,
+            FileMovement.movement_id,
+            FileMovement.ts,
+            FileMovement.vault_delta,
+            FileMovement.wallet_delta,
+            TransferRecord.workflow_type,
+            TransferRecord.transfer_id,
+        ])
+        .select_from(FileMovement.__table__.join(
+            TransferRecord.__table__,
+            TransferRecord.id == FileMovement.transfer_record_id))
+        .where(and_(
+            FileMovement.owner_id == owner_id,
+            FileMovement.reco_id.in_(query_reco_ids),
+        ))
+        .order_by(FileMovement.ts, FileMovement.movement_id))
+    for row in executor.execute(statement):
+        reco_movements_map[row.reco_id].append(row)
+
+    return reco_movements_map
@@ -18,19 +18,22 @@ from opnreco.reassign import pull_recos
 from opnreco.reassign import pull_unreco
 from opnreco.reassign import push_recos
 from opnreco.reassign import push_unreco
+from opnreco.reassign import push_unreco_periods
 from opnreco.serialize import serialize_period
 from opnreco.viewcommon import add_open_period
 from opnreco.viewcommon import compute_period_totals
 from opnreco.viewcommon import configure_dblog
+from opnreco.viewcommon import expire_period_summary
 from opnreco.viewcommon import handle_invalid
 from opnreco.viewcommon import open_end_period_exists
 from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.view import view_config
 from sqlalchemy import and_
 from sqlalchemy import case
+from sqlalchemy import Date
 from sqlalchemy import func
 from sqlalchemy import literal
-from sqlalchemy import or_
+from sqlalchemy.exc import IntegrityError
 import colander
 import datetime
 import logging
@@ -39,6 +42,9 @@ log = logging.getLogger(__name__)
 zero = Decimal('0')
 null = None
 
+# The PostgreSQL error code for an exclusion constraint violation.
+exclusion_violation = '23P01'
+
 
 @view_config(
     name='period-list',
@@ -47,51 +53,49 @@ null = None
     renderer='json')
 def period_list_api(context, request):
     """Return a page of periods in a file.
+
+    The periods are ordered by start_date, newest first. To get the
+    next page without skipping rows, pass the next_cursor from the
+    previous page as the cursor param along with offset=0.
     """
     params = request.params
     file = context.file
     offset, limit = get_offset_limit(params)
+    cursor = parse_period_cursor(params.get('cursor'))
 
     owner = request.owner
     owner_id = owner.id
     dbsession = request.dbsession
 
-    future = datetime.datetime.utcnow() + datetime.timedelta(days=366 * 100)
-
+    statement_count = (
+        dbsession.query(func.count(Statement.id))
+        .filter(Statement.period_id == Period.id)
+        .correlate(Period)
+        .as_scalar()
+        .label('statement_count'))
+
+    # Note: the (file_id, start_date) index provides this order, which
+    # puts the period with no start_date first.
     query = (
-        dbsession.query(Period)
+        dbsession.query(Period, statement_count)
         .filter(
             Period.owner_id == owner_id,
             Period.file_id == file.id,
         )
-        .order_by(func.coalesce(Period.start_date, future).desc())
+        .order_by(Period.start_date.desc().nullsfirst())
     )
 
-    totals_row = (
-        dbsession.query(
-            func.count(1).label('rowcount'),
-        )
-        .select_from(query.subquery('subq'))
-        .one())
+    if cursor is unbounded_cursor:
+        query = query.filter(Period.start_date != null)
+    elif cursor is not None:
+        query = query.filter(Period.start_date < cursor)
 
     list_query = query.offset(offset)
     if limit is not None:
         list_query = list_query.limit(limit)
-    period_rows = list_query.all()
+    rows = list_query.all()
 
-    all_period_ids = [period.id for period in period_rows]
-
-    statement_rows = (
-        dbsession.query(
-            Statement.period_id,
-            func.count(1).label('count'),
-        )
-        .filter(
-            Statement.owner_id == owner_id,
-            Statement.period_id.in_(all_period_ids),
-        )
-        .group_by(Statement.period_id)
-        .all())
+    period_rows = [period for period, _count in rows]
 
     # Compute the end_circ and end_surplus for periods that haven't computed
     # them yet.
@@ -113,42 +117,62 @@ def period_list_api(context, request):
     else:
         end_amounts_map = {}
 
-    statement_map = {row.period_id: row.count for row in statement_rows}
-
     periods = []
-    for p in period_rows:
-        period_id = p.id
+    for p, count in rows:
         period_state = serialize_period(
             p, end_amounts=end_amounts_map.get(p.id))
-        period_state['statement_count'] = statement_map.get(period_id, 0)
+        period_state['statement_count'] = count
         periods.append(period_state)
 
+    if limit is not None and len(rows) == limit and rows:
+        last_start_date = period_rows[-1].start_date
+        if last_start_date is None:
+            next_cursor = unbounded_cursor
+        else:
+            next_cursor = last_start_date.isoformat()
+    else:
+        next_cursor = None
+
     # Get the next_start_date, which is null if the last period is endless.
-    endless_c = case([(Period.end_date == null, 1)], else_=None)
-    last_end_row = (
-        dbsession.query(
-            func.max(Period.end_date).label('end_date'),
-            func.count(endless_c).label('endless'),
-        )
-        .filter(
-            Period.owner_id == owner_id,
-            Period.file_id == file.id,
-        )
-        .one())
-    if last_end_row.endless:
+    # The period_summary_trigger maintains the file's period summary.
+    if file.has_endless_period:
         next_start_date = None
-    elif last_end_row.end_date is not None:
-        next_start_date = last_end_row.end_date + datetime.timedelta(days=1)
+    elif file.last_period_end_date is not None:
+        next_start_date = (
+            file.last_period_end_date + datetime.timedelta(days=1))
     else:
         next_start_date = None
 
     return {
         'periods': periods,
-        'rowcount': totals_row.rowcount,
+        'rowcount': file.period_count,
         'next_start_date': next_start_date,
+        'next_cursor': next_cursor,
     }
 
 
+# unbounded_cursor follows the period that has no start_date.
+unbounded_cursor = 'unbounded'
+
+
+def parse_period_cursor(cursor_str):
+    """Parse the cursor param of the period list.
+
+    Return None, unbounded_cursor, or a date.
+    """
+    if not cursor_str:
+        return None
+    if cursor_str == unbounded_cursor:
+        return unbounded_cursor
+    try:
+        return datetime.datetime.strptime(cursor_str, '%Y-%m-%d').date()
+    except ValueError:
+        raise HTTPBadRequest(json_body={
+            'error': 'invalid_cursor',
+            'error_description': "Invalid period list cursor.",
+        })
+
+
 def get_delete_conflicts(dbsession, period):
     """Get an object that describes why a period can't be deleted (yet).
 
@@ -262,47 +286,12 @@ def period_state_api(context, request):
     return res
 
 
-def day_intersects(day, range_start, range_end, is_start):
-    """Make a SQL expr that checks whether a day intersects with a date range.
+def make_date_range(start_date, end_date):
+    """Make a SQL daterange expr that includes both dates.
+
+    A null date leaves the range unbounded at that end.
     """
-    if is_start:
-        no_bound_test = (range_start == null)
-    else:
-        no_bound_test = (range_end == null)
-
-    return or_(
-        and_(
-            # Yes if the range is unlimited, regardless of the day.
-            range_start == null,
-            range_end == null),
-        and_(
-            # Yes if the day is not given and the range has no boundary
-            # at the specified endpoint (the start or the end).
-            day == null,
-            no_bound_test),
-        and_(
-            # Yes if the day is given, the range has a start, and
-            # the day is at the start or later.
-            day != null,
-            range_start != null,
-            range_end == null,
-            day >= range_start),
-        and_(
-            # Yes if the day is given, the range has an end, and
-            # the day is at the end or earlier.
-            day != null,
-            range_start == null,
-            range_end != null,
-            day <= range_end),
-        and_(
-            # Yes if the day is given, the range is fully bounded, and
-            # the day is within the range.
-            day != null,
-            range_start != null,
-            range_end != null,
-            day >= range_start,
-            day <= range_end),
-    )
+    return func.daterange(start_date, end_date, '[]')
 
 
 def detect_date_overlap(dbsession, period, new_start_date, new_end_date):
@@ -310,42 +299,8 @@ def detect_date_overlap(dbsession, period, new_start_date, new_end_date):
 
     Return the first overlapping period.
     """
-
-    def has_overlap():
-        """Make a SQL expression that checks whether the new range intersects
-        with an existing range.
-        """
-        new_start_date1 = (
-            literal(None) if new_start_date is None else new_start_date)
-        new_end_date1 = (
-            literal(None) if new_end_date is None else new_end_date)
-
-        return or_(
-            day_intersects(
-                # Yes if the new start date intersects with the period.
-                new_start_date1,
-                Period.start_date,
-                Period.end_date,
-                True),
-            day_intersects(
-                # Yes if the new end date intersects with the period.
-                new_end_date1,
-                Period.start_date,
-                Period.end_date,
-                False),
-            day_intersects(
-                # Yes if the period start date intersects with the new range.
-                Period.start_date,
-                new_start_date1,
-                new_end_date1,
-                True),
-            day_intersects(
-                # Yes if the period end date intersects with the new range.
-                Period.end_date,
-                new_start_date1,
-                new_end_date1,
-                False),
-        )
+    new_range = make_date_range(
+        literal(new_start_date, Date), literal(new_end_date, Date))
 
     overlap_row = (
         dbsession.query(Period.id)
@@ -353,7 +308,8 @@ def detect_date_overlap(dbsession, period, new_start_date, new_end_date):
             Period.owner_id == period.owner_id,
             Period.file_id == period.file_id,
             Period.id != period.id,
-            has_overlap(),
+            make_date_range(Period.start_date, Period.end_date).op('&&')(
+                new_range),
         )
         .order_by(Period.start_date)
         .first())
@@ -454,6 +410,14 @@ def period_add_api(context, request):
         adding_period=True)
 
 
+def raise_date_overlap():
+    raise HTTPBadRequest(json_body={
+        'error': 'date_overlap',
+        'error_description': (
+            'The date range specified overlaps another period.'),
+    })
+
+
 def edit_period(request, period, appstruct, event_type, adding_period=False):
     """Edit a period. Used for both adding and saving periods."""
     dbsession = request.dbsession
@@ -480,11 +444,7 @@ def edit_period(request, period, appstruct, event_type, adding_period=False):
         new_start_date=start_date,
         new_end_date=end_date)
     if overlap_row is not None:
-        raise HTTPBadRequest(json_body={
-            'error': 'date_overlap',
-            'error_description': (
-                'The date range specified overlaps another period.'),
-        })
+        raise_date_overlap()
 
     if close and (start_date is None or end_date is None):
         raise HTTPBadRequest(json_body={
@@ -501,7 +461,18 @@ def edit_period(request, period, appstruct, event_type, adding_period=False):
 
     if adding_period:
         dbsession.add(period)
-        dbsession.flush()  # Assign period.id
+
+    try:
+        # The period_date_overlap constraint rejects overlaps that
+        # detect_date_overlap() could not see, such as overlaps created
+        # by a concurrent request.
+        with dbsession.begin_nested():
+            dbsession.flush()  # Assign period.id
+    except IntegrityError as e:
+        if getattr(e.orig, 'pgcode', None) == exclusion_violation:
+            raise_date_overlap()
+        raise
+    expire_period_summary(dbsession, period.file)
 
     move_counts = {}
 
@@ -682,7 +653,14 @@ def get_prev_end_balances(request, next_period):
     renderer='json')
 def period_reopen(context, request):
     period = context.period
+    reopen_period(request=request, period=period, event_type='period_reopen')
+    return {
+        'period': serialize_period(period),
+    }
 
+
+def reopen_period(request, period, event_type):
+    """Reopen a closed period."""
     period.closed = False
     # Force recomputation of the end_circ and end_surplus amounts.
     period.end_circ = None
@@ -695,7 +673,7 @@ def period_reopen(context, request):
     dbsession.add(OwnerLog(
         owner_id=owner_id,
         personal_id=request.personal_id,
-        event_type='period_reopen',
+        event_type=event_type,
         content={
             'period_id': period.id,
             'file_id': period.file_id,
@@ -707,8 +685,237 @@ def period_reopen(context, request):
             'end_surplus': period.end_surplus,
         }))
 
+
+class PeriodIdList(colander.SequenceSchema):
+    period_id = colander.SchemaNode(colander.Integer())
+
+
+class PeriodBatchSchema(colander.Schema):
+    period_ids = PeriodIdList(validator=colander.Length(min=1, max=1000))
+    pull = colander.SchemaNode(colander.Boolean(), missing=False)
+
+
+def get_period_run(request, file, period_ids):
+    """Get a chronologically ordered run of consecutive periods in a file.
+
+    Raise HTTPBadRequest if any of the periods are not in the file
+    or if other periods of the file fall between them.
+    """
+    dbsession = request.dbsession
+    owner_id = request.owner.id
+
+    # List the IDs of all the periods in the file in chronological order.
+    # (The periods in a file never overlap.)
+    id_rows = (
+        dbsession.query(Period.id)
+        .filter(
+            Period.owner_id == owner_id,
+            Period.file_id == file.id,
+        )
+        .order_by(Period.start_date.nullsfirst(), Period.id)
+        .all())
+    positions = {row.id: pos for (pos, row) in enumerate(id_rows)}
+
+    period_ids = set(period_ids)
+    run_positions = sorted(
+        positions[period_id] for period_id in period_ids
+        if period_id in positions)
+
+    if len(run_positions) != len(period_ids):
+        raise HTTPBadRequest(json_body={
+            'error': 'period_not_found',
+            'error_description': (
+                "One or more of the periods specified are not in the file."),
+        })
+
+    if run_positions[-1] - run_positions[0] != len(run_positions) - 1:
+        raise HTTPBadRequest(json_body={
+            'error': 'periods_not_consecutive',
+            'error_description': (
+                "The periods specified must be consecutive."),
+        })
+
+    periods = (
+        dbsession.query(Period)
+        .filter(
+            Period.owner_id == owner_id,
+            Period.id.in_(period_ids),
+        )
+        .all())
+    periods.sort(key=lambda p: positions[p.id])
+    return periods
+
+
+def chain_period_totals(totals, start):
+    """Change the start balances of computed period totals.
+
+    The deltas don't depend on the start balances, so shift the start,
+    reconciled_total, and end balances by the change in start balances.
+    """
+    for k in 'circ', 'surplus', 'combined':
+        shift = start[k] - totals['start'][k]
+        for phase in 'start', 'reconciled_total', 'end':
+            totals[phase][k] += shift
+
+
+@view_config(
+    name='period-close-batch',
+    context=FileResource,
+    permission=perms.edit_file,
+    renderer='json')
+def period_close_batch_api(context, request):
+    """Close a chronologically ordered run of periods in one transaction.
+
+    Push the unreconciled items forward once for the whole run, then
+    compute the end balances of each period and chain them into the start
+    balances of the next period. This is equivalent to closing the
+    periods one at a time in chronological order.
+    """
+    file = context.file
+    dbsession = request.dbsession
+    owner = request.owner
+    owner_id = owner.id
+
+    schema = PeriodBatchSchema()
+    try:
+        appstruct = schema.deserialize(request.json)
+    except colander.Invalid as e:
+        handle_invalid(e, schema=schema)
+
+    pull = appstruct['pull']
+    periods = get_period_run(
+        request=request, file=file, period_ids=appstruct['period_ids'])
+
+    for period in periods:
+        if period.closed:
+            raise HTTPBadRequest(json_body={
+                'error': 'period_closed',
+                'error_description': (
+                    "Period %s is already closed." % period.id),
+            })
+        if period.start_date is None or period.end_date is None:
+            raise HTTPBadRequest(json_body={
+                'error': 'dates_required',
+                'error_description': (
+                    "Start and end dates are required "
+                    "for closing the period."),
+            })
+
+    move_counts = {}
+
+    movement_op = MovementReassignOp(owner=owner)
+    account_entry_op = AccountEntryReassignOp()
+
+    # Push unreconciled movements and account entries in the periods
+    # to other open periods.
+    configure_dblog(request, event_type='push_unreco')
+    move_counts['push_unreco_movements'] = push_unreco_periods(
+        request=request, periods=periods, op=movement_op)
+    move_counts['push_unreco_account_entries'] = push_unreco_periods(
+        request=request, periods=periods, op=account_entry_op)
+
+    if pull:
+        # Pull recos from other open periods if the date range fits.
+        configure_dblog(request, event_type='push_recos')
+        move_counts['pull_recos'] = sum(
+            pull_recos(request=request, period=period)
+            for period in periods)
+
+    totals_map = compute_period_totals(
+        dbsession=dbsession,
+        owner_id=owner_id,
+        period_ids=[period.id for period in periods])
+
+    prev_totals = None
+    for period in periods:
+        totals = totals_map[period.id]
+        if prev_totals is not None:
+            chain_period_totals(totals, start=prev_totals['end'])
+            period.start_circ = totals['start']['circ']
+            period.start_surplus = totals['start']['surplus']
+
+        period.end_circ = totals['end']['circ']
+        period.end_surplus = totals['end']['surplus']
+        period.closed = True
+        prev_totals = totals
+
+        dbsession.add(OwnerLog(
+            owner_id=owner_id,
+            personal_id=request.personal_id,
+            event_type='period_close_batch',
+            content={
+                'period_id': period.id,
+                'file_id': period.file_id,
+                'start_date': period.start_date,
+                'start_circ': period.start_circ,
+                'start_surplus': period.start_surplus,
+                'end_date': period.end_date,
+                'end_circ': period.end_circ,
+                'end_surplus': period.end_surplus,
+                'close': True,
+                'pull': pull,
+            }))
+
+    # If there is no longer an open-ended period, create it now.
+    if not open_end_period_exists(request=request, file_id=file.id):
+        next_period = add_open_period(
+            request=request,
+            file_id=file.id,
+            event_type='add_period_on_edit')
+        # Pull unreconciled items into the automatically created period.
+        configure_dblog(request, event_type='pull_unreco')
+        move_counts['pull_next_unreco_movements'] = (
+            pull_unreco(
+                request=request,
+                period=next_period,
+                op=movement_op))
+        move_counts['pull_next_unreco_account_entries'] = (
+            pull_unreco(
+                request=request,
+                period=next_period,
+                op=account_entry_op))
+
+    update_next_period(
+        request=request, prev_period=periods[-1], totals=prev_totals)
+
     return {
-        'period': serialize_period(period),
+        'periods': [serialize_period(period) for period in periods],
+        'move_counts': move_counts,
+    }
+
+
+@view_config(
+    name='period-reopen-batch',
+    context=FileResource,
+    permission=perms.edit_file,
+    renderer='json')
+def period_reopen_batch_api(context, request):
+    """Reopen a run of closed periods in one transaction."""
+    file = context.file
+
+    schema = PeriodBatchSchema()
+    try:
+        appstruct = schema.deserialize(request.json)
+    except colander.Invalid as e:
+        handle_invalid(e, schema=schema)
+
+    periods = get_period_run(
+        request=request, file=file, period_ids=appstruct['period_ids'])
+
+    for period in periods:
+        if not period.closed:
+            raise HTTPBadRequest(json_body={
+                'error': 'period_open',
+                'error_description': (
+                    "Period %s is not closed." % period.id),
+            })
+
+    for period in periods:
+        reopen_period(
+            request=request, period=period, event_type='period_reopen')
+
+    return {
+        'periods': [serialize_period(period) for period in periods],
     }
 
 
@@ -766,6 +973,9 @@ def period_delete(context, request):
             'end_surplus': period.end_surplus,
         }))
 
+    file = period.file
     dbsession.delete(period)
+    dbsession.flush()
+    expire_period_summary(dbsession, file)
 
     return {}
@@ -18,17 +18,23 @@ from opnreco.models.db import Reco
 from opnreco.models.db import TransferRecord
 from opnreco.models.site import PeriodResource
 from opnreco.param import parse_amount
+from opnreco.searchcache import cached_search
 from opnreco.viewcommon import configure_dblog
 from opnreco.viewcommon import get_loop_map
 from opnreco.viewcommon import handle_invalid
 from opnreco.viewcommon import list_assignable_periods
+from opnreco.viewcommon import make_array_cte
 from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.view import view_config
 from sqlalchemy import and_
-from sqlalchemy import cast
+from sqlalchemy import BigInteger
+from sqlalchemy import Boolean
+from sqlalchemy import case
 from sqlalchemy import func
 from sqlalchemy import or_
+from sqlalchemy import select
 from sqlalchemy import String
+from sqlalchemy import Unicode
 import datetime
 import dateutil.parser
 import re
@@ -233,6 +239,211 @@ def reco_api(context, request, final=False):
     }
 
 
+class AmountCriterion:
+    """Search for an exact absolute amount or a range of absolute amounts.
+
+    The range is [low, low + 1) when the search omits the subunit value.
+    sign is -1, 1, or 0 (unspecified).
+    """
+
+    def __init__(self, parsed):
+        self.low = abs(parsed)
+        self.exact = '.' in parsed.amount_input
+        self.sign = parsed.sign
+
+    def get_filter(self, column):
+        abs_c = func.abs(column)
+        if self.exact:
+            # Exact amount.
+            filters = [abs_c == self.low]
+        else:
+            # The search omitted the subunit value.
+            filters = [abs_c >= self.low, abs_c < self.low + 1]
+        if self.sign < 0:
+            filters.append(column < 0)
+        elif self.sign > 0:
+            filters.append(column > 0)
+        return and_(*filters)
+
+    def matches(self, value):
+        if self.sign < 0 and not value < 0:
+            return False
+        if self.sign > 0 and not value > 0:
+            return False
+        abs_value = abs(value)
+        if self.exact:
+            return abs_value == self.low
+        return self.low <= abs_value < self.low + 1
+
+    def narrows(self, other):
+        if other.sign and other.sign != self.sign:
+            return False
+        if other.exact:
+            return self.exact and self.low == other.low
+        # Note: a range search and an exact search that omits zeros
+        # (such as "12" and "12.") are both within the range.
+        return other.low <= self.low < other.low + 1 and (
+            self.exact or self.low == other.low)
+
+
+def narrows_substring(value, other_value):
+    """Return true if a substring search narrows another substring search."""
+    if other_value is None:
+        return True
+    return value is not None and other_value in value
+
+
+class MovementSearch:
+    """The criteria of a movement search in the reconciliation dialog.
+
+    The criteria can be applied either as SQL filters or to rows in memory
+    (see opnreco.searchcache).
+    """
+    cacheable = True
+
+    def __init__(self, params, currency):
+        amount_input = str(params.get('amount', ''))
+        date_input = str(params.get('date', ''))
+        transfer_input = str(params.get('transfer', ''))
+        # tzoffset is the number of minutes as given by
+        # 'new Date().getTimezoneOffset()' in Javascript.
+        tzoffset_input = str(params.get('tzoffset'))
+        self.seen_ids = frozenset(int(x) for x in params.get('seen_ids', ()))
+        reco_id_input = params.get('reco_id')
+
+        if reco_id_input:
+            self.reco_id = int(reco_id_input)
+        else:
+            self.reco_id = None
+
+        amount_parsed = parse_amount(amount_input, currency=currency)
+        if amount_parsed is not None:
+            self.amount = AmountCriterion(amount_parsed)
+        else:
+            self.amount = None
+
+        self.currency = None
+        match = re.search(r'[A-Z]+', amount_input, re.I)
+        if match is not None:
+            self.currency = match.group(0).upper()
+
+        # ts_range is the range of the movement timestamp: [start, end).
+        self.ts_range = None
+        if date_input and tzoffset_input:
+            try:
+                parsed = dateutil.parser.parse(date_input)
+                tzoffset = int(tzoffset_input)
+            except Exception:
+                pass
+            else:
+                if parsed is not None:
+                    if parsed.tzinfo is not None:
+                        # The input specifies its own time zone.
+                        # Compare naive UTC datetimes like the ts column.
+                        ts = parsed.astimezone(
+                            datetime.timezone.utc).replace(tzinfo=None)
+                    else:
+                        ts = parsed + datetime.timedelta(
+                            seconds=tzoffset * 60)
+                    colon_count = sum((1 for c in date_input if c == ':'), 0)
+                    if colon_count >= 2:
+                        # Query with second resolution
+                        delta = datetime.timedelta(seconds=1)
+                    elif colon_count >= 1:
+                        # Query with minute resolution
+                        delta = datetime.timedelta(seconds=60)
+                    elif parsed.hour:
+                        # Query with hour resolution
+                        delta = datetime.timedelta(seconds=3600)
+                    else:
+                        # Query with day resolution
+                        delta = datetime.timedelta(days=1)
+                    self.ts_range = (ts, ts + delta)
+
+        self.transfer = None
+        match = re.search(r'[0-9\-]+', transfer_input)
+        if match is not None:
+            transfer_str = match.group(0).replace('-', '')
+            if transfer_str:
+                self.transfer = transfer_str
+
+    def is_empty(self):
+        return (
+            self.amount is None and
+            self.currency is None and
+            self.ts_range is None and
+            self.transfer is None)
+
+    def get_filters(self):
+        filters = []
+
+        if self.amount is not None:
+            filters.append(or_(
+                self.amount.get_filter(FileMovement.vault_delta),
+                self.amount.get_filter(FileMovement.wallet_delta),
+            ))
+
+        if self.currency is not None:
+            filters.append(
+                FileMovement.currency.like('%' + self.currency + '%'))
+
+        if self.ts_range is not None:
+            start, end = self.ts_range
+            filters.append(FileMovement.ts >= start)
+            filters.append(FileMovement.ts < end)
+
+        if self.transfer is not None:
+            # Note: pass the pattern as a plain string (rather than
+            # concatenating in SQL) so the planner can use the trigram
+            # index on transfer_id.
+            filters.append(
+                TransferRecord.transfer_id.like('%' + self.transfer + '%'))
+
+        if self.seen_ids:
+            filters.append(~FileMovement.movement_id.in_(self.seen_ids))
+
+        return filters
+
+    def matches(self, row):
+        if self.amount is not None and not (
+                self.amount.matches(row.vault_delta) or
+                self.amount.matches(row.wallet_delta)):
+            return False
+        if self.currency is not None and self.currency not in row.currency:
+            return False
+        if self.ts_range is not None:
+            start, end = self.ts_range
+            if not start <= row.ts < end:
+                return False
+        if (self.transfer is not None and
+                self.transfer not in row.transfer_id):
+            return False
+        if row.movement_id in self.seen_ids:
+            return False
+        return True
+
+    def narrows(self, other):
+        if not isinstance(other, MovementSearch):
+            return False
+        if self.reco_id != other.reco_id:
+            return False
+        if not self.seen_ids.issuperset(other.seen_ids):
+            return False
+        if other.amount is not None and (
+                self.amount is None or not self.amount.narrows(other.amount)):
+            return False
+        if other.ts_range is not None:
+            if self.ts_range is None:
+                return False
+            start, end = self.ts_range
+            other_start, other_end = other.ts_range
+            if not (other_start <= start and end <= other_end):
+                return False
+        return (
+            narrows_substring(self.currency, other.currency) and
+            narrows_substring(self.transfer, other.transfer))
+
+
 @view_config(
     name='reco-search-movement',
     context=PeriodResource,
@@ -241,140 +452,163 @@ def reco_api(context, request, final=False):
 def reco_search_movement(context, request, final=False):
     """Search for movements that haven't been reconciled."""
     period = context.period
-    params = request.json
-    amount_input = str(params.get('amount', ''))
-    date_input = str(params.get('date', ''))
-    transfer_input = str(params.get('transfer', ''))
-    # tzoffset is the number of minutes as given by
-    # 'new Date().getTimezoneOffset()' in Javascript.
-    tzoffset_input = str(params.get('tzoffset'))
-    seen_ids = set(int(x) for x in params.get('seen_ids', ()))
-    reco_id_input = params.get('reco_id')
-
-    if reco_id_input:
-        reco_id = int(reco_id_input)
-    else:
-        reco_id = None
+    search = MovementSearch(request.json, currency=period.file.currency)
+
+    if search.is_empty():
+        return []
 
     dbsession = request.dbsession
     owner = request.owner
     owner_id = owner.id
-    filters = []
-
-    amount_parsed = parse_amount(amount_input, currency=period.file.currency)
-    if amount_parsed is not None:
-        amount_abs = abs(amount_parsed)
-        vault_sign_filters = ()
-        wallet_sign_filters = ()
-        if amount_parsed.sign < 0:
-            vault_sign_filters = ((FileMovement.vault_delta < 0),)
-            wallet_sign_filters = ((FileMovement.wallet_delta < 0),)
-        elif amount_parsed.sign > 0:
-            vault_sign_filters = ((FileMovement.vault_delta > 0),)
-            wallet_sign_filters = ((FileMovement.wallet_delta > 0),)
-
-        if '.' in amount_parsed.amount_input:
-            # Exact amount.
-            filters.append(or_(
-                and_(
-                    func.abs(FileMovement.vault_delta) == amount_abs,
-                    *vault_sign_filters),
-                and_(
-                    func.abs(FileMovement.wallet_delta) == amount_abs,
-                    *wallet_sign_filters),
-            ))
-        else:
-            # The search omitted the subunit value.
-            filters.append(or_(
-                and_(
-                    func.abs(FileMovement.vault_delta) >= amount_abs,
-                    func.abs(FileMovement.vault_delta) < amount_abs + 1,
-                    *vault_sign_filters),
-                and_(
-                    func.abs(FileMovement.wallet_delta) >= amount_abs,
-                    func.abs(FileMovement.wallet_delta) < amount_abs + 1,
-                    *wallet_sign_filters),
-            ))
 
-    match = re.search(r'[A-Z]+', amount_input, re.I)
-    if match is not None:
-        currency = match.group(0).upper()
-        filters.append(
-            FileMovement.currency.like(func.concat('%', currency, '%')))
+    def query(row_limit):
+        return (
+            start_movement_query(
+                dbsession=dbsession,
+                owner_id=owner_id,
+                file_id=period.file_id)
+            .join(Period, Period.id == FileMovement.period_id)
+            .filter(
+                # Note: don't filter by period_id, otherwise, users won't be
+                # able to reconcile entries across periods.
+                or_(
+                    FileMovement.reco_id == null,
+                    FileMovement.reco_id == search.reco_id,
+                ),
+                # Movements assigned to closed periods are not eligible.
+                ~Period.closed,
+                *search.get_filters()
+            )
+            .order_by(
+                FileMovement.ts,
+                TransferRecord.transfer_id,
+                Movement.number,
+                Movement.amount_index,
+                FileMovement.file_id,
+                FileMovement.issuer_id,
+            )
+            .limit(row_limit)
+            .all())
 
-    if date_input and tzoffset_input:
-        try:
-            parsed = dateutil.parser.parse(date_input)
-            tzoffset = int(tzoffset_input)
-        except Exception:
-            pass
+    movement_rows = cached_search(
+        dbsession=dbsession,
+        owner_id=owner_id,
+        file_id=period.file_id,
+        search=search,
+        query=query,
+        limit=5)
+
+    movements_json = serialize_movement_rows(movement_rows)
+
+    return movements_json
+
+
+class AccountEntrySearch:
+    """The criteria of an account entry search in the reconciliation dialog.
+
+    The criteria can be applied either as SQL filters or to rows in memory
+    (see opnreco.searchcache).
+    """
+
+    def __init__(self, params, currency):
+        delta_input = str(params.get('delta', ''))
+        entry_date_input = str(params.get('entry_date', ''))
+        description_input = str(params.get('description', ''))
+        self.seen_ids = frozenset(int(x) for x in params.get('seen_ids', ()))
+        reco_id_input = params.get('reco_id')
+
+        if reco_id_input:
+            self.reco_id = int(reco_id_input)
         else:
-            if parsed is not None:
-                ts = parsed + datetime.timedelta(seconds=tzoffset * 60)
-                filters.append(FileMovement.ts >= ts)
-                colon_count = sum((1 for c in date_input if c == ':'), 0)
-                if colon_count >= 2:
-                    # Query with second resolution
-                    filters.append(
-                        FileMovement.ts < ts + datetime.timedelta(seconds=1))
-                elif colon_count >= 1:
-                    # Query with minute resolution
-                    filters.append(
-                        FileMovement.ts < ts + datetime.timedelta(seconds=60))
-                elif parsed.hour:
-                    # Query with hour resolution
-                    filters.append(
-                        FileMovement.ts < ts + datetime.timedelta(seconds=3600))
-                else:
-                    # Query with day resolution
-                    filters.append(
-                        FileMovement.ts < ts + datetime.timedelta(days=1))
-
-    match = re.search(r'[0-9\-]+', transfer_input)
-    if match is not None:
-        transfer_str = match.group(0).replace('-', '')
-        if transfer_str:
-            filters.append(
-                cast(TransferRecord.transfer_id, String).like(
-                    func.concat('%', transfer_str, '%')))
+            self.reco_id = None
 
-    if not filters:
-        return []
+        delta_parsed = parse_amount(delta_input, currency=currency)
+        if delta_parsed is not None:
+            self.delta = AmountCriterion(delta_parsed)
+        else:
+            self.delta = None
+
+        self.currency = None
+        match = re.search(r'[A-Z]+', delta_input, re.I)
+        if match is not None:
+            self.currency = match.group(0).upper()
+
+        self.entry_date = None
+        if entry_date_input:
+            try:
+                parsed = dateutil.parser.parse(entry_date_input).date()
+            except Exception:
+                pass
+            else:
+                self.entry_date = parsed
 
-    if seen_ids:
-        filters.append(~FileMovement.movement_id.in_(seen_ids))
+        self.description = description_input or None
 
-    movement_rows = (
-        start_movement_query(
-            dbsession=dbsession,
-            owner_id=owner_id,
-            file_id=period.file_id)
-        .join(Period, Period.id == FileMovement.period_id)
-        .filter(
-            # Note: don't filter by period_id, otherwise, users won't be able
-            # to reconcile entries across periods.
-            or_(
-                FileMovement.reco_id == null,
-                FileMovement.reco_id == reco_id,
-            ),
-            # Movements assigned to closed periods are not eligible.
-            ~Period.closed,
-            *filters
-        )
-        .order_by(
-            FileMovement.ts,
-            TransferRecord.transfer_id,
-            Movement.number,
-            Movement.amount_index,
-            FileMovement.file_id,
-            FileMovement.issuer_id,
-        )
-        .limit(5)
-        .all())
+        # LIKE wildcards in the description can't be matched in memory.
+        self.cacheable = not re.search(r'[%_\\]', description_input)
 
-    movements_json = serialize_movement_rows(movement_rows)
+    def is_empty(self):
+        return (
+            self.delta is None and
+            self.currency is None and
+            self.entry_date is None and
+            self.description is None)
 
-    return movements_json
+    def get_filters(self):
+        filters = []
+
+        if self.delta is not None:
+            filters.append(self.delta.get_filter(AccountEntry.delta))
+
+        if self.currency is not None:
+            filters.append(
+                AccountEntry.currency.like('%' + self.currency + '%'))
+
+        if self.entry_date is not None:
+            filters.append(AccountEntry.entry_date == self.entry_date)
+
+        if self.description is not None:
+            # The trigram index on description supports ILIKE.
+            filters.append(AccountEntry.description.ilike(
+                '%' + self.description + '%'))
+
+        if self.seen_ids:
+            filters.append(~AccountEntry.id.in_(self.seen_ids))
+
+        return filters
+
+    def matches(self, row):
+        if self.delta is not None and not self.delta.matches(row.delta):
+            return False
+        if self.currency is not None and self.currency not in row.currency:
+            return False
+        if self.entry_date is not None and row.entry_date != self.entry_date:
+            return False
+        if (self.description is not None and
+                self.description.lower() not in row.description.lower()):
+            return False
+        if row.id in self.seen_ids:
+            return False
+        return True
+
+    def narrows(self, other):
+        if not isinstance(other, AccountEntrySearch):
+            return False
+        if self.reco_id != other.reco_id:
+            return False
+        if not self.seen_ids.issuperset(other.seen_ids):
+            return False
+        if other.delta is not None and (
+                self.delta is None or not self.delta.narrows(other.delta)):
+            return False
+        if (other.entry_date is not None and
+                self.entry_date != other.entry_date):
+            return False
+        description = self.description and self.description.lower()
+        other_description = other.description and other.description.lower()
+        return (
+            narrows_substring(self.currency, other.currency) and
+            narrows_substring(description, other_description))
 
 
 @view_config(
@@ -385,93 +619,54 @@ def reco_search_movement(context, request, final=False):
 def reco_search_account_entries(context, request, final=False):
     """Search for account entries that haven't been reconciled."""
     period = context.period
-    params = request.json
-    delta_input = str(params.get('delta', ''))
-    entry_date_input = str(params.get('entry_date', ''))
-    description_input = str(params.get('description', ''))
-    seen_ids = set(int(x) for x in params.get('seen_ids', ()))
-    reco_id_input = params.get('reco_id')
-
-    if reco_id_input:
-        reco_id = int(reco_id_input)
-    else:
-        reco_id = None
+    search = AccountEntrySearch(request.json, currency=period.file.currency)
+
+    if search.is_empty():
+        return []
 
     dbsession = request.dbsession
     owner = request.owner
     owner_id = owner.id
-    filters = []
-
-    delta_parsed = parse_amount(delta_input, currency=period.file.currency)
-    if delta_parsed is not None:
-        delta_abs = abs(delta_parsed)
-
-        sign_filters = ()
-        if delta_parsed.sign < 0:
-            sign_filters = ((AccountEntry.delta < 0),)
-        elif delta_parsed.sign > 0:
-            sign_filters = ((AccountEntry.delta > 0),)
-
-        if '.' in delta_parsed.amount_input:
-            # Exact amount.
-            filters.append(and_(
-                func.abs(AccountEntry.delta) == delta_abs,
-                *sign_filters))
-        else:
-            # The search omitted the subunit value.
-            filters.append(and_(
-                func.abs(AccountEntry.delta) >= delta_abs,
-                func.abs(AccountEntry.delta) < delta_abs + 1,
-                *sign_filters))
-
-    match = re.search(r'[A-Z]+', delta_input, re.I)
-    if match is not None:
-        currency = match.group(0).upper()
-        filters.append(
-            AccountEntry.currency.like(func.concat('%', currency, '%')))
-
-    if entry_date_input:
-        try:
-            parsed = dateutil.parser.parse(entry_date_input).date()
-        except Exception:
-            pass
-        else:
-            if parsed is not None:
-                filters.append(AccountEntry.entry_date == parsed)
-
-    if description_input:
-        filters.append(AccountEntry.description.ilike(
-            func.concat('%', description_input, '%')))
 
-    if not filters:
-        return []
-
-    if seen_ids:
-        filters.append(~AccountEntry.id.in_(seen_ids))
+    def query(row_limit):
+        return (
+            dbsession.query(
+                AccountEntry.id,
+                AccountEntry.entry_date,
+                AccountEntry.loop_id,
+                AccountEntry.currency,
+                AccountEntry.delta,
+                AccountEntry.description,
+            )
+            .join(Period, Period.id == AccountEntry.period_id)
+            .filter(
+                AccountEntry.owner_id == owner_id,
+                # Note: don't filter by period_id, otherwise, users won't be
+                # able to reconcile entries across periods.
+                AccountEntry.file_id == period.file_id,
+                or_(
+                    AccountEntry.reco_id == null,
+                    AccountEntry.reco_id == search.reco_id,
+                ),
+                # Entries assigned to closed periods are not eligible.
+                ~Period.closed,
+                *search.get_filters()
+            )
+            .order_by(
+                AccountEntry.entry_date,
+                AccountEntry.description,
+                AccountEntry.id,
+            )
+            .limit(row_limit)
+            .all())
 
-    rows = (
-        dbsession.query(AccountEntry)
-        .join(Period, Period.id == AccountEntry.period_id)
-        .filter(
-            AccountEntry.owner_id == owner_id,
-            # Note: don't filter by period_id, otherwise, users won't be able
-            # to reconcile entries across periods.
-            AccountEntry.file_id == period.file_id,
-            or_(
-                AccountEntry.reco_id == null,
-                AccountEntry.reco_id == reco_id,
-            ),
-            # Entries assigned to closed periods are not eligible.
-            ~Period.closed,
-            *filters
-        )
-        .order_by(
-            AccountEntry.entry_date,
-            AccountEntry.description,
-            AccountEntry.id,
-        )
-        .limit(5)
-        .all())
+    rows = cached_search(
+        dbsession=dbsession,
+        owner_id=owner_id,
+        file_id=period.file_id,
+        search=search,
+        query=query,
+        limit=5)
 
     entries_json = serialize_account_entry_rows(rows)
 
@@ -520,6 +715,13 @@ class RecoSaveSchema(Schema):
     reco = RecoSchema()
 
 
+class RecoSaveBatchSchema(Schema):
+    recos = SchemaNode(
+        Sequence(),
+        RecoSaveSchema(),
+        validator=Length(min=1, max=1000))
+
+
 # movement_matches_required = (
 #     ('currency', "currency", "currencies"),
 #     ('loop_id', "cash design", "cash designs"),
@@ -527,104 +729,192 @@ class RecoSaveSchema(Schema):
 # )
 
 
-@view_config(
-    name='reco-save',
-    context=PeriodResource,
-    permission=perms.edit_period,
-    renderer='json')
-class RecoSave:
+class RecoSaver:
+    """Validate and save changes to a list of recos.
+
+    Validate all the recos with a few set queries and apply the changes
+    with bulk UPDATE statements, so the number of statements does not
+    depend on the number of recos. Either all the recos are saved or
+    none are.
+    """
+    # batch is true if errors should identify the reco by index.
+    batch = False
+
     def __init__(self, context, request):
         self.period = context.period
         self.request = request
 
-    def __call__(self):
-        """Save changes to a reco."""
-        request = self.request
-        schema = RecoSaveSchema()
-        try:
-            self.params = params = schema.deserialize(request.json)
-        except Invalid as e:
-            handle_invalid(e, schema=schema)
-
-        self.reco_id = params['reco_id']
-        self.reco_type = reco_type = params['reco']['reco_type']
-
-        if reco_type == 'account_only':
-            new_movements = ()
-        else:
-            new_movement_ids = set(
-                m['id'] for m in params['reco']['movements'])
-            new_movements = self.get_new_movements(new_movement_ids)
-
-        if reco_type in ('wallet_only', 'vault_only'):
-            new_account_entries = ()
-        else:
-            new_account_entries = self.get_new_account_entries(
-                params['reco']['account_entries'])
+    def save_recos(self, items):
+        """Save a list of {'reco_id', 'reco'} items.
+
+        Return a list of results in the same order as the items.
+        """
+        recos = []
+        for index, item in enumerate(items):
+            reco_params = item['reco']
+            reco_type = reco_params['reco_type']
+            if reco_type == 'account_only':
+                movement_ids = ()
+            else:
+                movement_ids = sorted(set(
+                    m['id'] for m in reco_params['movements']))
+            if reco_type in ('wallet_only', 'vault_only'):
+                account_entry_ids = ()
+            else:
+                account_entry_ids = [
+                    int(e['id']) for e in reco_params['account_entries']]
+            recos.append({
+                'index': index,
+                'reco_id': item['reco_id'],
+                'params': reco_params,
+                'reco_type': reco_type,
+                'comment': reco_params['comment'],
+                'movement_ids': movement_ids,
+                'account_entry_ids': account_entry_ids,
+            })
 
-        self.check_period_id()
-        reco = self.get_old_reco()  # May set reco == None or raise an error
-        self.check_type_and_balance(
-            new_movements=new_movements,
-            new_account_entries=new_account_entries)
+        self.check_duplicates(recos)
+        self.get_new_movements(recos)
+        self.get_new_account_entries(recos)
+        self.check_period_ids(recos)
+        self.check_old_recos(recos)
+        for reco in recos:
+            self.check_type_and_balance(reco)
 
         # Everything checks out. Save the changes.
 
-        configure_dblog(request, event_type='reco_save')
+        configure_dblog(self.request, event_type='reco_save')
 
-        if self.reco_id is not None:
-            self.remove_old_movements(new_movements=new_movements)
-            self.remove_old_account_entries(
-                new_account_entries=new_account_entries)
-        else:
-            if (not new_movements and not new_account_entries and
-                    not params['reco']['comment']):
+        saving = []
+        for reco in recos:
+            if (reco['reco_id'] is None and not reco['movements'] and
+                    not reco['account_entries'] and not reco['comment']):
                 # This is a new reco with no movements, account entries, or
                 # even a comment. Don't create an empty reco.
-                return {'empty': True}
-
-        reco_id = self.save(
-            reco=reco,
-            new_movements=new_movements,
-            new_account_entries=new_account_entries)
-
-        return {'ok': True, 'reco_id': reco_id}
-
-    def get_new_movements(self, new_movement_ids):
-        if not new_movement_ids:
-            return ()
+                reco['empty'] = True
+            else:
+                reco['empty'] = False
+                saving.append(reco)
+
+        if saving:
+            self.remove_old_movements(saving)
+            self.remove_old_account_entries(saving)
+            self.save(saving)
+
+        return [
+            {'empty': True} if reco['empty']
+            else {'ok': True, 'reco_id': reco['reco_id']}
+            for reco in recos]
+
+    def bad_request(self, reco, error, error_description):
+        json_body = {
+            'error': error,
+            'error_description': error_description,
+        }
+        if self.batch:
+            json_body['reco_index'] = reco['index']
+        raise HTTPBadRequest(json_body=json_body)
+
+    def check_duplicates(self, recos):
+        """Ensure no reco, movement, or entry is included more than once."""
+        reco_ids = set()
+        movement_ids = set()
+        account_entry_ids = set()
+
+        for reco in recos:
+            reco_id = reco['reco_id']
+            if reco_id is not None:
+                if reco_id in reco_ids:
+                    self.bad_request(
+                        reco, 'duplicate_reco_id',
+                        "The reconciliation is included more than once.")
+                reco_ids.add(reco_id)
+
+            if not movement_ids.isdisjoint(reco['movement_ids']):
+                self.bad_request(
+                    reco, 'duplicate_movement_id',
+                    "A movement is included in more than one "
+                    "reconciliation.")
+            movement_ids.update(reco['movement_ids'])
+
+            entry_id_set = set(reco['account_entry_ids'])
+            if len(entry_id_set) != len(reco['account_entry_ids']):
+                self.bad_request(
+                    reco, 'invalid_account_entry_id',
+                    "An account entry is included more than once.")
+            if not account_entry_ids.isdisjoint(entry_id_set):
+                self.bad_request(
+                    reco, 'duplicate_account_entry_id',
+                    "An account entry is included in more than one "
+                    "reconciliation.")
+            account_entry_ids.update(entry_id_set)
+
+    def get_batch_reco_ids(self, recos):
+        """Get the set of reco IDs that items may belong to before saving.
+
+        The set includes None (unreconciled) and the recos being changed.
+        """
+        res = set(reco['reco_id'] for reco in recos)
+        res.add(None)
+        return res
 
+    def get_new_movements(self, recos):
+        """Set reco['movements'] to the eligible movement rows of each reco.
+        """
         request = self.request
         dbsession = request.dbsession
-        owner = request.owner
-        owner_id = owner.id
+        owner_id = request.owner.id
         period = self.period
 
-        new_movements = (
-            dbsession.query(FileMovement)
-            .join(Period, Period.id == FileMovement.period_id)
-            .filter(
-                FileMovement.owner_id == owner_id,
-                FileMovement.movement_id.in_(new_movement_ids),
-                FileMovement.file_id == period.file_id,
-                or_(
-                    FileMovement.reco_id == null,
-                    FileMovement.reco_id == self.reco_id,
-                ),
-                # Movements assigned to closed periods are not eligible.
-                ~Period.closed,
-            )
-            .all())
-
-        if len(new_movements) != len(new_movement_ids):
-            raise HTTPBadRequest(json_body={
-                'error': 'invalid_movement_id',
-                'error_description': (
-                    "One (or more) of the movements specified is not "
-                    "eligible for this reconciliation. Some movements "
-                    "may have been reconciled previously. "
-                    "Try re-syncing with OPN."),
-            })
+        movement_ids = [
+            movement_id
+            for reco in recos
+            for movement_id in reco['movement_ids']]
+
+        if movement_ids:
+            movement_cte = make_array_cte('movement_cte', [
+                ('movement_id', BigInteger, movement_ids),
+            ])
+            rows = (
+                dbsession.query(
+                    FileMovement.movement_id,
+                    FileMovement.reco_id,
+                    FileMovement.wallet_delta,
+                    FileMovement.vault_delta,
+                    FileMovement.period_id,
+                    FileMovement.ts,
+                )
+                .join(
+                    movement_cte,
+                    movement_cte.c.movement_id == FileMovement.movement_id)
+                .join(Period, Period.id == FileMovement.period_id)
+                .filter(
+                    FileMovement.owner_id == owner_id,
+                    FileMovement.file_id == period.file_id,
+                    # Movements assigned to closed periods are not eligible.
+                    ~Period.closed,
+                )
+                .all())
+            row_map = {row.movement_id: row for row in rows}
+        else:
+            row_map = {}
+
+        # Movements can move between recos in the batch.
+        eligible_reco_ids = self.get_batch_reco_ids(recos)
+
+        for reco in recos:
+            movements = []
+            for movement_id in reco['movement_ids']:
+                row = row_map.get(movement_id)
+                if row is None or row.reco_id not in eligible_reco_ids:
+                    self.bad_request(
+                        reco, 'invalid_movement_id',
+                        "One (or more) of the movements specified is not "
+                        "eligible for this reconciliation. Some movements "
+                        "may have been reconciled previously. "
+                        "Try re-syncing with OPN.")
+                movements.append(row)
+            reco['movements'] = movements
 
         # for attr, singular, plural in movement_matches_required:
         #     value_set = set(getattr(m, attr) for m in new_movements)
@@ -637,276 +927,420 @@ class RecoSave:
         #                 % (plural, singular)),
         #         })
 
-        return new_movements
-
-    def get_new_account_entries(self, new_entries):
-        res = []  # [AccountEntry]
-        reusing_ids = []  # [account_entry_id]
-
-        for entry in new_entries:
-            reusing_ids.append(int(entry['id']))
-
-        if reusing_ids:
-            request = self.request
-            dbsession = request.dbsession
-            owner = request.owner
-            owner_id = owner.id
-            period = self.period
+    def get_new_account_entries(self, recos):
+        """Set reco['account_entries'] to the eligible entry rows of each reco.
+        """
+        request = self.request
+        dbsession = request.dbsession
+        owner_id = request.owner.id
+        period = self.period
 
-            reusing_entries = (
-                dbsession.query(AccountEntry)
+        account_entry_ids = [
+            account_entry_id
+            for reco in recos
+            for account_entry_id in reco['account_entry_ids']]
+
+        if account_entry_ids:
+            entry_cte = make_array_cte('entry_cte', [
+                ('account_entry_id', BigInteger, account_entry_ids),
+            ])
+            rows = (
+                dbsession.query(
+                    AccountEntry.id,
+                    AccountEntry.reco_id,
+                    AccountEntry.delta,
+                    AccountEntry.period_id,
+                    AccountEntry.entry_date,
+                )
+                .join(
+                    entry_cte,
+                    entry_cte.c.account_entry_id == AccountEntry.id)
                 .join(Period, Period.id == AccountEntry.period_id)
                 .filter(
                     AccountEntry.owner_id == owner_id,
-                    AccountEntry.id.in_(reusing_ids),
                     AccountEntry.file_id == period.file_id,
-                    or_(
-                        AccountEntry.reco_id == null,
-                        AccountEntry.reco_id == self.reco_id,
-                    ),
                     AccountEntry.delta != zero,
                     # Entries assigned to closed periods are not eligible.
                     ~Period.closed,
                 )
                 .all())
-
-            if len(reusing_entries) != len(reusing_ids):
-                raise HTTPBadRequest(json_body={
-                    'error': 'invalid_account_entry_id',
-                    'error_description': (
+            row_map = {row.id: row for row in rows}
+        else:
+            row_map = {}
+
+        # Entries can move between recos in the batch.
+        eligible_reco_ids = self.get_batch_reco_ids(recos)
+
+        for reco in recos:
+            entries = []
+            for account_entry_id in reco['account_entry_ids']:
+                row = row_map.get(account_entry_id)
+                if row is None or row.reco_id not in eligible_reco_ids:
+                    self.bad_request(
+                        reco, 'invalid_account_entry_id',
                         "One (or more) of the account entries specified "
                         "is not eligible for this reconciliation. "
                         "Some account entries may have been reconciled "
-                        "previously. Try re-syncing with OPN."),
-                })
+                        "previously. Try re-syncing with OPN.")
+                entries.append(row)
+            reco['account_entries'] = entries
 
-            res.extend(reusing_entries)
-
-        return res
-
-    def check_period_id(self):
-        """Raise HTTPBadRequest if the period specified is not valid."""
+    def check_period_ids(self, recos):
+        """Raise HTTPBadRequest if a period specified is not valid."""
         old_period = self.period
-        new_period_id = self.params['reco']['period_id']
-        if new_period_id is None or new_period_id == old_period.id:
+        period_ids = set()
+        for reco in recos:
+            period_id = reco['params']['period_id']
+            if period_id is not None and period_id != old_period.id:
+                period_ids.add(period_id)
+
+        if not period_ids:
             return
 
         request = self.request
         dbsession = request.dbsession
-        owner = request.owner
-        owner_id = owner.id
+        owner_id = request.owner.id
 
-        new_period = (
-            dbsession.query(Period)
+        rows = (
+            dbsession.query(Period.id)
             .filter(
                 Period.owner_id == owner_id,
                 Period.file_id == old_period.file_id,
                 ~Period.closed,
-                Period.id == new_period_id,
+                Period.id.in_(period_ids),
             )
-            .first())
-        if new_period is None:
-            raise HTTPBadRequest(json_body={
-                'error': 'invalid_period_id',
-                'error_description': (
-                    "The selected period is closed or not available."),
-            })
-
-    def get_old_reco(self):
-        reco_id = self.reco_id
-        if reco_id is None:
-            return None
+            .all())
+        valid_period_ids = set(period_id for (period_id,) in rows)
+
+        for reco in recos:
+            period_id = reco['params']['period_id']
+            if period_id in period_ids and period_id not in valid_period_ids:
+                self.bad_request(
+                    reco, 'invalid_period_id',
+                    "The selected period is closed or not available.")
+
+    def check_old_recos(self, recos):
+        """Raise HTTPBadRequest if a reco to change does not exist."""
+        reco_ids = set(
+            reco['reco_id'] for reco in recos if reco['reco_id'] is not None)
+        if not reco_ids:
+            return
 
         request = self.request
         dbsession = request.dbsession
         owner_id = request.owner.id
-        reco = (
-            dbsession.query(Reco)
+
+        rows = (
+            dbsession.query(Reco.id)
             .filter(
                 Reco.owner_id == owner_id,
-                Reco.id == reco_id)
-            .first())
-        if reco is None:
-            raise HTTPBadRequest(json_body={
-                'error': 'reco_not_found',
-                'error_description': "Reconciliation record not found.",
-            })
-
-        return reco
-
-    def check_type_and_balance(self, new_movements, new_account_entries):
-        reco_type = self.reco_type
+                Reco.id.in_(reco_ids))
+            .all())
+        found_reco_ids = set(reco_id for (reco_id,) in rows)
+
+        for reco in recos:
+            reco_id = reco['reco_id']
+            if reco_id is not None and reco_id not in found_reco_ids:
+                self.bad_request(
+                    reco, 'reco_not_found',
+                    "Reconciliation record not found.")
+
+    def check_type_and_balance(self, reco):
+        reco_type = reco['reco_type']
+        new_movements = reco['movements']
+        new_account_entries = reco['account_entries']
         if reco_type == 'standard':
             wallet_sum = sum(m.wallet_delta for m in new_movements)
             vault_sum = sum(m.vault_delta for m in new_movements)
             entries_sum = sum(e.delta for e in new_account_entries)
             if wallet_sum + vault_sum + entries_sum != zero:
-                raise HTTPBadRequest(json_body={
-                    'error': 'unbalanced_reconciliation',
-                    'error_description': "Unbalanced reconciliation. "
+                self.bad_request(
+                    reco, 'unbalanced_reconciliation',
+                    "Unbalanced reconciliation. "
                     "Standard reconciliation requires the sum "
                     "of changes to the wallet, vault, and account to "
                     "equal zero. "
                     "(Computed wallet changes: %s, vault changes: %s, "
                     "account changes: %s)" %
-                    (wallet_sum, vault_sum, entries_sum),
-                })
+                    (wallet_sum, vault_sum, entries_sum))
         elif reco_type == 'wallet_only':
             for m in new_movements:
                 if m.vault_delta:
-                    raise HTTPBadRequest(json_body={
-                        'error': 'wallet_only_excludes_vault',
-                        'error_description': "Wallet In/Out "
+                    self.bad_request(
+                        reco, 'wallet_only_excludes_vault',
+                        "Wallet In/Out "
                         "reconciliation can include wallet changes only, "
-                        "not vault changes.",
-                    })
+                        "not vault changes.")
 
         elif reco_type == 'vault_only':
             for m in new_movements:
                 if m.wallet_delta:
-                    raise HTTPBadRequest(json_body={
-                        'error': 'vault_only_excludes_wallet',
-                        'error_description': "Vault Offset "
+                    self.bad_request(
+                        reco, 'vault_only_excludes_wallet',
+                        "Vault Offset "
                         "reconciliation can include vault changes only, "
-                        "not wallet changes.",
-                    })
-
-        if self.reco_type != 'standard' and not self.params['reco']['comment']:
-            raise HTTPBadRequest(json_body={
-                'error': 'comment_required',
-                'error_description': (
-                    "An explanatory comment is required "
-                    "for nonstandard reconciliation."),
-            })
+                        "not wallet changes.")
+
+        if reco_type != 'standard' and not reco['comment']:
+            self.bad_request(
+                reco, 'comment_required',
+                "An explanatory comment is required "
+                "for nonstandard reconciliation.")
+
+    def remove_old_movements(self, recos):
+        """Remove old movements from the recos."""
+        old_reco_ids = [
+            reco['reco_id'] for reco in recos if reco['reco_id'] is not None]
+        if not old_reco_ids:
+            return
 
-    def remove_old_movements(self, new_movements):
-        """Remove old movements from the reco."""
         request = self.request
         dbsession = request.dbsession
         owner_id = request.owner.id
 
         filters = []
-        if new_movements:
+        movement_ids = [
+            m.movement_id for reco in recos for m in reco['movements']]
+        if movement_ids:
+            movement_cte = make_array_cte('movement_cte', [
+                ('movement_id', BigInteger, movement_ids),
+            ])
             filters.append(~FileMovement.movement_id.in_(
-                m.movement_id for m in new_movements))
+                select([movement_cte.c.movement_id])))
 
-        old_movements = (
+        (
             dbsession.query(FileMovement)
             .filter(
                 FileMovement.owner_id == owner_id,
-                FileMovement.reco_id == self.reco_id,
+                FileMovement.reco_id.in_(old_reco_ids),
                 *filters)
-            .all())
-
-        for m in old_movements:
-            m.reco_id = None
-            m.surplus_delta = -m.wallet_delta
+            .update({
+                'reco_id': None,
+                # Also reset the surplus_delta for each movement.
+                'surplus_delta': -FileMovement.wallet_delta,
+            }, synchronize_session=False))
+
+    def remove_old_account_entries(self, recos):
+        """Remove old account entries from the recos."""
+        old_reco_ids = [
+            reco['reco_id'] for reco in recos if reco['reco_id'] is not None]
+        if not old_reco_ids:
+            return
 
-    def remove_old_account_entries(self, new_account_entries):
-        """Remove old account entries from the reco."""
         request = self.request
         dbsession = request.dbsession
         owner_id = request.owner.id
 
-        new_account_entry_ids = [
-            e.id for e in new_account_entries if e.id is not None]
         filters = []
-        if new_account_entry_ids:
-            filters.append(~AccountEntry.id.in_(new_account_entry_ids))
-
-        old_account_entries = (
+        account_entry_ids = [
+            e.id for reco in recos for e in reco['account_entries']]
+        if account_entry_ids:
+            entry_cte = make_array_cte('entry_cte', [
+                ('account_entry_id', BigInteger, account_entry_ids),
+            ])
+            filters.append(~AccountEntry.id.in_(
+                select([entry_cte.c.account_entry_id])))
+
+        (
             dbsession.query(AccountEntry)
             .filter(
                 AccountEntry.owner_id == owner_id,
-                AccountEntry.reco_id == self.reco_id,
+                AccountEntry.reco_id.in_(old_reco_ids),
                 *filters)
-            .all())
-
-        for e in old_account_entries:
-            e.reco_id = None
-
-    def save(self, reco, new_movements, new_account_entries):
+            .update({
+                'reco_id': None,
+            }, synchronize_session=False))
+
+    def get_reco_period_id(self, reco):
+        """Choose the period of a reco."""
+        period_id = reco['params']['period_id']
+        if period_id is not None:
+            return period_id
+        if reco['account_entries']:
+            # Get the period_id from the first account entry.
+            entry = min(
+                reco['account_entries'], key=lambda x: (x.entry_date, x.id))
+            return entry.period_id
+        if reco['movements']:
+            # Get the period_id from the first movement.
+            movement = min(
+                reco['movements'], key=lambda x: (x.ts, x.movement_id))
+            return movement.period_id
+        return self.period.id
+
+    def save(self, recos):
+        """Add or change the recos and assign the movements and entries."""
         request = self.request
         dbsession = request.dbsession
         owner_id = request.owner.id
-        reco_type = self.reco_type
-        params = self.params
-        internal = (reco_type == 'standard' and not new_account_entries)
-        comment = params['reco']['comment']
-
-        period_id = params['reco']['period_id']
-        if period_id is None:
-            if new_account_entries:
-                # Get the period_id from the first account entry.
-                by_date = sorted(
-                    new_account_entries, key=lambda x: (x.entry_date, x.id))
-                period_id = by_date[0].period_id
-            elif new_movements:
-                # Get the period_id from the first movement.
-                by_ts = sorted(
-                    new_movements, key=lambda x: (x.ts, x.number, x.id))
-                period_id = by_ts[0].period_id
-            else:
-                period_id = self.period.id
 
-        if reco is None:
-            added = True
-            reco = Reco(
-                owner_id=owner_id,
-                reco_type=reco_type,
-                internal=internal,
-                period_id=period_id,
-                comment=comment)
-            dbsession.add(reco)
-            dbsession.flush()  # Assign reco.id
-            reco_id = reco.id
-        else:
-            reco_id = reco.id
-            reco.reco_type = reco_type
-            reco.internal = internal
-            reco.period_id = period_id
-            reco.comment = comment
-            added = False
-
-        for m in new_movements:
-            m.reco_id = reco_id
-            # Reassign the movement to the reco's period.
-            m.period_id = period_id
-            if reco_type == 'wallet_only':
-                # Wallet-only reconciliations should have no effect on
-                # the surplus amount.
-                m.surplus_delta = zero
-            elif reco_type == 'vault_only':
-                # Vault-only reconciliations expect the surplus to change
-                # with the vault.
-                m.surplus_delta = m.vault_delta
-            else:
-                # Other reconciliations expect the surplus to change
-                # inversely to the wallet.
-                m.surplus_delta = -m.wallet_delta
-
-        for entry in new_account_entries:
-            assert entry.id is not None
-            entry.reco_id = reco_id
-            # Reassign the entry to the reco's period
-            entry.period_id = period_id
-
-        dbsession.add(OwnerLog(
-            owner_id=owner_id,
-            personal_id=request.personal_id,
-            event_type='reco_add' if added else 'reco_change',
-            remote_addr=request.remote_addr,
-            user_agent=request.user_agent,
-            content={
-                'reco_id': reco_id,
-                'reco': params['reco'],
-                'internal': internal,
-                'movement_ids': [m.movement_id for m in new_movements],
-                'account_entry_ids': [e.id for e in new_account_entries],
-                'period_id': period_id,
+        for reco in recos:
+            reco['added'] = reco['reco_id'] is None
+            reco['internal'] = (
+                reco['reco_type'] == 'standard' and
+                not reco['account_entries'])
+            reco['period_id'] = self.get_reco_period_id(reco)
+
+        added = [reco for reco in recos if reco['added']]
+        if added:
+            # Allocate the IDs of the new recos, then add them all
+            # in one statement.
+            id_rows = (
+                dbsession.query(
+                    func.nextval(func.pg_get_serial_sequence('reco', 'id')))
+                .select_from(func.generate_series(1, len(added)))
+                .all())
+            for reco, (reco_id,) in zip(added, id_rows):
+                reco['reco_id'] = reco_id
+            dbsession.execute(Reco.__table__.insert().values([{
+                'id': reco['reco_id'],
+                'owner_id': owner_id,
+                'reco_type': reco['reco_type'],
+                'internal': reco['internal'],
+                'period_id': reco['period_id'],
+                'comment': reco['comment'],
+            } for reco in added]))
+
+        changed = [reco for reco in recos if not reco['added']]
+        if changed:
+            reco_cte = make_array_cte('reco_cte', [
+                ('id', BigInteger, [reco['reco_id'] for reco in changed]),
+                ('reco_type', String, [reco['reco_type'] for reco in changed]),
+                ('internal', Boolean, [reco['internal'] for reco in changed]),
+                ('period_id', BigInteger,
+                    [reco['period_id'] for reco in changed]),
+                ('comment', Unicode, [reco['comment'] for reco in changed]),
+            ])
+            (
+                dbsession.query(Reco)
+                .filter(
+                    Reco.owner_id == owner_id,
+                    Reco.id == reco_cte.c.id)
+                .update({
+                    'reco_type': reco_cte.c.reco_type,
+                    'internal': reco_cte.c.internal,
+                    'period_id': reco_cte.c.period_id,
+                    'comment': reco_cte.c.comment,
+                }, synchronize_session=False))
+
+        movement_items = [
+            (m.movement_id, reco)
+            for reco in recos
+            for m in reco['movements']]
+        if movement_items:
+            movement_cte = make_array_cte('movement_cte', [
+                ('movement_id', BigInteger,
+                    [movement_id for (movement_id, reco) in movement_items]),
+                ('reco_id', BigInteger,
+                    [reco['reco_id'] for (mid, reco) in movement_items]),
+                ('period_id', BigInteger,
+                    [reco['period_id'] for (mid, reco) in movement_items]),
+                ('reco_type', String,
+                    [reco['reco_type'] for (mid, reco) in movement_items]),
+            ])
+            (
+                dbsession.query(FileMovement)
+                .filter(
+                    FileMovement.owner_id == owner_id,
+                    FileMovement.file_id == self.period.file_id,
+                    FileMovement.movement_id == movement_cte.c.movement_id)
+                .update({
+                    'reco_id': movement_cte.c.reco_id,
+                    # Reassign the movement to the reco's period.
+                    'period_id': movement_cte.c.period_id,
+                    'surplus_delta': case([
+                        # Wallet-only reconciliations should have no
+                        # effect on the surplus amount.
+                        (movement_cte.c.reco_type == 'wallet_only', zero),
+                        # Vault-only reconciliations expect the surplus
+                        # to change with the vault.
+                        (movement_cte.c.reco_type == 'vault_only',
+                            FileMovement.vault_delta),
+                    ],
+                        # Other reconciliations expect the surplus to
+                        # change inversely to the wallet.
+                        else_=-FileMovement.wallet_delta),
+                }, synchronize_session=False))
+
+        entry_items = [
+            (e.id, reco)
+            for reco in recos
+            for e in reco['account_entries']]
+        if entry_items:
+            entry_cte = make_array_cte('entry_cte', [
+                ('account_entry_id', BigInteger,
+                    [entry_id for (entry_id, reco) in entry_items]),
+                ('reco_id', BigInteger,
+                    [reco['reco_id'] for (eid, reco) in entry_items]),
+                ('period_id', BigInteger,
+                    [reco['period_id'] for (eid, reco) in entry_items]),
+            ])
+            (
+                dbsession.query(AccountEntry)
+                .filter(
+                    AccountEntry.owner_id == owner_id,
+                    AccountEntry.id == entry_cte.c.account_entry_id)
+                .update({
+                    'reco_id': entry_cte.c.reco_id,
+                    # Reassign the entry to the reco's period
+                    'period_id': entry_cte.c.period_id,
+                }, synchronize_session=False))
+
+        dbsession.execute(OwnerLog.__table__.insert().values([{
+            'owner_id': owner_id,
+            'personal_id': request.personal_id,
+            'event_type': 'reco_add' if reco['added'] else 'reco_change',
+            'remote_addr': request.remote_addr,
+            'user_agent': request.user_agent,
+            'content': {
+                'reco_id': reco['reco_id'],
+                'reco': reco['params'],
+                'internal': reco['internal'],
+                'movement_ids': [m.movement_id for m in reco['movements']],
+                'account_entry_ids': [
+                    e.id for e in reco['account_entries']],
+                'period_id': reco['period_id'],
                 'file_id': self.period.file_id,
             },
-        ))
-        dbsession.flush()
+        } for reco in recos]))
+
+
+@view_config(
+    name='reco-save',
+    context=PeriodResource,
+    permission=perms.edit_period,
+    renderer='json')
+class RecoSave(RecoSaver):
+
+    def __call__(self):
+        """Save changes to a reco."""
+        request = self.request
+        schema = RecoSaveSchema()
+        try:
+            params = schema.deserialize(request.json)
+        except Invalid as e:
+            handle_invalid(e, schema=schema)
+
+        [result] = self.save_recos([params])
+        return result
+
+
+@view_config(
+    name='reco-save-batch',
+    context=PeriodResource,
+    permission=perms.edit_period,
+    renderer='json')
+class RecoSaveBatch(RecoSaver):
+    batch = True
+
+    def __call__(self):
+        """Save changes to many recos in one request."""
+        request = self.request
+        schema = RecoSaveBatchSchema()
+        try:
+            params = schema.deserialize(request.json)
+        except Invalid as e:
+            handle_invalid(e, schema=schema)
 
-        return reco_id
+        results = self.save_recos(params['recos'])
+        return {'ok': True, 'results': results}
@@ -6,15 +6,25 @@ from opnreco.models.db import Reco
 from opnreco.models.db import TransferRecord
 from opnreco.models import perms
 from opnreco.models.site import PeriodResource
+from opnreco.render import encode_compact
+from opnreco.streaming import iter_json_list
+from opnreco.streaming import iter_json_object
+from opnreco.streaming import iter_rows
+from opnreco.streaming import make_stream_response
+from opnreco.streaming import stream_requested
 from opnreco.viewcommon import compute_period_totals
 from pyramid.view import view_config
 from sqlalchemy import and_
 from sqlalchemy import func
 from sqlalchemy import or_
 import collections
+import itertools
 
 null = None
 zero = Decimal()
+str_signs = {-1: '-1', 1: '1'}
+
+movement_delta_cols = -(FileMovement.wallet_delta + FileMovement.vault_delta)
 
 
 @view_config(
@@ -24,18 +34,43 @@ zero = Decimal()
     renderer='json')
 def reco_report_api(context, request):
     period_id = context.period.id
-    dbsession = request.dbsession
     owner_id = request.owner.id
 
-    movement_delta_cols = -(
-        FileMovement.wallet_delta + FileMovement.vault_delta)
+    if stream_requested(request):
+        def make_chunks(dbsession, connection):
+            head, outstanding_query = get_reco_report_head(
+                dbsession=dbsession, owner_id=owner_id, period_id=period_id)
+            rows = iter_rows(connection, outstanding_query.statement)
+            return iter_json_object(head, [
+                ('outstanding_map', iter_outstanding_map(rows)),
+            ])
 
-    movement_filter = and_(
-        FileMovement.owner_id == owner_id,
-        FileMovement.period_id == period_id,
-        FileMovement.transfer_record_id == TransferRecord.id,
-        movement_delta_cols != 0,
-    )
+        return make_stream_response(request, make_chunks)
+
+    head, outstanding_query = get_reco_report_head(
+        dbsession=request.dbsession, owner_id=owner_id, period_id=period_id)
+
+    # Create outstanding_map:
+    # {str(sign): {workflow_type: [{transfer_id, delta, ts, id}]}}.
+    outstanding_map = {
+        '-1': {},
+        '1': {},
+    }
+
+    for r in outstanding_query.all():
+        outstanding_map[str_signs[r.sign]].setdefault(
+            r.workflow_type, []).append(serialize_outstanding(r))
+
+    head['outstanding_map'] = outstanding_map
+    return head
+
+
+def get_reco_report_head(dbsession, owner_id, period_id):
+    """Compute the reco report except for the outstanding movements.
+
+    Return (head, outstanding_query).
+    """
+    movement_filter = get_movement_filter(owner_id, period_id)
 
     now = dbsession.query(now_func).scalar()
 
@@ -60,67 +95,39 @@ def reco_report_api(context, request):
             TransferRecord.workflow_type)
         .all())
 
-    str_signs = {-1: '-1', 1: '1'}
-
     # Create workflow_types_pre:
     # {(str(sign), workflow_type): (circ, surplus, combined)}}
     workflow_types_pre = collections.defaultdict(Decimal)
     for r in workflow_type_rows:
-        str_sign = str_signs[r.sign]
-        workflow_type = r.workflow_type
-        workflow_types_pre[(str(r.sign), r.workflow_type)] = (zero, zero, zero)
+        workflow_types_pre[(str(r.sign), r.workflow_type)] = (
+            zero, zero, zero)
 
-    # outstanding_rows lists the unreconciled movements.
-    outstanding_rows = (
+    outstanding_filter = and_(
+        movement_filter,
+        FileMovement.reco_id == null)
+
+    # Add the deltas of the unreconciled movements to workflow_types_pre.
+    # circ_delta is always the negative of vault_delta.
+    outstanding_total_rows = (
         dbsession.query(
             func.sign(movement_delta_cols).label('sign'),
             TransferRecord.workflow_type,
-            TransferRecord.transfer_id,
-            # circ_delta is always the negative of vault_delta.
-            (-FileMovement.vault_delta).label('circ_delta'),
-            FileMovement.surplus_delta,
-            FileMovement.ts,
-            FileMovement.movement_id,
+            func.sum(-FileMovement.vault_delta).label('circ_delta'),
+            func.sum(FileMovement.surplus_delta).label('surplus_delta'),
         )
-        .filter(
-            movement_filter,
-            FileMovement.reco_id == null)
+        .filter(outstanding_filter)
+        .group_by(
+            func.sign(movement_delta_cols),
+            TransferRecord.workflow_type)
         .all())
 
-    # Create outstanding_map:
-    # {str(sign): {workflow_type: [{transfer_id, delta, ts, id}]}}.
-    outstanding_map = {
-        '-1': collections.defaultdict(list),
-        '1': collections.defaultdict(list),
-    }
-
-    for r in outstanding_rows:
-        str_sign = str_signs[r.sign]
-        workflow_type = r.workflow_type
+    for r in outstanding_total_rows:
         circ_delta = r.circ_delta
         surplus_delta = r.surplus_delta
-        combined_delta = circ_delta + surplus_delta
-        outstanding_map[str_sign][workflow_type].append({
-            'transfer_id': r.transfer_id,
-            'circ': str(circ_delta) if circ_delta else '0',
-            'surplus': str(surplus_delta) if surplus_delta else '0',
-            'combined': str(combined_delta) if combined_delta else '0',
-            'ts': r.ts.isoformat() + 'Z',
-            'movement_id': str(r.movement_id),
-        })
-        # Add the deltas to workflow_types_pre.
-        cd0, sd0, td0 = workflow_types_pre[(str_sign, workflow_type)]
-        workflow_types_pre[(str_sign, workflow_type)] = (
-            cd0 + circ_delta,
-            sd0 + surplus_delta,
-            td0 + combined_delta)
-
-    # Convert outstanding_map from defaultdicts to dicts for JSON encoding.
-    for sign, m in list(outstanding_map.items()):
-        outstanding_map[sign] = dict(m)
-        for lst in m.values():
-            # Sort the outstanding list by timestamp.
-            lst.sort(key=lambda x: x['ts'])
+        workflow_types_pre[(str_signs[r.sign], r.workflow_type)] = (
+            circ_delta,
+            surplus_delta,
+            circ_delta + surplus_delta)
 
     # Convert workflow_types to JSON encoding:
     # {str(sign): {workflow_type: {'circ', 'surplus', 'combined'}}}
@@ -141,10 +148,90 @@ def reco_report_api(context, request):
         owner_id=owner_id,
         period_ids=[period_id])[period_id]
 
-    return {
+    outstanding_query = get_outstanding_query(
+        dbsession=dbsession, owner_id=owner_id, period_id=period_id)
+
+    head = {
         'now': now,
         'reconciled_totals': totals['reconciled_total'],
         'outstanding_totals': totals['end'],
         'workflow_types': workflow_types,
-        'outstanding_map': outstanding_map,
     }
+    return head, outstanding_query
+
+
+def get_movement_filter(owner_id, period_id):
+    """Filter the movements in a period that have an effect."""
+    return and_(
+        FileMovement.owner_id == owner_id,
+        FileMovement.period_id == period_id,
+        FileMovement.transfer_record_id == TransferRecord.id,
+        movement_delta_cols != 0,
+    )
+
+
+def get_outstanding_query(dbsession, owner_id, period_id):
+    """Query the unreconciled movements in the order of outstanding_map.
+    """
+    return (
+        dbsession.query(
+            func.sign(movement_delta_cols).label('sign'),
+            TransferRecord.workflow_type,
+            TransferRecord.transfer_id,
+            # circ_delta is always the negative of vault_delta.
+            (-FileMovement.vault_delta).label('circ_delta'),
+            FileMovement.surplus_delta,
+            FileMovement.ts,
+            FileMovement.movement_id,
+        )
+        .filter(
+            get_movement_filter(owner_id, period_id),
+            FileMovement.reco_id == null)
+        .order_by(
+            func.sign(movement_delta_cols),
+            TransferRecord.workflow_type,
+            FileMovement.ts,
+            FileMovement.movement_id,
+        ))
+
+
+def serialize_outstanding(r):
+    """Serialize an unreconciled movement row for outstanding_map."""
+    circ_delta = r.circ_delta
+    surplus_delta = r.surplus_delta
+    combined_delta = circ_delta + surplus_delta
+    return {
+        'transfer_id': r.transfer_id,
+        'circ': str(circ_delta) if circ_delta else '0',
+        'surplus': str(surplus_delta) if surplus_delta else '0',
+        'combined': str(combined_delta) if combined_delta else '0',
+        'ts': r.ts.isoformat() + 'Z',
+        'movement_id': str(r.movement_id),
+    }
+
+
+def iter_outstanding_map(rows):
+    """Encode outstanding_map as JSON bytes.
+
+    The rows must be ordered by sign, workflow_type, and ts.
+    """
+    sign_groups = itertools.groupby(rows, key=lambda r: str_signs[r.sign])
+    group = next(sign_groups, None)
+    yield b'{'
+    for str_sign in ('-1', '1'):
+        if str_sign == '1':
+            yield b','
+        yield encode_compact(str_sign) + b':{'
+        if group is not None and group[0] == str_sign:
+            type_groups = itertools.groupby(
+                group[1], key=lambda r: r.workflow_type)
+            for i, (workflow_type, type_rows) in enumerate(type_groups):
+                if i:
+                    yield b','
+                yield encode_compact(workflow_type) + b':'
+                for chunk in iter_json_list(
+                        serialize_outstanding(r) for r in type_rows):
+                    yield chunk
+            group = next(sign_groups, None)
+        yield b'}'
+    yield b'}'
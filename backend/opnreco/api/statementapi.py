@@ -1,6 +1,7 @@
 
-from defusedxml.common import EntitiesForbidden
 from opnreco.autorecostmt import auto_reco_statement
+from opnreco.blobstore import get_blob_store
+from opnreco.blobstore import get_content_id
 from opnreco.models import perms
 from opnreco.models.db import AccountEntry
 from opnreco.models.db import FileMovement
@@ -12,24 +13,23 @@ from opnreco.models.site import PeriodResource
 from opnreco.param import amount_re
 from opnreco.param import parse_amount
 from opnreco.reassign import reassign_statement_period
+from opnreco.statementparse import get_statement_parser
 from opnreco.viewcommon import configure_dblog
 from opnreco.viewcommon import handle_invalid
 from opnreco.viewcommon import list_assignable_periods
 from pyramid.decorator import reify
 from pyramid.httpexceptions import HTTPBadRequest
+from pyramid.response import FileResponse
 from pyramid.response import Response
 from pyramid.view import view_config
 from sqlalchemy import case
 from sqlalchemy import func
-from xlrd.formula import cellname
-from xlrd.xldate import xldate_as_tuple
 import base64
 import colander
-import datetime
 import dateutil
 import defusedxml
 import logging
-import xlrd
+import os
 
 log = logging.getLogger(__name__)
 
@@ -252,6 +252,32 @@ def statement_download_api(context, request):
             ),
         })
 
+    headers = {
+        'Content-Disposition': 'attachment; filename="%s"' % (
+            statement.filename),
+    }
+    content_type = statement.content_type or 'application/octet-stream'
+
+    if statement.content_sha256:
+        path = get_blob_store().get_path(statement.content_sha256)
+        if not os.path.exists(path):
+            log.error(
+                "Blob %s for statement %s is missing",
+                statement.content_sha256, statement.id)
+            raise HTTPBadRequest(json_body={
+                'error': 'statement_upload_missing',
+                'error_description': (
+                    "The file uploaded for statement %s is not available."
+                    % statement_id
+                ),
+            })
+        # FileResponse streams the file and supports Range requests.
+        response = FileResponse(
+            path, request=request, content_type=content_type)
+        response.etag = statement.content_sha256
+        response.headers.update(headers)
+        return response
+
     content = statement.content
 
     if content is None:
@@ -263,14 +289,10 @@ def statement_download_api(context, request):
             ),
         })
 
-    headers = {
-        'Content-Disposition': 'attachment; filename="%s"' % (
-            statement.filename),
-        'Content-Type': statement.content_type,
-        'Content-Length': '%d' % len(content),
-    }
+    headers['Content-Type'] = content_type
+    headers['Content-Length'] = '%d' % len(content)
 
-    return Response(content, headers=headers)
+    return Response(content, headers=headers, conditional_response=True)
 
 
 class StatementSaveSchema(colander.Schema):
@@ -781,12 +803,9 @@ class StatementUploadSchema(colander.Schema):
     renderer='json')
 class StatementUploadAPI:
     """Upload a statement."""
-    excel_types = (
-        'application/vnd.ms-excel',
-        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-    )
 
-    excel_extensions = ('.xls', '.xlsx')
+    # insert_chunk_size is the number of account entries to add per INSERT.
+    insert_chunk_size = 1000
 
     def __init__(self, context, request):
         self.context = context
@@ -814,10 +833,8 @@ class StatementUploadAPI:
             ext = ''
 
         content_type = appstruct['type'].split(';')[0]
-        if content_type in self.excel_types or ext in self.excel_extensions:
-            self.handle_excel()
-
-        if self.statement is None:
+        parser_class = get_statement_parser(content_type, ext)
+        if parser_class is None:
             raise HTTPBadRequest(json_body={
                 'error': 'file_type_not_supported',
                 'error_description': (
@@ -826,6 +843,11 @@ class StatementUploadAPI:
                 ),
             })
 
+        parser = parser_class(content=self.content, currency=self.currency)
+        parser.open()
+        self.add_statement(parser.source)
+        self.add_account_entries(parser.parse())
+
         # Auto-reconcile the statement to the extent possible.
         configure_dblog(request=request, event_type='statement_auto_reco')
         auto_reco_statement(
@@ -855,11 +877,21 @@ class StatementUploadAPI:
             },
         ))
 
+        self.store_content()
+
         return {'statement': serialize_statement(self.statement)}
 
+    def store_content(self):
+        """Store the uploaded file in the blob store.
+
+        If the transaction is rolled back after this, the blob remains
+        until gc_opnreco_statement_blobs removes it.
+        """
+        get_blob_store().put(self.content)
+
     @reify
     def content(self):
-        return base64.decodestring(self.appstruct['b64'].encode('ascii'))
+        return base64.b64decode(self.appstruct['b64'].encode('ascii'))
 
     def add_statement(self, source):
         appstruct = self.appstruct
@@ -878,6 +910,10 @@ class StatementUploadAPI:
         configure_dblog(
             request=self.request, account_entry_event_type='upload')
 
+        # Identical uploads share a blob. The blob is stored after the
+        # upload has been parsed (see store_content()).
+        content_sha256, content_size = get_content_id(self.content)
+
         statement = Statement(
             owner_id=owner_id,
             period_id=period.id,
@@ -886,7 +922,8 @@ class StatementUploadAPI:
             upload_ts=now_func,
             filename=name,
             content_type=appstruct['type'],
-            content=self.content,
+            content_sha256=content_sha256,
+            content_size=content_size,
         )
         dbsession.add(statement)
         dbsession.flush()  # Assign statement.id
@@ -894,139 +931,39 @@ class StatementUploadAPI:
         self.statement = statement
         return statement
 
-    def handle_excel(self):
-        period = self.context.period
-        file = period.file
-        dbsession = self.request.dbsession
-        owner = self.request.owner
-        owner_id = owner.id
-
-        content = self.content
-        try:
-            book = xlrd.open_workbook(file_contents=content)
-        except EntitiesForbidden:
-            raise HTTPBadRequest(json_body={
-                'error': 'xee_forbidden',
-                'error_description': (
-                    "Please upload a file with no complex XML entities."),
-            })
+    def add_account_entries(self, entries):
+        """Add the entries generated by a parser to the statement.
 
-        statement = self.add_statement("Spreadsheet")
-
-        for sheetx, sheet in enumerate(book.sheets()):
-            # Look for a heading row.
-            # The heading must contain at least "date" and "amount".
-            column_names = None
-            heading_rowx = -1
-            for rowx, row in enumerate(sheet.get_rows()):
-                texts = [str(cell.value).strip().lower() for cell in row]
-                if 'date' in texts and 'amount' in texts:
-                    # Found the heading.
-                    column_names = tuple(texts)
-                    heading_rowx = rowx
-            if not column_names:
-                # No heading row found. Assume default columns.
-                column_names = ('date', 'amount', 'description')
-
-            if 'date' not in column_names or 'amount' not in column_names:
-                # Skip this sheet.
-                continue
-
-            sheet_name = sheet.name.strip() or str(sheetx + 1)
-            if sheet_name.lower().startswith('sheet'):
-                # Remove the redundant word.
-                sheet_name = sheet_name[5:].strip()
-
-            # Parse the sheet and add AccountEntry rows.
-            for rowx, row in enumerate(sheet.get_rows()):
-                if rowx <= heading_rowx:
-                    continue
-
-                attrs = {
-                    'sheet': sheet_name,
-                    'row': rowx + 1,
-                }
-                for colx, cell in enumerate(row):
-                    if not cell.value:
-                        continue
-                    column_name = column_names[colx]
-                    try:
-                        info = self.parse_excel_cell(book, cell, column_name)
-                    except Exception as e:
-                        error_description = (
-                            "Unable to parse %s cell %s on sheet %s. "
-                            "Cell contents: '%s', error: %s, %s" % (
-                                column_name,
-                                cellname(rowx, colx),
-                                sheet_name,
-                                cell.value,
-                                type(e),
-                                e,
-                            ))
-                        log.exception(error_description)
-                        raise HTTPBadRequest(json_body={
-                            'error': 'parse_error',
-                            'error_description': error_description,
-                        })
-                    else:
-                        if info:
-                            k, v = info
-                            attrs[k] = v
-
-                if 'delta' not in attrs or 'entry_date' not in attrs:
-                    # Empty or incomplete row.
-                    continue
-
-                if not attrs['delta']:
-                    # Ignore zero amount rows.
-                    continue
-
-                sign = attrs.pop('sign', None)
-                if sign:
-                    # Force the sign of the amount.
-                    attrs['delta'] = abs(attrs['delta']) * sign
-
-                if not attrs.get('description'):
-                    attrs['description'] = ''
-
-                dbsession.add(AccountEntry(
-                    owner_id=owner_id,
-                    file_id=period.file_id,
-                    period_id=period.id,
-                    statement_id=statement.id,
-                    loop_id='0',
-                    currency=file.currency,
-                    reco_id=None,
-                    **attrs))
-
-    def parse_excel_cell(self, book, cell, column_name):
-        """Return (AccountEntry attr, value) or None.
-
-        Raise an exception in the event of a parse error.
+        Use a single INSERT per chunk of entries.
         """
-        if column_name in ('date', 'entry date', 'entry_date'):
-            if isinstance(cell.value, (int, float)):
-                tup = xldate_as_tuple(cell.value, book.datemode)
-                parsed = datetime.date(*tup[:3])
-            else:
-                parsed = dateutil.parser.parse(
-                    str(cell.value).strip()).date()
-            return 'entry_date', parsed
-
-        if column_name in ('amount', 'delta'):
-            parsed = parse_amount(
-                str(cell.value).strip(), currency=self.currency)
-            return 'delta', parsed
-
-        if column_name in ('description', 'desc'):
-            return 'description', str(cell.value).strip()
-
-        if column_name == 'sign':
-            v = str(cell.value).strip().lower()
-            # Treat it as a liability account: credit = increase.
-            if v in ('+', 'c', 'cr', 'credit', 'deposit'):
-                return 'sign', 1
-            elif v in ('-', 'd', 'dr', 'debit', 'withdrawal'):
-                return 'sign', -1
-
-        return None
+        chunk = []
+        for entry in entries:
+            chunk.append(entry)
+            if len(chunk) >= self.insert_chunk_size:
+                self.insert_account_entries(chunk)
+                chunk = []
+        if chunk:
+            self.insert_account_entries(chunk)
+
+    def insert_account_entries(self, entries):
+        """Add account entries to the statement using a single INSERT."""
+        period = self.context.period
+        common = {
+            'owner_id': self.request.owner.id,
+            'file_id': period.file_id,
+            'period_id': period.id,
+            'statement_id': self.statement.id,
+            'loop_id': '0',
+            'currency': period.file.currency,
+            'reco_id': None,
+        }
+        self.request.dbsession.execute(
+            AccountEntry.__table__.insert().values([
+                dict(
+                    common,
+                    sheet=sheet,
+                    row=row,
+                    entry_date=entry_date,
+                    delta=delta,
+                    description=description,
+                ) for sheet, row, entry_date, delta, description in entries]))
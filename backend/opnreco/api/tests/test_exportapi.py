@@ -0,0 +1,242 @@
+from decimal import Decimal
+from opnreco.testing import add_test_movement
+from opnreco.testing import add_test_owner_file
+from opnreco.testing import DBSessionFixture
+import csv
+import datetime
+import io
+import pyramid.testing
+import unittest
+
+
+def setup_module():
+    global dbsession_fixture
+    dbsession_fixture = DBSessionFixture()
+
+
+def teardown_module():
+    dbsession_fixture.close()
+
+
+class ExportTestBase:
+
+    def setUp(self):
+        self.config = pyramid.testing.setUp()
+        self.dbsession, self.close_session = dbsession_fixture.begin_session()
+
+    def tearDown(self):
+        self.close_session()
+        pyramid.testing.tearDown()
+
+    def _setup(self):
+        from opnreco.models import db
+        from opnreco.models.site import PeriodResource
+        dbsession = self.dbsession
+
+        self.owner = add_test_owner_file(dbsession)
+
+        self.period = period = db.Period(
+            owner_id='102',
+            file_id=1239,
+            start_date=datetime.date(2018, 1, 1),
+            end_date=datetime.date(2018, 1, 31),
+            start_circ=Decimal('100.00'),
+            start_surplus=Decimal(0),
+        )
+        dbsession.add(period)
+        dbsession.flush()
+
+        statement = db.Statement(
+            owner_id='102',
+            file_id=1239,
+            period_id=period.id,
+            source='manual',
+        )
+        dbsession.add(statement)
+
+        self.reco = reco = db.Reco(
+            owner_id='102',
+            period_id=period.id,
+            reco_type='standard',
+            internal=False,
+        )
+        self.internal_reco = internal_reco = db.Reco(
+            owner_id='102',
+            period_id=period.id,
+            reco_type='standard',
+            internal=True,
+        )
+        dbsession.add(reco)
+        dbsession.add(internal_reco)
+        dbsession.flush()
+
+        # (day, workflow_type, vault_delta, reco_id)
+        for number, spec in enumerate((
+                (3, 'redeem', '-5.00', None),
+                (4, 'grant', '2.00', None),
+                (5, 'redeem', '-1.00', reco.id),
+                (6, 'redeem', '-4.00', internal_reco.id),
+                (6, 'redeem', '4.00', internal_reco.id))):
+            day, workflow_type, vault_delta, reco_id = spec
+            add_test_movement(
+                dbsession, period, '65%02d' % number, day,
+                vault_delta=Decimal(vault_delta),
+                workflow_type=workflow_type,
+                reco_id=reco_id)
+
+        dbsession.add(db.AccountEntry(
+            owner_id='102',
+            file_id=1239,
+            period_id=period.id,
+            statement_id=statement.id,
+            entry_date=datetime.date(2018, 1, 7),
+            loop_id='0',
+            currency='USD',
+            delta=Decimal('1.00'),
+            description='ACH',
+            reco_id=reco.id,
+        ))
+        dbsession.flush()
+
+        return PeriodResource(None, str(period.id), period, False)
+
+    def _make_request(self, **params):
+        return pyramid.testing.DummyRequest(
+            dbsession=self.dbsession,
+            owner=self.owner,
+            params=params,
+        )
+
+    def _read(self, response):
+        try:
+            return b''.join(response.app_iter)
+        finally:
+            response.app_iter.close()
+
+    def _read_csv(self, response):
+        self.assertEqual('text/csv', response.content_type)
+        content = self._read(response).decode('utf-8-sig')
+        return list(csv.reader(io.StringIO(content)))
+
+    def _read_xlsx(self, response):
+        import openpyxl
+        content = self._read(response)
+        book = openpyxl.load_workbook(io.BytesIO(content))
+        sheet = book.worksheets[0]
+        return [
+            [cell.value for cell in row] for row in sheet.iter_rows()]
+
+    def _get_table(self, rows, first_title):
+        """Get the rows after the column titles."""
+        for index, row in enumerate(rows):
+            if row and row[0] == first_title:
+                return rows[index + 1:]
+        self.fail("No column titles found")
+
+
+class Test_reco_report_export_api(ExportTestBase, unittest.TestCase):
+
+    def _call(self, *args, **kw):
+        from ..exportapi import reco_report_export_api
+        return reco_report_export_api(*args, **kw)
+
+    def test_csv(self):
+        context = self._setup()
+        response = self._call(context, self._make_request())
+        self.assertEqual(
+            'attachment; filename="reco-report-period-%s.csv"'
+            % self.period.id,
+            response.headers['Content-Disposition'])
+        rows = self._read_csv(response)
+        self.assertEqual(['Reconciliation Report'], rows[0])
+        self.assertEqual(['File', 'Test File'], rows[1])
+        self.assertIn(['Start', '100.00', '0', '100.00'], rows)
+        table = self._get_table(rows, 'Direction')
+        self.assertEqual([
+            ['Decrease', 'grant', '6501', '2018-01-04 06:00:00',
+             '-2.00', '0', '-2.00'],
+            ['Increase', 'redeem', '6500', '2018-01-03 06:00:00',
+             '5.00', '0', '5.00'],
+        ], [row[:-1] for row in table])
+
+    def test_xlsx(self):
+        context = self._setup()
+        response = self._call(context, self._make_request(format='xlsx'))
+        self.assertEqual(
+            'application/vnd.openxmlformats-officedocument.'
+            'spreadsheetml.sheet',
+            response.content_type)
+        self.assertTrue(response.headers['Content-Disposition'].endswith(
+            '.xlsx"'))
+        rows = self._read_xlsx(response)
+        self.assertEqual('Reconciliation Report', rows[0][0])
+        table = self._get_table(rows, 'Direction')
+        self.assertEqual(2, len(table))
+        self.assertEqual(
+            ['Increase', 'redeem', '6500',
+             datetime.datetime(2018, 1, 3, 6, 0, 0), 5, 0, 5],
+            table[1][:-1])
+
+    def test_csv_escapes_formulas(self):
+        context = self._setup()
+        self.period.file.title = '=HYPERLINK("http://example.com")'
+        response = self._call(context, self._make_request())
+        rows = self._read_csv(response)
+        self.assertEqual(
+            ['File', '\'=HYPERLINK("http://example.com")'], rows[1])
+        # Negative amounts are numbers, not formulas.
+        table = self._get_table(rows, 'Direction')
+        self.assertEqual('-2.00', table[0][4])
+
+    def test_xlsx_escapes_formulas(self):
+        context = self._setup()
+        self.period.file.title = '@SUM(1+1)'
+        response = self._call(context, self._make_request(format='xlsx'))
+        rows = self._read_xlsx(response)
+        self.assertEqual(['File', "'@SUM(1+1)"], rows[1][:2])
+        table = self._get_table(rows, 'Direction')
+        self.assertEqual(-2, table[0][4])
+
+    def test_invalid_format(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        context = self._setup()
+        with self.assertRaises(HTTPBadRequest) as cm:
+            self._call(context, self._make_request(format='pdf'))
+        self.assertEqual('invalid_format', cm.exception.json_body['error'])
+
+
+class Test_transactions_export_api(ExportTestBase, unittest.TestCase):
+
+    def _call(self, *args, **kw):
+        from ..exportapi import transactions_export_api
+        return transactions_export_api(*args, **kw)
+
+    def test_csv(self):
+        context = self._setup()
+        response = self._call(context, self._make_request(format='csv'))
+        rows = self._read_csv(response)
+        table = self._get_table(rows, 'Direction')
+        self.assertEqual([
+            ('Increase', str(self.reco.id), 'Movement', '6502'),
+            ('Increase', str(self.reco.id), 'Account Entry', ''),
+            ('Increase', '', 'Movement', '6500'),
+            ('Decrease', '', 'Movement', '6501'),
+        ], [(row[0], row[1], row[2], row[6]) for row in table])
+        self.assertEqual('1.00', table[1][10])
+
+
+class Test_internal_recos_export_api(ExportTestBase, unittest.TestCase):
+
+    def _call(self, *args, **kw):
+        from ..exportapi import internal_recos_export_api
+        return internal_recos_export_api(*args, **kw)
+
+    def test_csv(self):
+        context = self._setup()
+        response = self._call(context, self._make_request())
+        rows = self._read_csv(response)
+        table = self._get_table(rows, 'Reco ID')
+        self.assertEqual([
+            (str(self.internal_reco.id), '6503', '-4.00'),
+            (str(self.internal_reco.id), '6504', '4.00'),
+        ], [(row[0], row[3], row[5]) for row in table])
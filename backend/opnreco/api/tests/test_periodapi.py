@@ -1,6 +1,7 @@
 
 from decimal import Decimal
 from opnreco.testing import DBSessionFixture
+from sqlalchemy import func
 import datetime
 import pyramid.testing
 import unittest
@@ -402,3 +403,488 @@ class Test_detect_date_overlap(unittest.TestCase):
             new_end_date=None)
 
         self.assertIsNone(conflict_row)
+
+    def test_overlap_detection_is_indexed(self):
+        row = self.dbsession.execute(
+            "select 1 from pg_indexes where tablename = 'period' "
+            "and indexname = 'period_date_overlap'").first()
+        self.assertIsNotNone(row)
+
+    def test_database_rejects_overlap(self):
+        from opnreco.models import db
+        from sqlalchemy.exc import IntegrityError
+
+        self.register_periods()
+        period = db.Period(
+            owner_id='102',
+            file_id=1239,
+            start_date=datetime.date(2016, 6, 1),
+            end_date=datetime.date(2017, 6, 30))
+        with self.assertRaises(IntegrityError) as cm:
+            with self.dbsession.begin_nested():
+                self.dbsession.add(period)
+                self.dbsession.flush()
+        self.assertEqual('23P01', cm.exception.orig.pgcode)
+
+    def test_edit_period_reports_concurrent_overlap(self):
+        from opnreco.models import db
+        from pyramid.httpexceptions import HTTPBadRequest
+        from unittest import mock
+
+        self.register_periods()
+        request = pyramid.testing.DummyRequest(
+            dbsession=self.dbsession,
+            owner=self.dbsession.query(db.Owner).get('102'))
+        appstruct = {
+            'start_date': datetime.date(2015, 1, 1),
+            'end_date': datetime.date(2016, 1, 31),
+            'start_circ': zero,
+            'start_surplus': zero,
+            'pull': False,
+            'close': False,
+        }
+
+        from ..periodapi import edit_period
+
+        # Simulate a period added by a concurrent request after the check.
+        with mock.patch(
+                'opnreco.api.periodapi.detect_date_overlap',
+                return_value=None):
+            with self.assertRaises(HTTPBadRequest) as cm:
+                edit_period(
+                    request=request,
+                    period=db.Period(owner_id='102', file_id=1239),
+                    appstruct=appstruct,
+                    event_type='period_add',
+                    adding_period=True)
+        self.assertEqual('date_overlap', cm.exception.json_body['error'])
+
+
+class Test_period_close_batch_api(unittest.TestCase):
+
+    def setUp(self):
+        self.config = pyramid.testing.setUp()
+        self.dbsession, self.close_session = dbsession_fixture.begin_session()
+
+    def tearDown(self):
+        self.close_session()
+        pyramid.testing.tearDown()
+
+    def _call(self, *args, **kw):
+        from ..periodapi import period_close_batch_api
+        return period_close_batch_api(*args, **kw)
+
+    def _make_context_and_request(self):
+        from opnreco.models import db
+        from opnreco.models.site import FileResource
+        dbsession = self.dbsession
+
+        self.owner = owner = db.Owner(
+            id='102',
+            title="Testy Owner",
+            username='testowner',
+            tzname='UTC',
+        )
+        dbsession.add(owner)
+        dbsession.flush()
+
+        self.file = file = db.File(
+            id=1239,
+            owner_id=owner.id,
+            file_type='open_circ',
+            title='Test File',
+            currency='USD',
+            has_vault=True)
+        dbsession.add(file)
+        dbsession.flush()
+
+        request = pyramid.testing.DummyRequest(
+            dbsession=dbsession,
+            owner=owner,
+            personal_id='102',
+        )
+        request.json = {'period_ids': [], 'pull': False}
+        context = FileResource(None, '1239', file)
+        return context, request
+
+    def add_periods(self):
+        from opnreco.models import db
+        dbsession = self.dbsession
+
+        self.jan = db.Period(
+            owner_id='102',
+            file_id=1239,
+            start_date=datetime.date(2018, 1, 1),
+            end_date=datetime.date(2018, 1, 31),
+            start_circ=Decimal('100.00'),
+            start_surplus=Decimal('1.00'),
+        )
+        self.feb = db.Period(
+            owner_id='102',
+            file_id=1239,
+            start_date=datetime.date(2018, 2, 1),
+            end_date=datetime.date(2018, 2, 28),
+            start_circ=zero,
+            start_surplus=zero,
+        )
+        self.mar = db.Period(
+            owner_id='102',
+            file_id=1239,
+            start_date=datetime.date(2018, 3, 1),
+            end_date=datetime.date(2018, 3, 31),
+            start_circ=zero,
+            start_surplus=zero,
+        )
+        self.apr = db.Period(
+            owner_id='102',
+            file_id=1239,
+            start_date=datetime.date(2018, 4, 1),
+            end_date=None,
+            start_circ=zero,
+            start_surplus=zero,
+        )
+        for period in (self.jan, self.feb, self.mar, self.apr):
+            dbsession.add(period)
+        dbsession.flush()
+
+    def add_movement(self, period, transfer_id, ts, amount):
+        from opnreco.models import db
+        dbsession = self.dbsession
+
+        dbsession.query(
+            func.set_config('opnreco.personal_id', '102', True),
+            func.set_config('opnreco.movement.event_type', 'test', True),
+        ).one()
+
+        record = db.TransferRecord(
+            owner_id='102',
+            transfer_id=transfer_id,
+            workflow_type='redeem',
+            start=ts,
+            currency='USD',
+            amount=amount,
+            timestamp=ts,
+            next_activity='completed',
+            completed=True,
+            canceled=False,
+            sender_id='11',
+            sender_uid='wingcash:11',
+            sender_info={'title': "Testy User"},
+            recipient_id='211',
+            recipient_uid='wingcash:211',
+            recipient_info={'title': "My Account"},
+        )
+        dbsession.add(record)
+        dbsession.flush()
+
+        m = db.Movement(
+            owner_id='102',
+            transfer_record_id=record.id,
+            number=1,
+            amount_index=0,
+            loop_id='0',
+            currency='USD',
+            issuer_id='19',
+            from_id='11',
+            to_id='19',
+            amount=amount,
+            action='redeem',
+            ts=ts,
+        )
+        dbsession.add(m)
+        dbsession.flush()
+
+        fm = db.FileMovement(
+            owner_id='102',
+            movement_id=m.id,
+            file_id=1239,
+            peer_id='11',
+            loop_id='0',
+            currency='USD',
+            issuer_id='19',
+            transfer_record_id=record.id,
+            ts=ts,
+            wallet_delta=zero,
+            vault_delta=-amount,
+            period_id=period.id,
+            surplus_delta=zero,
+        )
+        dbsession.add(fm)
+        dbsession.flush()
+        return fm
+
+    def test_close_two_periods(self):
+        context, request = self._make_context_and_request()
+        self.add_periods()
+        fm1 = self.add_movement(
+            self.jan, '501', datetime.datetime(2018, 1, 15),
+            Decimal('5.00'))
+        fm2 = self.add_movement(
+            self.feb, '502', datetime.datetime(2018, 2, 15),
+            Decimal('3.00'))
+        request.json['period_ids'] = [str(self.feb.id), str(self.jan.id)]
+
+        result = self._call(context, request)
+
+        self.assertEqual(
+            [str(self.jan.id), str(self.feb.id)],
+            [p['id'] for p in result['periods']])
+        self.assertEqual(2, result['move_counts']['push_unreco_movements'])
+
+        # The unreconciled movements were pushed to the endless period.
+        self.dbsession.refresh(fm1)
+        self.dbsession.refresh(fm2)
+        self.assertEqual(self.apr.id, fm1.period_id)
+        self.assertEqual(self.apr.id, fm2.period_id)
+
+        # The end balances are chained into the next periods.
+        self.assertTrue(self.jan.closed)
+        self.assertTrue(self.feb.closed)
+        self.assertFalse(self.mar.closed)
+        self.assertEqual(Decimal('100.00'), self.jan.end_circ)
+        self.assertEqual(Decimal('1.00'), self.jan.end_surplus)
+        self.assertEqual(self.jan.end_circ, self.feb.start_circ)
+        self.assertEqual(self.jan.end_surplus, self.feb.start_surplus)
+        self.assertEqual(self.feb.start_circ, self.feb.end_circ)
+        self.assertEqual(self.feb.end_circ, self.mar.start_circ)
+        self.assertEqual(self.feb.end_surplus, self.mar.start_surplus)
+
+    def test_periods_not_consecutive(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        context, request = self._make_context_and_request()
+        self.add_periods()
+        request.json['period_ids'] = [str(self.jan.id), str(self.mar.id)]
+        with self.assertRaises(HTTPBadRequest) as cm:
+            self._call(context, request)
+        self.assertEqual(
+            'periods_not_consecutive', cm.exception.json_body['error'])
+
+    def test_endless_period_requires_dates(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        context, request = self._make_context_and_request()
+        self.add_periods()
+        request.json['period_ids'] = [str(self.mar.id), str(self.apr.id)]
+        with self.assertRaises(HTTPBadRequest) as cm:
+            self._call(context, request)
+        self.assertEqual('dates_required', cm.exception.json_body['error'])
+        self.assertFalse(self.mar.closed)
+
+    def test_reopen_batch(self):
+        from ..periodapi import period_reopen_batch_api
+        context, request = self._make_context_and_request()
+        self.add_periods()
+        request.json['period_ids'] = [str(self.jan.id), str(self.feb.id)]
+        self._call(context, request)
+
+        result = period_reopen_batch_api(context, request)
+        self.assertEqual(2, len(result['periods']))
+        self.assertFalse(self.jan.closed)
+        self.assertFalse(self.feb.closed)
+        self.assertIsNone(self.jan.end_circ)
+
+
+class Test_period_list_api(unittest.TestCase):
+
+    def setUp(self):
+        self.config = pyramid.testing.setUp()
+        self.dbsession, self.close_session = dbsession_fixture.begin_session()
+
+    def tearDown(self):
+        self.close_session()
+        pyramid.testing.tearDown()
+
+    def _call(self, *args, **kw):
+        from ..periodapi import period_list_api
+        return period_list_api(*args, **kw)
+
+    def _make_context_and_request(self, **params):
+        from opnreco.models import db
+        from opnreco.models.site import FileResource
+        dbsession = self.dbsession
+
+        self.owner = owner = db.Owner(
+            id='102',
+            title="Testy Owner",
+            username='testowner',
+            tzname='UTC',
+        )
+        dbsession.add(owner)
+        dbsession.flush()
+
+        self.file = file = db.File(
+            id=1239,
+            owner_id=owner.id,
+            file_type='open_circ',
+            title='Test File',
+            currency='USD',
+            has_vault=True)
+        dbsession.add(file)
+        dbsession.flush()
+
+        request = pyramid.testing.DummyRequest(
+            dbsession=dbsession,
+            owner=owner,
+            personal_id='102',
+            params=params,
+        )
+        context = FileResource(None, '1239', file)
+        return context, request
+
+    def add_periods(self):
+        from opnreco.models import db
+        dbsession = self.dbsession
+
+        self.old = db.Period(
+            owner_id='102',
+            file_id=1239,
+            start_date=None,
+            end_date=datetime.date(2017, 12, 31),
+            start_circ=zero,
+            start_surplus=zero,
+            end_circ=zero,
+            end_surplus=zero,
+        )
+        self.jan = db.Period(
+            owner_id='102',
+            file_id=1239,
+            start_date=datetime.date(2018, 1, 1),
+            end_date=datetime.date(2018, 1, 31),
+            start_circ=zero,
+            start_surplus=zero,
+        )
+        self.feb = db.Period(
+            owner_id='102',
+            file_id=1239,
+            start_date=datetime.date(2018, 2, 1),
+            end_date=datetime.date(2018, 2, 28),
+            start_circ=zero,
+            start_surplus=zero,
+        )
+        for period in (self.old, self.jan, self.feb):
+            dbsession.add(period)
+        dbsession.flush()
+
+        for i in range(2):
+            dbsession.add(db.Statement(
+                owner_id='102',
+                file_id=1239,
+                period_id=str(self.jan.id),
+                source='manual',
+            ))
+        dbsession.flush()
+        self.expire_summary()
+
+    def expire_summary(self):
+        from opnreco.viewcommon import expire_period_summary
+        expire_period_summary(self.dbsession, self.file)
+
+    def test_empty(self):
+        context, request = self._make_context_and_request(
+            offset='0', limit='10')
+        result = self._call(context, request)
+        self.assertEqual({
+            'periods': [],
+            'rowcount': 0,
+            'next_start_date': None,
+            'next_cursor': None,
+        }, result)
+
+    def test_offset_page(self):
+        context, request = self._make_context_and_request(
+            offset='1', limit='10')
+        self.add_periods()
+        result = self._call(context, request)
+        # The period with no start_date sorts first.
+        self.assertEqual(
+            [str(self.feb.id), str(self.jan.id)],
+            [p['id'] for p in result['periods']])
+        self.assertEqual(
+            [0, 2], [p['statement_count'] for p in result['periods']])
+        self.assertEqual(3, result['rowcount'])
+        self.assertEqual(
+            datetime.date(2018, 3, 1), result['next_start_date'])
+        self.assertIsNone(result['next_cursor'])
+
+    def test_cursor_pages(self):
+        context, request = self._make_context_and_request(
+            offset='0', limit='1')
+        self.add_periods()
+
+        ids = []
+        cursors = []
+        for _i in range(5):
+            result = self._call(context, request)
+            ids.extend(p['id'] for p in result['periods'])
+            cursor = result['next_cursor']
+            cursors.append(cursor)
+            if cursor is None:
+                break
+            request.params['cursor'] = cursor
+
+        self.assertEqual(
+            [str(self.old.id), str(self.feb.id), str(self.jan.id)], ids)
+        self.assertEqual(
+            ['unbounded', '2018-02-01', '2018-01-01', None], cursors)
+
+    def test_cursor_and_offset(self):
+        context, request = self._make_context_and_request(
+            offset='1', limit='1', cursor='unbounded')
+        self.add_periods()
+        result = self._call(context, request)
+        self.assertEqual(
+            [str(self.jan.id)], [p['id'] for p in result['periods']])
+        self.assertEqual('2018-01-01', result['next_cursor'])
+        self.assertEqual(3, result['rowcount'])
+
+    def test_invalid_cursor(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        context, request = self._make_context_and_request(
+            offset='0', limit='1', cursor='2018-02-30')
+        with self.assertRaises(HTTPBadRequest) as cm:
+            self._call(context, request)
+        self.assertEqual('invalid_cursor', cm.exception.json_body['error'])
+
+    def test_summary_follows_period_changes(self):
+        context, request = self._make_context_and_request(
+            offset='0', limit='all')
+        self.add_periods()
+        dbsession = self.dbsession
+
+        self.feb.end_date = datetime.date(2018, 2, 27)
+        dbsession.flush()
+        self.expire_summary()
+        result = self._call(context, request)
+        self.assertEqual(3, result['rowcount'])
+        self.assertEqual(
+            datetime.date(2018, 2, 28), result['next_start_date'])
+
+        self.feb.end_date = None
+        dbsession.flush()
+        self.expire_summary()
+        result = self._call(context, request)
+        self.assertIsNone(result['next_start_date'])
+
+        dbsession.delete(self.feb)
+        dbsession.flush()
+        self.expire_summary()
+        result = self._call(context, request)
+        self.assertEqual(2, result['rowcount'])
+        self.assertEqual(
+            datetime.date(2018, 2, 1), result['next_start_date'])
+        self.assertIsNone(result['next_cursor'])
+
+    def test_add_open_period_expires_summary(self):
+        from opnreco.viewcommon import add_open_period
+        context, request = self._make_context_and_request(
+            offset='0', limit='all')
+        self.add_periods()
+        self.assertEqual(3, self.file.period_count)
+
+        add_open_period(
+            request=request, file_id=self.file.id, event_type='test')
+        # The loaded File reflects the change without a refresh.
+        self.assertEqual(4, self.file.period_count)
+        self.assertTrue(self.file.has_endless_period)
+        result = self._call(context, request)
+        self.assertEqual(4, result['rowcount'])
+        self.assertIsNone(result['next_start_date'])
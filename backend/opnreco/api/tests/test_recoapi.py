@@ -0,0 +1,486 @@
+from decimal import Decimal
+from opnreco.testing import add_test_owner_file
+from opnreco.testing import DBSessionFixture
+import datetime
+import pyramid.testing
+import unittest
+
+
+def setup_module():
+    global dbsession_fixture
+    dbsession_fixture = DBSessionFixture()
+
+
+def teardown_module():
+    dbsession_fixture.close()
+
+
+class RecoSaveTestBase:
+
+    def setUp(self):
+        from opnreco import searchcache
+        self.config = pyramid.testing.setUp()
+        self.dbsession, self.close_session = dbsession_fixture.begin_session()
+        searchcache.search_cache.clear()
+
+    def tearDown(self):
+        from opnreco import searchcache
+        self.close_session()
+        pyramid.testing.tearDown()
+        searchcache.search_cache.clear()
+
+    def _setup(self):
+        from opnreco.models import db
+
+        dbsession = self.dbsession
+        self.owner = add_test_owner_file(dbsession)
+
+        self.closed_period = db.Period(
+            owner_id='102',
+            file_id=1239,
+            start_date=datetime.date(2017, 1, 1),
+            end_date=datetime.date(2017, 12, 31),
+            end_circ=Decimal(0),
+            end_surplus=Decimal(0),
+            closed=True,
+        )
+        dbsession.add(self.closed_period)
+
+        self.period = db.Period(
+            owner_id='102',
+            file_id=1239,
+            start_date=datetime.date(2018, 1, 1),
+            end_date=None,
+        )
+        dbsession.add(self.period)
+        dbsession.flush()
+
+        self.statement = db.Statement(
+            owner_id='102',
+            file_id=1239,
+            period_id=self.period.id,
+            source='manual',
+        )
+        dbsession.add(self.statement)
+        dbsession.flush()
+
+        self.movements = [
+            self._add_movement('6502', wallet_delta=Decimal('2.00')),
+            self._add_movement('6510', vault_delta=Decimal('10.00')),
+        ]
+        self.entries = [
+            self._add_entry(Decimal('-2.00')),
+            self._add_entry(Decimal('-10.00')),
+        ]
+
+    def _add_movement(
+            self, transfer_id, wallet_delta=Decimal(0),
+            vault_delta=Decimal(0)):
+        from opnreco.models import db
+        dbsession = self.dbsession
+        amount = wallet_delta + vault_delta
+
+        r = db.TransferRecord(
+            owner_id='102',
+            transfer_id=transfer_id,
+            workflow_type='redeem',
+            start=datetime.datetime(2018, 1, 15, 6, 0, 0),
+            currency='USD',
+            amount=amount,
+            timestamp=datetime.datetime(2018, 1, 15, 6, 0, 1),
+            next_activity='completed',
+            completed=True,
+            canceled=False,
+            sender_id='11',
+            sender_uid='wingcash:11',
+            sender_info={'title': "Testy User"},
+            recipient_id='211',
+            recipient_uid='wingcash:211',
+            recipient_info={'title': "My Account"},
+        )
+        dbsession.add(r)
+        dbsession.flush()
+
+        m = db.Movement(
+            owner_id='102',
+            transfer_record_id=r.id,
+            number=2,
+            amount_index=0,
+            loop_id='0',
+            currency='USD',
+            issuer_id='19',
+            from_id='19',
+            to_id='211',
+            amount=amount,
+            action='deposit',
+            ts=datetime.datetime(2018, 1, 15, 6, 0, 1),
+        )
+        dbsession.add(m)
+        dbsession.flush()
+
+        fm = db.FileMovement(
+            owner_id='102',
+            movement_id=m.id,
+            file_id=1239,
+            peer_id='211',
+            loop_id=m.loop_id,
+            currency=m.currency,
+            issuer_id=m.issuer_id,
+            transfer_record_id=m.transfer_record_id,
+            ts=m.ts,
+            wallet_delta=wallet_delta,
+            vault_delta=vault_delta,
+            period_id=self.period.id,
+            surplus_delta=-wallet_delta,
+        )
+        dbsession.add(fm)
+        dbsession.flush()
+        return fm
+
+    def _add_entry(self, delta):
+        from opnreco.models import db
+
+        e = db.AccountEntry(
+            owner_id='102',
+            file_id=1239,
+            period_id=self.period.id,
+            statement_id=self.statement.id,
+            entry_date=datetime.date(2018, 1, 16),
+            loop_id='0',
+            currency='USD',
+            delta=delta,
+            description='ACH',
+        )
+        self.dbsession.add(e)
+        self.dbsession.flush()
+        return e
+
+    def _make_reco(
+            self, movements=(), entries=(), reco_id=None,
+            reco_type='standard', comment=''):
+        return {
+            'reco_id': reco_id,
+            'reco': {
+                'reco_type': reco_type,
+                'comment': comment,
+                'movements': [{'id': m.movement_id} for m in movements],
+                'account_entries': [{'id': e.id} for e in entries],
+            },
+        }
+
+    def _make_request(self, json):
+        request = pyramid.testing.DummyRequest(
+            dbsession=self.dbsession,
+            owner=self.owner,
+            personal_id='11',
+            remote_addr='127.0.0.1',
+            user_agent='Test UA',
+        )
+        request.json = json
+        return request
+
+    def _refresh(self):
+        self.dbsession.expire_all()
+
+
+class TestRecoSave(RecoSaveTestBase, unittest.TestCase):
+
+    def _call(self, json):
+        from ..recoapi import RecoSave
+        context = pyramid.testing.DummyResource(period=self.period)
+        return RecoSave(context, self._make_request(json))()
+
+    def test_add_reco(self):
+        from opnreco.models import db
+        self._setup()
+        m1, m2 = self.movements
+        e1, e2 = self.entries
+        result = self._call(self._make_reco(movements=[m1], entries=[e1]))
+        self.assertTrue(result['ok'])
+        reco_id = result['reco_id']
+
+        self._refresh()
+        reco = self.dbsession.query(db.Reco).get(reco_id)
+        self.assertEqual('standard', reco.reco_type)
+        self.assertFalse(reco.internal)
+        self.assertEqual(self.period.id, reco.period_id)
+        self.assertEqual(reco_id, m1.reco_id)
+        self.assertEqual(Decimal('-2.00'), m1.surplus_delta)
+        self.assertEqual(reco_id, e1.reco_id)
+        self.assertIsNone(m2.reco_id)
+
+        log = (
+            self.dbsession.query(db.OwnerLog)
+            .filter_by(event_type='reco_add')
+            .one())
+        self.assertEqual(reco_id, log.content['reco_id'])
+        self.assertEqual([m1.movement_id], log.content['movement_ids'])
+
+    def test_change_reco_removes_old_items(self):
+        self._setup()
+        m1, m2 = self.movements
+        e1, e2 = self.entries
+        reco_id = self._call(self._make_reco(
+            movements=[m1], entries=[e1]))['reco_id']
+
+        result = self._call(self._make_reco(
+            reco_id=reco_id, reco_type='wallet_only', movements=[m1],
+            comment='Wallet only'))
+        self.assertEqual({'ok': True, 'reco_id': reco_id}, result)
+
+        self._refresh()
+        self.assertEqual(reco_id, m1.reco_id)
+        self.assertEqual(Decimal('0'), m1.surplus_delta)
+        self.assertIsNone(e1.reco_id)
+
+    def test_empty_new_reco(self):
+        self._setup()
+        self.assertEqual({'empty': True}, self._call(self._make_reco()))
+
+    def test_unbalanced(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        self._setup()
+        m1, m2 = self.movements
+        e1, e2 = self.entries
+        with self.assertRaises(HTTPBadRequest) as cm:
+            self._call(self._make_reco(movements=[m1], entries=[e2]))
+        self.assertEqual(
+            'unbalanced_reconciliation', cm.exception.json_body['error'])
+        self.assertNotIn('reco_index', cm.exception.json_body)
+
+    def test_movement_in_closed_period_is_not_eligible(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        self._setup()
+        m1, m2 = self.movements
+        e1, e2 = self.entries
+        m1.period_id = self.closed_period.id
+        self.dbsession.flush()
+        with self.assertRaises(HTTPBadRequest) as cm:
+            self._call(self._make_reco(movements=[m1], entries=[e1]))
+        self.assertEqual(
+            'invalid_movement_id', cm.exception.json_body['error'])
+
+
+class TestRecoSaveBatch(RecoSaveTestBase, unittest.TestCase):
+
+    def _call(self, recos):
+        from ..recoapi import RecoSaveBatch
+        context = pyramid.testing.DummyResource(period=self.period)
+        return RecoSaveBatch(context, self._make_request({'recos': recos}))()
+
+    def test_add_recos(self):
+        self._setup()
+        m1, m2 = self.movements
+        e1, e2 = self.entries
+        result = self._call([
+            self._make_reco(movements=[m1], entries=[e1]),
+            self._make_reco(),
+            self._make_reco(movements=[m2], entries=[e2]),
+        ])
+        self.assertTrue(result['ok'])
+        r1, r2, r3 = result['results']
+        self.assertEqual({'empty': True}, r2)
+        self.assertNotEqual(r1['reco_id'], r3['reco_id'])
+
+        self._refresh()
+        self.assertEqual(r1['reco_id'], m1.reco_id)
+        self.assertEqual(r1['reco_id'], e1.reco_id)
+        self.assertEqual(r3['reco_id'], m2.reco_id)
+        self.assertEqual(r3['reco_id'], e2.reco_id)
+        self.assertEqual(Decimal('0'), m2.surplus_delta)
+
+    def test_add_and_change_recos(self):
+        self._setup()
+        m1, m2 = self.movements
+        e1, e2 = self.entries
+        [r1, r2] = self._call([
+            self._make_reco(movements=[m1], entries=[e1]),
+            self._make_reco(movements=[m2], entries=[e2]),
+        ])['results']
+
+        # Remove the entry from the first reco and add the second.
+        result = self._call([
+            self._make_reco(
+                reco_id=r1['reco_id'], reco_type='wallet_only',
+                movements=[m1], comment='Moved'),
+            self._make_reco(
+                reco_id=r2['reco_id'], reco_type='account_only',
+                entries=[e1, e2], comment='Entries only'),
+        ])
+        self.assertEqual([r1, r2], result['results'])
+
+        self._refresh()
+        self.assertEqual(r1['reco_id'], m1.reco_id)
+        self.assertIsNone(m2.reco_id)
+        self.assertEqual(-m2.wallet_delta, m2.surplus_delta)
+        self.assertEqual(r2['reco_id'], e1.reco_id)
+        self.assertEqual(r2['reco_id'], e2.reco_id)
+
+    def test_error_identifies_reco(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        self._setup()
+        m1, m2 = self.movements
+        e1, e2 = self.entries
+        with self.assertRaises(HTTPBadRequest) as cm:
+            self._call([
+                self._make_reco(movements=[m1], entries=[e1]),
+                self._make_reco(movements=[m2], entries=[e1]),
+            ])
+        self.assertEqual(
+            'duplicate_account_entry_id', cm.exception.json_body['error'])
+        self.assertEqual(1, cm.exception.json_body['reco_index'])
+
+    def test_reco_not_found(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        self._setup()
+        m1, m2 = self.movements
+        e1, e2 = self.entries
+        with self.assertRaises(HTTPBadRequest) as cm:
+            self._call([
+                self._make_reco(movements=[m1], entries=[e1]),
+                self._make_reco(reco_id=999999, movements=[m2], entries=[e2]),
+            ])
+        self.assertEqual('reco_not_found', cm.exception.json_body['error'])
+        self.assertEqual(1, cm.exception.json_body['reco_index'])
+
+
+class TestRecoSearch(RecoSaveTestBase, unittest.TestCase):
+
+    def _search_movements(self, **params):
+        from ..recoapi import reco_search_movement
+        context = pyramid.testing.DummyResource(period=self.period)
+        return reco_search_movement(context, self._make_request(params))
+
+    def _search_account_entries(self, **params):
+        from ..recoapi import reco_search_account_entries
+        context = pyramid.testing.DummyResource(period=self.period)
+        return reco_search_account_entries(
+            context, self._make_request(params))
+
+    def test_movement_by_transfer_id_substring(self):
+        self._setup()
+        m1, m2 = self.movements
+        result = self._search_movements(transfer='51')
+        self.assertEqual(
+            [str(m2.movement_id)], [item['id'] for item in result])
+
+    def test_movement_by_amount(self):
+        self._setup()
+        m1, m2 = self.movements
+        result = self._search_movements(amount='2.00')
+        self.assertEqual(
+            [str(m1.movement_id)], [item['id'] for item in result])
+        result = self._search_movements(amount='-10')
+        self.assertEqual([], result)
+        result = self._search_movements(amount='10')
+        self.assertEqual(
+            [str(m2.movement_id)], [item['id'] for item in result])
+
+    def test_account_entry_by_description_and_amount(self):
+        self._setup()
+        e1, e2 = self.entries
+        e2.description = 'Deposit T6510'
+        self.dbsession.flush()
+        result = self._search_account_entries(description='t65')
+        self.assertEqual([str(e2.id)], [item['id'] for item in result])
+        result = self._search_account_entries(delta='-2')
+        self.assertEqual([str(e1.id)], [item['id'] for item in result])
+
+    def test_narrowing_movement_search_uses_cached_rows(self):
+        from opnreco import searchcache
+        self._setup()
+        m1, m2 = self.movements
+        result = self._search_movements(amount='10')
+        self.assertEqual(
+            [str(m2.movement_id)], [item['id'] for item in result])
+        entries = searchcache.search_cache[('102', 1239)]
+        self.assertEqual(1, len(entries))
+        result = self._search_movements(amount='10.0')
+        self.assertEqual(
+            [str(m2.movement_id)], [item['id'] for item in result])
+        # The narrower search didn't query the database and add a result.
+        self.assertEqual(1, len(entries))
+
+    def test_movement_change_makes_cached_search_stale(self):
+        self._setup()
+        m1, m2 = self.movements
+        result = self._search_movements(amount='10')
+        self.assertEqual(
+            [str(m2.movement_id)], [item['id'] for item in result])
+        m2.vault_delta = Decimal('10.50')
+        self.dbsession.flush()
+        result = self._search_movements(amount='10.5')
+        self.assertEqual(
+            [str(m2.movement_id)], [item['id'] for item in result])
+        self.assertEqual(Decimal('10.50'), result[0]['vault_delta'])
+
+    def test_period_close_makes_cached_search_stale(self):
+        self._setup()
+        result = self._search_movements(amount='10')
+        self.assertEqual(1, len(result))
+        period = self.period
+        period.start_date = datetime.date(2018, 1, 1)
+        period.end_date = datetime.date(2018, 1, 31)
+        period.end_circ = Decimal('0')
+        period.end_surplus = Decimal('0')
+        period.closed = True
+        self.dbsession.flush()
+        result = self._search_movements(amount='10.0')
+        self.assertEqual([], result)
+
+    def test_account_entry_change_makes_cached_search_stale(self):
+        self._setup()
+        e1, e2 = self.entries
+        result = self._search_account_entries(description='ach')
+        self.assertEqual(2, len(result))
+        self.dbsession.delete(e1)
+        self.dbsession.flush()
+        result = self._search_account_entries(description='ach')
+        self.assertEqual([str(e2.id)], [item['id'] for item in result])
+
+    def test_wider_movement_search_queries_the_database(self):
+        self._setup()
+        m1, m2 = self.movements
+        result = self._search_movements(amount='10.00')
+        self.assertEqual(1, len(result))
+        m2.vault_delta = Decimal('10.50')
+        self.dbsession.flush()
+        result = self._search_movements(amount='10')
+        self.assertEqual(Decimal('10.50'), result[0]['vault_delta'])
+
+    def test_narrowing_movement_search_with_time_zone(self):
+        self._setup()
+        m1, m2 = self.movements
+        result = self._search_movements(date='2018-01-15', tzoffset=0)
+        self.assertEqual(2, len(result))
+        # The narrower search specifies its own time zone, so it can't
+        # be applied to the cached rows without normalizing it to UTC.
+        result = self._search_movements(
+            date='2018-01-15 07:00:01+01:00', tzoffset=300)
+        self.assertEqual(
+            sorted([str(m1.movement_id), str(m2.movement_id)]),
+            sorted(item['id'] for item in result))
+        result = self._search_movements(
+            date='2018-01-15 06:00:02Z', tzoffset=300)
+        self.assertEqual([], result)
+
+    def test_reco_save_invalidates_cached_search(self):
+        self._setup()
+        m1, m2 = self.movements
+        e1, e2 = self.entries
+        result = self._search_movements(amount='2')
+        self.assertEqual(
+            [str(m1.movement_id)], [item['id'] for item in result])
+        from ..recoapi import RecoSave
+        context = pyramid.testing.DummyResource(period=self.period)
+        RecoSave(context, self._make_request(
+            self._make_reco(movements=[m1], entries=[e1])))()
+        result = self._search_movements(amount='2.00')
+        self.assertEqual([], result)
+
+    def test_account_entry_search_with_wildcard_not_cached(self):
+        from opnreco import searchcache
+        self._setup()
+        result = self._search_account_entries(description='%')
+        self.assertEqual(2, len(result))
+        self.assertEqual({}, dict(searchcache.search_cache))
@@ -0,0 +1,131 @@
+from decimal import Decimal
+from opnreco.testing import add_test_movement
+from opnreco.testing import add_test_owner_file
+from opnreco.testing import DBSessionFixture
+import datetime
+import json
+import pyramid.testing
+import unittest
+
+
+def setup_module():
+    global dbsession_fixture
+    dbsession_fixture = DBSessionFixture()
+
+
+def teardown_module():
+    dbsession_fixture.close()
+
+
+class Test_reco_report_api(unittest.TestCase):
+
+    def setUp(self):
+        self.config = pyramid.testing.setUp()
+        self.dbsession, self.close_session = dbsession_fixture.begin_session()
+
+    def tearDown(self):
+        self.close_session()
+        pyramid.testing.tearDown()
+
+    def _call(self, *args, **kw):
+        from ..recoreportapi import reco_report_api
+        return reco_report_api(*args, **kw)
+
+    def _setup(self):
+        from opnreco.models import db
+        from opnreco.models.site import PeriodResource
+        dbsession = self.dbsession
+
+        self.owner = add_test_owner_file(dbsession)
+
+        self.period = period = db.Period(
+            owner_id='102',
+            file_id=1239,
+            start_date=datetime.date(2018, 1, 1),
+            end_date=None,
+            start_circ=Decimal('100.00'),
+            start_surplus=Decimal(0),
+        )
+        dbsession.add(period)
+        dbsession.flush()
+
+        reco = db.Reco(
+            owner_id='102',
+            period_id=period.id,
+            reco_type='standard',
+            internal=False,
+        )
+        dbsession.add(reco)
+        dbsession.flush()
+
+        # (day, workflow_type, vault_delta, wallet_delta, reco_id)
+        for number, spec in enumerate((
+                (9, 'redeem', '-5.00', '0', None),
+                (3, 'redeem', '-1.25', '-0.25', None),
+                (4, 'grant', '-2.00', '0', None),
+                (5, 'redeem', '7.00', '0', None),
+                (6, 'receive_ach', '-3.00', '0', reco.id))):
+            day, workflow_type, vault_delta, wallet_delta, reco_id = spec
+            add_test_movement(
+                dbsession, period, '65%02d' % number, day,
+                vault_delta=Decimal(vault_delta),
+                wallet_delta=Decimal(wallet_delta),
+                workflow_type=workflow_type,
+                reco_id=reco_id)
+
+        return PeriodResource(None, str(period.id), period, False)
+
+    def _make_request(self, **params):
+        return pyramid.testing.DummyRequest(
+            dbsession=self.dbsession,
+            owner=self.owner,
+            params=params,
+        )
+
+    def test_outstanding_map(self):
+        context = self._setup()
+        result = self._call(context, self._make_request())
+        outstanding_map = result['outstanding_map']
+        self.assertEqual(['-1', '1'], sorted(outstanding_map))
+        self.assertEqual(['-7.00'], [
+            x['circ'] for x in outstanding_map['-1']['redeem']])
+        # The outstanding movements are sorted by timestamp.
+        self.assertEqual(['6501', '6500'], [
+            x['transfer_id'] for x in outstanding_map['1']['redeem']])
+        self.assertEqual({
+            'circ': '6.25',
+            'surplus': '0.25',
+            'combined': '6.50',
+        }, result['workflow_types']['1']['redeem'])
+        # Reconciled movements contribute only their workflow type.
+        self.assertEqual({
+            'circ': '0',
+            'surplus': '0',
+            'combined': '0',
+        }, result['workflow_types']['1']['receive_ach'])
+
+    def test_stream_matches_dict(self):
+        from opnreco.render import encode_compact
+        context = self._setup()
+        expect = json.loads(encode_compact(
+            self._call(context, self._make_request())))
+        response = self._call(context, self._make_request(stream='true'))
+        try:
+            actual = json.loads(b''.join(response.app_iter))
+        finally:
+            response.app_iter.close()
+        self.assertEqual(expect, actual)
+
+    def test_stream_without_outstanding(self):
+        from opnreco.models import db
+        context = self._setup()
+        (
+            self.dbsession.query(db.FileMovement)
+            .filter(db.FileMovement.reco_id == None)  # noqa
+            .delete(synchronize_session=False))
+        response = self._call(context, self._make_request(stream='true'))
+        try:
+            actual = json.loads(b''.join(response.app_iter))
+        finally:
+            response.app_iter.close()
+        self.assertEqual({'-1': {}, '1': {}}, actual['outstanding_map'])
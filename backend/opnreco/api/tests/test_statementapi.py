@@ -0,0 +1,477 @@
+
+from decimal import Decimal
+from opnreco.testing import DBSessionFixture
+from sqlalchemy import func
+import base64
+import datetime
+import hashlib
+import io
+import os
+import pyramid.testing
+import shutil
+import tempfile
+import time
+import unittest
+import unittest.mock as mock
+
+
+def setup_module():
+    global dbsession_fixture
+    dbsession_fixture = DBSessionFixture()
+
+
+def teardown_module():
+    dbsession_fixture.close()
+
+
+class StatementTestBase:
+
+    def setUp(self):
+        self.config = pyramid.testing.setUp()
+        self.dbsession, self.close_session = dbsession_fixture.begin_session()
+        self.blob_dir = tempfile.mkdtemp()
+        self.env_patch = mock.patch.dict(
+            os.environ, {'opnreco_blob_dir': self.blob_dir})
+        self.env_patch.start()
+
+    def tearDown(self):
+        self.env_patch.stop()
+        shutil.rmtree(self.blob_dir)
+        self.close_session()
+        pyramid.testing.tearDown()
+
+    def _setup(self):
+        from opnreco.models import db
+
+        dbsession = self.dbsession
+        dbsession.query(
+            func.set_config('opnreco.personal_id', '11', True),
+            func.set_config('opnreco.movement.event_type', 'test', True),
+            func.set_config('opnreco.account_entry.event_type', 'test', True),
+        ).one()
+
+        self.owner = owner = db.Owner(
+            id='102',
+            title="Testy Owner",
+            username='testowner',
+            tzname='UTC',
+        )
+        dbsession.add(owner)
+        dbsession.flush()
+
+        file = db.File(
+            id=1239,
+            owner_id=owner.id,
+            file_type='open_circ',
+            title='Test File',
+            currency='USD',
+            has_vault=True)
+        dbsession.add(file)
+        dbsession.flush()
+
+        self.period = period = db.Period(
+            owner_id=owner.id,
+            file_id=file.id,
+            start_date=datetime.date(2018, 1, 1),
+            end_date=None,
+        )
+        dbsession.add(period)
+        dbsession.flush()
+
+
+class TestStatementUploadAPI(StatementTestBase, unittest.TestCase):
+
+    def _make_xlsx(self, sheets):
+        import openpyxl
+        book = openpyxl.Workbook()
+        book.remove(book.active)
+        for title, rows in sheets:
+            sheet = book.create_sheet(title)
+            for row in rows:
+                sheet.append(row)
+        f = io.BytesIO()
+        book.save(f)
+        return f.getvalue()
+
+    def _call(
+            self, content, name='statement.xlsx', chunk_size=None,
+            content_type=(
+                'application/vnd.openxmlformats-officedocument'
+                '.spreadsheetml.sheet')):
+        from ..statementapi import StatementUploadAPI
+        request = pyramid.testing.DummyRequest(
+            dbsession=self.dbsession,
+            owner=self.owner,
+            personal_id='11',
+            remote_addr='127.0.0.1',
+            user_agent='Test UA',
+        )
+        request.json = {
+            'b64': base64.b64encode(content).decode('ascii'),
+            'name': name,
+            'size': len(content),
+            'type': content_type,
+        }
+        context = pyramid.testing.DummyResource(period=self.period)
+        api = StatementUploadAPI(context, request)
+        if chunk_size is not None:
+            api.insert_chunk_size = chunk_size
+        return api()
+
+    def _get_entries(self, statement_id):
+        from opnreco.models import db
+        return (
+            self.dbsession.query(db.AccountEntry)
+            .filter(db.AccountEntry.statement_id == statement_id)
+            .order_by(db.AccountEntry.sheet, db.AccountEntry.row)
+            .all())
+
+    def test_xlsx_with_heading(self):
+        self._setup()
+        content = self._make_xlsx([
+            ('Sheet1', [
+                ('Bank statement',),
+                (),
+                ('Date', 'Description', 'Amount', 'Sign'),
+                (datetime.datetime(2018, 2, 3), 'Deposit', 12.5, 'CR'),
+                ('2018-02-04', 'Fee', '1.25', 'DR'),
+                (datetime.datetime(2018, 2, 5), 'Nothing', 0, 'DR'),
+                (None, 'Note'),
+            ]),
+        ])
+        result = self._call(content)
+        entries = self._get_entries(int(result['statement']['id']))
+        self.assertEqual([
+            ('1', 4, datetime.date(2018, 2, 3), Decimal('12.50'), 'Deposit'),
+            ('1', 5, datetime.date(2018, 2, 4), Decimal('-1.25'), 'Fee'),
+        ], [(
+            e.sheet, e.row, e.entry_date, e.delta, e.description,
+        ) for e in entries])
+        self.assertEqual('0', entries[0].loop_id)
+        self.assertEqual('USD', entries[0].currency)
+        self.assertEqual(self.period.id, entries[0].period_id)
+
+    def test_xlsx_without_heading_uses_default_columns(self):
+        self._setup()
+        content = self._make_xlsx([
+            ('Deposits', [
+                (datetime.datetime(2018, 2, 3), 12, 'First'),
+                (datetime.datetime(2018, 2, 4), -3, 'Second'),
+            ]),
+        ])
+        result = self._call(content)
+        entries = self._get_entries(int(result['statement']['id']))
+        self.assertEqual([
+            ('Deposits', 1, Decimal('12'), 'First'),
+            ('Deposits', 2, Decimal('-3'), 'Second'),
+        ], [(e.sheet, e.row, e.delta, e.description) for e in entries])
+
+    def test_xlsx_repeated_heading_and_multiple_sheets_in_chunks(self):
+        self._setup()
+        content = self._make_xlsx([
+            ('A', [
+                ('Date', 'Amount'),
+                (datetime.datetime(2018, 2, 3), 1),
+                (datetime.datetime(2018, 2, 4), 2),
+                ('Amount', 'Date'),
+                (3, datetime.datetime(2018, 2, 5)),
+            ]),
+            ('B', [
+                ('date', 'amount', 'desc'),
+                (datetime.datetime(2018, 3, 1), 4, 'Fourth'),
+            ]),
+        ])
+        result = self._call(content, chunk_size=2)
+        entries = self._get_entries(int(result['statement']['id']))
+        self.assertEqual([
+            ('A', 2, datetime.date(2018, 2, 3), Decimal('1')),
+            ('A', 3, datetime.date(2018, 2, 4), Decimal('2')),
+            ('A', 5, datetime.date(2018, 2, 5), Decimal('3')),
+            ('B', 2, datetime.date(2018, 3, 1), Decimal('4')),
+        ], [(e.sheet, e.row, e.entry_date, e.delta) for e in entries])
+
+    def test_xlsx_parse_error(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        self._setup()
+        content = self._make_xlsx([
+            ('Sheet1', [
+                ('Date', 'Amount'),
+                ('not a date', 5),
+            ]),
+        ])
+        with self.assertRaises(HTTPBadRequest) as cm:
+            self._call(content)
+        self.assertEqual('parse_error', cm.exception.json_body['error'])
+        self.assertIn(
+            'cell A2 on sheet 1', cm.exception.json_body['error_description'])
+        # The upload was not stored.
+        self.assertEqual([], list(os.walk(self.blob_dir))[0][1])
+
+    def test_csv_with_heading(self):
+        self._setup()
+        content = (
+            'Account 1234\r\n'
+            'Date,Description,Amount\r\n'
+            '2018-02-03,"Deposit, branch 5",12.50\r\n'
+            '02/04/2018,Cafe,-1.25\r\n'
+            ',,\r\n'
+        ).encode('ascii')
+        result = self._call(
+            content, name='statement.csv',
+            content_type='application/vnd.ms-excel')
+        self.assertEqual('CSV', result['statement']['source'])
+        entries = self._get_entries(int(result['statement']['id']))
+        self.assertEqual([
+            (None, 3, datetime.date(2018, 2, 3), Decimal('12.50'),
+                'Deposit, branch 5'),
+            (None, 4, datetime.date(2018, 2, 4), Decimal('-1.25'),
+                'Cafe'),
+        ], [(
+            e.sheet, e.row, e.entry_date, e.delta, e.description,
+        ) for e in entries])
+
+    def test_csv_with_semicolons_and_no_heading(self):
+        self._setup()
+        content = (
+            '2018-02-03;5.00;First\n'
+            '2018-02-04;-6;Second\n'
+        ).encode('utf-8')
+        result = self._call(
+            content, name='statement.csv', content_type='text/csv',
+            chunk_size=1)
+        entries = self._get_entries(int(result['statement']['id']))
+        self.assertEqual([
+            (1, Decimal('5.00'), 'First'),
+            (2, Decimal('-6.00'), 'Second'),
+        ], [(e.row, e.delta, e.description) for e in entries])
+
+    def test_csv_parse_error(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        self._setup()
+        content = b'date,amount\nyesterday,5\n'
+        with self.assertRaises(HTTPBadRequest) as cm:
+            self._call(content, name='s.csv', content_type='text/csv')
+        self.assertEqual('parse_error', cm.exception.json_body['error'])
+        self.assertIn(
+            'in row 2, column 1', cm.exception.json_body['error_description'])
+
+    def test_ofx_sgml(self):
+        self._setup()
+        content = (
+            'OFXHEADER:100\r\n'
+            'DATA:OFXSGML\r\n'
+            'VERSION:102\r\n'
+            '\r\n'
+            '<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS>\r\n'
+            '<CURDEF>USD\r\n'
+            '<BANKTRANLIST>\r\n'
+            '<STMTTRN><TRNTYPE>CREDIT<DTPOSTED>20180203120000[-5:EST]\r\n'
+            '<TRNAMT>12.50<FITID>1001<NAME>Deposit<MEMO>Branch &amp; ATM\r\n'
+            '</STMTTRN>\r\n'
+            '<STMTTRN><TRNTYPE>DEBIT<DTPOSTED>20180204<TRNAMT>-1,25\r\n'
+            '<FITID>1002<NAME>Fee</STMTTRN>\r\n'
+            '<STMTTRN><TRNTYPE>OTHER<DTPOSTED>20180205<TRNAMT>0.00\r\n'
+            '<FITID>1003<NAME>Nothing</STMTTRN>\r\n'
+            '</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>\r\n'
+        ).encode('ascii')
+        result = self._call(
+            content, name='statement.qfx', content_type='')
+        self.assertEqual('OFX', result['statement']['source'])
+        entries = self._get_entries(int(result['statement']['id']))
+        self.assertEqual([
+            (1, datetime.date(2018, 2, 3), Decimal('12.50'),
+                'Deposit Branch & ATM'),
+            (2, datetime.date(2018, 2, 4), Decimal('-1.25'), 'Fee'),
+        ], [(
+            e.row, e.entry_date, e.delta, e.description,
+        ) for e in entries])
+
+    def test_ofx_xml_currency_mismatch(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        self._setup()
+        content = (
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS>'
+            '<CURDEF>EUR</CURDEF><BANKTRANLIST>'
+            '<STMTTRN><DTPOSTED>20180203</DTPOSTED><TRNAMT>1.00</TRNAMT>'
+            '</STMTTRN></BANKTRANLIST></STMTRS></STMTTRNRS>'
+            '</BANKMSGSRSV1></OFX>'
+        ).encode('utf-8')
+        with self.assertRaises(HTTPBadRequest) as cm:
+            self._call(
+                content, name='statement.ofx',
+                content_type='application/x-ofx')
+        self.assertEqual(
+            'currency_mismatch', cm.exception.json_body['error'])
+
+    def test_unsupported_file_type(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        self._setup()
+        with self.assertRaises(HTTPBadRequest) as cm:
+            self._call(b'%PDF-1.4', name='s.pdf', content_type='text/pdf')
+        self.assertEqual(
+            'file_type_not_supported', cm.exception.json_body['error'])
+
+    def test_upload_stored_in_blob_store(self):
+        from opnreco.models import db
+        self._setup()
+        content = b'date,amount\n2018-02-03,5\n'
+        result = self._call(content, name='s.csv', content_type='text/csv')
+        statement = self.dbsession.query(db.Statement).get(
+            int(result['statement']['id']))
+        sha256 = hashlib.sha256(content).hexdigest()
+        self.assertEqual(sha256, statement.content_sha256)
+        self.assertEqual(len(content), statement.content_size)
+        self.assertIsNone(statement.content)
+        path = os.path.join(self.blob_dir, sha256[:2], sha256[2:4], sha256)
+        with open(path, 'rb') as f:
+            self.assertEqual(content, f.read())
+
+    def test_identical_uploads_share_a_blob(self):
+        from opnreco.models import db
+        self._setup()
+        content = b'date,amount\n2018-02-03,5\n'
+        result1 = self._call(content, name='a.csv', content_type='text/csv')
+        result2 = self._call(content, name='b.csv', content_type='text/csv')
+        statement1 = self.dbsession.query(db.Statement).get(
+            int(result1['statement']['id']))
+        statement2 = self.dbsession.query(db.Statement).get(
+            int(result2['statement']['id']))
+        self.assertNotEqual(statement1.id, statement2.id)
+        self.assertEqual(
+            statement1.content_sha256, statement2.content_sha256)
+        blob_files = [
+            name for _, _, names in os.walk(self.blob_dir)
+            for name in names]
+        self.assertEqual([statement1.content_sha256], blob_files)
+
+
+class Test_statement_download_api(StatementTestBase, unittest.TestCase):
+
+    def _call(self, statement_id):
+        from ..statementapi import statement_download_api
+        request = pyramid.testing.DummyRequest(
+            dbsession=self.dbsession,
+            owner=self.owner,
+            subpath=(str(statement_id),),
+        )
+        context = pyramid.testing.DummyResource(period=self.period)
+        response = statement_download_api(context, request)
+        return request, response
+
+    def _add_statement(self, **kw):
+        from opnreco.models import db
+        statement = db.Statement(
+            owner_id=self.owner.id,
+            file_id=self.period.file_id,
+            period_id=self.period.id,
+            source='Spreadsheet',
+            filename='s.csv',
+            content_type='text/csv',
+            **kw)
+        self.dbsession.add(statement)
+        self.dbsession.flush()
+        return statement
+
+    def test_download_blob(self):
+        from opnreco.blobstore import get_blob_store
+        from webob import Request
+        self._setup()
+        content = b'date,amount\n2018-02-03,5\n'
+        sha256, size = get_blob_store().put(content)
+        statement = self._add_statement(
+            content_sha256=sha256, content_size=size)
+        request, response = self._call(statement.id)
+        self.assertEqual('text/csv', response.content_type)
+        self.assertEqual(len(content), response.content_length)
+        self.assertEqual(
+            'attachment; filename="s.csv"',
+            response.headers['Content-Disposition'])
+        self.assertEqual(content, response.body)
+
+        # Range requests are supported.
+        request, response = self._call(statement.id)
+        range_response = Request.blank(
+            '/', headers={'Range': 'bytes=0-3'}).get_response(response)
+        self.assertEqual(206, range_response.status_int)
+        self.assertEqual(b'date', range_response.body)
+
+    def test_download_legacy_content(self):
+        self._setup()
+        statement = self._add_statement(content=b'abc')
+        request, response = self._call(statement.id)
+        self.assertEqual(b'abc', response.body)
+        self.assertEqual('3', response.headers['Content-Length'])
+
+    def test_download_missing_blob(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        self._setup()
+        statement = self._add_statement(
+            content_sha256='0' * 64, content_size=3)
+        with self.assertRaises(HTTPBadRequest) as cm:
+            self._call(statement.id)
+        self.assertEqual(
+            'statement_upload_missing', cm.exception.json_body['error'])
+
+
+class Test_collect_garbage(StatementTestBase, unittest.TestCase):
+
+    def _call(self, **kw):
+        from opnreco.scripts.gcstatementblobs import collect_garbage
+        from opnreco.blobstore import get_blob_store
+        return collect_garbage(
+            dbsession=self.dbsession, blob_store=get_blob_store(), **kw)
+
+    def _add_statement(self, content):
+        from opnreco.blobstore import get_blob_store
+        from opnreco.models import db
+        sha256, size = get_blob_store().put(content)
+        statement = db.Statement(
+            owner_id=self.owner.id,
+            period_id=self.period.id,
+            file_id=self.period.file_id,
+            source='CSV',
+            content_sha256=sha256,
+            content_size=size,
+        )
+        self.dbsession.add(statement)
+        self.dbsession.flush()
+        return statement
+
+    def test_remove_unused_blobs(self):
+        from opnreco.blobstore import get_blob_store
+        self._setup()
+        statement1 = self._add_statement(b'statement 1')
+        statement2 = self._add_statement(b'statement 2')
+        self._add_statement(b'statement 2')
+        self.dbsession.delete(statement1)
+        self.dbsession.delete(statement2)
+        self.dbsession.flush()
+
+        removed = self._call(max_mtime=time.time() + 1)
+        self.assertEqual(1, removed)
+        store = get_blob_store()
+        self.assertFalse(store.exists(statement1.content_sha256))
+        self.assertTrue(store.exists(statement2.content_sha256))
+
+    def test_keep_recent_blobs(self):
+        from opnreco.blobstore import get_blob_store
+        self._setup()
+        statement = self._add_statement(b'statement 1')
+        self.dbsession.delete(statement)
+        self.dbsession.flush()
+
+        removed = self._call(max_mtime=time.time() - 60)
+        self.assertEqual(0, removed)
+        self.assertTrue(get_blob_store().exists(statement.content_sha256))
+
+    def test_dry_run(self):
+        from opnreco.blobstore import get_blob_store
+        self._setup()
+        statement = self._add_statement(b'statement 1')
+        self.dbsession.delete(statement)
+        self.dbsession.flush()
+
+        removed = self._call(max_mtime=time.time() + 1, dry_run=True)
+        self.assertEqual(1, removed)
+        self.assertTrue(get_blob_store().exists(statement.content_sha256))
@@ -1459,6 +1459,79 @@ class TestSyncAPI(unittest.TestCase):
         mvlog = mvlogs[1]
         self.assertEqual('sync_file_movements', mvlog.event_type)
 
+    def test_bundles_increment_file_versions_once_per_batch(self):
+        from opnreco.viewcommon import get_file_versions
+
+        def _make_transfer_result(transfer_id, **kw):
+            result = {
+                'id': transfer_id,
+                'workflow_type': 'receive_ach_file',
+                'start': '2018-08-01T04:05:06Z',
+                'currency': 'USD',
+                'amount': '1.00',
+                'timestamp': '2018-08-01T04:05:08Z',
+                'next_activity': 'completed',
+                'completed': True,
+                'canceled': False,
+                'sender_id': '11',
+                'sender_uid': 'wingcash:11',
+                'sender_info': {
+                    'title': "Tester",
+                },
+                'recipient_id': '1102',
+                'recipient_uid': 'wingcash:1102',
+                'recipient_info': {
+                    'title': "Acct",
+                },
+                'movements': [],
+            }
+            result.update(kw)
+            return result
+
+        def _sync(results):
+            with responses.RequestsMock() as rsps:
+                rsps.add(
+                    responses.POST,
+                    'https://opn.example.com:9999/wallet/history_sync',
+                    json={
+                        'results': results,
+                        'more': False,
+                        'first_sync_ts': '2018-08-01T04:05:10Z',
+                        'last_sync_ts': '2018-08-01T04:05:11Z',
+                    })
+                obj()
+
+        obj = self._make()
+        bundled_transfers = [{
+            'transfer_id': '600',
+            'currency': 'USD',
+            'loop_id': '0',
+            'issuer_id': '19',
+            'amount': '1.00',
+        }]
+
+        # Two bundles in one batch increment the versions once.
+        _sync([
+            _make_transfer_result(
+                '500', bundled_transfers=bundled_transfers),
+            _make_transfer_result(
+                '501', bundled_transfers=bundled_transfers),
+        ])
+        self.assertEqual((1, 0), get_file_versions(self.dbsession, 1239))
+
+        # Changes that don't affect bundles don't increment the versions.
+        _sync([
+            _make_transfer_result(
+                '500', bundled_transfers=bundled_transfers,
+                next_activity='someactivity'),
+            _make_transfer_result('502'),
+        ])
+        self.assertEqual((1, 0), get_file_versions(self.dbsession, 1239))
+
+        # Changing a bundle increments the versions.
+        _sync([_make_transfer_result('501', bundled_transfers=[])])
+        self.assertEqual((2, 0), get_file_versions(self.dbsession, 1239))
+
     @responses.activate
     def test_closed_loop_send_design(self):
         # Reconcile closed loop cash for the distributor (profile 12).
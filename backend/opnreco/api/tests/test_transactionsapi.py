@@ -0,0 +1,157 @@
+from decimal import Decimal
+from opnreco.testing import add_test_movement
+from opnreco.testing import add_test_owner_file
+from opnreco.testing import DBSessionFixture
+import datetime
+import json
+import pyramid.testing
+import unittest
+
+
+def setup_module():
+    global dbsession_fixture
+    dbsession_fixture = DBSessionFixture()
+
+
+def teardown_module():
+    dbsession_fixture.close()
+
+
+class Test_transactions_api(unittest.TestCase):
+
+    def setUp(self):
+        self.config = pyramid.testing.setUp()
+        self.dbsession, self.close_session = dbsession_fixture.begin_session()
+
+    def tearDown(self):
+        self.close_session()
+        pyramid.testing.tearDown()
+
+    def _call(self, *args, **kw):
+        from ..transactionsapi import transactions_api
+        return transactions_api(*args, **kw)
+
+    def _setup(self):
+        from opnreco.models import db
+        from opnreco.models.site import PeriodResource
+        dbsession = self.dbsession
+
+        self.owner = add_test_owner_file(dbsession)
+
+        self.period = period = db.Period(
+            owner_id='102',
+            file_id=1239,
+            start_date=datetime.date(2018, 1, 1),
+            end_date=None,
+        )
+        dbsession.add(period)
+        dbsession.flush()
+
+        self.statement = db.Statement(
+            owner_id='102',
+            file_id=1239,
+            period_id=period.id,
+            source='manual',
+        )
+        dbsession.add(self.statement)
+        dbsession.flush()
+
+        reco = db.Reco(
+            owner_id='102',
+            period_id=period.id,
+            reco_type='standard',
+            internal=False,
+        )
+        dbsession.add(reco)
+        dbsession.flush()
+
+        for day, transfer_id, vault_delta, reco_id in (
+                (3, '6503', '-5.00', None),
+                (4, '6504', '7.25', None),
+                (5, '6505', '-1.00', reco.id),
+                (6, '6506', '2.00', None)):
+            add_test_movement(
+                dbsession, period, transfer_id, day,
+                vault_delta=Decimal(vault_delta),
+                reco_id=reco_id)
+
+        for day, delta, reco_id in (
+                (7, '1.00', reco.id),
+                (8, '-3.50', None),
+                (9, '4.00', None)):
+            dbsession.add(db.AccountEntry(
+                owner_id='102',
+                file_id=1239,
+                period_id=period.id,
+                statement_id=self.statement.id,
+                entry_date=datetime.date(2018, 1, day),
+                loop_id='0',
+                currency='USD',
+                delta=Decimal(delta),
+                description='ACH',
+                reco_id=reco_id,
+            ))
+        dbsession.flush()
+
+        return PeriodResource(None, str(period.id), period, False)
+
+    def _make_request(self, **params):
+        return pyramid.testing.DummyRequest(
+            dbsession=self.dbsession,
+            owner=self.owner,
+            params=params,
+        )
+
+    def _encode(self, value):
+        from opnreco.render import encode_compact
+        return json.loads(encode_compact(value))
+
+    def _read_stream(self, response):
+        try:
+            return json.loads(b''.join(response.app_iter))
+        finally:
+            response.app_iter.close()
+
+    def test_page(self):
+        context = self._setup()
+        result = self._call(context, self._make_request(offset='0', limit='3'))
+        self.assertEqual(6, result['rowcount'])
+        self.assertFalse(result['all_shown'])
+        # The page contains the reco and the account entries.
+        inc_records = result['inc_records']
+        self.assertEqual(2, len(inc_records))
+        self.assertEqual(['6505'], [
+            m['transfer_id'] for m in inc_records[0]['movements']])
+        self.assertEqual(
+            ['1.00'],
+            [str(e['account_delta'])
+             for e in inc_records[0]['account_entries']])
+        self.assertEqual(1, len(result['dec_records']))
+
+    def test_stream_matches_list(self):
+        from opnreco import streaming
+        context = self._setup()
+        expect = self._encode(self._call(
+            context, self._make_request(offset='0', limit='all')))
+        self.assertTrue(expect['all_shown'])
+        self.assertEqual(3, len(expect['inc_records']))
+        self.assertEqual(3, len(expect['dec_records']))
+
+        # Fetch one row at a time to exercise the batching.
+        fetch_size = streaming.fetch_size
+        streaming.fetch_size = 1
+        try:
+            response = self._call(context, self._make_request(
+                offset='0', limit='all', stream='true'))
+            self.assertEqual('application/json', response.content_type)
+            actual = self._read_stream(response)
+        finally:
+            streaming.fetch_size = fetch_size
+
+        self.assertEqual(expect, actual)
+
+    def test_stream_ignored_when_paging(self):
+        context = self._setup()
+        result = self._call(context, self._make_request(
+            offset='0', limit='3', stream='true'))
+        self.assertIsInstance(result, dict)
@@ -0,0 +1,593 @@
+
+from decimal import Decimal
+from opnreco.testing import DBSessionFixture
+from sqlalchemy import func
+import datetime
+import os
+import pyramid.testing
+import responses
+import unittest
+
+history_sync_url = 'https://opn.example.com:9999/wallet/history_sync'
+
+
+def setup_module():
+    global dbsession_fixture
+    dbsession_fixture = DBSessionFixture()
+
+
+def teardown_module():
+    dbsession_fixture.close()
+
+
+def make_transfer_json(transfer_id, timestamp):
+    return {
+        'id': transfer_id,
+        'workflow_type': 'redeem',
+        'start': '2018-08-01T04:05:06Z',
+        'currency': 'USD',
+        'amount': '1.25',
+        'timestamp': timestamp,
+        'next_activity': 'completed',
+        'completed': True,
+        'canceled': False,
+        'sender_id': '11',
+        'sender_uid': 'wingcash:11',
+        'sender_info': {'title': "Tester"},
+        'recipient_id': '1102',
+        'recipient_uid': 'wingcash:1102',
+        'recipient_info': {'title': "Acct"},
+        'movements': [],
+    }
+
+
+class TestVerifyAPI(unittest.TestCase):
+
+    def setUp(self):
+        os.environ['opn_api_url'] = 'https://opn.example.com:9999'
+        self.config = pyramid.testing.setUp()
+        self.dbsession, self.close_session = dbsession_fixture.begin_session()
+
+    def tearDown(self):
+        self.close_session()
+        pyramid.testing.tearDown()
+
+    @property
+    def _class(self):
+        from ..verifyapi import VerifyAPI
+        return VerifyAPI
+
+    def _setup_owner(self):
+        from opnreco.models import db
+
+        self.owner = owner = db.Owner(
+            id='11',
+            title="Test Profile",
+            username='testy',
+        )
+        self.dbsession.add(owner)
+        self.dbsession.flush()
+
+        for transfer_id, timestamp in (
+                ('500', datetime.datetime(2018, 8, 1, 4, 5, 8)),
+                ('501', datetime.datetime(2018, 8, 3, 4, 5, 8))):
+            self.dbsession.add(db.TransferRecord(
+                owner_id='11',
+                transfer_id=transfer_id,
+                workflow_type='redeem',
+                start=datetime.datetime(2018, 8, 1, 4, 5, 6),
+                currency='USD',
+                amount=Decimal('1.25'),
+                timestamp=timestamp,
+                next_activity='completed',
+                completed=True,
+                canceled=False,
+                sender_id='11',
+                sender_uid='wingcash:11',
+                sender_info={'title': "Tester"},
+                recipient_id='1102',
+                recipient_uid='wingcash:1102',
+                recipient_info={'title': "Acct"},
+            ))
+        self.dbsession.flush()
+
+    def _call(self, verification_id=None, incremental=False, **kw):
+        request = pyramid.testing.DummyRequest(
+            dbsession=self.dbsession,
+            owner=self.owner,
+            personal_id='12',
+            access_token='example-token',
+        )
+        request.json = {
+            'verification_id': verification_id,
+            'verify_sync': True,
+            'incremental': incremental,
+        }
+        request.json.update(kw)
+        return self._class(request)()
+
+    def _add_batch(self, transfers, more=False, remain=0, last_sync_ts=None):
+        if last_sync_ts is None and transfers:
+            last_sync_ts = transfers[-1]['timestamp']
+        responses.add(
+            responses.POST,
+            history_sync_url,
+            json={
+                'results': transfers,
+                'more': more,
+                'remain': remain,
+                'first_sync_ts': (
+                    transfers[0]['timestamp'] if transfers else None),
+                'last_sync_ts': last_sync_ts,
+            })
+
+    @responses.activate
+    def test_full_verify_records_watermark(self):
+        self._setup_owner()
+        self._add_batch([
+            make_transfer_json('500', '2018-08-01T04:05:08Z'),
+            make_transfer_json('501', '2018-08-03T04:05:08Z'),
+        ])
+        result = self._call()
+        self.assertFalse(result['more'])
+        self.assertFalse(result['incremental'])
+        self.assertEqual(0, result['change_count'])
+        self.assertEqual(
+            datetime.datetime(2018, 8, 3, 4, 5, 8),
+            self.owner.verified_sync_ts)
+        self.assertEqual('501', self.owner.verified_sync_transfer_id)
+
+    @responses.activate
+    def test_full_verify_missing_transfer(self):
+        from pyramid.httpexceptions import HTTPInsufficientStorage
+        self._setup_owner()
+        self._add_batch([
+            make_transfer_json('501', '2018-08-03T04:05:08Z'),
+        ])
+        with self.assertRaises(HTTPInsufficientStorage) as cm:
+            self._call()
+        self.assertIn(
+            'Verification failure in transfer 500',
+            cm.exception.json_body['error_description'])
+        self.assertIsNone(self.owner.verified_sync_ts)
+
+    @responses.activate
+    def test_full_verify_across_batches(self):
+        from opnreco.models import db
+        from pyramid.httpexceptions import HTTPInsufficientStorage
+        self._setup_owner()
+        self.dbsession.add(db.TransferRecord(
+            owner_id='11',
+            transfer_id='499',
+            workflow_type='redeem',
+            start=datetime.datetime(2018, 7, 1),
+            currency='USD',
+            amount=Decimal('1.00'),
+            timestamp=datetime.datetime(2018, 7, 1),
+            next_activity='completed',
+            completed=True,
+            canceled=False,
+        ))
+        self.dbsession.flush()
+
+        self._add_batch([
+            make_transfer_json('500', '2018-08-01T04:05:08Z'),
+        ], more=True, remain=1)
+        self._add_batch([
+            make_transfer_json('502', '2018-08-04T04:05:08Z'),
+        ])
+
+        result = self._call()
+        self.assertTrue(result['more'])
+        with self.assertRaises(HTTPInsufficientStorage) as cm:
+            self._call(verification_id=result['verification_id'])
+        self.assertIn(
+            'Verification failure in transfer 499',
+            cm.exception.json_body['error_description'])
+        self.assertIn(
+            'Total missing transfers: 2',
+            cm.exception.json_body['error_description'])
+
+    @responses.activate
+    def test_incremental_verify(self):
+        self._setup_owner()
+        self.owner.verified_sync_ts = datetime.datetime(2018, 8, 2)
+        self.owner.verified_sync_transfer_id = '499'
+
+        # The changed transfers.
+        self._add_batch([
+            make_transfer_json('501', '2018-08-03T04:05:08Z'),
+        ])
+        # The sample of older transfers.
+        self._add_batch([
+            make_transfer_json('500', '2018-08-01T04:05:08Z'),
+        ], more=False)
+
+        result = self._call(incremental=True)
+        self.assertTrue(result['more'])
+        self.assertTrue(result['incremental'])
+
+        request_body = responses.calls[0].request.body
+        self.assertIn('sync_ts=2018-08-02T00%3A00%3A00Z', request_body)
+        self.assertIn('transfer_id=499', request_body)
+
+        result = self._call(
+            verification_id=result['verification_id'], incremental=True)
+        self.assertFalse(result['more'])
+        self.assertEqual(100, result['progress_percent'])
+
+        request_body = responses.calls[1].request.body
+        self.assertIn('sync_ts=1970-01-01T00%3A00%3A00Z', request_body)
+
+        self.assertEqual(
+            datetime.datetime(2018, 8, 3, 4, 5, 8),
+            self.owner.verified_sync_ts)
+        # The sample reached the end, so it starts over next time.
+        self.assertIsNone(self.owner.verify_sample_ts)
+
+    @responses.activate
+    def test_incremental_verify_missing_changed_transfer(self):
+        from pyramid.httpexceptions import HTTPInsufficientStorage
+        self._setup_owner()
+        self.owner.verified_sync_ts = datetime.datetime(2018, 8, 2)
+        self.owner.verified_sync_transfer_id = '499'
+
+        # Transfer 501 is missing.
+        self._add_batch([])
+        self._add_batch([
+            make_transfer_json('500', '2018-08-01T04:05:08Z'),
+        ], more=False)
+
+        result = self._call(incremental=True)
+        self.assertTrue(result['more'])
+
+        with self.assertRaises(HTTPInsufficientStorage) as cm:
+            self._call(
+                verification_id=result['verification_id'],
+                incremental=True)
+        self.assertIn(
+            'Verification failure in transfer 501',
+            cm.exception.json_body['error_description'])
+
+    @responses.activate
+    def test_incremental_verify_resumes_sample(self):
+        from opnreco.api import verifyapi
+        self._setup_owner()
+        self.owner.verified_sync_ts = datetime.datetime(2018, 8, 2)
+        self.owner.verified_sync_transfer_id = '499'
+
+        self._add_batch([
+            make_transfer_json('501', '2018-08-03T04:05:08Z'),
+        ])
+        self._add_batch([
+            make_transfer_json('500', '2018-08-01T04:05:08Z'),
+        ], more=True)
+
+        original_sample_size = verifyapi.VerifyAPI.sample_size
+        verifyapi.VerifyAPI.sample_size = 1
+        try:
+            result = self._call(incremental=True)
+            result = self._call(
+                verification_id=result['verification_id'],
+                incremental=True)
+        finally:
+            verifyapi.VerifyAPI.sample_size = original_sample_size
+
+        self.assertFalse(result['more'])
+        self.assertEqual(
+            datetime.datetime(2018, 8, 1, 4, 5, 8),
+            self.owner.verify_sample_ts)
+        self.assertEqual('500', self.owner.verify_sample_transfer_id)
+
+    @responses.activate
+    def test_sharded_verify(self):
+        self._setup_owner()
+        result = self._call(shards=2)
+        self.assertTrue(result['more'])
+        self.assertEqual(2, result['shard_count'])
+        self.assertEqual(2, result['sync_total'])
+        verification_id = result['verification_id']
+
+        # OPN returns transfers past the end of the first shard.
+        # The shard keeps the whole batch.
+        self._add_batch([
+            make_transfer_json('500', '2018-08-01T04:05:08Z'),
+            make_transfer_json('501', '2018-08-03T04:05:08Z'),
+        ], more=True)
+        result = self._call(verification_id, shard=0)
+        self.assertFalse(result['more'])
+        self.assertEqual(2, result['sync_done'])
+        self.assertEqual(1, result['sync_total'])
+
+        self._add_batch([
+            make_transfer_json('501', '2018-08-03T04:05:08Z'),
+        ])
+        result = self._call(verification_id, shard=1)
+        self.assertFalse(result['more'])
+        self.assertEqual(1, result['sync_done'])
+
+        result = self._call(verification_id)
+        self.assertFalse(result['more'])
+        self.assertEqual(100, result['progress_percent'])
+        self.assertEqual(3, result['sync_done'])
+        self.assertEqual(
+            datetime.datetime(2018, 8, 3, 4, 5, 8),
+            self.owner.verified_sync_ts)
+        self.assertEqual('501', self.owner.verified_sync_transfer_id)
+
+    @responses.activate
+    def test_sharded_verify_follows_sync_cursor(self):
+        import urllib.parse
+        self._setup_owner()
+        verification_id = self._call(shards=2)['verification_id']
+
+        # The timestamp of 501 is after the end of the first shard,
+        # but its sync timestamp is not, so the shard continues.
+        self._add_batch([
+            make_transfer_json('501', '2018-08-03T04:05:08Z'),
+        ], more=True, last_sync_ts='2018-08-01T04:05:07Z')
+        result = self._call(verification_id, shard=0)
+        self.assertTrue(result['more'])
+
+        self._add_batch([
+            make_transfer_json('500', '2018-08-01T04:05:08Z'),
+        ], more=True, last_sync_ts='2018-08-01T04:05:11Z')
+        result = self._call(verification_id, shard=0)
+        self.assertFalse(result['more'])
+        self.assertEqual(2, result['sync_done'])
+
+        # The second batch continued from the sync cursor of the first.
+        params = urllib.parse.parse_qs(responses.calls[1].request.body)
+        self.assertEqual(['2018-08-01T04:05:07Z'], params['sync_ts'])
+        self.assertEqual(['501'], params['transfer_id'])
+
+        # The shard row records the sync cursor, not the timestamp.
+        from opnreco.models import db
+        shard_row = (
+            self.dbsession.query(db.VerificationResult)
+            .filter_by(verification_id=verification_id, shard=0)
+            .one())
+        self.assertEqual(
+            datetime.datetime(2018, 8, 1, 4, 5, 11), shard_row.last_sync_ts)
+        self.assertEqual('500', shard_row.last_sync_transfer_id)
+
+    def test_start_shards_uses_download_sync_ts(self):
+        from opnreco.models import db
+        self._setup_owner()
+
+        # OPN synced 501 before 500.
+        records = {
+            r.transfer_id: r for r in
+            self.dbsession.query(db.TransferRecord).filter_by(owner_id='11')}
+        for transfer_id, last_sync_ts in (
+                ('501', '2018-08-04T00:00:00Z'),
+                ('500', '2018-08-05T00:00:00Z')):
+            opn_download = db.OPNDownload(
+                owner_id='11',
+                content={
+                    'transfers': {'last_sync_ts': last_sync_ts},
+                    'more': False,
+                })
+            self.dbsession.add(opn_download)
+            self.dbsession.flush()
+            self.dbsession.add(db.TransferDownloadRecord(
+                opn_download_id=opn_download.id,
+                transfer_record_id=records[transfer_id].id,
+                transfer_id=transfer_id,
+                changed=[]))
+        self.dbsession.flush()
+
+        verification_id = self._call(shards=2)['verification_id']
+        shard_rows = (
+            self.dbsession.query(db.VerificationResult)
+            .filter_by(verification_id=verification_id)
+            .filter(db.VerificationResult.shard.isnot(None))
+            .order_by(db.VerificationResult.shard)
+            .all())
+        self.assertEqual(
+            [datetime.datetime(2018, 8, 4), None],
+            [row.shard_end_ts for row in shard_rows])
+
+    @responses.activate
+    def test_sharded_verify_missing_transfer(self):
+        from pyramid.httpexceptions import HTTPInsufficientStorage
+        self._setup_owner()
+        verification_id = self._call(shards=2)['verification_id']
+
+        self._add_batch([
+            make_transfer_json('500', '2018-08-01T04:05:08Z'),
+        ])
+        self._call(verification_id, shard=0)
+        self._call(verification_id, shard=1)
+
+        with self.assertRaises(HTTPInsufficientStorage) as cm:
+            self._call(verification_id)
+        self.assertIn(
+            'transfer 501', cm.exception.json_body['error_description'])
+
+    @responses.activate
+    def test_sharded_verify_merge_requires_complete_shards(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        self._setup_owner()
+        verification_id = self._call(shards=2)['verification_id']
+
+        self._add_batch([
+            make_transfer_json('500', '2018-08-01T04:05:08Z'),
+        ])
+        self._call(verification_id, shard=0)
+
+        with self.assertRaises(HTTPBadRequest) as cm:
+            self._call(verification_id)
+        self.assertEqual(
+            'shards_incomplete', cm.exception.json_body['error'])
+
+    def test_sharded_verify_invalid_shards(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        self._setup_owner()
+        with self.assertRaises(HTTPBadRequest) as cm:
+            self._call(shards=100)
+        self.assertEqual('invalid_shards', cm.exception.json_body['error'])
+
+
+class TestVerifyAPIInternal(unittest.TestCase):
+
+    def setUp(self):
+        self.config = pyramid.testing.setUp()
+        self.dbsession, self.close_session = dbsession_fixture.begin_session()
+
+    def tearDown(self):
+        self.close_session()
+        pyramid.testing.tearDown()
+
+    @property
+    def _class(self):
+        from ..verifyapi import VerifyAPI
+        return VerifyAPI
+
+    def _setup(self):
+        from opnreco.models import db
+
+        dbsession = self.dbsession
+        self.owner = owner = db.Owner(
+            id='11',
+            title="Test Profile",
+            username='testy',
+        )
+        dbsession.add(owner)
+        dbsession.flush()
+
+        file = db.File(
+            id=1239,
+            owner_id=owner.id,
+            file_type='open_circ',
+            title='Test File',
+            currency='USD',
+            has_vault=True)
+        dbsession.add(file)
+        dbsession.flush()
+
+        dbsession.query(
+            func.set_config('opnreco.personal_id', '12', True),
+            func.set_config('opnreco.account_entry.event_type', 'test', True),
+        ).one()
+
+        self.periods = []
+        for year in (2016, 2017, 2018):
+            period = db.Period(
+                owner_id=owner.id,
+                file_id=file.id,
+                start_date=datetime.date(year, 1, 1),
+                end_date=datetime.date(year, 12, 31),
+                start_circ=Decimal('10'),
+                end_circ=Decimal('10'),
+                start_surplus=Decimal('0'),
+                end_surplus=Decimal('0'),
+                closed=True,
+            )
+            dbsession.add(period)
+            self.periods.append(period)
+        dbsession.flush()
+
+        statement = db.Statement(
+            owner_id=owner.id,
+            file_id=file.id,
+            period_id=self.periods[0].id,
+            source='manual',
+        )
+        dbsession.add(statement)
+        dbsession.flush()
+        self.statement = statement
+
+    def _add_reco(self, *deltas):
+        from opnreco.models import db
+
+        period = self.periods[0]
+        reco = db.Reco(
+            owner_id=self.owner.id,
+            period_id=period.id,
+            reco_type='standard',
+            internal=False,
+        )
+        self.dbsession.add(reco)
+        self.dbsession.flush()
+        for delta in deltas:
+            self.dbsession.add(db.AccountEntry(
+                owner_id=self.owner.id,
+                file_id=period.file_id,
+                period_id=period.id,
+                statement_id=self.statement.id,
+                entry_date=datetime.date(2016, 1, 5),
+                loop_id='0',
+                currency='USD',
+                delta=Decimal(delta),
+                description='Test entry',
+                reco_id=reco.id,
+            ))
+        self.dbsession.flush()
+        return reco
+
+    def _call(self):
+        request = pyramid.testing.DummyRequest(
+            dbsession=self.dbsession,
+            owner=self.owner,
+            personal_id='12',
+            access_token='example-token',
+        )
+        request.json = {
+            'verification_id': None,
+            'verify_sync': False,
+        }
+        return self._class(request)()
+
+    def test_consistent(self):
+        self._setup()
+        self._add_reco('5', '-5')
+        result = self._call()
+        self.assertTrue(result['internal_ok'])
+        self.assertEqual(
+            ['periods', 'recos'], sorted(result['internal_timing']))
+
+    def test_reports_all_unbalanced_recos(self):
+        from pyramid.httpexceptions import HTTPInsufficientStorage
+        self._setup()
+        self._add_reco('5', '-5')
+        reco1 = self._add_reco('5', '-4')
+        reco2 = self._add_reco('3')
+        with self.assertRaises(HTTPInsufficientStorage) as cm:
+            self._call()
+        details = cm.exception.json_body['details']
+        self.assertFalse(details['recos_ok'])
+        self.assertTrue(details['periods_ok'])
+        self.assertEqual([
+            {'reco_id': str(reco1.id), 'delta': '1'},
+            {'reco_id': str(reco2.id), 'delta': '3'},
+        ], details['unbalanced_recos'])
+        self.assertEqual(
+            ['periods', 'recos'], sorted(details['timing']))
+
+    def test_reports_all_period_mismatches(self):
+        from pyramid.httpexceptions import HTTPInsufficientStorage
+        self._setup()
+        p2016, p2017, p2018 = self.periods
+        p2016.end_circ = Decimal('11')
+        p2017.end_surplus = Decimal('2')
+        self.dbsession.flush()
+        with self.assertRaises(HTTPInsufficientStorage) as cm:
+            self._call()
+        details = cm.exception.json_body['details']
+        self.assertTrue(details['recos_ok'])
+        self.assertFalse(details['periods_ok'])
+        self.assertEqual(
+            [str(p2017.id), str(p2018.id)],
+            [item['period_id'] for item in details['period_mismatches']])
+        self.assertEqual(
+            '11', details['period_mismatches'][0]['prev_end_circ'])
+
+    def test_skips_period_after_open_period(self):
+        self._setup()
+        p2016, p2017, p2018 = self.periods
+        p2016.closed = False
+        p2016.end_circ = Decimal('11')
+        self.dbsession.flush()
+        result = self._call()
+        self.assertTrue(result['internal_ok'])
@@ -8,7 +8,13 @@ from opnreco.models.db import Reco
 from opnreco.models.db import TransferRecord
 from opnreco.models.site import PeriodResource
 from opnreco.param import get_offset_limit
+from opnreco.streaming import iter_json_list
+from opnreco.streaming import iter_json_object
+from opnreco.streaming import iter_row_batches
+from opnreco.streaming import make_stream_response
+from opnreco.streaming import stream_requested
 from pyramid.view import view_config
+from sqlalchemy import and_
 from sqlalchemy import BigInteger
 from sqlalchemy import case
 from sqlalchemy import cast
@@ -16,6 +22,7 @@ from sqlalchemy import Date
 from sqlalchemy import DateTime
 from sqlalchemy import func
 from sqlalchemy import Numeric
+from sqlalchemy import select
 from sqlalchemy import String
 import collections
 
@@ -39,10 +46,169 @@ def transactions_api(context, request):
     params = request.params
     offset, limit = get_offset_limit(params)
 
-    dbsession = request.dbsession
     owner = request.owner
     owner_id = owner.id
 
+    if limit is None and stream_requested(request):
+        # Stream all the rows. The increases and decreases are streamed
+        # separately, so the page totals are the same as the totals.
+        def make_chunks(dbsession, connection):
+            query = get_transactions_query(
+                dbsession=dbsession, owner_id=owner_id, period_id=period_id)
+            totals_row, all_incs, all_decs = get_transactions_totals(
+                dbsession=dbsession, query=query)
+            head = {
+                'now': totals_row.now,
+                'rowcount': totals_row.rowcount,
+                'all_shown': True,
+                'inc_totals': {
+                    'page': all_incs,
+                    'all': all_incs,
+                },
+                'dec_totals': {
+                    'page': all_decs,
+                    'all': all_decs,
+                },
+            }
+            subq = query.subquery('subq')
+            order_by = get_order_by(subq)
+            subq_amount = func.coalesce(
+                subq.c.account_delta, subq.c.movement_delta)
+            tail = []
+            for name, amount_filter in (
+                    ('inc_records', subq_amount > 0),
+                    ('dec_records', subq_amount < 0)):
+                statement = (
+                    dbsession.query(subq)
+                    .filter(amount_filter)
+                    .order_by(*order_by)
+                    .statement)
+                records = iter_records(
+                    connection=connection,
+                    owner_id=owner_id,
+                    statement=statement)
+                tail.append((name, iter_json_list(
+                    record for _inc, record in records)))
+            return iter_json_object(head, tail)
+
+        return make_stream_response(request, make_chunks)
+
+    dbsession = request.dbsession
+    query = get_transactions_query(
+        dbsession=dbsession, owner_id=owner_id, period_id=period_id)
+    totals_row, all_incs, all_decs = get_transactions_totals(
+        dbsession=dbsession, query=query)
+
+    subq = query.subquery('subq')
+    order_by = get_order_by(subq)
+
+    main_rows_query = (
+        dbsession.query(subq)
+        .order_by(*order_by)
+        .offset(offset)
+    )
+    if limit is not None:
+        main_rows_query = main_rows_query.limit(limit)
+    main_rows = main_rows_query.all()
+
+    # Now main_rows contains the rows for the table.
+
+    inc_records = []
+    page_incs = {'account_delta': zero, 'reco_movement_delta': zero}
+    dec_records = []
+    page_decs = {'account_delta': zero, 'reco_movement_delta': zero}
+
+    reco_movements_map, reco_entries_map = load_reco_details(
+        executor=dbsession, owner_id=owner_id, main_rows=main_rows)
+
+    for main_row in main_rows:
+        inc, record = make_record(
+            main_row, reco_movements_map, reco_entries_map)
+
+        if inc is not None:
+            account_delta = main_row.account_delta
+            reco_movement_delta = main_row.reco_movement_delta
+            if inc:
+                inc_records.append(record)
+                if account_delta:
+                    page_incs['account_delta'] += account_delta
+                if reco_movement_delta:
+                    page_incs['reco_movement_delta'] += reco_movement_delta
+            else:
+                dec_records.append(record)
+                if account_delta:
+                    page_decs['account_delta'] += account_delta
+                if reco_movement_delta:
+                    page_decs['reco_movement_delta'] += reco_movement_delta
+
+    all_shown = totals_row.rowcount == len(main_rows)
+    if all_shown:
+        # Take an opportunity to test the total calculations.
+        if page_incs != all_incs or page_decs != all_decs:
+            raise AssertionError("All rows shown but total mismatch. %s" % {
+                'page_incs': page_incs,
+                'all_incs': all_incs,
+                'page_decs': page_decs,
+                'all_decs': all_decs,
+            })
+
+    return {
+        'now': totals_row.now,
+        'rowcount': totals_row.rowcount,
+        'all_shown': all_shown,
+        'inc_records': inc_records,
+        'inc_totals': {
+            'page': page_incs,
+            'all': all_incs,
+        },
+        'dec_records': dec_records,
+        'dec_totals': {
+            'page': page_decs,
+            'all': all_decs,
+        },
+    }
+
+
+def get_transactions_totals(dbsession, query):
+    """Total the rows of a transactions query.
+
+    Return (totals_row, all_incs, all_decs).
+    """
+    total_cte = query.cte('total_cte')
+    amount_expr = func.coalesce(
+        total_cte.c.account_delta, total_cte.c.movement_delta)
+    inc_row = amount_expr > 0
+    dec_row = amount_expr < 0
+    totals_row = (
+        dbsession.query(
+            now_func.label('now'),
+            func.count(1).label('rowcount'),
+            func.sum(case([
+                (inc_row, total_cte.c.account_delta),
+            ], else_=0)).label('inc_account_delta'),
+            func.sum(case([
+                (dec_row, total_cte.c.account_delta),
+            ], else_=0)).label('dec_account_delta'),
+            func.sum(case([
+                (inc_row, total_cte.c.reco_movement_delta),
+            ], else_=0)).label('inc_reco_movement_delta'),
+            func.sum(case([
+                (dec_row, total_cte.c.reco_movement_delta),
+            ], else_=0)).label('dec_reco_movement_delta'),
+        ).one())
+    all_incs = {
+        'account_delta': totals_row.inc_account_delta or zero,
+        'reco_movement_delta': totals_row.inc_reco_movement_delta or zero,
+    }
+    all_decs = {
+        'account_delta': totals_row.dec_account_delta or zero,
+        'reco_movement_delta': totals_row.dec_reco_movement_delta or zero,
+    }
+    return totals_row, all_incs, all_decs
+
+
+def get_transactions_query(dbsession, owner_id, period_id):
+    """Query the reconciled and unreconciled rows of a period."""
     # Compose a big query that returns a combination of reconciled rows,
     # unreconciled account entries, and unreconciled movements.
     # (The big query causes all ordering and paging to be done in the
@@ -157,204 +323,157 @@ def transactions_api(context, request):
         ),
     )
 
-    total_cte = query.cte('total_cte')
-    amount_expr = func.coalesce(
-        total_cte.c.account_delta, total_cte.c.movement_delta)
-    inc_row = amount_expr > 0
-    dec_row = amount_expr < 0
-    totals_row = (
-        dbsession.query(
-            now_func.label('now'),
-            func.count(1).label('rowcount'),
-            func.sum(case([
-                (inc_row, total_cte.c.account_delta),
-            ], else_=0)).label('inc_account_delta'),
-            func.sum(case([
-                (dec_row, total_cte.c.account_delta),
-            ], else_=0)).label('dec_account_delta'),
-            func.sum(case([
-                (inc_row, total_cte.c.reco_movement_delta),
-            ], else_=0)).label('inc_reco_movement_delta'),
-            func.sum(case([
-                (dec_row, total_cte.c.reco_movement_delta),
-            ], else_=0)).label('dec_reco_movement_delta'),
-        ).one())
-    all_incs = {
-        'account_delta': totals_row.inc_account_delta or zero,
-        'reco_movement_delta': totals_row.inc_reco_movement_delta or zero,
-    }
-    all_decs = {
-        'account_delta': totals_row.dec_account_delta or zero,
-        'reco_movement_delta': totals_row.dec_reco_movement_delta or zero,
-    }
+    return query
 
-    subq = query.subquery('subq')
-    main_rows_query = (
-        dbsession.query(subq)
-        .order_by(
-            subq.c.entry_date,
-            subq.c.ts,
-            subq.c.account_entry_id,
-            subq.c.movement_id,
-        )
-        .offset(offset)
+
+def get_order_by(subq):
+    """Get the order of the rows of get_transactions_query()."""
+    return (
+        subq.c.entry_date,
+        subq.c.ts,
+        subq.c.account_entry_id,
+        subq.c.movement_id,
     )
-    if limit is not None:
-        main_rows_query = main_rows_query.limit(limit)
-    main_rows = main_rows_query.all()
 
-    # Now main_rows contains the rows for the table.
 
-    inc_records = []
-    page_incs = {'account_delta': zero, 'reco_movement_delta': zero}
-    dec_records = []
-    page_decs = {'account_delta': zero, 'reco_movement_delta': zero}
+def load_reco_details(executor, owner_id, main_rows):
+    """Get the movements and account entries of the recos in main_rows.
 
-    query_reco_ids = [r.reco_id for r in main_rows if r.reco_id is not None]
+    executor is a session or connection. Return
+    (reco_movements_map, reco_entries_map).
+    """
     # reco_movements_map: {reco_id: [Movement]}
     reco_movements_map = collections.defaultdict(list)
     # reco_entries_map: {reco_id: [AccountEntry]}
     reco_entries_map = collections.defaultdict(list)
 
-    if query_reco_ids:
-        # Some of the rows may contain multiple account entries or movements.
-        # Fill reco_movements_map and reco_entries_map.
-        rows = (
-            dbsession.query(
-                FileMovement.reco_id,
-                FileMovement.movement_id,
-                FileMovement.ts,
-                movement_delta_cols.label('movement_delta'),
-                reco_movement_delta_cols.label('reco_movement_delta'),
-                TransferRecord.workflow_type,
-                TransferRecord.transfer_id,
-            )
-            .join(
-                TransferRecord,
-                TransferRecord.id == FileMovement.transfer_record_id)
-            .filter(
-                FileMovement.owner_id == owner_id,
-                FileMovement.reco_id.in_(query_reco_ids),
-            )
-            .order_by(FileMovement.ts, FileMovement.movement_id)
-            .all())
-        for row in rows:
-            reco_movements_map[row.reco_id].append(row)
-
-        rows = (
-            dbsession.query(
-                AccountEntry.reco_id,
-                AccountEntry.id.label('account_entry_id'),
-                AccountEntry.entry_date,
-                AccountEntry.delta.label('account_delta'),
-            )
-            .filter(
-                AccountEntry.owner_id == owner_id,
-                AccountEntry.reco_id.in_(query_reco_ids),
-            )
-            .order_by(AccountEntry.entry_date, AccountEntry.id)
-            .all())
-        for row in rows:
-            reco_entries_map[row.reco_id].append(row)
+    query_reco_ids = [r.reco_id for r in main_rows if r.reco_id is not None]
+    if not query_reco_ids:
+        return reco_movements_map, reco_entries_map
 
-    for main_row in main_rows:
-        account_delta = main_row.account_delta
-        movement_delta = main_row.movement_delta
-        d = (
-            account_delta if account_delta is not None
-            else movement_delta if movement_delta is not None
-            else zero)
-        inc = True if d > zero else False if d < zero else None
+    # Some of the rows may contain multiple account entries or movements.
+    # Fill reco_movements_map and reco_entries_map.
+    statement = (
+        select([
+            FileMovement.reco_id,
+            FileMovement.movement_id,
+            FileMovement.ts,
+            movement_delta_cols.label('movement_delta'),
+            reco_movement_delta_cols.label('reco_movement_delta'),
+            TransferRecord.workflow_type,
+            TransferRecord.transfer_id,
+        ])
+        .select_from(FileMovement.__table__.join(
+            TransferRecord.__table__,
+            TransferRecord.id == FileMovement.transfer_record_id))
+        .where(and_(
+            FileMovement.owner_id == owner_id,
+            FileMovement.reco_id.in_(query_reco_ids),
+        ))
+        .order_by(FileMovement.ts, FileMovement.movement_id))
+    for row in executor.execute(statement):
+        reco_movements_map[row.reco_id].append(row)
 
-        if inc is not None:
-            movement_id = main_row.movement_id
-            account_entry_id = main_row.account_entry_id
-            reco_id = main_row.reco_id
-            reco_movement_delta = main_row.reco_movement_delta
-            record = {
-                'reco_id': None if reco_id is None else str(reco_id),
-                'account_entry_id': (
-                    None if account_entry_id is None
-                    else str(account_entry_id)),
-                'movement_id': (
-                    None if movement_id is None
-                    else str(movement_id)),
-                'account_entries': [],
-                'movements': [],
-            }
+    statement = (
+        select([
+            AccountEntry.reco_id,
+            AccountEntry.id.label('account_entry_id'),
+            AccountEntry.entry_date,
+            AccountEntry.delta.label('account_delta'),
+        ])
+        .where(and_(
+            AccountEntry.owner_id == owner_id,
+            AccountEntry.reco_id.in_(query_reco_ids),
+        ))
+        .order_by(AccountEntry.entry_date, AccountEntry.id))
+    for row in executor.execute(statement):
+        reco_entries_map[row.reco_id].append(row)
 
-            if reco_id is None:
-                # Unreconciled rows contain a movement or account entry.
-                if account_entry_id is not None:
-                    record['account_entries'].append({
-                        'id': str(account_entry_id),
-                        'entry_date': main_row.entry_date,
-                        'account_delta': account_delta,
-                    })
-                if movement_id is not None:
-                    record['movements'].append({
-                        'id': str(movement_id),
-                        'ts': main_row.ts,
-                        'movement_delta': movement_delta or '0',
-                        'reco_movement_delta': reco_movement_delta or '0',
-                        'workflow_type': main_row.workflow_type,
-                        'transfer_id': main_row.transfer_id,
-                    })
-            else:
-                # Reconciled rows have multiple (or zero) movements
-                # and account entries. Include them.
-                for row in reco_movements_map[reco_id]:
-                    record['movements'].append({
-                        'id': str(row.movement_id),
-                        'ts': row.ts,
-                        'movement_delta': row.movement_delta or '0',
-                        'reco_movement_delta': row.reco_movement_delta or '0',
-                        'workflow_type': row.workflow_type,
-                        'transfer_id': row.transfer_id,
-                    })
-                for row in reco_entries_map[reco_id]:
-                    record['account_entries'].append({
-                        'id': str(row.account_entry_id),
-                        'entry_date': row.entry_date,
-                        'account_delta': row.account_delta,
-                    })
+    return reco_movements_map, reco_entries_map
 
-            if inc:
-                inc_records.append(record)
-                if account_delta:
-                    page_incs['account_delta'] += account_delta
-                if reco_movement_delta:
-                    page_incs['reco_movement_delta'] += reco_movement_delta
-            else:
-                dec_records.append(record)
-                if account_delta:
-                    page_decs['account_delta'] += account_delta
-                if reco_movement_delta:
-                    page_decs['reco_movement_delta'] += reco_movement_delta
 
-    all_shown = totals_row.rowcount == len(main_rows)
-    if all_shown:
-        # Take an opportunity to test the total calculations.
-        if page_incs != all_incs or page_decs != all_decs:
-            raise AssertionError("All rows shown but total mismatch. %s" % {
-                'page_incs': page_incs,
-                'all_incs': all_incs,
-                'page_decs': page_decs,
-                'all_decs': all_decs,
-            })
+def make_record(main_row, reco_movements_map, reco_entries_map):
+    """Serialize a row of the transactions list.
 
-    return {
-        'now': totals_row.now,
-        'rowcount': totals_row.rowcount,
-        'all_shown': all_shown,
-        'inc_records': inc_records,
-        'inc_totals': {
-            'page': page_incs,
-            'all': all_incs,
-        },
-        'dec_records': dec_records,
-        'dec_totals': {
-            'page': page_decs,
-            'all': all_decs,
-        },
+    Return (inc, record), where inc is True for an increase, False for
+    a decrease, or None if the row has no effect (and record is None).
+    """
+    account_delta = main_row.account_delta
+    movement_delta = main_row.movement_delta
+    d = (
+        account_delta if account_delta is not None
+        else movement_delta if movement_delta is not None
+        else zero)
+    inc = True if d > zero else False if d < zero else None
+
+    if inc is None:
+        return None, None
+
+    movement_id = main_row.movement_id
+    account_entry_id = main_row.account_entry_id
+    reco_id = main_row.reco_id
+    reco_movement_delta = main_row.reco_movement_delta
+    record = {
+        'reco_id': None if reco_id is None else str(reco_id),
+        'account_entry_id': (
+            None if account_entry_id is None
+            else str(account_entry_id)),
+        'movement_id': (
+            None if movement_id is None
+            else str(movement_id)),
+        'account_entries': [],
+        'movements': [],
     }
+
+    if reco_id is None:
+        # Unreconciled rows contain a movement or account entry.
+        if account_entry_id is not None:
+            record['account_entries'].append({
+                'id': str(account_entry_id),
+                'entry_date': main_row.entry_date,
+                'account_delta': account_delta,
+            })
+        if movement_id is not None:
+            record['movements'].append({
+                'id': str(movement_id),
+                'ts': main_row.ts,
+                'movement_delta': movement_delta or '0',
+                'reco_movement_delta': reco_movement_delta or '0',
+                'workflow_type': main_row.workflow_type,
+                'transfer_id': main_row.transfer_id,
+            })
+    else:
+        # Reconciled rows have multiple (or zero) movements
+        # and account entries. Include them.
+        for row in reco_movements_map[reco_id]:
+            record['movements'].append({
+                'id': str(row.movement_id),
+                'ts': row.ts,
+                'movement_delta': row.movement_delta or '0',
+                'reco_movement_delta': row.reco_movement_delta or '0',
+                'workflow_type': row.workflow_type,
+                'transfer_id': row.transfer_id,
+            })
+        for row in reco_entries_map[reco_id]:
+            record['account_entries'].append({
+                'id': str(row.account_entry_id),
+                'entry_date': row.entry_date,
+                'account_delta': row.account_delta,
+            })
+
+    return inc, record
+
+
+def iter_records(connection, owner_id, statement):
+    """Stream the records of the transactions list from a statement.
+
+    Yield (inc, record) for each row that has an effect.
+    """
+    for main_rows in iter_row_batches(connection, statement):
+        reco_movements_map, reco_entries_map = load_reco_details(
+            executor=connection, owner_id=owner_id, main_rows=main_rows)
+        for main_row in main_rows:
+            inc, record = make_record(
+                main_row, reco_movements_map, reco_entries_map)
+            if record is not None:
+                yield inc, record
@@ -2,8 +2,10 @@
 from opnreco.models import perms
 from opnreco.models.db import AccountEntry
 from opnreco.models.db import FileMovement
+from opnreco.models.db import OPNDownload
 from opnreco.models.db import Period
 from opnreco.models.db import Reco
+from opnreco.models.db import TransferDownloadRecord
 from opnreco.models.db import TransferRecord
 from opnreco.models.db import VerificationResult
 from opnreco.models.site import API
@@ -14,12 +16,20 @@ from pyramid.decorator import reify
 from pyramid.httpexceptions import HTTPBadRequest
 from pyramid.httpexceptions import HTTPInsufficientStorage
 from pyramid.view import view_config
+from sqlalchemy import and_
+from sqlalchemy import cast
+from sqlalchemy import DateTime
 from sqlalchemy import func
+from sqlalchemy import or_
+from sqlalchemy import select
+from sqlalchemy import union_all
 import datetime
-import uuid
 import logging
+import time
+import uuid
 
 log = logging.getLogger(__name__)
+null = None
 
 
 @view_config(
@@ -28,9 +38,29 @@ log = logging.getLogger(__name__)
     permission=perms.use_app,
     renderer='json')
 class VerifyAPI(SyncBase):
-    """Verify existing OPN transfer records have not changed."""
+    """Verify existing OPN transfer records have not changed.
+
+    When the client requests incremental verification and a previous
+    verification succeeded, verify only the transfers changed since the
+    previous verification, followed by a rolling sample of older
+    transfers. Each incremental verification resumes the sample where the
+    previous one stopped, so repeated incremental verifications
+    eventually cover the whole history.
+
+    When the client requests a number of shards, split the history into
+    sync time ranges holding about the same number of transfer records. The
+    client can then verify the shards concurrently, each in a separate
+    series of requests (and therefore separate server workers and OPN
+    connections.) Each shard tracks its progress in its own
+    VerificationResult row. Once all the shards are complete, the client
+    makes a final request without a shard to check for missing transfers.
+    """
     write_enabled = False
     batch_limit = 250
+    # sample_size is the number of older transfers to verify
+    # in each incremental verification.
+    sample_size = 1000
+    max_shards = 16
 
     def __call__(self):
         request = self.request
@@ -49,8 +79,12 @@ class VerifyAPI(SyncBase):
 
         try:
             ivr = self.ivr
+            shard = request.json.get('shard')
             if request.json.get('verify_sync'):
-                progress_percent, more = self.verify_sync()
+                if shard is not None:
+                    progress_percent, more = self.verify_shard(shard)
+                else:
+                    progress_percent, more = self.verify_sync()
             else:
                 self.verify_internal()
                 progress_percent = 100
@@ -65,16 +99,23 @@ class VerifyAPI(SyncBase):
             raise HTTPInsufficientStorage(json_body={
                 'error': 'verification_failure',
                 'error_description': str(e),
+                'details': e.details,
             })
 
+        # Report the progress of the shard if a shard was verified.
+        progress_row = getattr(self, 'shard_row', None) or ivr
+
         return {
             'verification_id': ivr.verification_id,
-            'sync_done': ivr.sync_done,
-            'sync_total': ivr.sync_total,
+            'sync_done': progress_row.sync_done,
+            'sync_total': progress_row.sync_total,
             'progress_percent': progress_percent,
             'change_count': len(self.change_log),
             'more': more,
             'internal_ok': not not ivr.internal_result,
+            'internal_timing': (ivr.internal_result or {}).get('timing'),
+            'incremental': ivr.since_ts is not None,
+            'shard_count': ivr.shard_count,
         }
 
     def get_ivr(self):
@@ -93,15 +134,29 @@ class VerifyAPI(SyncBase):
                 datetime.datetime.utcnow().strftime('%Y%m%d%H%M%S'),
                 uuid.uuid4())
 
+            shard_count = self.get_requested_shard_count()
+            if (request.json.get('incremental') and
+                    owner.verified_sync_ts is not None and
+                    not shard_count):
+                # Verify only the transfers changed since the last
+                # successful verification (plus a sample.)
+                since_ts = owner.verified_sync_ts
+                since_transfer_id = owner.verified_sync_transfer_id
+            else:
+                since_ts = None
+                since_transfer_id = None
+
             ivr = VerificationResult(
                 owner_id=owner.id,
                 verification_id=verification_id,
                 initial=True,
-                last_sync_ts=datetime.datetime(1970, 1, 1),
-                last_sync_transfer_id=None,
+                last_sync_ts=since_ts or datetime.datetime(1970, 1, 1),
+                last_sync_transfer_id=since_transfer_id,
+                since_ts=since_ts,
                 sync_done=0,
                 verified={},
                 expires=self.expires,
+                shard_count=shard_count,
             )
             dbsession.add(ivr)
             created_ivr = True
@@ -142,6 +197,17 @@ class VerifyAPI(SyncBase):
         ivr = self.ivr
         created_ivr = self.created_ivr
 
+        if ivr.sample_done is not None:
+            # The changed transfers have been verified already.
+            return self.verify_sample()
+
+        if ivr.shard_count:
+            if created_ivr:
+                self.start_shards()
+                return 0, True
+            else:
+                return self.merge_shards()
+
         transfers_download = self.download_batch(
             sync_ts_iso=ivr.last_sync_ts.isoformat() + 'Z',
             sync_transfer_id=ivr.last_sync_transfer_id,
@@ -151,28 +217,118 @@ class VerifyAPI(SyncBase):
 
         self.log_download(transfers_download=transfers_download)
 
-        if transfers_download['more']:
-            # Note: avoid division by zero.
-            progress_percent = min(99, int(
-                100.0 * ivr.sync_done / ivr.sync_total
-                if ivr.sync_total else 0.0))
+        more = transfers_download['more']
+        if more:
+            progress_percent = self.get_progress_percent()
+        elif ivr.since_ts is not None:
+            # Verify a sample of older transfers next.
+            self.start_sample()
+            progress_percent = self.get_progress_percent()
+            more = True
         else:
             self.verify_final()
             progress_percent = 100
 
-        more = transfers_download['more']
         return progress_percent, more
 
-    def log_download(self, transfers_download):
+    def get_progress_percent(self):
+        ivr = self.ivr
+        done = ivr.sync_done
+        total = ivr.sync_total or 0
+        if ivr.since_ts is not None:
+            done += ivr.sample_done or 0
+            total += self.sample_size
+        # Note: avoid division by zero.
+        return min(99, int(100.0 * done / total if total else 0.0))
+
+    def start_sample(self):
+        """Start verifying the rolling sample of older transfers."""
+        owner = self.owner
+        ivr = self.ivr
+
+        sample_ts = owner.verify_sample_ts
+        if sample_ts is None or sample_ts >= ivr.since_ts:
+            # Start the sample at the beginning of the history.
+            sample_ts = datetime.datetime(1970, 1, 1)
+            sample_transfer_id = None
+        else:
+            sample_transfer_id = owner.verify_sample_transfer_id
+
+        ivr.sample_start_ts = sample_ts
+        ivr.sample_sync_ts = sample_ts
+        ivr.sample_sync_transfer_id = sample_transfer_id
+        ivr.sample_done = 0
+
+    def verify_sample(self):
+        """Compare a batch of older transfer records."""
+        ivr = self.ivr
+
+        transfers_download = self.download_batch(
+            sync_ts_iso=ivr.sample_sync_ts.isoformat() + 'Z',
+            sync_transfer_id=ivr.sample_sync_transfer_id,
+            count_remain=False)
+
+        self.import_transfer_records(transfers_download)
+
+        self.log_download(transfers_download=transfers_download, sample=True)
+
+        if not transfers_download['more']:
+            # The sample reached the end of the history.
+            self.verify_final(sample_end_ts=None)
+            return 100, False
+
+        if (ivr.sample_done >= self.sample_size or
+                ivr.sample_sync_ts >= ivr.since_ts):
+            self.verify_final(sample_end_ts=ivr.sample_sync_ts)
+            return 100, False
+
+        return self.get_progress_percent(), True
+
+    def log_download(self, transfers_download, sample=False):
         """Log the results of the transfer download in a VerificationResult."""
         request = self.request
         dbsession = request.dbsession
         owner = request.owner
 
-        len_results = len(transfers_download['results'])
+        results = transfers_download['results']
+        len_results = len(results)
+        verified = self.get_verified_map(results)
+
+        ivr = self.ivr
+        if self.created_ivr:
+            ivr.first_sync_ts = to_datetime(
+                transfers_download['first_sync_ts'], allow_none=True)
+            ivr.sync_total = len_results + transfers_download['remain']
+            ivr.sync_done = len_results
+            ivr.verified = verified
+        else:
+            if sample:
+                ivr.sample_done += len_results
+            else:
+                ivr.sync_done += len_results
+            dbsession.add(VerificationResult(
+                owner_id=owner.id,
+                verification_id=ivr.verification_id,
+                initial=False,
+                verified=verified,
+                expires=self.expires,
+            ))
+
+        if results:
+            last_sync_ts = to_datetime(transfers_download['last_sync_ts'])
+            last_sync_transfer_id = results[-1]['id']
+            if sample:
+                ivr.sample_sync_ts = last_sync_ts
+                ivr.sample_sync_transfer_id = last_sync_transfer_id
+            else:
+                ivr.last_sync_ts = last_sync_ts
+                ivr.last_sync_transfer_id = last_sync_transfer_id
+
+    def get_verified_map(self, results):
+        """Map the downloaded transfer IDs to the changes found, if any."""
         verified = {
             item['id']: None
-            for item in transfers_download['results']}
+            for item in results}
 
         for entry in self.change_log:
             transfer_id = entry.get('transfer_id')
@@ -185,60 +341,266 @@ class VerifyAPI(SyncBase):
                 del entry_copy['transfer_id']
                 transfer_changes.append(entry_copy)
 
+        return verified
+
+    def get_requested_shard_count(self):
+        """Get the number of shards requested for a new verification.
+
+        Return None if the client did not request sharding.
+        """
+        shards = self.request.json.get('shards')
+        if shards is None:
+            return None
+        if (not isinstance(shards, int) or isinstance(shards, bool) or
+                not 1 <= shards <= self.max_shards):
+            raise HTTPBadRequest(json_body={
+                'error': 'invalid_shards',
+                'error_description': (
+                    "The number of shards must be between 1 and %d." %
+                    self.max_shards),
+            })
+        return shards
+
+    def start_shards(self):
+        """Split the history into shards and create a row for each shard.
+
+        OPN returns transfers in the order of their sync timestamps, so
+        each shard covers a range of sync timestamps: from the end of the
+        previous shard up to and including the end of the shard. The last
+        shard has no end, so it includes transfers changed since the
+        verification started.
+
+        The sync timestamp of each transfer record is approximated by the
+        last_sync_ts of the most recent download that provided it, or by
+        the timestamp of the transfer if no download record exists. The
+        approximation only affects the size of the shards; the shards
+        still cover the whole history.
+        """
+        request = self.request
+        dbsession = request.dbsession
+        owner = request.owner
         ivr = self.ivr
-        if self.created_ivr:
-            ivr.first_sync_ts = to_datetime(
-                transfers_download['first_sync_ts'])
-            ivr.sync_total = len_results + transfers_download['remain']
-            ivr.sync_done = len_results
-            ivr.verified = verified
+
+        download_sync_ts = cast(
+            OPNDownload.content['transfers']['last_sync_ts'].astext,
+            DateTime)
+        download_subq = (
+            dbsession.query(
+                TransferDownloadRecord.transfer_record_id,
+                func.max(download_sync_ts).label('sync_ts'),
+            )
+            .join(
+                OPNDownload,
+                OPNDownload.id == TransferDownloadRecord.opn_download_id)
+            .filter(OPNDownload.owner_id == owner.id)
+            .group_by(TransferDownloadRecord.transfer_record_id)
+            .subquery('download_subq'))
+
+        sync_ts = func.coalesce(
+            download_subq.c.sync_ts, TransferRecord.timestamp)
+
+        # Find the sync timestamp boundaries that split the transfer
+        # records into shard_count groups of about the same size.
+        bucket_cte = (
+            dbsession.query(
+                sync_ts.label('sync_ts'),
+                func.ntile(ivr.shard_count).over(
+                    order_by=sync_ts).label('bucket'),
+            )
+            .outerjoin(
+                download_subq,
+                download_subq.c.transfer_record_id == TransferRecord.id)
+            .filter(TransferRecord.owner_id == owner.id)
+            .cte('bucket_cte'))
+
+        rows = (
+            dbsession.query(
+                func.max(bucket_cte.c.sync_ts).label('end_ts'),
+                func.count().label('count'),
+            )
+            .group_by(bucket_cte.c.bucket)
+            .order_by(bucket_cte.c.bucket)
+            .all())
+
+        # Combine buckets that end at the same sync timestamp.
+        shards = []  # [[end_ts, count]]
+        for end_ts, count in rows:
+            if shards and shards[-1][0] == end_ts:
+                shards[-1][1] += count
+            else:
+                shards.append([end_ts, count])
+        if shards:
+            shards[-1][0] = None
         else:
-            ivr.sync_done += len_results
+            shards.append([None, 0])
+
+        start_ts = datetime.datetime(1970, 1, 1)
+        for shard, (end_ts, count) in enumerate(shards):
             dbsession.add(VerificationResult(
                 owner_id=owner.id,
                 verification_id=ivr.verification_id,
                 initial=False,
-                verified=verified,
+                shard=shard,
+                last_sync_ts=start_ts,
+                shard_end_ts=end_ts,
+                shard_complete=False,
+                sync_done=0,
+                sync_total=count,
+                verified={},
                 expires=self.expires,
             ))
+            start_ts = end_ts
 
-        ivr.last_sync_ts = to_datetime(
-            transfers_download['last_sync_ts'])
-        ivr.last_sync_transfer_id = (
-            transfers_download['results'][-1]['id'])
+        ivr.shard_count = len(shards)
+        ivr.sync_total = sum(count for (end_ts, count) in shards)
 
-    def verify_final(self):
-        """Verify the entire download.
+    def verify_shard(self, shard):
+        """Compare a batch of transfer records in a shard.
+
+        The transfers don't include their sync timestamps, so the shard
+        verifies whole batches until the sync cursor passes the end of the
+        shard. The last batch of a shard may overlap the first batch of
+        the next shard, which is harmless.
         """
         request = self.request
         dbsession = request.dbsession
         owner = request.owner
         ivr = self.ivr
 
-        # Look for transfers
-        # downloaded previously that were not included in the
-        # download.
-        rows = (
-            dbsession.query(TransferRecord.transfer_id)
-            .filter(TransferRecord.owner_id == owner.id)
-            .all())
-        stored_transfer_ids = set(row[0] for row in rows)
+        shard_row = None
+        if ivr.shard_count and isinstance(shard, int):
+            # Lock the shard row so that concurrent requests for the
+            # same shard don't verify the same batch.
+            shard_row = (
+                dbsession.query(VerificationResult)
+                .filter(
+                    VerificationResult.owner_id == owner.id,
+                    VerificationResult.verification_id ==
+                    ivr.verification_id,
+                    VerificationResult.shard == shard,
+                )
+                .with_for_update()
+                .first())
 
-        rows = (
-            dbsession.query(VerificationResult.verified)
+        if shard_row is None:
+            raise HTTPBadRequest(json_body={
+                'error': 'shard_not_found',
+            })
+
+        self.shard_row = shard_row
+
+        if shard_row.shard_complete:
+            return 100, False
+
+        transfers_download = self.download_batch(
+            sync_ts_iso=shard_row.last_sync_ts.isoformat() + 'Z',
+            sync_transfer_id=shard_row.last_sync_transfer_id,
+            count_remain=False)
+
+        self.import_transfer_records(transfers_download)
+
+        results = transfers_download['results']
+        dbsession.add(VerificationResult(
+            owner_id=owner.id,
+            verification_id=ivr.verification_id,
+            initial=False,
+            verified=self.get_verified_map(results),
+            expires=self.expires,
+        ))
+
+        shard_row.sync_done += len(results)
+        if results:
+            shard_row.last_sync_ts = to_datetime(
+                transfers_download['last_sync_ts'])
+            shard_row.last_sync_transfer_id = results[-1]['id']
+
+        # Note: transfers with the same sync timestamp as the end of the
+        # shard may be in the next batch, so the shard is complete only
+        # once the sync cursor is past the end.
+        end_ts = shard_row.shard_end_ts
+        complete = not transfers_download['more'] or (
+            end_ts is not None and shard_row.last_sync_ts > end_ts)
+
+        if complete:
+            shard_row.shard_complete = True
+            return 100, False
+
+        total = shard_row.sync_total
+        # Note: avoid division by zero.
+        progress_percent = min(
+            99, int(100.0 * shard_row.sync_done / total if total else 0.0))
+        return progress_percent, True
+
+    def merge_shards(self):
+        """Verify the entire download once all the shards are complete."""
+        request = self.request
+        dbsession = request.dbsession
+        owner = request.owner
+        ivr = self.ivr
+
+        shard_rows = (
+            dbsession.query(VerificationResult)
             .filter(
                 VerificationResult.owner_id == owner.id,
                 VerificationResult.verification_id == ivr.verification_id,
+                VerificationResult.shard != null,
             )
+            .order_by(VerificationResult.shard)
             .all())
-        verified_transfer_ids = set.union(*(set(row[0]) for row in rows))
 
-        missing_transfer_ids = (
-            stored_transfer_ids.difference(verified_transfer_ids))
+        incomplete = [
+            row.shard for row in shard_rows if not row.shard_complete]
+        if incomplete:
+            raise HTTPBadRequest(json_body={
+                'error': 'shards_incomplete',
+                'error_description': (
+                    "Verification of shards %s is not complete." %
+                    ', '.join(str(shard) for shard in incomplete)),
+            })
+
+        ivr.sync_done = sum(row.sync_done for row in shard_rows)
+        ivr.sync_total = max(
+            ivr.sync_done, sum(row.sync_total for row in shard_rows))
+        last_row = shard_rows[-1]
+        ivr.last_sync_ts = last_row.last_sync_ts
+        ivr.last_sync_transfer_id = last_row.last_sync_transfer_id
 
-        if missing_transfer_ids:
-            missing_list = sorted(missing_transfer_ids)
-            transfer_id = missing_list[0]
+        self.verify_final()
+        return 100, False
+
+    def verify_final(self, sample_end_ts=None):
+        """Verify the entire download.
+
+        For incremental verification, sample_end_ts is where the sample
+        of older transfers stopped, or None if the sample reached the end
+        of the history.
+        """
+        request = self.request
+        owner = request.owner
+        ivr = self.ivr
+
+        # Look for transfers downloaded previously that were not
+        # included in the download.
+        if ivr.since_ts is None:
+            record_filter = None
+        else:
+            # Look only in the ranges of the history that were
+            # downloaded. Ranges are exclusive so that transfers
+            # sharing a timestamp with the end of a batch are not
+            # reported as missing.
+            if sample_end_ts is not None:
+                sample_filter = and_(
+                    TransferRecord.timestamp > ivr.sample_start_ts,
+                    TransferRecord.timestamp < sample_end_ts)
+            else:
+                sample_filter = TransferRecord.timestamp > ivr.sample_start_ts
+            record_filter = or_(
+                TransferRecord.timestamp > ivr.since_ts, sample_filter)
+
+        missing_count, transfer_id = self.find_missing_transfers(
+            record_filter=record_filter)
+
+        if missing_count:
             # Note that it's possible for clients to trigger
             # this error inappropriately by downloading
             # only part of the history while claiming all of
@@ -248,100 +610,228 @@ class VerifyAPI(SyncBase):
                 "The transfer appears to be missing from OPN. "
                 "Total missing transfers: %d, verification ID: %s" % (
                     transfer_id,
-                    len(missing_list),
+                    missing_count,
                     ivr.verification_id,
                 ))
             log.error(msg)
             raise VerificationFailure(msg, transfer_id=transfer_id)
 
+        # Record the watermark for the next incremental verification.
+        owner.verified_sync_ts = ivr.last_sync_ts
+        owner.verified_sync_transfer_id = ivr.last_sync_transfer_id
+        if ivr.since_ts is not None:
+            if sample_end_ts is not None:
+                owner.verify_sample_ts = ivr.sample_sync_ts
+                owner.verify_sample_transfer_id = ivr.sample_sync_transfer_id
+            else:
+                # Restart the sample at the beginning next time.
+                owner.verify_sample_ts = None
+                owner.verify_sample_transfer_id = None
+
         if request.json.get('verify_internal'):
             self.verify_internal()
 
-    def verify_internal(self):
-        """Verify the internal state of this tool."""
+    def find_missing_transfers(self, record_filter=None):
+        """Find stored transfers that were not included in the download.
 
-        # Ensure all standard recos sum to zero.
+        Compute the set difference in the database using an anti-join
+        with the keys of the verified transfer maps, so the transfer IDs
+        never need to be loaded into memory. record_filter optionally
+        limits the transfer records to check.
+
+        Return (missing_count, first_missing_transfer_id).
+        """
         request = self.request
         dbsession = request.dbsession
         owner = request.owner
+        ivr = self.ivr
 
-        movement_delta_c = FileMovement.wallet_delta + FileMovement.vault_delta
-        movement_subq = (
-            dbsession.query(func.sum(movement_delta_c).label('delta'))
-            .filter(FileMovement.reco_id == Reco.id)
-            .correlate(Reco)
-            .as_scalar())
-
-        entry_subq = (
-            dbsession.query(func.sum(AccountEntry.delta).label('delta'))
-            .filter(AccountEntry.reco_id == Reco.id)
-            .correlate(Reco)
-            .as_scalar())
-
-        row = (
-            dbsession.query(Reco.id)
+        verified_cte = (
+            dbsession.query(
+                func.jsonb_object_keys(
+                    VerificationResult.verified).label('transfer_id'),
+            )
             .filter(
-                Reco.owner_id == owner.id,
-                Reco.reco_type == 'standard',
-                movement_subq + entry_subq != 0,
+                VerificationResult.owner_id == owner.id,
+                VerificationResult.verification_id == ivr.verification_id,
             )
-            .order_by(Reco.id)
-            .first())
+            .cte('verified_cte'))
 
-        if row is not None:
-            [reco_id] = row
-            msg = (
-                "Reconciliation verification failure: "
-                "standard reconciliation %s is unbalanced." % reco_id)
-            raise VerificationFailure(msg, transfer_id=None)
-
-        # Ensure the balance at the start of every period matches the end
-        # of the previous period.
-
-        periods = (
-            dbsession.query(Period)
-            .filter(Period.owner_id == owner.id)
-            .order_by(
-                Period.file_id,
-                Period.start_date)
-            .all())
+        query = (
+            dbsession.query(
+                func.count(TransferRecord.id).label('missing_count'),
+                func.min(TransferRecord.transfer_id.collate('C')).label(
+                    'transfer_id'),
+            )
+            .outerjoin(
+                verified_cte,
+                verified_cte.c.transfer_id == TransferRecord.transfer_id)
+            .filter(
+                TransferRecord.owner_id == owner.id,
+                verified_cte.c.transfer_id == null,
+            ))
+        if record_filter is not None:
+            query = query.filter(record_filter)
+        row = query.one()
+
+        return row.missing_count, row.transfer_id
+
+    def verify_internal(self):
+        """Verify the internal state of this tool.
+
+        Report up to violation_limit violations of each kind, along with
+        the time spent on each check.
+        """
+        timing = {}
+
+        start = time.time()
+        unbalanced_recos = self.find_unbalanced_recos()
+        timing['recos'] = round(time.time() - start, 3)
+
+        start = time.time()
+        period_mismatches = self.find_period_mismatches()
+        timing['periods'] = round(time.time() - start, 3)
+
+        result = {
+            'recos_ok': not unbalanced_recos,
+            'periods_ok': not period_mismatches,
+            'unbalanced_recos': unbalanced_recos,
+            'period_mismatches': period_mismatches,
+            'timing': timing,
+        }
 
-        prev_file_id = None
-        prev_period = None
-
-        for period in periods:
-            file_id = period.file_id
-            if file_id != prev_file_id:
-                # Start of a new sequence
-                prev_file_id = file_id
-                prev_period = period
-                continue
-
-            if not prev_period.closed:
-                # The previous balance is still fluctuating.
-                prev_period = period
-                continue
-
-            if (period.start_circ != prev_period.end_circ or
-                    period.start_surplus != prev_period.end_surplus):
-                msg = (
+        if unbalanced_recos or period_mismatches:
+            msgs = []
+            for item in unbalanced_recos:
+                msgs.append(
+                    "Reconciliation verification failure: "
+                    "standard reconciliation %s is unbalanced "
+                    "(sum of changes: %s)." % (
+                        item['reco_id'], item['delta']))
+            for item in period_mismatches:
+                msgs.append(
                     "Period balance verification failure: "
                     "Period %s (start date %s) starts with balances of "
                     "%s (circulation) and %s (surplus), "
                     "but the previous period ends with "
                     "%s (circulation) and %s (surplus)." % (
-                        period.id,
-                        period.start_date.isoformat(),
-                        period.start_circ, period.start_surplus,
-                        prev_period.end_circ, prev_period.end_surplus,
+                        item['period_id'],
+                        item['start_date'],
+                        item['start_circ'], item['start_surplus'],
+                        item['prev_end_circ'], item['prev_end_surplus'],
                     ))
-                raise VerificationFailure(msg, transfer_id=None)
+            raise VerificationFailure(
+                ' '.join(msgs), transfer_id=None, details=result)
+
+        self.ivr.internal_result = result
 
-            prev_period = period
+    # violation_limit is the maximum number of violations of each kind
+    # to report.
+    violation_limit = 100
 
-        self.ivr.internal_result = {
-            'recos_ok': True, 'periods_ok': True,
+    def find_unbalanced_recos(self):
+        """List the standard recos whose changes do not sum to zero."""
+        request = self.request
+        dbsession = request.dbsession
+        owner = request.owner
+
+        # Sum the movements and account entries per reco in one pass
+        # over each table rather than once per reco.
+        movement_delta_c = FileMovement.wallet_delta + FileMovement.vault_delta
+        delta_union = union_all(
+            select([
+                FileMovement.reco_id.label('reco_id'),
+                movement_delta_c.label('delta'),
+            ]).where(and_(
+                FileMovement.owner_id == owner.id,
+                FileMovement.reco_id != null,
+            )),
+            select([
+                AccountEntry.reco_id.label('reco_id'),
+                AccountEntry.delta.label('delta'),
+            ]).where(and_(
+                AccountEntry.owner_id == owner.id,
+                AccountEntry.reco_id != null,
+            )),
+        ).alias('delta_union')
+
+        delta_sum_c = func.sum(delta_union.c.delta)
+        rows = (
+            dbsession.query(Reco.id, delta_sum_c)
+            .join(delta_union, delta_union.c.reco_id == Reco.id)
+            .filter(
+                Reco.owner_id == owner.id,
+                Reco.reco_type == 'standard',
+            )
+            .group_by(Reco.id)
+            .having(delta_sum_c != 0)
+            .order_by(Reco.id)
+            .limit(self.violation_limit)
+            .all())
+
+        return [{
+            'reco_id': str(reco_id),
+            'delta': str(delta),
+        } for (reco_id, delta) in rows]
+
+    def find_period_mismatches(self):
+        """List the periods that do not start where the previous ended.
+
+        Periods that follow an open period are not checked because
+        the balance of the open period is still fluctuating.
+        """
+        request = self.request
+        dbsession = request.dbsession
+        owner = request.owner
+
+        window = {
+            'partition_by': Period.file_id,
+            'order_by': Period.start_date,
         }
+        period_cte = (
+            select([
+                Period.id,
+                Period.start_date,
+                Period.start_circ,
+                Period.start_surplus,
+                func.lag(Period.closed).over(**window).label('prev_closed'),
+                func.lag(Period.end_circ).over(**window).label(
+                    'prev_end_circ'),
+                func.lag(Period.end_surplus).over(**window).label(
+                    'prev_end_surplus'),
+            ])
+            .where(Period.owner_id == owner.id)
+            .cte('period_cte'))
+
+        c = period_cte.c
+        rows = dbsession.execute(
+            select([
+                c.id,
+                c.start_date,
+                c.start_circ,
+                c.start_surplus,
+                c.prev_end_circ,
+                c.prev_end_surplus,
+            ])
+            .where(and_(
+                c.prev_closed,
+                or_(
+                    c.start_circ != c.prev_end_circ,
+                    c.start_surplus != c.prev_end_surplus,
+                ),
+            ))
+            .order_by(c.id)
+            .limit(self.violation_limit)).fetchall()
+
+        return [{
+            'period_id': str(row.id),
+            'start_date': (
+                row.start_date.isoformat() if row.start_date else None),
+            'start_circ': str(row.start_circ),
+            'start_surplus': str(row.start_surplus),
+            'prev_end_circ': str(row.prev_end_circ),
+            'prev_end_surplus': str(row.prev_end_surplus),
+        } for row in rows]
 
 
 @view_config(
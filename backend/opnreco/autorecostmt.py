@@ -1,25 +1,31 @@
 
-from decimal import Decimal
 from opnreco.models.db import AccountEntry
 from opnreco.models.db import FileMovement
 from opnreco.models.db import Period
 from opnreco.models.db import Reco
 from opnreco.models.db import TransferRecord
+from opnreco.models.dbmeta import call_after_commit
+from opnreco.viewcommon import get_file_versions
 from opnreco.viewcommon import get_tzname
+from opnreco.viewcommon import make_array_cte
+from sqlalchemy import and_
 from sqlalchemy import BigInteger
 from sqlalchemy import Date
 from sqlalchemy import cast
 from sqlalchemy import func
-from sqlalchemy import literal
+from sqlalchemy import Integer
 from sqlalchemy import Numeric
 from sqlalchemy import select
 from sqlalchemy import String
 from sqlalchemy import union_all
+from sqlalchemy.dialects.postgresql import aggregate_order_by
 from sqlalchemy.dialects.postgresql import array
 from sqlalchemy.dialects.postgresql import array_agg
+from sqlalchemy.dialects.postgresql import JSONB
 import collections
 import datetime
 import logging
+import threading
 
 log = logging.getLogger(__name__)
 
@@ -27,6 +33,9 @@ null = None
 max_autoreco_delay = datetime.timedelta(days=7)
 file_movement_delta = -(FileMovement.wallet_delta + FileMovement.vault_delta)
 
+# The maximum number of files that keep a cached BundleIndex.
+bundle_index_cache_size = 100
+
 
 class SortableMatch:
     """A potential reconciliation match.
@@ -104,6 +113,119 @@ def build_single_movement_query(dbsession, owner, period):
         ))
 
 
+class BundleIndex:
+    """The bundles of a file and their unreconciled bundled movements.
+
+    Listing the bundles requires an aggregate query over all the
+    unreconciled bundled movements in the open periods of a file, so
+    BundleFinder caches the index for each file and reuses it for every
+    statement uploaded until the token changes.
+
+    Attributes:
+
+    - token: identifies the state of the database the index describes.
+      See get_bundle_index_token().
+
+    - qualified_bundles: [(bundle_transfer_id, date, delta, movement_ids)]
+      lists the bundles qualified for auto reconciliation.
+
+    - unqualified_movement_ids: the IDs of the unreconciled movements
+      that belong to bundles that did not qualify.
+    """
+
+    def __init__(self, token, qualified_bundles, unqualified_movement_ids):
+        self.token = token
+        self.qualified_bundles = qualified_bundles
+        self.unqualified_movement_ids = unqualified_movement_ids
+
+    def without_movements(self, movement_ids, token):
+        """Return a copy of the index without the specified movements.
+
+        Reconciling any movement of a qualified bundle disqualifies the
+        bundle because the bundled transfer is then reconciled in part.
+        Reconciling a movement of an unqualified bundle could make that
+        bundle qualify, so return None in that case; the index
+        needs to be rebuilt.
+
+        Cached indexes may be shared between threads, so this does not
+        modify the index in place.
+        """
+        movement_ids = set(movement_ids)
+        if not movement_ids.isdisjoint(self.unqualified_movement_ids):
+            return None
+
+        qualified_bundles = [
+            bundle for bundle in self.qualified_bundles
+            if movement_ids.isdisjoint(bundle[3])]
+
+        return BundleIndex(
+            token=token,
+            qualified_bundles=qualified_bundles,
+            unqualified_movement_ids=self.unqualified_movement_ids,
+        )
+
+
+# bundle_index_cache: {(owner_id, file_id): BundleIndex}
+bundle_index_cache = collections.OrderedDict()
+bundle_index_cache_lock = threading.Lock()
+
+
+def get_cached_bundle_index(owner_id, file_id, token):
+    """Get the cached BundleIndex for a file if it is still current."""
+    key = (owner_id, file_id)
+    with bundle_index_cache_lock:
+        index = bundle_index_cache.get(key)
+        if index is None:
+            return None
+        if index.token != token:
+            del bundle_index_cache[key]
+            return None
+        bundle_index_cache.move_to_end(key)
+        return index
+
+
+def set_cached_bundle_index(owner_id, file_id, index):
+    """Cache a BundleIndex, discarding the least recently used ones.
+
+    Set index to None to remove the cached index.
+    """
+    key = (owner_id, file_id)
+    with bundle_index_cache_lock:
+        if index is None:
+            bundle_index_cache.pop(key, None)
+            return
+        bundle_index_cache[key] = index
+        bundle_index_cache.move_to_end(key)
+        while len(bundle_index_cache) > bundle_index_cache_size:
+            bundle_index_cache.popitem(last=False)
+
+
+def get_bundle_index_token(dbsession, owner, file_id):
+    """Get a token that changes whenever a file's BundleIndex may be stale.
+
+    The movement version of the file changes in commit order whenever
+    the file's movements (including their recos and periods), its
+    periods, or the owner's transfer records (including
+    bundled_transfers) change. See opnreco.models.db.FileVersion.
+    """
+    movement_version, _entry_version = get_file_versions(
+        dbsession=dbsession, file_id=file_id)
+    return (movement_version, get_tzname(owner))
+
+
+def publish_bundle_index(dbsession, owner_id, file_id, index):
+    """Cache a BundleIndex once the state it describes is committed.
+
+    The index may describe changes made by the current transaction,
+    so other transactions must not see it unless the transaction commits.
+    """
+    def publish():
+        set_cached_bundle_index(
+            owner_id=owner_id, file_id=file_id, index=index)
+
+    call_after_commit(dbsession, publish)
+
+
 class BundleFinder:
     """Build a query that lists the qualified, unreconciled bundled transfers.
 
@@ -129,37 +251,117 @@ class BundleFinder:
         self.dbsession = dbsession
         self.owner = owner
         self.period = period
+        self.index = None
 
     def find(self):
         """Create and return bundle_query or None (if nothing qualifies)."""
-        movement_list_lookup = self.build_movement_list_lookup()
-        if not movement_list_lookup:
-            return None
-
-        bundle_records = self.list_bundle_records()
-        if not bundle_records:
-            return None
-
-        qualified_bundles = self.list_qualified_bundles(
-            bundle_records=bundle_records,
-            movement_list_lookup=movement_list_lookup)
-        if not qualified_bundles:
+        index = self.get_index()
+        if not index.qualified_bundles:
             return None
 
-        return self.build_query(qualified_bundles=qualified_bundles)
+        return self.build_query(qualified_bundles=index.qualified_bundles)
 
-    def build_movement_list_lookup(self):
-        """List the unreconciled movements that could be part of bundles."""
+    def get_index(self):
+        """Get the BundleIndex for the file, building it if necessary."""
+        owner = self.owner
+        file_id = self.period.file_id
+        token = get_bundle_index_token(
+            dbsession=self.dbsession, owner=owner, file_id=file_id)
+        index = self.index
+        if index is None or index.token != token:
+            index = get_cached_bundle_index(
+                owner_id=owner.id, file_id=file_id, token=token)
+
+        if index is None:
+            qualified_bundles = []
+            unqualified_movement_ids = set()
+            for row in self.list_bundles():
+                if row.qualified:
+                    qualified_bundles.append((
+                        row.transfer_id,
+                        row.date,
+                        row.delta,
+                        row.movement_ids,
+                    ))
+                else:
+                    unqualified_movement_ids.update(row.movement_ids)
+
+            log.info(
+                "BundleFinder: %s qualified bundle(s) for period %s",
+                len(qualified_bundles), self.period.id)
+
+            index = BundleIndex(
+                token=token,
+                qualified_bundles=qualified_bundles,
+                unqualified_movement_ids=frozenset(unqualified_movement_ids),
+            )
+            publish_bundle_index(
+                dbsession=self.dbsession,
+                owner_id=owner.id,
+                file_id=file_id,
+                index=index)
+        else:
+            log.info(
+                "BundleFinder: using the cached bundle index for file %s",
+                file_id)
+
+        self.index = index
+        return index
+
+    def discard_movements(self, movement_ids):
+        """Update the cached index after reconciling movements.
+
+        Call this after the reconciled movements have been flushed
+        so the next statement can reuse the index without rebuilding it.
+        The updated index is cached when the transaction commits.
+        """
+        index = self.index
+        if index is None:
+            return
+        owner = self.owner
+        file_id = self.period.file_id
+        token = get_bundle_index_token(
+            dbsession=self.dbsession, owner=owner, file_id=file_id)
+        self.index = index = index.without_movements(movement_ids, token)
+        if index is not None:
+            publish_bundle_index(
+                dbsession=self.dbsession,
+                owner_id=owner.id,
+                file_id=file_id,
+                index=index)
+
+    def list_bundles(self):
+        """List the bundles that contain unreconciled bundled movements.
+
+        Qualify each bundle in a single query. Each bundle transfer
+        produces one row per issuer, since this may generate more
+        than one bundle per transfer, especially if the bundle transfer
+        used multiple issuers. A bundle qualifies when, for every bundled
+        transfer listed in the bundle's bundled_transfers, the sum of the
+        unreconciled movements matches the specified amount.
+
+        Return rows with these columns:
+
+        - transfer_id (of the bundle)
+        - date
+        - issuer_id
+        - qualified
+        - delta
+        - movement_ids
+        """
         dbsession = self.dbsession
         owner = self.owner
         period = self.period
 
-        movement_rows = (
+        # bundled_movement_cte lists the unreconciled bundled movements
+        # in open periods of this file.
+        bundled_movement_cte = (
             dbsession.query(
+                FileMovement.movement_id,
                 FileMovement.issuer_id,
                 TransferRecord.transfer_id,
-                func.sum(file_movement_delta).label('delta'),
-                array_agg(FileMovement.movement_id).label('movement_ids'),
+                TransferRecord.bundle_transfer_id,
+                file_movement_delta.label('delta'),
             )
             .select_from(FileMovement)
             .join(
@@ -174,182 +376,186 @@ class BundleFinder:
                 TransferRecord.bundle_transfer_id != null,
                 ~Period.closed,
             )
-            .group_by(
-                FileMovement.issuer_id,
-                TransferRecord.transfer_id,
-            )
-            .all())
-
-        log.info(
-            "BundleFinder: %s unreconciled bundled movement(s) for period %s",
-            len(movement_rows), period.id)
-
-        # movement_list_lookup: {
-        #     (bundled_transfer_id, issuer_id): (delta, movement_ids)
-        # }
-        movement_list_lookup = {}
-        for row in movement_rows:
-            key = (row.transfer_id, row.issuer_id)
-            movement_list_lookup[key] = (row.delta, row.movement_ids)
+            .cte('bundled_movement_cte'))
 
-        return movement_list_lookup
-
-    def list_bundle_records(self):
-        """List bundle transfers that contain unreconciled bundled movements.
-        """
-        dbsession = self.dbsession
-        owner = self.owner
-        period = self.period
-
-        # bundle_transfer_ids_cte lists the bundle transfer IDs
-        # of the unreconciled bundled movements for this file.
-        bundle_transfer_ids_cte = (
-            dbsession.query(TransferRecord.bundle_transfer_id)
-            .select_from(FileMovement)
-            .join(
-                TransferRecord,
-                TransferRecord.id == FileMovement.transfer_record_id)
-            .join(Period, Period.id == FileMovement.period_id)
-            .filter(
-                FileMovement.owner_id == owner.id,
-                FileMovement.file_id == period.file_id,
-                FileMovement.reco_id == null,
-                file_movement_delta != 0,
-                TransferRecord.bundle_transfer_id != null,
-                ~Period.closed,
+        # movement_sum_cte sums the unreconciled movements
+        # of each bundled transfer and issuer.
+        movement_sum_cte = (
+            dbsession.query(
+                bundled_movement_cte.c.transfer_id,
+                bundled_movement_cte.c.issuer_id,
+                func.sum(bundled_movement_cte.c.delta).label('delta'),
+            )
+            .group_by(
+                bundled_movement_cte.c.transfer_id,
+                bundled_movement_cte.c.issuer_id,
             )
-            .distinct()
-            .cte('bundle_transfer_ids_cte'))
+            .cte('movement_sum_cte'))
 
         record_date_c = func.date(func.timezone(
             get_tzname(owner),
             func.timezone('UTC', TransferRecord.start)
         ))
 
-        bundle_records = (
+        # bundled_transfer_cte expands the bundled_transfers of the bundles
+        # that contain unreconciled bundled movements.
+        bundled_transfer_cte = (
             dbsession.query(
                 TransferRecord.transfer_id,
-                TransferRecord.bundled_transfers,
                 record_date_c.label('date'),
+                func.jsonb_array_elements(
+                    TransferRecord.bundled_transfers,
+                    type_=JSONB,
+                ).label('bundled_transfer'),
             )
             .filter(
                 TransferRecord.owner_id == owner.id,
-                TransferRecord.transfer_id.in_(bundle_transfer_ids_cte),
+                TransferRecord.transfer_id.in_(
+                    dbsession.query(bundled_movement_cte.c.bundle_transfer_id)
+                    .distinct()),
                 TransferRecord.bundled_transfers != null,
                 func.jsonb_array_length(TransferRecord.bundled_transfers) > 0,
             )
-            .order_by(TransferRecord.start, TransferRecord.transfer_id)
+            .cte('bundled_transfer_cte'))
+
+        # spec_cte is the mapping of movements required for each bundle
+        # to qualify for automatic bundle reconciliation.
+        bundled_transfer = bundled_transfer_cte.c.bundled_transfer
+        spec_cte = (
+            dbsession.query(
+                bundled_transfer_cte.c.transfer_id,
+                bundled_transfer_cte.c.date,
+                bundled_transfer['issuer_id'].astext.label('issuer_id'),
+                bundled_transfer['transfer_id'].astext.label(
+                    'bundled_transfer_id'),
+                func.sum(cast(
+                    bundled_transfer['amount'].astext, Numeric,
+                )).label('delta'),
+            )
+            .group_by(
+                bundled_transfer_cte.c.transfer_id,
+                bundled_transfer_cte.c.date,
+                bundled_transfer['issuer_id'].astext,
+                bundled_transfer['transfer_id'].astext,
+            )
+            .cte('spec_cte'))
+
+        # bundle_cte qualifies each bundle. The bundle does not qualify if
+        # any bundled transfer was not downloaded, did not send the
+        # specified amount, or is already reconciled (in full or in part).
+        bundle_cte = (
+            dbsession.query(
+                spec_cte.c.transfer_id,
+                spec_cte.c.date,
+                spec_cte.c.issuer_id,
+                func.bool_and(func.coalesce(
+                    movement_sum_cte.c.delta == spec_cte.c.delta,
+                    False,
+                )).label('qualified'),
+                func.sum(spec_cte.c.delta).label('delta'),
+            )
+            .select_from(spec_cte)
+            .outerjoin(movement_sum_cte, and_(
+                movement_sum_cte.c.transfer_id ==
+                spec_cte.c.bundled_transfer_id,
+                movement_sum_cte.c.issuer_id == spec_cte.c.issuer_id,
+            ))
+            .group_by(
+                spec_cte.c.transfer_id,
+                spec_cte.c.date,
+                spec_cte.c.issuer_id,
+            )
+            .cte('bundle_cte'))
+
+        # Attach the unreconciled movements to each bundle.
+        rows = (
+            dbsession.query(
+                bundle_cte.c.transfer_id,
+                bundle_cte.c.date,
+                bundle_cte.c.issuer_id,
+                bundle_cte.c.qualified,
+                bundle_cte.c.delta,
+                array_agg(aggregate_order_by(
+                    bundled_movement_cte.c.movement_id,
+                    bundled_movement_cte.c.movement_id,
+                )).label('movement_ids'),
+            )
+            .select_from(bundle_cte)
+            .join(spec_cte, and_(
+                spec_cte.c.transfer_id == bundle_cte.c.transfer_id,
+                spec_cte.c.issuer_id == bundle_cte.c.issuer_id,
+            ))
+            .join(bundled_movement_cte, and_(
+                bundled_movement_cte.c.transfer_id ==
+                spec_cte.c.bundled_transfer_id,
+                bundled_movement_cte.c.issuer_id == spec_cte.c.issuer_id,
+            ))
+            .group_by(
+                bundle_cte.c.transfer_id,
+                bundle_cte.c.date,
+                bundle_cte.c.issuer_id,
+                bundle_cte.c.qualified,
+                bundle_cte.c.delta,
+            )
+            .order_by(
+                bundle_cte.c.date,
+                bundle_cte.c.transfer_id,
+                bundle_cte.c.issuer_id,
+            )
             .all())
 
         log.info(
             "BundleFinder: %s unreconciled bundle(s) for period %s",
-            len(bundle_records), period.id)
-
-        return bundle_records
+            len(rows), period.id)
 
-    def list_qualified_bundles(self, bundle_records, movement_list_lookup):
-        """List the bundle records qualified for auto reconciliation.
+        return rows
 
-        The results must be formatted for building the bundle_query.
-
-        Note that this may generate more than one bundle per transfer,
-        especially if the bundle transfer used multiple issuers.
+    def build_query(self, qualified_bundles):
+        """Create a query from the qualified bundles.
 
-        Return [(
-            bundle_transfer_id,
-            date,
-            delta,
-            movement_ids,
-        )].
+        Pass the bundles as bound arrays rather than literal SQL.
+        The movement IDs are flattened into bundle_movement_cte and
+        regrouped by bundle index.
         """
-        qualified_bundles = []
-
-        for bundle_record in bundle_records:
-            # specs is the mapping of movements required for each bundle
-            # to qualify for automatic bundle reconciliation.
-            # specs:
-            # {issuer_id: {bundled_transfer_id: delta}}
-            specs = collections.defaultdict(
-                lambda: collections.defaultdict(Decimal))
-            for t in bundle_record.bundled_transfers:
-                key = t['issuer_id']
-                specs[key][t['transfer_id']] += Decimal(t['amount'])
-
-            for issuer_id, spec in sorted(specs.items()):
-                # issuer_id and spec describe a potentially reconcilable
-                # bundle. Do the unreconciled movements match the spec?
-                qualified = True
-                bundled_movement_ids = []
-                total_delta = Decimal()
-                for bundled_transfer_id, spec_delta in sorted(spec.items()):
-                    movement_key = (bundled_transfer_id, issuer_id)
-                    movements_info = movement_list_lookup.get(movement_key)
-                    if not movements_info:
-                        # The bundle should not be reconciled
-                        # automatically because this bundled transfer
-                        # was not downloaded or is already
-                        # reconciled (in full or in part).
-                        qualified = False
-                        break
-                    else:
-                        movements_delta, movement_ids = movements_info
-                        if movements_delta != spec_delta:
-                            # The bundle transfer should not be reconciled
-                            # automatically because this bundled transfer
-                            # did not send the specified amount or is already
-                            # reconciled (in full or in part).
-                            qualified = False
-                            break
-                        else:
-                            bundled_movement_ids.extend(movement_ids)
-                            total_delta += spec_delta
-
-                if not qualified:
-                    continue
-
-                # Found a qualified bundle. Add it to qualified_bundles.
-                qualified_bundles.append((
-                    bundle_record.transfer_id,
-                    bundle_record.date,
-                    total_delta,
-                    bundled_movement_ids,
-                ))
-
-        log.info(
-            "BundleFinder: %s qualified bundle(s) for period %s",
-            len(qualified_bundles), self.period.id)
-        return qualified_bundles
-
-    def build_query(self, qualified_bundles):
-        """Create a query from the qualified bundles."""
-        stmts = []
-        for tup in qualified_bundles:
-            (
-                transfer_id,
-                date,
-                delta,
-                movement_ids,
-            ) = tup
-            if not stmts:
-                # Apply column types and labels to the first row.
-                stmts.append(select([
-                    cast(literal(transfer_id), String).label('transfer_id'),
-                    cast(literal(date), Date).label('date'),
-                    cast(literal(delta), Numeric).label('delta'),
-                    array(movement_ids, type_=BigInteger).label(
-                        'movement_ids'),
-                ]))
-            else:
-                # The column types and labels in the remaining rows are
-                # inferred from the first row.
-                stmts.append(select([
-                    literal(transfer_id),
-                    literal(date),
-                    literal(delta),
-                    array(movement_ids),
-                ]))
-
-        query = union_all(*stmts)
+        bundle_indexes = []
+        movement_bundle_indexes = []
+        movement_ids = []
+        for bundle_index, tup in enumerate(qualified_bundles):
+            bundle_indexes.append(bundle_index)
+            for movement_id in tup[3]:
+                movement_bundle_indexes.append(bundle_index)
+                movement_ids.append(movement_id)
+
+        bundle_cte = make_array_cte('bundle_cte', [
+            ('bundle_index', Integer, bundle_indexes),
+            ('transfer_id', String, [tup[0] for tup in qualified_bundles]),
+            ('date', Date, [tup[1] for tup in qualified_bundles]),
+            ('delta', Numeric, [tup[2] for tup in qualified_bundles]),
+        ])
+
+        bundle_movement_cte = make_array_cte('bundle_movement_cte', [
+            ('bundle_index', Integer, movement_bundle_indexes),
+            ('movement_id', BigInteger, movement_ids),
+        ])
+
+        query = (
+            select([
+                bundle_cte.c.transfer_id,
+                bundle_cte.c.date,
+                bundle_cte.c.delta,
+                array_agg(bundle_movement_cte.c.movement_id).label(
+                    'movement_ids'),
+            ])
+            .select_from(bundle_cte.join(
+                bundle_movement_cte,
+                bundle_movement_cte.c.bundle_index ==
+                bundle_cte.c.bundle_index))
+            .group_by(
+                bundle_cte.c.bundle_index,
+                bundle_cte.c.transfer_id,
+                bundle_cte.c.date,
+                bundle_cte.c.delta,
+            ))
         return query
 
 
@@ -364,10 +570,11 @@ def auto_reco_statement(dbsession, owner, period, statement):
 
     # Also reconcile with bundled movements (receive_ach_file transfers,
     # for example.)
-    bundle_query = BundleFinder(
+    bundle_finder = BundleFinder(
         dbsession=dbsession,
         owner=owner,
-        period=period).find()
+        period=period)
+    bundle_query = bundle_finder.find()
 
     if bundle_query is not None:
         # Include bundle matches.
@@ -502,3 +709,6 @@ def auto_reco_statement(dbsession, owner, period, statement):
         entry.reco_id = reco.id
         entry.period_id = period.id
     dbsession.flush()
+
+    # Keep the cached bundle index current for the next statement.
+    bundle_finder.discard_movements(movement_recos.keys())
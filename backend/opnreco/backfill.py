@@ -0,0 +1,329 @@
+
+"""
+Set-based interpretation of all movements for a File that has never synced.
+
+MovementInterpreter.interpret() interprets one Movement at a time, which
+is slow for an owner with millions of movements. When a File has no
+FileSync rows yet, backfill_file() creates the same FileMovements using
+INSERT ... SELECT statements that express the interpretation rules in SQL.
+Only auto-reconciliation within transfers is left to Python.
+"""
+
+from opnreco.models.db import FileLoopConfig
+from opnreco.models.db import FileMovement
+from opnreco.models.db import FileSync
+from opnreco.models.db import Movement
+from opnreco.models.db import OwnerLog
+from opnreco.models.db import TransferRecord
+from opnreco.viewcommon import configure_dblog
+from opnreco.viewcommon import make_array_cte
+from sqlalchemy import and_
+from sqlalchemy import BigInteger
+from sqlalchemy import case
+from sqlalchemy import Date
+from sqlalchemy import cast
+from sqlalchemy import exists
+from sqlalchemy import func
+from sqlalchemy import literal
+from sqlalchemy import or_
+from sqlalchemy import select
+import collections
+import logging
+
+log = logging.getLogger(__name__)
+null = None
+
+# autoreco_batch_size is the number of transfers to load at a time
+# for auto-reconciliation.
+autoreco_batch_size = 100
+
+
+def backfill_needed(dbsession, file):
+    """Return true if the file has no FileSync or FileMovement rows."""
+    row = (
+        dbsession.query(FileSync.transfer_record_id)
+        .filter(FileSync.file_id == file.id)
+        .first())
+    if row is not None:
+        return False
+    row = (
+        dbsession.query(FileMovement.movement_id)
+        .filter(FileMovement.file_id == file.id)
+        .first())
+    return row is None
+
+
+def get_movement_rules(file):
+    """Express the rules of MovementInterpreter.interpret() in SQL.
+
+    Return (filter, peer_id, wallet_delta, vault_delta) expressions
+    over the movement table.
+    """
+    owner_id = file.owner_id
+    from_id = Movement.from_id
+    to_id = Movement.to_id
+    issuer_id = Movement.issuer_id
+    amount = Movement.amount
+    open_loop = Movement.loop_id == '0'
+    file_type = file.file_type
+
+    if file_type == 'open_circ':
+        send = and_(from_id == owner_id, to_id != owner_id)
+        receive = and_(to_id == owner_id, from_id != owner_id)
+        return (
+            and_(open_loop, or_(send, receive)),
+            case([(send, to_id)], else_=from_id),
+            case([
+                # Notes were sent to an account or other wallet.
+                (and_(send, from_id != issuer_id), -amount),
+                # Notes were received from an account or other wallet.
+                (and_(receive, to_id != issuer_id), amount),
+            ], else_=0),
+            case([
+                # Notes were put into circulation.
+                (and_(send, from_id == issuer_id), -amount),
+                # Notes were taken out of circulation.
+                (and_(receive, to_id == issuer_id), amount),
+            ], else_=0),
+        )
+
+    if file_type == 'account':
+        peer_id = file.peer_id
+        send = and_(from_id == owner_id, to_id == peer_id)
+        receive = and_(from_id == peer_id, to_id == owner_id)
+        return (
+            or_(send, receive),
+            literal(peer_id),
+            case([(send, -amount)], else_=amount),
+            literal(0),
+        )
+
+    if file_type == 'closed_circ':
+        loop_enabled = exists().where(and_(
+            FileLoopConfig.file_id == file.id,
+            FileLoopConfig.loop_id == Movement.loop_id,
+            FileLoopConfig.issuer_id == issuer_id,
+            FileLoopConfig.enabled,
+        ))
+        from_me = or_(from_id == owner_id, from_id == issuer_id)
+        to_me = or_(to_id == owner_id, to_id == issuer_id)
+        circulate = and_(~open_loop, from_me, ~to_me)
+        uncirculate = and_(~open_loop, to_me, ~from_me)
+        send = and_(open_loop, from_id == owner_id, to_id != owner_id)
+        receive = and_(open_loop, to_id == owner_id, from_id != owner_id)
+        return (
+            or_(
+                and_(or_(circulate, uncirculate), loop_enabled),
+                send,
+                receive,
+            ),
+            case([(or_(circulate, send), to_id)], else_=from_id),
+            case([(send, -amount), (receive, amount)], else_=0),
+            case([(circulate, -amount), (uncirculate, amount)], else_=0),
+        )
+
+    raise ValueError("Unknown file_type: %s" % file_type)
+
+
+def backfill_file(interpreter):
+    """Create the FileMovements and FileSync rows for a File in bulk.
+
+    interpreter is the File's MovementInterpreter. It assigns periods
+    and performs auto-reconciliation.
+    """
+    request = interpreter.request
+    dbsession = request.dbsession
+    file = interpreter.file
+    owner_id = file.owner_id
+
+    # The movements the file could be interested in.
+    # (Issuance movements have no from_id.)
+    candidate_filter = and_(
+        Movement.owner_id == owner_id,
+        Movement.from_id != null,
+        Movement.from_id != '',
+        Movement.currency == file.currency,
+    )
+
+    if file.file_type == 'closed_circ':
+        add_loop_configs(interpreter, candidate_filter)
+
+    rule_filter, peer_id, wallet_delta, vault_delta = get_movement_rules(file)
+    movement_filter = and_(
+        candidate_filter,
+        rule_filter,
+        Movement.amount != 0,
+    )
+
+    # Map the days of the movements to open periods, adding periods
+    # as needed.
+    day = cast(
+        func.timezone(
+            interpreter.timezone.zone, func.timezone('UTC', Movement.ts)),
+        Date)
+    days = [
+        row[0] for row in (
+            dbsession.query(day.label('day'))
+            .filter(movement_filter)
+            .distinct()
+            .order_by('day')
+            .all())]
+
+    if days:
+        period_ids = [
+            interpreter.get_open_period(day=d).id for d in days]
+        day_period = make_array_cte('day_period', [
+            ('day', Date, days),
+            ('period_id', BigInteger, period_ids),
+        ])
+
+        configure_dblog(
+            request=request, movement_event_type='sync_file_movements')
+
+        movement_select = (
+            select([
+                literal(file.id),
+                Movement.id,
+                Movement.owner_id,
+                Movement.currency,
+                Movement.loop_id,
+                Movement.issuer_id,
+                Movement.transfer_record_id,
+                Movement.ts,
+                peer_id,
+                wallet_delta,
+                vault_delta,
+                day_period.c.period_id,
+                -wallet_delta,
+            ])
+            .select_from(
+                Movement.__table__.join(day_period, day_period.c.day == day))
+            .where(movement_filter))
+
+        dbsession.execute(FileMovement.__table__.insert().from_select([
+            'file_id',
+            'movement_id',
+            'owner_id',
+            'currency',
+            'loop_id',
+            'issuer_id',
+            'transfer_record_id',
+            'ts',
+            'peer_id',
+            'wallet_delta',
+            'vault_delta',
+            'period_id',
+            'surplus_delta',
+        ], movement_select))
+
+    # The file has now interpreted all the owner's transfers.
+    dbsession.execute(FileSync.__table__.insert().from_select(
+        ['file_id', 'transfer_record_id'],
+        select([literal(file.id), TransferRecord.id])
+        .where(TransferRecord.owner_id == owner_id)))
+
+    autoreco_file(interpreter)
+
+
+def add_loop_configs(interpreter, candidate_filter):
+    """Add FileLoopConfigs for all the closed loops in a closed_circ file.
+
+    Do it the way MovementInterpreter.include_closed_loop() would.
+    """
+    request = interpreter.request
+    dbsession = request.dbsession
+    file = interpreter.file
+    owner_id = file.owner_id
+    enabled = bool(file.auto_enable_loops)
+
+    config_select = (
+        select([
+            literal(owner_id),
+            literal(file.id),
+            Movement.loop_id,
+            Movement.issuer_id,
+            literal(enabled),
+        ])
+        .where(and_(
+            candidate_filter,
+            Movement.loop_id != '0',
+            ~exists().where(and_(
+                FileLoopConfig.file_id == file.id,
+                FileLoopConfig.loop_id == Movement.loop_id,
+                FileLoopConfig.issuer_id == Movement.issuer_id,
+            )),
+        ))
+        .distinct())
+
+    added = dbsession.execute(
+        FileLoopConfig.__table__.insert()
+        .from_select(
+            ['owner_id', 'file_id', 'loop_id', 'issuer_id', 'enabled'],
+            config_select)
+        .returning(
+            FileLoopConfig.loop_id,
+            FileLoopConfig.issuer_id)).fetchall()
+
+    if not added:
+        return
+
+    dbsession.execute(OwnerLog.__table__.insert().values([{
+        'owner_id': owner_id,
+        'personal_id': request.personal_id,
+        'event_type': 'add_file_loop_config',
+        'content': {
+            'file_id': file.id,
+            'loop_id': loop_id,
+            'issuer_id': issuer_id,
+            'enabled': enabled,
+        },
+    } for loop_id, issuer_id in sorted(added)]))
+
+    # Reload the loop configuration if it was loaded already.
+    interpreter.__dict__.pop('loops_enabled', None)
+
+
+def autoreco_file(interpreter):
+    """Auto-reconcile within the transfers that have 2+ FileMovements."""
+    dbsession = interpreter.request.dbsession
+    file = interpreter.file
+
+    record_ids = [
+        row[0] for row in (
+            dbsession.query(FileMovement.transfer_record_id)
+            .filter(FileMovement.file_id == file.id)
+            .group_by(FileMovement.transfer_record_id)
+            .having(func.count() >= 2)
+            .order_by(FileMovement.transfer_record_id)
+            .all())]
+
+    if not record_ids:
+        return
+
+    for pos in range(0, len(record_ids), autoreco_batch_size):
+        batch_ids = record_ids[pos:pos + autoreco_batch_size]
+        records = (
+            dbsession.query(TransferRecord)
+            .filter(TransferRecord.id.in_(batch_ids))
+            .order_by(TransferRecord.id)
+            .all())
+        rows = (
+            dbsession.query(FileMovement, Movement)
+            .join(Movement, Movement.id == FileMovement.movement_id)
+            .filter(
+                FileMovement.file_id == file.id,
+                FileMovement.transfer_record_id.in_(batch_ids))
+            .order_by(Movement.transfer_record_id, Movement.id)
+            .all())
+
+        movement_rows = collections.defaultdict(list)
+        for file_movement, movement in rows:
+            movement_rows[movement.transfer_record_id].append(
+                (file_movement, movement))
+
+        for record in records:
+            interpreter.autoreco(
+                record=record,
+                movement_rows=movement_rows[record.id])
+
+        interpreter.save_autorecos()
@@ -0,0 +1,112 @@
+
+"""
+Content-addressed storage for uploaded files.
+
+Blobs are stored in the directory named by the opnreco_blob_dir
+environment variable, at a path derived from the SHA-256 hash of their
+content. A relative directory is relative to the opnreco package
+directory, like opn_frontend_build. Storing identical content again
+reuses the existing blob. Blobs are never modified once written.
+
+Blobs are not deleted with the statements that refer to them, since
+other statements may share them. The gc_opnreco_statement_blobs script
+removes the blobs that no statement refers to.
+"""
+
+import hashlib
+import os
+import tempfile
+
+
+def get_content_id(content):
+    """Return the (sha256, size) that identifies content in the store."""
+    return hashlib.sha256(content).hexdigest(), len(content)
+
+
+class BlobStore:
+    """A directory of blobs named by their SHA-256 hash."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def get_path(self, sha256):
+        """Get the path of a blob. Use 2 levels of subdirectories."""
+        if len(sha256) != 64 or not all(
+                c in '0123456789abcdef' for c in sha256):
+            raise ValueError("Invalid SHA-256 hash: %r" % sha256)
+        return os.path.join(self.directory, sha256[:2], sha256[2:4], sha256)
+
+    def put(self, content):
+        """Store content (bytes) if not already stored.
+
+        If the content is already stored, update the modification time
+        of the blob so garbage collection leaves it alone for a while.
+        Return (sha256, size).
+        """
+        sha256, size = get_content_id(content)
+        path = self.get_path(sha256)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            dirname = os.path.dirname(path)
+            os.makedirs(dirname, exist_ok=True)
+            # Write to a temporary file, then move it into place
+            # so readers never see a partial blob.
+            fd, temp_path = tempfile.mkstemp(dir=dirname, prefix='.tmp-')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(content)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.chmod(temp_path, 0o644)
+                os.replace(temp_path, path)
+            except BaseException:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                raise
+        return sha256, size
+
+    def exists(self, sha256):
+        return os.path.exists(self.get_path(sha256))
+
+    def list_blobs(self):
+        """Generate (sha256, mtime) for each stored blob."""
+        for dirpath, dirnames, filenames in os.walk(self.directory):
+            dirnames.sort()
+            for name in sorted(filenames):
+                if name.startswith('.tmp-'):
+                    continue
+                try:
+                    path = self.get_path(name)
+                except ValueError:
+                    continue
+                if path != os.path.join(dirpath, name):
+                    continue
+                try:
+                    mtime = os.path.getmtime(path)
+                except FileNotFoundError:
+                    continue
+                yield name, mtime
+
+    def remove(self, sha256, max_mtime=None):
+        """Remove a blob.
+
+        If max_mtime is given, keep the blob if it was modified (or
+        reused by put()) after max_mtime. Return true if removed.
+        """
+        path = self.get_path(sha256)
+        try:
+            if max_mtime is not None and os.path.getmtime(path) > max_mtime:
+                return False
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+
+def get_blob_store():
+    """Get the BlobStore configured by the environment."""
+    return BlobStore(os.path.abspath(os.path.join(
+        os.path.dirname(__file__),
+        os.environ['opnreco_blob_dir'],
+    )))
@@ -0,0 +1,92 @@
+
+"""Compress large JSON responses.
+
+Responses smaller than the opnreco.compress_min_size setting (in bytes)
+are sent as-is. Brotli is preferred when the client accepts it and the
+brotli package is installed; otherwise gzip is used.
+"""
+
+from pyramid.settings import asbool
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+default_min_size = 1024
+
+# gzip_level and brotli_quality favor speed over size. The JSON
+# compresses well even at these levels.
+gzip_level = 6
+brotli_quality = 5
+
+compressible_types = frozenset([
+    'application/json',
+])
+
+
+def gzip_compress(data):
+    # wbits=31 selects the gzip container.
+    compressor = zlib.compressobj(gzip_level, zlib.DEFLATED, 31)
+    return compressor.compress(data) + compressor.flush()
+
+
+def brotli_compress(data):
+    return brotli.compress(data, quality=brotli_quality)
+
+
+def get_encoders():
+    """List the available (encoding, compress function) pairs."""
+    res = []
+    if brotli is not None:
+        res.append(('br', brotli_compress))
+    res.append(('gzip', gzip_compress))
+    return res
+
+
+def compress_response(request, response, min_size, encoders):
+    """Compress the response body in place if appropriate."""
+    if request.method == 'HEAD' or not request.headers.get('Accept-Encoding'):
+        return
+    if response.content_encoding or response.status_int in (204, 304):
+        return
+    if response.content_type not in compressible_types:
+        return
+    size = response.content_length
+    if size is None or size < min_size:
+        # Streaming responses have no content_length.
+        return
+
+    offers = request.accept_encoding.acceptable_offers(
+        [encoding for encoding, _compress in encoders])
+    if not offers:
+        return
+    encoding = offers[0][0]
+    compress = dict(encoders)[encoding]
+
+    response.body = compress(response.body)
+    response.content_encoding = encoding
+    vary = response.vary or ()
+    if 'Accept-Encoding' not in vary:
+        response.vary = tuple(vary) + ('Accept-Encoding',)
+
+
+def tween_factory(handler, registry):
+    settings = registry.settings or {}
+    if not asbool(settings.get('opnreco.compress', True)):
+        return handler
+    min_size = int(settings.get('opnreco.compress_min_size', default_min_size))
+    encoders = get_encoders()
+
+    def compress_tween(request):
+        response = handler(request)
+        if response is not None:
+            compress_response(request, response, min_size, encoders)
+        return response
+
+    return compress_tween
+
+
+def includeme(config):
+    config.add_tween('opnreco.compress.tween_factory')
@@ -0,0 +1,133 @@
+
+"""Encode spreadsheet exports a row at a time.
+
+Each export is an iterable of rows (lists of values) that is encoded
+as CSV or as XLSX using an openpyxl write-only workbook, so the rows
+never need to be held in memory together.
+"""
+
+from pyramid.httpexceptions import HTTPBadRequest
+import csv
+import datetime
+import io
+import openpyxl
+import tempfile
+
+# read_size is the number of bytes to read at a time from a saved workbook.
+read_size = 65536
+
+
+# formula_prefixes lists the first characters that make spreadsheet
+# programs evaluate text as a formula.
+formula_prefixes = ('=', '+', '-', '@', '\t', '\r')
+
+
+def escape_formula(value):
+    """Prefix text that looks like a formula with an apostrophe.
+
+    Exported text such as file titles comes from users, so it must not
+    run as a formula when the export is opened.
+    Numbers, including negative Decimals, are unchanged.
+    """
+    if isinstance(value, str) and value.startswith(formula_prefixes):
+        return "'" + value
+    return value
+
+
+def format_csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, datetime.datetime):
+        # Omit the microseconds and 'T' for spreadsheet programs.
+        return value.strftime('%Y-%m-%d %H:%M:%S')
+    if isinstance(value, datetime.date):
+        return value.isoformat()
+    return escape_formula(value)
+
+
+def iter_csv(rows, title):
+    """Encode rows as UTF-8 CSV. Yield bytes."""
+    # Start with a byte order mark so spreadsheet programs detect UTF-8.
+    yield b'\xef\xbb\xbf'
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow([format_csv_value(value) for value in row])
+        yield buf.getvalue().encode('utf-8')
+        buf.seek(0)
+        buf.truncate()
+
+
+def iter_xlsx(rows, title):
+    """Encode rows as an XLSX workbook with one sheet. Yield bytes.
+
+    The write-only workbook stores the rows in a temporary file until
+    the workbook is saved.
+    """
+    book = openpyxl.Workbook(write_only=True)
+    sheet = book.create_sheet(title=title[:31])
+    for row in rows:
+        sheet.append([escape_formula(value) for value in row])
+    with tempfile.TemporaryFile() as f:
+        book.save(f)
+        f.seek(0)
+        while True:
+            data = f.read(read_size)
+            if not data:
+                break
+            yield data
+
+
+# export_formats: {format: (file extension, content type, charset, encoder)}
+export_formats = {
+    'csv': ('csv', 'text/csv', 'UTF-8', iter_csv),
+    'xlsx': (
+        'xlsx',
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        None,
+        iter_xlsx),
+}
+
+
+def get_export_format(params):
+    """Get the export format from request params. Default to CSV."""
+    export_format = params.get('format') or 'csv'
+    if export_format not in export_formats:
+        raise HTTPBadRequest(json_body={
+            'error': 'invalid_format',
+            'error_description': (
+                "The export format must be one of: %s" %
+                ', '.join(sorted(export_formats))),
+        })
+    return export_format
+
+
+def get_period_header_rows(period, title, totals_rows):
+    """Describe a period at the top of an export.
+
+    totals_rows is a list of (label, {'circ', 'surplus', 'combined'}).
+    """
+    file = period.file
+    rows = [
+        [title],
+        ['File', file.title],
+        ['Currency', file.currency],
+        ['Period Start', period.start_date],
+        ['Period End', period.end_date],
+        [],
+        ['', 'Circulation', 'Surplus', 'Combined'],
+    ]
+    for label, totals in totals_rows:
+        rows.append([
+            label, totals['circ'], totals['surplus'], totals['combined']])
+    rows.append([])
+    return rows
+
+
+def get_export_headers(period, name, export_format):
+    """Get the Content-Disposition header for an export of a period."""
+    ext = export_formats[export_format][0]
+    return {
+        'Content-Disposition': 'attachment; filename="%s-period-%s.%s"' % (
+            name, period.id, ext),
+    }
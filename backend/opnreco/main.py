@@ -148,6 +148,7 @@ def main(global_config, **settings):
     config.add_renderer('json', CustomJSONRenderer)
 
     config.include('opnreco.cors')
+    config.include('opnreco.compress')
     config.include('pyramid_retry')
     config.include('pyramid_tm')
     config.include('opnreco.models.dbmeta')
@@ -0,0 +1,218 @@
+
+-- Convert to the 2.2 schema.
+
+begin;
+
+-- Versions for detecting changes to the content of a file.
+CREATE TABLE public.file_version (
+    file_id bigint NOT NULL,
+    movement_version bigint NOT NULL,
+    entry_version bigint NOT NULL
+);
+ALTER TABLE ONLY public.file_version
+    ADD CONSTRAINT pk_file_version PRIMARY KEY (file_id);
+ALTER TABLE ONLY public.file_version
+    ADD CONSTRAINT fk_file_version_file_id_file
+    FOREIGN KEY (file_id) REFERENCES public.file(id);
+
+create or replace function file_version_process() returns trigger
+as $triggerbody$
+begin
+    insert into file_version (file_id, movement_version, entry_version)
+    select distinct
+        file_id,
+        case when TG_ARGV[0] = 'movement' then 1 else 0 end,
+        case when TG_ARGV[0] = 'entry' then 1 else 0 end
+    from changed_rows
+    order by file_id
+    on conflict (file_id) do update set
+        movement_version =
+            file_version.movement_version + excluded.movement_version,
+        entry_version =
+            file_version.entry_version + excluded.entry_version;
+    return null;
+end;
+$triggerbody$ language plpgsql;
+
+create trigger file_movement_version_insert_trigger
+after insert on file_movement
+    referencing new table as changed_rows
+    for each statement execute procedure file_version_process('movement');
+create trigger file_movement_version_update_trigger
+after update on file_movement
+    referencing new table as changed_rows
+    for each statement execute procedure file_version_process('movement');
+create trigger file_movement_version_delete_trigger
+after delete on file_movement
+    referencing old table as changed_rows
+    for each statement execute procedure file_version_process('movement');
+
+create trigger period_version_insert_trigger
+after insert on period
+    referencing new table as changed_rows
+    for each statement execute procedure file_version_process('movement');
+create trigger period_version_update_trigger
+after update on period
+    referencing new table as changed_rows
+    for each statement execute procedure file_version_process('movement');
+create trigger period_version_delete_trigger
+after delete on period
+    referencing old table as changed_rows
+    for each statement execute procedure file_version_process('movement');
+
+create trigger account_entry_version_insert_trigger
+after insert on account_entry
+    referencing new table as changed_rows
+    for each statement execute procedure file_version_process('entry');
+create trigger account_entry_version_update_trigger
+after update on account_entry
+    referencing new table as changed_rows
+    for each statement execute procedure file_version_process('entry');
+create trigger account_entry_version_delete_trigger
+after delete on account_entry
+    referencing old table as changed_rows
+    for each statement execute procedure file_version_process('entry');
+
+-- Incremental verification.
+ALTER TABLE public.owner ADD COLUMN verified_sync_ts timestamp without time zone;
+ALTER TABLE public.owner ADD COLUMN verified_sync_transfer_id character varying;
+ALTER TABLE public.owner ADD COLUMN verify_sample_ts timestamp without time zone;
+ALTER TABLE public.owner ADD COLUMN verify_sample_transfer_id character varying;
+
+ALTER TABLE public.verification_result ADD COLUMN since_ts timestamp without time zone;
+ALTER TABLE public.verification_result ADD COLUMN sample_start_ts timestamp without time zone;
+ALTER TABLE public.verification_result ADD COLUMN sample_sync_ts timestamp without time zone;
+ALTER TABLE public.verification_result ADD COLUMN sample_sync_transfer_id character varying;
+ALTER TABLE public.verification_result ADD COLUMN sample_done bigint;
+
+-- Sharded verification.
+ALTER TABLE public.verification_result ADD COLUMN shard_count integer;
+ALTER TABLE public.verification_result ADD COLUMN shard integer;
+ALTER TABLE public.verification_result ADD COLUMN shard_end_ts timestamp without time zone;
+ALTER TABLE public.verification_result ADD COLUMN shard_complete boolean;
+
+-- Indexes for the reconciliation dialog searches.
+CREATE INDEX ix_file_movement_file_id_abs_vault_delta
+    ON public.file_movement USING btree (file_id, abs(vault_delta));
+CREATE INDEX ix_file_movement_file_id_abs_wallet_delta
+    ON public.file_movement USING btree (file_id, abs(wallet_delta));
+CREATE INDEX ix_file_movement_transfer_record_id
+    ON public.file_movement USING btree (transfer_record_id);
+CREATE INDEX ix_account_entry_file_id_abs_delta
+    ON public.account_entry USING btree (file_id, abs(delta));
+
+-- Trigram indexes for substring searches. Requires the pg_trgm
+-- extension (included in the PostgreSQL contrib package.)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX ix_transfer_record_transfer_id_trgm
+    ON public.transfer_record USING gin (transfer_id gin_trgm_ops);
+CREATE INDEX ix_account_entry_description_trgm
+    ON public.account_entry USING gin (description gin_trgm_ops);
+
+-- Statement uploads are stored in the blob store.
+-- Run move_opnreco_statement_blobs to move existing uploads.
+ALTER TABLE public.statement ADD COLUMN content_sha256 character varying;
+ALTER TABLE public.statement ADD COLUMN content_size bigint;
+
+-- Reject overlapping periods in the database. The constraint can not be
+-- added while any periods overlap, so list the overlapping periods first.
+-- Fix or delete the listed periods, then run this migration again.
+DO $preflight$
+DECLARE
+    overlap_list text;
+BEGIN
+    SELECT string_agg(format(
+            'file %s: period %s (%s to %s) overlaps period %s (%s to %s)',
+            a.file_id,
+            a.id, coalesce(a.start_date::text, 'unbounded'),
+            coalesce(a.end_date::text, 'unbounded'),
+            b.id, coalesce(b.start_date::text, 'unbounded'),
+            coalesce(b.end_date::text, 'unbounded')),
+        E'\n' ORDER BY a.file_id, a.id, b.id)
+    INTO overlap_list
+    FROM public.period a
+    JOIN public.period b ON (
+        b.file_id = a.file_id
+        AND b.id > a.id
+        AND daterange(a.start_date, a.end_date, '[]') &&
+            daterange(b.start_date, b.end_date, '[]'));
+    IF overlap_list IS NOT NULL THEN
+        RAISE EXCEPTION 'Overlapping periods prevent adding the '
+            'period_date_overlap constraint:%', E'\n' || overlap_list;
+    END IF;
+END;
+$preflight$;
+ALTER TABLE public.period ADD CONSTRAINT period_date_overlap
+    EXCLUDE USING gist (
+        int8range(file_id, file_id, '[]') WITH &&,
+        daterange(start_date, end_date, '[]') WITH &&);
+
+-- Summarize the periods of each file for the period list.
+ALTER TABLE public.file ADD COLUMN period_count integer DEFAULT 0 NOT NULL;
+ALTER TABLE public.file ADD COLUMN last_period_end_date date;
+ALTER TABLE public.file
+    ADD COLUMN has_endless_period boolean DEFAULT false NOT NULL;
+CREATE INDEX ix_period_file_id_start_date
+    ON public.period USING btree (file_id, start_date);
+CREATE INDEX ix_period_file_id_end_date
+    ON public.period USING btree (file_id, end_date);
+
+create or replace function period_summary_process() returns trigger
+as $triggerbody$
+begin
+    if (TG_OP in ('DELETE', 'UPDATE')) then
+        -- Remove the old row from the summary. Look up the latest
+        -- end_date only if the old row had it.
+        update file set
+            period_count = period_count - 1,
+            has_endless_period = (
+                has_endless_period and old.end_date is not null),
+            last_period_end_date = case
+                when old.end_date is null
+                    or old.end_date < last_period_end_date
+                    then last_period_end_date
+                else (
+                    select max(period.end_date)
+                    from period
+                    where period.file_id = old.file_id)
+                end
+        where id = old.file_id;
+    end if;
+
+    if (TG_OP in ('INSERT', 'UPDATE')) then
+        -- Add the new row to the summary.
+        update file set
+            period_count = period_count + 1,
+            has_endless_period = (
+                has_endless_period or new.end_date is null),
+            last_period_end_date = greatest(
+                last_period_end_date, new.end_date)
+        where id = new.file_id;
+    end if;
+
+    return null;
+end;
+$triggerbody$ language plpgsql;
+
+create trigger period_summary_trigger
+after insert or delete or update of file_id, end_date on period
+    for each row execute procedure period_summary_process();
+
+UPDATE public.file SET
+    period_count = summary.period_count,
+    last_period_end_date = summary.last_period_end_date,
+    has_endless_period = summary.has_endless_period
+FROM (
+    SELECT
+        file.id AS file_id,
+        count(period.id) AS period_count,
+        max(period.end_date) AS last_period_end_date,
+        coalesce(bool_or(period.end_date IS NULL), false)
+            AS has_endless_period
+    FROM public.file
+    LEFT JOIN public.period ON (period.file_id = file.id)
+    GROUP BY file.id
+) AS summary
+WHERE file.id = summary.file_id;
+
+commit;
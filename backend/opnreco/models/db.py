@@ -64,6 +64,16 @@ class Owner(Base):
     # sync_done is the number of transfer records downloaded
     # successfully in this sync operation.
     sync_done = Column(BigInteger, nullable=False, default=0)
+    # verified_sync_ts and verified_sync_transfer_id are the position in
+    # the OPN history reached by the last successful verification.
+    # Incremental verification starts there.
+    verified_sync_ts = Column(DateTime, nullable=True)
+    verified_sync_transfer_id = Column(String, nullable=True)
+    # verify_sample_ts and verify_sample_transfer_id are the position in
+    # the OPN history where the next incremental verification resumes
+    # its rolling sample of older transfers.
+    verify_sample_ts = Column(DateTime, nullable=True)
+    verify_sample_transfer_id = Column(String, nullable=True)
 
 
 class OwnerLog(Base):
@@ -138,6 +148,15 @@ class File(Base):
     auto_enable_loops = Column(Boolean, nullable=False, default=False)
     archived = Column(Boolean, nullable=False, default=False)
 
+    # period_count, last_period_end_date, and has_endless_period summarize
+    # the file's periods for the period list. The period_summary_trigger
+    # maintains them.
+    period_count = Column(
+        Integer, nullable=False, default=0, server_default='0')
+    last_period_end_date = Column(Date, nullable=True)
+    has_endless_period = Column(
+        Boolean, nullable=False, default=False, server_default='false')
+
     owner = relationship(Owner)
 
     __table_args__ = (
@@ -175,6 +194,31 @@ Index(
     unique=True)
 
 
+class FileVersion(Base):
+    """Counters that change whenever the content of a file changes.
+
+    Caches of per-file query results use the versions to detect stale
+    entries (see opnreco.autorecostmt.BundleIndex and
+    opnreco.searchcache.) The triggers in file_version_ddl and
+    opnreco.viewcommon.bump_owner_file_versions() increment the
+    versions in the same transaction as the change. Concurrent writers
+    wait for each other's lock on the row, so the versions increase in
+    commit order and every committed change produces a new version.
+
+    A file has no file_version row until its content changes for the
+    first time. get_file_versions() treats a missing row as version 0.
+    """
+    __tablename__ = 'file_version'
+    file_id = Column(
+        BigInteger, ForeignKey('file.id'),
+        nullable=False, primary_key=True)
+    # movement_version changes when the file's movements or periods
+    # change, or when the bundles in the owner's transfer records change.
+    movement_version = Column(BigInteger, nullable=False, default=0)
+    # entry_version changes when the file's account entries change.
+    entry_version = Column(BigInteger, nullable=False, default=0)
+
+
 class FileLoopConfig(Base):
     """The configuration of loops for closed_circ files."""
     __tablename__ = 'file_loop_config'
@@ -247,6 +291,85 @@ Index(
     unique=True)
 
 
+# The periods of a file must not overlap. The period_date_overlap
+# exclusion constraint makes the database reject overlapping periods,
+# even when requests edit periods concurrently. Comparing the file_id as
+# a single-value range lets the constraint use the built-in GiST range
+# operator class, so it needs no extension. (file.id is unique across
+# owners.)
+period_overlap_ddl = DDL("""
+alter table period add constraint period_date_overlap
+    exclude using gist (
+        int8range(file_id, file_id, '[]') with &&,
+        daterange(start_date, end_date, '[]') with &&);
+""")
+event.listen(Period.__table__, 'after_create', period_overlap_ddl)
+
+
+Index(
+    # This index supports the keyset pagination of the period list.
+    'ix_period_file_id_start_date',
+    Period.file_id,
+    Period.start_date)
+
+
+Index(
+    # This index finds the latest end_date of a file's periods.
+    'ix_period_file_id_end_date',
+    Period.file_id,
+    Period.end_date)
+
+
+# The period_summary_trigger maintains the period summary columns of
+# File one period row at a time, so writes never aggregate all the
+# periods of a file. Only one period of a file can be endless (see
+# ix_period_single_unbounded_end_date), so has_endless_period changes
+# only with the endless period.
+period_summary_ddl = DDL("""
+create or replace function period_summary_process() returns trigger
+as $triggerbody$
+begin
+    if (TG_OP in ('DELETE', 'UPDATE')) then
+        -- Remove the old row from the summary. Look up the latest
+        -- end_date only if the old row had it.
+        update file set
+            period_count = period_count - 1,
+            has_endless_period = (
+                has_endless_period and old.end_date is not null),
+            last_period_end_date = case
+                when old.end_date is null
+                    or old.end_date < last_period_end_date
+                    then last_period_end_date
+                else (
+                    select max(period.end_date)
+                    from period
+                    where period.file_id = old.file_id)
+                end
+        where id = old.file_id;
+    end if;
+
+    if (TG_OP in ('INSERT', 'UPDATE')) then
+        -- Add the new row to the summary.
+        update file set
+            period_count = period_count + 1,
+            has_endless_period = (
+                has_endless_period or new.end_date is null),
+            last_period_end_date = greatest(
+                last_period_end_date, new.end_date)
+        where id = new.file_id;
+    end if;
+
+    return null;
+end;
+$triggerbody$ language plpgsql;
+
+create trigger period_summary_trigger
+after insert or delete or update of file_id, end_date on period
+    for each row execute procedure period_summary_process();
+""")
+event.listen(Period.__table__, 'after_create', period_summary_ddl)
+
+
 class TransferRecord(Base):
     """An owner's transfer record.
 
@@ -516,6 +639,27 @@ class FileMovement(Base):
         {})
 
 
+# Expression indexes for searching movements by amount in the
+# reconciliation dialog.
+Index(
+    'ix_file_movement_file_id_abs_vault_delta',
+    FileMovement.file_id,
+    func.abs(FileMovement.vault_delta))
+
+
+Index(
+    'ix_file_movement_file_id_abs_wallet_delta',
+    FileMovement.file_id,
+    func.abs(FileMovement.wallet_delta))
+
+
+Index(
+    # This index lets searches by transfer ID join transfer records
+    # to file movements.
+    'ix_file_movement_transfer_record_id',
+    FileMovement.transfer_record_id)
+
+
 class FileMovementLog(Base):
     """Log of changes to a file movement.
 
@@ -611,10 +755,17 @@ class Statement(Base):
         BigInteger, ForeignKey('period.id'), nullable=False, index=True)
     source = Column(Unicode, nullable=True)  # 'manual' or some external ID
 
-    # upload_ts, filename, content_type, and content are set on upload.
+    # upload_ts, filename, content_type, content_sha256, and content_size
+    # are set on upload. content_sha256 identifies the uploaded file in the
+    # blob store (see opnreco.blobstore).
     upload_ts = Column(DateTime, nullable=True)
     filename = Column(Unicode, nullable=True)
     content_type = Column(String, nullable=True)
+    content_sha256 = Column(String, nullable=True)
+    content_size = Column(BigInteger, nullable=True)
+
+    # content holds files uploaded before the blob store existed.
+    # See move_opnreco_statement_blobs.
     content = deferred(Column(LargeBinary, nullable=True))
 
 
@@ -769,6 +920,107 @@ after insert or update or delete on account_entry
 event.listen(AccountEntry.__table__, 'after_create', account_entry_log_ddl)
 
 
+# Expression index for searching account entries by amount in the
+# reconciliation dialog.
+Index(
+    'ix_account_entry_file_id_abs_delta',
+    AccountEntry.file_id,
+    func.abs(AccountEntry.delta))
+
+
+# The trigram indexes make substring searches by transfer ID and
+# account entry description (LIKE '%...%') use an index. The indexes
+# require the pg_trgm extension. If the extension is not available,
+# the searches still work, but they scan the file's movements and entries.
+search_index_ddl = DDL("""
+do $searchbody$
+begin
+    begin
+        create extension if not exists pg_trgm;
+    exception when others then
+        null;
+    end;
+    if exists (select 1 from pg_extension where extname = 'pg_trgm') then
+        create index if not exists ix_transfer_record_transfer_id_trgm
+            on transfer_record using gin (transfer_id gin_trgm_ops);
+        create index if not exists ix_account_entry_description_trgm
+            on account_entry using gin (description gin_trgm_ops);
+    end if;
+end;
+$searchbody$;
+""")
+event.listen(Base.metadata, 'after_create', search_index_ddl)
+
+
+# Increment the file versions in statement level triggers, so each
+# insert, update, or delete statement updates each file_version row
+# once. The file_id of movements, account entries, and periods never
+# changes, so the update triggers only need the new rows. Changes to
+# the bundles in transfer records can affect any file of the owner, so
+# SyncBase calls bump_owner_file_versions() once per batch instead of
+# using a trigger on transfer_record.
+file_version_ddl = DDL("""
+create or replace function file_version_process() returns trigger
+as $triggerbody$
+begin
+    insert into file_version (file_id, movement_version, entry_version)
+    select distinct
+        file_id,
+        case when TG_ARGV[0] = 'movement' then 1 else 0 end,
+        case when TG_ARGV[0] = 'entry' then 1 else 0 end
+    from changed_rows
+    order by file_id
+    on conflict (file_id) do update set
+        movement_version =
+            file_version.movement_version + excluded.movement_version,
+        entry_version =
+            file_version.entry_version + excluded.entry_version;
+    return null;
+end;
+$triggerbody$ language plpgsql;
+
+create trigger file_movement_version_insert_trigger
+after insert on file_movement
+    referencing new table as changed_rows
+    for each statement execute procedure file_version_process('movement');
+create trigger file_movement_version_update_trigger
+after update on file_movement
+    referencing new table as changed_rows
+    for each statement execute procedure file_version_process('movement');
+create trigger file_movement_version_delete_trigger
+after delete on file_movement
+    referencing old table as changed_rows
+    for each statement execute procedure file_version_process('movement');
+
+create trigger period_version_insert_trigger
+after insert on period
+    referencing new table as changed_rows
+    for each statement execute procedure file_version_process('movement');
+create trigger period_version_update_trigger
+after update on period
+    referencing new table as changed_rows
+    for each statement execute procedure file_version_process('movement');
+create trigger period_version_delete_trigger
+after delete on period
+    referencing old table as changed_rows
+    for each statement execute procedure file_version_process('movement');
+
+create trigger account_entry_version_insert_trigger
+after insert on account_entry
+    referencing new table as changed_rows
+    for each statement execute procedure file_version_process('entry');
+create trigger account_entry_version_update_trigger
+after update on account_entry
+    referencing new table as changed_rows
+    for each statement execute procedure file_version_process('entry');
+create trigger account_entry_version_delete_trigger
+after delete on account_entry
+    referencing old table as changed_rows
+    for each statement execute procedure file_version_process('entry');
+""")
+event.listen(Base.metadata, 'after_create', file_version_ddl)
+
+
 class Reco(Base):
     """A reco/reconciliation matches movement(s) and/or account entries."""
     __tablename__ = 'reco'
@@ -833,6 +1085,27 @@ class VerificationResult(Base):
     sync_done = Column(BigInteger, nullable=True)
     internal_result = Column(JSONB(none_as_null=True), nullable=True)
 
+    # since_ts is set only for incremental verification. It is the
+    # watermark where verification of changed transfers started.
+    since_ts = Column(DateTime, nullable=True)
+    # sample_start_ts, sample_sync_ts, sample_sync_transfer_id, and
+    # sample_done describe the rolling sample of older transfers that
+    # incremental verification verifies after the changed transfers.
+    sample_start_ts = Column(DateTime, nullable=True)
+    sample_sync_ts = Column(DateTime, nullable=True)
+    sample_sync_transfer_id = Column(String, nullable=True)
+    sample_done = Column(BigInteger, nullable=True)
+
+    # shard_count is set only for the initial batch of a sharded
+    # verification. shard, shard_end_ts, and shard_complete are set only
+    # for the rows that track the progress of each shard. The shard rows
+    # use last_sync_ts, last_sync_transfer_id, sync_done, and sync_total
+    # for the shard rather than the whole operation.
+    shard_count = Column(Integer, nullable=True)
+    shard = Column(Integer, nullable=True)
+    shard_end_ts = Column(DateTime, nullable=True)
+    shard_complete = Column(Boolean, nullable=True)
+
     # verified: {transfer_id: null or change_log as [{event_type, ...}]}
     verified = Column(JSONB, nullable=False)
     expires = Column(DateTime, nullable=False, index=True)
@@ -1,6 +1,7 @@
 
 from opnreco.render import get_json_default
 from sqlalchemy import engine_from_config
+from sqlalchemy import event
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import configure_mappers
 import json
@@ -63,6 +64,35 @@ def get_tm_dbsession(dbsession_factory, transaction_manager):
     return dbsession
 
 
+def call_after_commit(dbsession, callback):
+    """Call callback() after the session's transaction commits.
+
+    Discard the call if the transaction rolls back instead. Use this to
+    share the results of uncommitted changes with other transactions,
+    such as in a cache.
+    """
+    callbacks = dbsession.info.get('after_commit_callbacks')
+    if callbacks is None:
+        dbsession.info['after_commit_callbacks'] = callbacks = []
+
+        def after_commit(session):
+            if session.transaction.nested:
+                # Wait for the outermost transaction.
+                return
+            pending = list(callbacks)
+            del callbacks[:]
+            for f in pending:
+                f()
+
+        def after_rollback(session):
+            del callbacks[:]
+
+        event.listen(dbsession, 'after_commit', after_commit)
+        event.listen(dbsession, 'after_rollback', after_rollback)
+
+    callbacks.append(callback)
+
+
 def includeme(config):
     """
     Initialize the model for a Pyramid app.
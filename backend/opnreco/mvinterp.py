@@ -1,5 +1,7 @@
 
 from decimal import Decimal
+from opnreco.backfill import backfill_file
+from opnreco.backfill import backfill_needed
 from opnreco.models.db import FileLoopConfig
 from opnreco.models.db import FileMovement
 from opnreco.models.db import FileSync
@@ -10,9 +12,12 @@ from opnreco.models.db import Reco
 from opnreco.models.db import TransferRecord
 from opnreco.viewcommon import add_open_period
 from opnreco.viewcommon import configure_dblog
-from opnreco.viewcommon import get_period_for_day
+from opnreco.viewcommon import make_array_cte
+from opnreco.viewcommon import PeriodIndex
 from pyramid.decorator import reify
 from sqlalchemy import and_
+from sqlalchemy import BigInteger
+from sqlalchemy.orm.attributes import set_committed_value
 import collections
 import logging
 import pytz
@@ -44,6 +49,10 @@ class MovementInterpreter:
         # open_periods: {date: open Period}
         self.open_periods = {}
 
+        # pending_recos lists the auto-recos to add in save_autorecos().
+        # pending_recos: [(transfer_record_id, period_id, [FileMovement])]
+        self.pending_recos = []
+
     @reify
     def timezone(self):
         """Get the pytz time zone for the owner.
@@ -67,6 +76,11 @@ class MovementInterpreter:
             .order_by(Period.id)
             .all())
 
+    @reify
+    def open_period_index(self):
+        """Get a PeriodIndex of the open Periods for the File."""
+        return PeriodIndex(self.open_period_list)
+
     @reify
     def open_period_ids(self):
         """Get the set of open Period IDs for the File."""
@@ -223,18 +237,22 @@ class MovementInterpreter:
 
         if len(to_reconcile) >= 2:
             # Auto-reconciliation within the transfer might be possible.
-            configure_dblog(
-                request=self.request, movement_event_type='autoreco')
             self.autoreco(
                 record=record,
-                movement_rows=to_reconcile,
-                is_new_record=is_new_record)
+                movement_rows=to_reconcile)
+
+    # use_backfill enables the set-based interpretation of all movements
+    # for files that have never synced. See opnreco.backfill.
+    use_backfill = True
 
     def sync_missing(self):
         """Fill in any missing TransferRecord interpretations for this File.
         """
         dbsession = self.request.dbsession
 
+        if self.use_backfill and backfill_needed(dbsession, self.file):
+            backfill_file(self)
+
         while True:
             q = (
                 dbsession.query(TransferRecord)
@@ -284,6 +302,8 @@ class MovementInterpreter:
                     movements=movement_dict.get(record.id, ()),
                     is_new_record=(record.id not in existing_record_ids))
 
+            self.save_autorecos()
+
     def interpret(self, movement):
         """Compute the FileMovement attrs for a Movement in this File.
 
@@ -399,10 +419,8 @@ class MovementInterpreter:
         if period is not None:
             return period
 
-        open_period_list = self.open_period_list
-
         # See if any of the existing periods match.
-        period = get_period_for_day(open_period_list, day)
+        period = self.open_period_index.get(day)
         if period is not None:
             # Found a matching open period.
             self.open_periods[day] = period
@@ -415,6 +433,7 @@ class MovementInterpreter:
             event_type='add_period_for_sync')
 
         self.open_period_list.append(period)
+        self.open_period_index.add(period)
         self.open_periods[day] = period
         self.open_period_ids.add(period.id)
         self.change_log.append({
@@ -424,33 +443,21 @@ class MovementInterpreter:
 
         return period
 
-    def autoreco(self, record, movement_rows, is_new_record):
+    def autoreco(self, record, movement_rows):
         """Auto-reconcile some of the movements in a File + TransferRecord.
-        """
-        dbsession = self.request.dbsession
 
-        if is_new_record:
-            # No recos exist yet for this TransferRecord.
-            reco_rows = ()
-            done_movement_ids = set()
-        else:
-            # List the existing reconciled movements.
-            reco_rows = (
-                dbsession.query(FileMovement.movement_id)
-                .filter(
-                    FileMovement.file_id == self.file.id,
-                    FileMovement.reco_id != null,
-                    FileMovement.transfer_record_id == record.id,
-                    )
-                .all())
-            done_movement_ids = set(row[0] for row in reco_rows)
+        movement_rows must list all the File's movements in the transfer.
+        save_autorecos() adds the Recos queued here.
+        """
+        # List the existing reconciled movements.
+        done_movement_ids = set(
+            movement.id for file_movement, movement in movement_rows
+            if file_movement.reco_id is not None)
 
         internal_seqs = find_internal_movements(
             movement_rows=movement_rows,
             done_movement_ids=done_movement_ids)
 
-        added = False
-
         for mvlist in internal_seqs:
             if len(mvlist) < 2:
                 continue
@@ -476,26 +483,84 @@ class MovementInterpreter:
                     "movement list for transfer %s: %s != %s" % (
                         record.transfer_id, wallet_total, -vault_total))
 
-            reco = Reco(
-                owner_id=self.owner_id,
-                period_id=mvlist[0][0].period_id,
-                reco_type='standard',
-                internal=True)
-            dbsession.add(reco)
-            dbsession.flush()
-            reco_id = reco.id
-            added = True
+            self.pending_recos.append((
+                record.id,
+                mvlist[0][0].period_id,
+                [file_movement for file_movement, movement in mvlist]))
 
-            for file_movement, movement in mvlist:
-                file_movement.reco_id = reco_id
-                file_movement.period_id = reco.period_id
+    def save_autorecos(self):
+        """Add the queued auto-recos.
+
+        Insert all the Recos with one statement and assign the
+        FileMovements with another.
+        """
+        pending_recos = self.pending_recos
+        if not pending_recos:
+            return
+        self.pending_recos = []
 
-        if added:
+        request = self.request
+        dbsession = request.dbsession
+
+        # Write the new FileMovements before changing the event type.
+        dbsession.flush()
+        configure_dblog(request=request, movement_event_type='autoreco')
+
+        reco_table = Reco.__table__
+        rows = dbsession.execute(
+            reco_table.insert()
+            .values([{
+                'owner_id': self.owner_id,
+                'period_id': period_id,
+                'reco_type': 'standard',
+                'internal': True,
+            } for _record_id, period_id, _file_movements in pending_recos])
+            .returning(reco_table.c.id)).fetchall()
+        # The IDs come from a sequence in the order of the values.
+        reco_ids = sorted(row[0] for row in rows)
+
+        movement_ids = []
+        movement_reco_ids = []
+        movement_period_ids = []
+        # record_reco_ids: {transfer_record_id: last reco_id}
+        record_reco_ids = {}
+        for (record_id, period_id, file_movements), reco_id in zip(
+                pending_recos, reco_ids):
+            record_reco_ids[record_id] = reco_id
+            for file_movement in file_movements:
+                movement_ids.append(file_movement.movement_id)
+                movement_reco_ids.append(reco_id)
+                movement_period_ids.append(period_id)
+
+        assign_cte = make_array_cte('assign_reco', [
+            ('movement_id', BigInteger, movement_ids),
+            ('reco_id', BigInteger, movement_reco_ids),
+            ('period_id', BigInteger, movement_period_ids),
+        ])
+        file_movement_table = FileMovement.__table__
+        dbsession.execute(
+            file_movement_table.update()
+            .where(and_(
+                file_movement_table.c.file_id == self.file.id,
+                file_movement_table.c.movement_id ==
+                assign_cte.c.movement_id,
+            ))
+            .values(
+                reco_id=assign_cte.c.reco_id,
+                period_id=assign_cte.c.period_id))
+
+        # Update the loaded FileMovements to match.
+        for (record_id, period_id, file_movements), reco_id in zip(
+                pending_recos, reco_ids):
+            for file_movement in file_movements:
+                set_committed_value(file_movement, 'reco_id', reco_id)
+                set_committed_value(file_movement, 'period_id', period_id)
+
+        for reco_id in record_reco_ids.values():
             self.change_log.append({
                 'event_type': 'reco_add',
                 'reco_id': reco_id,
             })
-            dbsession.flush()
 
 
 def find_internal_movements(movement_rows, done_movement_ids):
@@ -0,0 +1,140 @@
+
+"""
+Interpret missing movements for several Files in parallel.
+
+SyncBase.sync_missing() interprets movements for each of the owner's
+Files in turn. The Files are independent of each other, so
+sync_missing_parallel() runs each File's MovementInterpreter.sync_missing()
+in a separate process with its own database session and transaction.
+
+The worker processes can't see uncommitted changes, so use this only
+after the transfer records have been committed (for example, from the
+sync_opnreco_files script after reinterpreting Files.)
+"""
+
+from concurrent.futures import as_completed
+from concurrent.futures import ProcessPoolExecutor
+from opnreco.models.db import File
+from opnreco.models.db import Owner
+from opnreco.models.dbmeta import get_dbsession_factory
+from opnreco.models.dbmeta import get_engine
+from opnreco.mvinterp import MovementInterpreter
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# worker_dbsession_factory creates sessions in a worker process.
+worker_dbsession_factory = None
+
+
+class FileSyncRequest:
+    """The parts of a request that MovementInterpreter uses."""
+
+    def __init__(self, dbsession, owner, personal_id):
+        self.dbsession = dbsession
+        self.owner = owner
+        self.personal_id = personal_id
+
+
+class FileSyncResult:
+    """The outcome of interpreting the missing movements of a File."""
+
+    def __init__(self, file_id, change_count=0, elapsed=0.0, error=None):
+        self.file_id = file_id
+        self.change_count = change_count
+        self.elapsed = elapsed
+        # error is a description of the exception raised, if any.
+        self.error = error
+
+
+def sync_file(dbsession, file_id, personal_id):
+    """Interpret the missing movements for a File. Return the change_log.
+    """
+    file = dbsession.query(File).get(file_id)
+    if file is None:
+        raise ValueError("File %s does not exist" % file_id)
+    owner = dbsession.query(Owner).get(file.owner_id)
+    request = FileSyncRequest(
+        dbsession=dbsession, owner=owner, personal_id=personal_id)
+    change_log = []
+    interpreter = MovementInterpreter(
+        request=request, file=file, change_log=change_log)
+    interpreter.sync_missing()
+    dbsession.flush()
+    return change_log
+
+
+def init_worker():
+    """Connect to the database in a new worker process."""
+    global worker_dbsession_factory
+    worker_dbsession_factory = get_dbsession_factory(get_engine())
+
+
+def run_file_sync(file_id, personal_id):
+    """Interpret a File in its own transaction. Return a FileSyncResult.
+
+    Report errors in the result rather than raising them, so the other
+    Files can complete.
+    """
+    start = time.monotonic()
+    dbsession = worker_dbsession_factory()
+    try:
+        change_log = sync_file(
+            dbsession=dbsession, file_id=file_id, personal_id=personal_id)
+        dbsession.commit()
+    except Exception as e:
+        log.exception("Failed to sync file %s", file_id)
+        dbsession.rollback()
+        return FileSyncResult(
+            file_id=file_id,
+            elapsed=time.monotonic() - start,
+            error='%s: %s' % (type(e).__name__, e))
+    finally:
+        dbsession.close()
+
+    return FileSyncResult(
+        file_id=file_id,
+        change_count=len(change_log),
+        elapsed=time.monotonic() - start)
+
+
+def list_owner_file_ids(dbsession, owner_id):
+    """List the IDs of the Files SyncBase interprets for an owner."""
+    return [
+        row[0] for row in (
+            dbsession.query(File.id)
+            .filter(File.owner_id == owner_id, ~File.archived)
+            .order_by(File.id)
+            .all())]
+
+
+def sync_missing_parallel(
+        file_ids, personal_id, processes=None, progress=None):
+    """Interpret the missing movements for Files in worker processes.
+
+    processes is the maximum number of worker processes (by default,
+    the number of CPUs). progress, if provided, is called with each
+    FileSyncResult as the Files complete. Return the list of
+    FileSyncResults in the order of file_ids.
+    """
+    results = {}
+    with ProcessPoolExecutor(
+            max_workers=processes, initializer=init_worker) as executor:
+        futures = {
+            executor.submit(run_file_sync, file_id, personal_id): file_id
+            for file_id in file_ids}
+        for future in as_completed(futures):
+            file_id = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # The worker process failed.
+                result = FileSyncResult(
+                    file_id=file_id,
+                    error='%s: %s' % (type(e).__name__, e))
+            results[file_id] = result
+            if progress is not None:
+                progress(result)
+
+    return [results[file_id] for file_id in file_ids]
@@ -12,15 +12,14 @@ from opnreco.models.db import Reco
 from opnreco.viewcommon import add_open_period
 from opnreco.viewcommon import get_period_for_day
 from opnreco.viewcommon import get_tzname
+from opnreco.viewcommon import make_array_cte
+from opnreco.viewcommon import PeriodIndex
 from sqlalchemy import and_
 from sqlalchemy import BigInteger
-from sqlalchemy import cast
 from sqlalchemy import Date
 from sqlalchemy import exists
 from sqlalchemy import func
-from sqlalchemy import literal
 from sqlalchemy import select
-from sqlalchemy import union_all
 import datetime
 
 null = None
@@ -61,43 +60,22 @@ def make_day_period_cte(days, period_list, default_endless=True):
       don't map to any period.
     """
     # Choose a period for the movements, entries, or recos on a given date.
+    period_index = PeriodIndex(period_list, default_endless=default_endless)
     day_periods = []  # [(date, period_id)]
     missing_period = False
     for day in days:
-        period = get_period_for_day(
-            period_list, day, default_endless=default_endless)
+        period = period_index.get(day)
         if period is None:
             missing_period = True
         else:
             day_periods.append((day, period.id))
 
-    if day_periods:
-        # Turn day_periods into day_period_cte, a common table expression
-        # that contains a simple mapping of date to period ID.
-        # See: https://stackoverflow.com/questions/44140632
-
-        # Optimization to reduce the size of the statement:
-        # Type cast only for first row;
-        # for other rows the database will infer.
-        stmts = [
-            select([
-                cast(literal(d), Date).label('day'),
-                cast(literal(pid), BigInteger).label('period_id'),
-            ])
-            for (d, pid) in day_periods[:1]]
-        stmts.extend(
-            select([literal(d), literal(pid)])
-            for (d, pid) in day_periods[1:])
-        day_period_cte = union_all(*stmts).cte(name='day_period_cte')
-
-    else:
-        # There are no periods for any of the days.
-        # Use a table with zero rows as day_period_cte.
-        day_period_cte = (
-            select([
-                cast(literal(None), Date).label('day'),
-                cast(literal(None), BigInteger).label('period_id'),
-            ]).where(literal(1) == literal(0)).cte(name='day_period_cte'))
+    # Turn day_periods into day_period_cte, a common table expression
+    # that contains a simple mapping of date to period ID.
+    day_period_cte = make_array_cte('day_period_cte', [
+        ('day', Date, [d for (d, pid) in day_periods]),
+        ('period_id', BigInteger, [pid for (d, pid) in day_periods]),
+    ])
 
     return day_periods, day_period_cte, missing_period
 
@@ -107,19 +85,32 @@ def push_unreco(request, period, op):
 
     Create a new period if necessary.
     """
+    return push_unreco_periods(request=request, periods=[period], op=op)
+
+
+def push_unreco_periods(request, periods, op):
+    """Push the unreconciled items in some periods to other open periods.
+
+    All the periods must belong to the same file. Items are pushed only
+    to open periods not in the list. Create a new period if necessary.
+    """
     dbsession = request.dbsession
     owner = request.owner
     owner_id = owner.id
-    assert period.owner_id == owner_id
+    file_id = periods[0].file_id
+    period_ids = [period.id for period in periods]
+    for period in periods:
+        assert period.owner_id == owner_id
+        assert period.file_id == file_id
 
     item_filter = and_(
         op.table.owner_id == owner_id,
-        op.table.file_id == period.file_id,
-        op.table.period_id == period.id,
+        op.table.file_id == file_id,
+        op.table.period_id.in_(period_ids),
         op.table.reco_id == null,
     )
 
-    # List the dates of all items in the period.
+    # List the dates of all items in the periods.
     unreco_query = (
         dbsession.query(
             op.date_c.label('day'),
@@ -130,7 +121,7 @@ def push_unreco(request, period, op):
     unreco_rows = unreco_query.all()
 
     if not unreco_rows:
-        # There are no unreconciled items in the period.
+        # There are no unreconciled items in the periods.
         return 0
 
     # List the other open periods for the file.
@@ -138,9 +129,9 @@ def push_unreco(request, period, op):
         dbsession.query(Period)
         .filter(
             Period.owner_id == owner_id,
-            Period.file_id == period.file_id,
+            Period.file_id == file_id,
             ~Period.closed,
-            Period.id != period.id)
+            ~Period.id.in_(period_ids))
         .all())
 
     # List the items to reassign.
@@ -161,7 +152,7 @@ def push_unreco(request, period, op):
     if missing_period:
         new_period = add_open_period(
             request=request,
-            file_id=period.file_id,
+            file_id=file_id,
             event_type='add_period_for_push_unreco_%s' % op.plural)
         new_period_id = new_period.id
     else:
@@ -178,17 +169,22 @@ def push_unreco(request, period, op):
             {'period_id': func.coalesce(subq, new_period_id)},
             synchronize_session='fetch'))
 
+    content = {
+        'file_id': file_id,
+        'item_ids': item_ids,
+        'day_periods': day_periods,
+        'new_period_id': new_period_id,
+    }
+    if len(period_ids) == 1:
+        content['period_id'] = period_ids[0]
+    else:
+        content['period_ids'] = period_ids
+
     dbsession.add(OwnerLog(
         owner_id=owner_id,
         personal_id=request.personal_id,
         event_type='push_unreco_%s' % op.plural,
-        content={
-            'period_id': period.id,
-            'file_id': period.file_id,
-            'item_ids': item_ids,
-            'day_periods': day_periods,
-            'new_period_id': new_period_id,
-        }))
+        content=content))
 
     return len(item_ids)
 
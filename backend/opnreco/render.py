@@ -1,16 +1,33 @@
-
 from colander import null
 from decimal import Decimal
+from pyramid.settings import asbool
 import collections
 import datetime
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 class CustomJSONRenderer(object):
-    """JSON renderer that handles Decimal, datetime, and colander.null."""
+    """JSON renderer that handles Decimal, datetime, and colander.null.
+
+    The output is compact unless the opnreco.json_pretty setting is true,
+    in which case it is indented with sorted keys for easier reading.
+    If orjson is installed, it encodes the output unless the
+    opnreco.json_orjson setting is false.
+    """
 
     def __init__(self, info):
-        pass
+        settings = getattr(info, 'settings', None) or {}
+        self.pretty = asbool(settings.get('opnreco.json_pretty', False))
+        use_orjson = asbool(settings.get('opnreco.json_orjson', True))
+        if use_orjson and orjson is not None:
+            self.encode = self.encode_orjson
+        else:
+            self.encode = self.encode_json
 
     def __call__(self, value, system):
         """ Call the renderer implementation with the value
@@ -20,15 +37,8 @@ class CustomJSONRenderer(object):
         dictionary containing available system values
         (e.g. view, context, and request). """
         request = system.get('request')
-        indent = '  '
-        separators = (', ', ': ')
 
-        res = json.dumps(
-            value,
-            separators=separators,
-            indent=indent,
-            sort_keys=True,
-            default=get_json_default)
+        res = self.encode(value)
 
         if request is not None:
             response = request.response
@@ -38,6 +48,46 @@ class CustomJSONRenderer(object):
 
         return res
 
+    def encode_json(self, value):
+        if self.pretty:
+            return json.dumps(
+                value,
+                separators=(', ', ': '),
+                indent='  ',
+                sort_keys=True,
+                default=get_json_default)
+        return json.dumps(
+            value,
+            separators=(',', ':'),
+            default=get_json_default)
+
+    def encode_orjson(self, value):
+        option = orjson_options
+        if self.pretty:
+            option |= orjson.OPT_INDENT_2 | orjson.OPT_SORT_KEYS
+        # Pyramid accepts the encoded bytes as the response body.
+        return orjson.dumps(value, default=get_json_default, option=option)
+
+
+if orjson is not None:
+    # Encode naive datetimes as UTC with a 'Z' suffix, like
+    # datetime_to_json(), and allow non-string keys like json.dumps().
+    orjson_options = (
+        orjson.OPT_NAIVE_UTC | orjson.OPT_UTC_Z | orjson.OPT_NON_STR_KEYS)
+else:
+    orjson_options = 0
+
+
+def encode_compact(value):
+    """Encode a value as compact JSON. Return UTF-8 bytes."""
+    if orjson is not None:
+        return orjson.dumps(
+            value, default=get_json_default, option=orjson_options)
+    return json.dumps(
+        value,
+        separators=(',', ':'),
+        default=get_json_default).encode('utf-8')
+
 
 def get_json_default(obj):
     """Try to serialize an object without an implicit serialization."""
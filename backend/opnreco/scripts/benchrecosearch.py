@@ -0,0 +1,238 @@
+"""Benchmark the searches made by the reconciliation dialog.
+
+Add a file with many movements and account entries inside a transaction,
+time the searches the dialog makes as the user types each keystroke,
+then roll back the transaction.
+
+Usage: python -m opnreco.scripts.benchrecosearch [--movements N]
+
+The database is configured by the sqlalchemy_url environment variable
+(or .env file), as in initialize_opnreco_db. The trigram indexes are
+used only if the pg_trgm extension is installed.
+"""
+
+from dotenv import load_dotenv
+from opnreco.api.recoapi import reco_search_account_entries
+from opnreco.api.recoapi import reco_search_movement
+from opnreco.models.db import File
+from opnreco.models.db import Owner
+from opnreco.models.db import Period
+from opnreco.models.db import Statement
+from opnreco.models.dbmeta import get_engine
+from opnreco.searchcache import invalidate_search_cache
+from sqlalchemy import func
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+import argparse
+import datetime
+import sys
+import time
+
+owner_id = 'bench-reco-search'
+
+# Each search is a series of inputs, one per keystroke.
+movement_searches = (
+    ('transfer', ('4', '48', '482', '4821', '48213')),
+    ('amount', ('1', '12', '12.', '12.3', '12.34')),
+)
+
+account_entry_searches = (
+    ('description', ('T', 'T1', 'T10', 'T100', 'T1000')),
+    ('delta', ('-1', '-12', '-12.', '-12.3', '-12.34')),
+)
+
+
+class BenchContext:
+    def __init__(self, period):
+        self.period = period
+
+
+class BenchRequest:
+    def __init__(self, dbsession, owner, json):
+        self.dbsession = dbsession
+        self.owner = owner
+        self.json = json
+
+
+def populate(dbsession, movement_count):
+    """Add a file with movement_count movements and account entries."""
+    dbsession.query(
+        func.set_config('opnreco.personal_id', owner_id, True),
+        func.set_config('opnreco.movement.event_type', 'bench', True),
+        func.set_config('opnreco.account_entry.event_type', 'bench', True),
+    ).one()
+
+    owner = Owner(id=owner_id, title="Benchmark", username='bench')
+    dbsession.add(owner)
+    dbsession.flush()
+
+    file = File(
+        owner_id=owner_id,
+        file_type='open_circ',
+        title="Benchmark",
+        currency='USD',
+        has_vault=True)
+    dbsession.add(file)
+    dbsession.flush()
+
+    period = Period(
+        owner_id=owner_id,
+        file_id=file.id,
+        start_date=datetime.date(2018, 1, 1),
+        end_date=None)
+    dbsession.add(period)
+    dbsession.flush()
+
+    statement = Statement(
+        owner_id=owner_id,
+        file_id=file.id,
+        period_id=period.id,
+        source='bench')
+    dbsession.add(statement)
+    dbsession.flush()
+
+    params = {
+        'owner_id': owner_id,
+        'file_id': file.id,
+        'period_id': period.id,
+        'statement_id': statement.id,
+        'count': movement_count,
+    }
+
+    dbsession.execute(text("""
+        insert into transfer_record (
+            owner_id, transfer_id, workflow_type, start, currency, amount,
+            timestamp, next_activity, completed, canceled,
+            sender_id, sender_uid, sender_info,
+            recipient_id, recipient_uid, recipient_info)
+        select
+            :owner_id,
+            (1000000000 + (i * 7919) % 8999999999)::text,
+            'redeem', ts, 'USD', amount,
+            ts, 'completed', true, false,
+            '11', 'wingcash:11', '{}'::jsonb,
+            '12', 'wingcash:12', '{}'::jsonb
+        from (
+            select
+                i,
+                timestamp '2018-01-01' + i * interval '1 minute' as ts,
+                ((i * 104729) % 1000000) / 100.0 + 0.01 as amount
+            from generate_series(1::bigint, :count) as i
+        ) as s
+    """), params)
+
+    dbsession.execute(text("""
+        insert into movement (
+            owner_id, transfer_record_id, number, amount_index, loop_id,
+            currency, issuer_id, from_id, to_id, amount, action, ts)
+        select
+            owner_id, id, 1, 0, '0',
+            currency, '19', '19', '12', amount, 'deposit', timestamp
+        from transfer_record
+        where owner_id = :owner_id
+    """), params)
+
+    dbsession.execute(text("""
+        insert into file_movement (
+            file_id, movement_id, owner_id, currency, loop_id, issuer_id,
+            transfer_record_id, ts, peer_id, wallet_delta, vault_delta,
+            period_id, surplus_delta)
+        select
+            :file_id, id, owner_id, currency, loop_id, issuer_id,
+            transfer_record_id, ts, '19', 0, amount,
+            :period_id, 0
+        from movement
+        where owner_id = :owner_id
+    """), params)
+
+    dbsession.execute(text("""
+        insert into account_entry (
+            owner_id, file_id, period_id, statement_id, entry_date,
+            currency, loop_id, delta, description)
+        select
+            tr.owner_id, :file_id, :period_id, :statement_id,
+            tr.timestamp::date, tr.currency, '0', -tr.amount,
+            'ACH T' || tr.transfer_id
+        from transfer_record tr
+        where tr.owner_id = :owner_id
+    """), params)
+
+    dbsession.execute(text("analyze"))
+
+    return owner, period
+
+
+def time_search(search_func, dbsession, owner, period, param_name, inputs,
+                repeat):
+    """Time the search for each keystroke. Return [(input, ms, count)].
+
+    Each repetition types the inputs in order, starting with an empty
+    search cache, so later keystrokes may be served by the cache.
+    """
+    context = BenchContext(period)
+    times = [[] for _ in inputs]
+    counts = [0] * len(inputs)
+    for _ in range(repeat):
+        invalidate_search_cache(owner.id, period.file_id)
+        for index, input_value in enumerate(inputs):
+            request = BenchRequest(
+                dbsession=dbsession,
+                owner=owner,
+                json={param_name: input_value, 'tzoffset': 0})
+            start = time.perf_counter()
+            results = search_func(context, request)
+            times[index].append(time.perf_counter() - start)
+            counts[index] = len(results)
+    res = []
+    for input_value, input_times, count in zip(inputs, times, counts):
+        input_times.sort()
+        res.append((
+            input_value, input_times[len(input_times) // 2] * 1000, count))
+    return res
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        '--movements', type=int, default=1000000,
+        help="Number of movements (and account entries) to add")
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help="Number of times to repeat each search (reporting the median)")
+    args = parser.parse_args(argv[1:])
+
+    load_dotenv()
+
+    engine = get_engine()
+    connection = engine.connect()
+    transaction = connection.begin()
+    dbsession = Session(bind=connection)
+    try:
+        trgm = dbsession.execute(text(
+            "select count(1) from pg_extension where extname = 'pg_trgm'"
+        )).scalar()
+        print("pg_trgm installed: %s" % ('yes' if trgm else 'no'))
+
+        start = time.perf_counter()
+        owner, period = populate(dbsession, args.movements)
+        print("Added %d movements and account entries in %.1f s" % (
+            args.movements, time.perf_counter() - start))
+
+        for search_func, searches in (
+                (reco_search_movement, movement_searches),
+                (reco_search_account_entries, account_entry_searches)):
+            for param_name, inputs in searches:
+                print("%s by %s:" % (search_func.__name__, param_name))
+                for input_value, ms, count in time_search(
+                        search_func, dbsession, owner, period,
+                        param_name, inputs, args.repeat):
+                    print("  %-10s %8.2f ms  (%d results)" % (
+                        repr(input_value), ms, count))
+    finally:
+        dbsession.close()
+        transaction.rollback()
+        connection.close()
+
+
+if __name__ == '__main__':
+    main()
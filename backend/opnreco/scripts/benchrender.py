@@ -0,0 +1,215 @@
+"""Benchmark the JSON renderer.
+
+Compare the previous rendering (indented json.dumps with sorted keys)
+with the compact json.dumps and orjson encoders of CustomJSONRenderer
+over synthetic transactions, reco-report, and transfer-record payloads.
+Also report the gzip and brotli sizes. No database is needed.
+
+Usage: python -m opnreco.scripts.benchrender [--rows N]
+"""
+
+from decimal import Decimal
+from opnreco.compress import get_encoders
+from opnreco.render import CustomJSONRenderer
+from opnreco.render import get_json_default
+from opnreco.render import orjson
+import argparse
+import collections
+import datetime
+import gc
+import json
+import random
+import sys
+import time
+
+
+class RendererInfo:
+    def __init__(self, settings):
+        self.settings = settings
+
+
+def make_movement(rnd, movement_id, ts):
+    return {
+        'id': str(movement_id),
+        'ts': ts,
+        'movement_delta': Decimal(rnd.randint(-100000, 100000)) / 100,
+        'reco_movement_delta': Decimal(rnd.randint(-100000, 100000)) / 100,
+        'workflow_type': rnd.choice(('redeem', 'grant', 'receive_ach')),
+        'transfer_id': '%d' % rnd.randint(10 ** 15, 10 ** 16),
+    }
+
+
+def make_transactions(rows, seed=1):
+    """Make a payload shaped like the transactions API response."""
+    rnd = random.Random(seed)
+    start = datetime.datetime(2018, 1, 1)
+    records = ([], [])
+    for i in range(rows):
+        ts = start + datetime.timedelta(seconds=rnd.randint(0, 86400 * 365))
+        record = {
+            'reco_id': str(10000 + i) if rnd.random() < 0.5 else None,
+            'account_entry_id': None,
+            'movement_id': str(50000 + i),
+            'account_entries': [{
+                'id': str(70000 + i),
+                'entry_date': ts.date(),
+                'account_delta': Decimal(rnd.randint(-100000, 100000)) / 100,
+            }],
+            'movements': [
+                make_movement(rnd, 50000 + i * 3 + j, ts)
+                for j in range(rnd.randint(1, 3))],
+        }
+        records[i % 2].append(record)
+    totals = {
+        'page': {'account_delta': Decimal('12.34'),
+                 'reco_movement_delta': Decimal('-5.67')},
+        'all': {'account_delta': Decimal('12.34'),
+                'reco_movement_delta': Decimal('-5.67')},
+    }
+    return {
+        'now': datetime.datetime.utcnow(),
+        'rowcount': rows,
+        'all_shown': True,
+        'inc_records': records[0],
+        'inc_totals': totals,
+        'dec_records': records[1],
+        'dec_totals': totals,
+    }
+
+
+def make_reco_report(rows, seed=2):
+    """Make a payload shaped like the reco-report API response."""
+    rnd = random.Random(seed)
+    start = datetime.datetime(2018, 1, 1)
+    outstanding_map = collections.defaultdict(list)
+    for i in range(rows):
+        sign = rnd.choice(('-1', '1'))
+        outstanding_map[sign].append({
+            'amount': Decimal(rnd.randint(1, 100000)) / 100,
+            'transfer_id': '%d' % rnd.randint(10 ** 15, 10 ** 16),
+            'ts': start + datetime.timedelta(
+                seconds=rnd.randint(0, 86400 * 31)),
+            'workflow_type': 'redeem',
+        })
+    return {
+        'file': {'id': '1239', 'title': 'Test File', 'currency': 'USD'},
+        'totals': {
+            'start': {'circ': Decimal('100.00'), 'surplus': Decimal('0')},
+            'end': {'circ': Decimal('200.00'), 'surplus': Decimal('1.25')},
+        },
+        'outstanding_map': outstanding_map,
+        'now': datetime.datetime.utcnow(),
+    }
+
+
+def make_transfer_record(rows, seed=3):
+    """Make a payload shaped like the transfer-record API response."""
+    rnd = random.Random(seed)
+    ts = datetime.datetime(2018, 1, 1, 12)
+    movements = []
+    for i in range(rows):
+        movement = make_movement(rnd, i, ts)
+        movement.update({
+            'number': i + 1,
+            'amount_index': 0,
+            'loop_id': '0',
+            'currency': 'USD',
+            'issuer_id': '300',
+            'from_id': '102',
+            'to_id': '200',
+            'action': 'split',
+        })
+        movements.append(movement)
+    return {
+        'transfer_id': '1234567890123456',
+        'workflow_type': 'redeem',
+        'start': ts,
+        'timestamp': ts,
+        'amount': Decimal('10.00'),
+        'movements': movements,
+        'peers': {str(i): {'title': 'Peer %d' % i} for i in range(50)},
+    }
+
+
+def render_previous(value):
+    return json.dumps(
+        value,
+        separators=(', ', ': '),
+        indent='  ',
+        sort_keys=True,
+        default=get_json_default)
+
+
+def time_call(func, value, repeat):
+    """Call func(value) repeatedly. Return (result, minimum seconds)."""
+    times = []
+    result = None
+    for _ in range(repeat):
+        result = None
+        gc.collect()
+        gc.disable()
+        try:
+            start = time.perf_counter()
+            result = func(value)
+            times.append(time.perf_counter() - start)
+        finally:
+            gc.enable()
+    return result, min(times)
+
+
+def to_bytes(data):
+    if isinstance(data, str):
+        return data.encode('utf-8')
+    return data
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument(
+        '--rows', type=int, default=20000,
+        help="Number of rows in each payload")
+    parser.add_argument(
+        '--repeat', type=int, default=5,
+        help="Number of times to run each renderer (reporting the best)")
+    args = parser.parse_args(argv[1:])
+
+    renderers = [('previous', render_previous)]
+    compact = CustomJSONRenderer(RendererInfo({'opnreco.json_orjson': 'no'}))
+    renderers.append(('compact', compact.encode))
+    if orjson is not None:
+        fast = CustomJSONRenderer(RendererInfo({}))
+        renderers.append(('orjson', fast.encode))
+    else:
+        print("orjson is not installed; skipping the orjson renderer.")
+
+    payloads = [
+        ('transactions', make_transactions(args.rows)),
+        ('reco-report', make_reco_report(args.rows)),
+        ('transfer-record', make_transfer_record(args.rows)),
+    ]
+
+    for payload_name, payload in payloads:
+        print("%s (%d rows):" % (payload_name, args.rows))
+        expected = None
+        base_time = None
+        for name, func in renderers:
+            data, seconds = time_call(func, payload, args.repeat)
+            data = to_bytes(data)
+            decoded = json.loads(data)
+            if expected is None:
+                expected = decoded
+                base_time = seconds
+            elif decoded != expected:
+                raise AssertionError(
+                    "The %s renderer disagrees with the previous renderer "
+                    "for %s" % (name, payload_name))
+            sizes = ' '.join(
+                '%s: %7d KB' % (encoding, len(compress(data)) // 1024)
+                for encoding, compress in get_encoders())
+            print("  %-9s %7.1f ms (%5.2fx)  %7d KB  %s" % (
+                name, seconds * 1000, base_time / seconds,
+                len(data) // 1024, sizes))
+
+
+if __name__ == '__main__':
+    main()
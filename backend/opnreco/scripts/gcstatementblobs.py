@@ -0,0 +1,98 @@
+"""Remove the statement uploads in the blob store that no statement uses.
+
+Usage: gc_opnreco_statement_blobs <config_uri> [--min-age HOURS] [--dry-run]
+
+Deleting a statement leaves its blob in place because other statements
+may share it, and an upload that is rolled back after storing its blob
+leaves the blob behind. Run this script periodically to remove those
+blobs. Blobs stored or reused within the last min-age hours are kept,
+since an upload in progress may refer to them.
+"""
+
+from dotenv import load_dotenv
+from opnreco.blobstore import get_blob_store
+from opnreco.models.db import Statement
+from opnreco.models.dbmeta import get_engine
+from pyramid.paster import setup_logging
+from sqlalchemy.orm import Session
+import argparse
+import logging
+import sys
+import time
+
+log = logging.getLogger(__name__)
+
+# batch_size is the number of blobs to look up in the database at a time.
+batch_size = 1000
+
+
+def collect_garbage(dbsession, blob_store, max_mtime, dry_run=False):
+    """Remove the blobs no statement refers to. Return the number removed.
+
+    Keep the blobs modified after max_mtime.
+    """
+    removed = 0
+
+    def remove_unused(sha256s):
+        used = set(
+            sha256 for (sha256,) in (
+                dbsession.query(Statement.content_sha256)
+                .filter(Statement.content_sha256.in_(sha256s))
+                .distinct()))
+        count = 0
+        for sha256 in sha256s:
+            if sha256 in used:
+                continue
+            if dry_run:
+                log.info("Would remove blob %s", sha256)
+                count += 1
+            elif blob_store.remove(sha256, max_mtime=max_mtime):
+                log.info("Removed blob %s", sha256)
+                count += 1
+        return count
+
+    batch = []
+    for sha256, mtime in blob_store.list_blobs():
+        if mtime > max_mtime:
+            continue
+        batch.append(sha256)
+        if len(batch) >= batch_size:
+            removed += remove_unused(batch)
+            batch = []
+    if batch:
+        removed += remove_unused(batch)
+
+    return removed
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('config_uri')
+    parser.add_argument(
+        '--min-age', type=float, default=24,
+        help="Keep blobs stored or reused within this many hours")
+    parser.add_argument(
+        '--dry-run', action='store_true',
+        help="List the blobs to remove without removing them")
+    args = parser.parse_args(argv[1:])
+
+    load_dotenv()
+    setup_logging(args.config_uri)
+
+    engine = get_engine()
+    dbsession = Session(bind=engine)
+    try:
+        removed = collect_garbage(
+            dbsession=dbsession,
+            blob_store=get_blob_store(),
+            max_mtime=time.time() - args.min_age * 3600,
+            dry_run=args.dry_run)
+    finally:
+        dbsession.close()
+        engine.dispose()
+
+    log.info("Done. Removed %d unused statement blobs.", removed)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""Move statement uploads stored in the database to the blob store.
+
+Usage: move_opnreco_statement_blobs <config_uri> [--batch-size N]
+
+The blob store directory is configured by the opnreco_blob_dir
+environment variable (or .env file). Each batch is committed separately,
+so the script can be interrupted and run again.
+"""
+
+from dotenv import load_dotenv
+from opnreco.blobstore import get_blob_store
+from opnreco.models.db import Statement
+from opnreco.models.dbmeta import get_engine
+from pyramid.paster import setup_logging
+from sqlalchemy.orm import Session
+from sqlalchemy.orm import undefer
+import argparse
+import logging
+import sys
+
+log = logging.getLogger(__name__)
+
+
+def move_blobs(dbsession, blob_store, batch_size):
+    """Move a batch of statement uploads. Return the number moved."""
+    statements = (
+        dbsession.query(Statement)
+        .options(undefer(Statement.content))
+        .filter(
+            Statement.content != None,  # noqa
+            Statement.content_sha256 == None,  # noqa
+        )
+        .order_by(Statement.id)
+        .limit(batch_size)
+        .with_for_update(skip_locked=True)
+        .all())
+
+    for statement in statements:
+        sha256, size = blob_store.put(statement.content)
+        statement.content_sha256 = sha256
+        statement.content_size = size
+        statement.content = None
+
+    return len(statements)
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('config_uri')
+    parser.add_argument(
+        '--batch-size', type=int, default=100,
+        help="Number of statements to move per transaction")
+    args = parser.parse_args(argv[1:])
+
+    load_dotenv()
+    setup_logging(args.config_uri)
+
+    engine = get_engine()
+    blob_store = get_blob_store()
+    total = 0
+    while True:
+        dbsession = Session(bind=engine)
+        try:
+            count = move_blobs(dbsession, blob_store, args.batch_size)
+            dbsession.commit()
+        finally:
+            dbsession.close()
+        if not count:
+            break
+        total += count
+        log.info("Moved %d statement uploads", total)
+
+    log.info("Done. Moved %d statement uploads.", total)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""Interpret the missing movements of an owner's Files in parallel.
+
+Usage: sync_opnreco_files <config_uri> <owner_id> <personal_id>
+    [--processes N] [--file-id ID ...]
+
+Each File is interpreted in a separate process and transaction. A File
+that fails does not prevent the others from completing.
+"""
+
+from dotenv import load_dotenv
+from opnreco.models.dbmeta import get_engine
+from opnreco.parallelsync import list_owner_file_ids
+from opnreco.parallelsync import sync_missing_parallel
+from pyramid.paster import setup_logging
+from sqlalchemy.orm import Session
+import argparse
+import logging
+import sys
+
+log = logging.getLogger(__name__)
+
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('config_uri')
+    parser.add_argument('owner_id')
+    parser.add_argument(
+        'personal_id',
+        help="The OPN personal profile ID to record in the owner log")
+    parser.add_argument(
+        '--processes', type=int, default=None,
+        help="Maximum number of worker processes (default: CPU count)")
+    parser.add_argument(
+        '--file-id', type=int, action='append', dest='file_ids',
+        help="Interpret only the specified File (may be repeated)")
+    args = parser.parse_args(argv[1:])
+
+    load_dotenv()
+    setup_logging(args.config_uri)
+
+    file_ids = args.file_ids
+    if not file_ids:
+        engine = get_engine()
+        dbsession = Session(bind=engine)
+        try:
+            file_ids = list_owner_file_ids(dbsession, args.owner_id)
+        finally:
+            dbsession.close()
+            engine.dispose()
+
+    done = []
+
+    def progress(result):
+        done.append(result)
+        if result.error:
+            log.error(
+                "File %s failed after %.1fs (%d/%d): %s",
+                result.file_id, result.elapsed, len(done), len(file_ids),
+                result.error)
+        else:
+            log.info(
+                "File %s: %d changes in %.1fs (%d/%d)",
+                result.file_id, result.change_count, result.elapsed,
+                len(done), len(file_ids))
+
+    results = sync_missing_parallel(
+        file_ids=file_ids,
+        personal_id=args.personal_id,
+        processes=args.processes,
+        progress=progress)
+
+    failed = [result.file_id for result in results if result.error]
+    if failed:
+        log.error("Failed to sync files: %s", failed)
+        return 1
+    log.info("Done. Synced %d files.", len(results))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+"""Short lived cache of reconciliation search results.
+
+The reconciliation dialog searches for movements and account entries as
+the user types, so successive searches usually narrow the previous one
+("12", "12.", "12.5"). When a search finds all of its matches (rather
+than stopping at a row limit), the cache keeps the rows for a few
+seconds and answers narrower searches on the same file by filtering
+the cached rows in memory.
+
+Search objects stored in the cache must provide:
+
+- cacheable: false if the search can't be matched in memory.
+- narrows(other): true if every row matched by the search is also
+  matched by the other search.
+- matches(row): true if the search matches a row.
+
+Each cached result is keyed on a token read from the file_version row
+of the file (see get_search_token()), so any change to the file's
+movements, account entries, or periods, in any process, makes the
+cached results unusable. The TTL only limits how long unused results
+stay in memory.
+"""
+
+from opnreco.models.db import FileVersion
+from sqlalchemy import cast
+from sqlalchemy import literal_column
+from sqlalchemy import String
+import collections
+import threading
+import time
+
+# search_cache_ttl is the number of seconds to keep a search result.
+search_cache_ttl = 30
+
+# search_cache_row_limit is the maximum number of rows in a cached result.
+# Searches that find more rows than this are not cached.
+search_cache_row_limit = 100
+
+# The maximum number of results to keep per file.
+search_cache_file_size = 20
+
+# The maximum number of files to keep results for.
+search_cache_size = 100
+
+
+class SearchCacheEntry:
+    def __init__(self, token, search, rows, expires):
+        self.token = token
+        self.search = search
+        self.rows = rows
+        self.expires = expires
+
+
+# search_cache: {(owner_id, file_id): [SearchCacheEntry]}
+search_cache = collections.OrderedDict()
+search_cache_lock = threading.Lock()
+
+
+def get_search_token(dbsession, file_id):
+    """Get a token that identifies the committed content of a file.
+
+    The token includes the versions of the file (see
+    opnreco.models.db.FileVersion) and the ID of the transaction that
+    last changed them (xmin). The transaction ID ensures that a result
+    read by a transaction that changed the file, then rolled back,
+    never matches the token of a committed state.
+    """
+    row = (
+        dbsession.query(
+            FileVersion.movement_version,
+            FileVersion.entry_version,
+            cast(literal_column('file_version.xmin'), String).label('xmin'),
+        )
+        .filter(FileVersion.file_id == file_id)
+        .first())
+    if row is None:
+        return (0, 0, None)
+    return (row.movement_version, row.entry_version, row.xmin)
+
+
+def get_cached_rows(owner_id, file_id, token, search):
+    """Get the cached rows of a search that the search narrows.
+
+    Return None if no such search is cached for the token.
+    """
+    key = (owner_id, file_id)
+    now = time.monotonic()
+    with search_cache_lock:
+        entries = search_cache.get(key)
+        if not entries:
+            return None
+        entries[:] = [
+            entry for entry in entries
+            if entry.expires > now and entry.token == token]
+        search_cache.move_to_end(key)
+        # Prefer the most recent (and usually narrowest) search.
+        for entry in reversed(entries):
+            if search.narrows(entry.search):
+                return entry.rows
+    return None
+
+
+def set_cached_rows(owner_id, file_id, token, search, rows):
+    """Cache all the rows found by a search."""
+    key = (owner_id, file_id)
+    entry = SearchCacheEntry(
+        token=token,
+        search=search,
+        rows=tuple(rows),
+        expires=time.monotonic() + search_cache_ttl)
+    with search_cache_lock:
+        entries = search_cache.get(key)
+        if entries is None:
+            search_cache[key] = entries = []
+        entries.append(entry)
+        del entries[:-search_cache_file_size]
+        search_cache.move_to_end(key)
+        while len(search_cache) > search_cache_size:
+            search_cache.popitem(last=False)
+
+
+def invalidate_search_cache(owner_id, file_id):
+    """Discard the cached search results for a file (for benchmarks.)"""
+    with search_cache_lock:
+        search_cache.pop((owner_id, file_id), None)
+
+
+def cached_search(dbsession, owner_id, file_id, search, query, limit):
+    """Run a search, filtering a cached result if possible.
+
+    query(row_limit) runs the search in the database and returns up to
+    row_limit rows in order. Return up to limit rows.
+    """
+    if not search.cacheable:
+        return query(limit)
+
+    # Read the token before running the query, so a cached result is
+    # never older than its token.
+    token = get_search_token(dbsession, file_id)
+    rows = get_cached_rows(owner_id, file_id, token, search)
+    if rows is not None:
+        res = []
+        for row in rows:
+            if search.matches(row):
+                res.append(row)
+                if len(res) >= limit:
+                    break
+        return res
+
+    row_limit = max(limit, search_cache_row_limit)
+    rows = query(row_limit + 1)
+    if len(rows) <= row_limit:
+        # The search found all of its matches.
+        set_cached_rows(owner_id, file_id, token, search, rows)
+    return rows[:limit]
@@ -0,0 +1,494 @@
+
+"""
+Parsers for uploaded statement files.
+
+Each parser reads an uploaded file lazily and generates
+(sheet, row, entry_date, delta, description) tuples, one per account entry.
+Parsers are registered by content type and file extension using
+register_statement_parser().
+"""
+
+from defusedxml.common import EntitiesForbidden
+from openpyxl.utils.datetime import CALENDAR_MAC_1904
+from opnreco.param import parse_amount
+from pyramid.httpexceptions import HTTPBadRequest
+from xlrd.formula import cellname
+from xlrd.xldate import xldate_as_tuple
+import abc
+import codecs
+import csv
+import datetime
+import dateutil.parser
+import html
+import inspect
+import io
+import itertools
+import logging
+import openpyxl
+import re
+import xlrd
+
+log = logging.getLogger(__name__)
+
+
+# statement_parsers: [(content_types, extensions, parser class)]
+statement_parsers = []
+
+
+def register_statement_parser(content_types=(), extensions=()):
+    """Class decorator that registers a statement parser."""
+    def register(cls):
+        if inspect.isabstract(cls):
+            raise TypeError(
+                "Statement parser %s does not implement: %s" % (
+                    cls.__name__,
+                    ', '.join(sorted(cls.__abstractmethods__))))
+        statement_parsers.append((
+            frozenset(content_types),
+            frozenset(extensions),
+            cls,
+        ))
+        return cls
+    return register
+
+
+def get_statement_parser(content_type, ext):
+    """Get the parser class for an uploaded file or None.
+
+    Prefer a match by file extension because browsers report a variety of
+    content types for some files. (For example, some browsers
+    report CSV files as application/vnd.ms-excel.)
+    """
+    for content_types, extensions, cls in statement_parsers:
+        if ext in extensions:
+            return cls
+    for content_types, extensions, cls in statement_parsers:
+        if content_type in content_types:
+            return cls
+    return None
+
+
+def detect_encoding(content):
+    """Choose UTF-8 if the content is valid UTF-8, otherwise Windows-1252."""
+    if content.startswith(codecs.BOM_UTF8):
+        return 'utf-8-sig'
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    view = memoryview(content)
+    chunk_size = 65536
+    try:
+        for pos in range(0, len(view), chunk_size):
+            decoder.decode(view[pos:pos + chunk_size])
+        decoder.decode(b'', final=True)
+    except UnicodeDecodeError:
+        return 'cp1252'
+    return 'utf-8'
+
+
+class StatementParser(abc.ABC):
+    """Base class for statement parsers."""
+
+    # source is the Statement.source of statements created by the parser.
+    source = None
+
+    def __init__(self, content, currency):
+        self.content = content
+        self.currency = currency
+
+    def open(self):
+        """Prepare to parse the content.
+
+        Raise HTTPBadRequest if the content can't be parsed.
+        """
+
+    @abc.abstractmethod
+    def parse(self):
+        """Generate (sheet, row, entry_date, delta, description) tuples."""
+
+    def parse_error(self, error_description):
+        log.exception(error_description)
+        raise HTTPBadRequest(json_body={
+            'error': 'parse_error',
+            'error_description': error_description,
+        })
+
+
+class TableParser(StatementParser):
+    """Parse a statement made of tables with optional heading rows."""
+
+    # default_column_names applies to tables with no heading row.
+    default_column_names = ('date', 'amount', 'description')
+
+    # heading_search_rows is the number of rows at the start of a table
+    # to search for the heading.
+    heading_search_rows = 100
+
+    def parse(self):
+        for sheet_name, rows in self.get_tables():
+            for entry in self.parse_table(sheet_name, rows):
+                yield entry
+
+    @abc.abstractmethod
+    def get_tables(self):
+        """Generate (sheet_name, rows) for each table.
+
+        rows is an iterable of row value sequences.
+        """
+
+    @abc.abstractmethod
+    def describe_cell(self, sheet_name, rowx, colx):
+        """Describe the location of a cell for error messages."""
+
+    def parse_table(self, sheet_name, rows):
+        """Generate the entry tuples for the rows of a table.
+
+        The heading row must contain at least "date" and "amount".
+        Look for the heading in the first heading_search_rows rows and
+        ignore the rows before it. If the table has no heading in those
+        rows, parse the table using the default columns, skipping rows
+        that fail to parse (such as a long preamble) until the first
+        heading or valid row. A later heading row (as in exports with a
+        heading on every page) sets the columns for the rows that follow.
+
+        Only the first heading_search_rows rows are held in memory.
+        """
+        rows = enumerate(rows)
+        column_names = None
+        # Read ahead to find the first heading.
+        leading_rows = []
+        for rowx, values in itertools.islice(rows, self.heading_search_rows):
+            texts = self.get_heading_texts(values)
+            if texts is not None:
+                column_names = texts
+                leading_rows = None
+                break
+            leading_rows.append((rowx, values))
+
+        # In the preamble, skip the rows that fail to parse.
+        preamble = leading_rows is not None
+        if preamble:
+            # No heading row found. Assume default columns.
+            column_names = self.default_column_names
+            rows = itertools.chain(leading_rows, rows)
+
+        for rowx, values in rows:
+            texts = self.get_heading_texts(values)
+            if texts is not None:
+                column_names = texts
+                preamble = False
+                continue
+
+            entry = self.parse_row(
+                sheet_name, rowx, values, column_names, strict=not preamble)
+            if entry is not None:
+                preamble = False
+                yield entry
+
+    def get_heading_texts(self, values):
+        """Return the column names if the row is a heading, else None."""
+        texts = tuple(
+            '' if value is None else str(value).strip().lower()
+            for value in values)
+        if 'date' in texts and 'amount' in texts:
+            return texts
+        return None
+
+    def parse_row(self, sheet_name, rowx, values, column_names, strict=True):
+        """Return the entry tuple for a row or None to skip the row.
+
+        If strict is false, skip the row rather than report an error
+        when a cell fails to parse.
+        """
+        attrs = {}
+        for colx, value in enumerate(values[:len(column_names)]):
+            if not value:
+                continue
+            column_name = column_names[colx]
+            try:
+                info = self.parse_cell(value, column_name)
+            except Exception as e:
+                if not strict:
+                    return None
+                self.parse_error(
+                    "Unable to parse %s %s. "
+                    "Cell contents: '%s', error: %s, %s" % (
+                        column_name,
+                        self.describe_cell(sheet_name, rowx, colx),
+                        value,
+                        type(e),
+                        e,
+                    ))
+            else:
+                if info:
+                    k, v = info
+                    attrs[k] = v
+
+        delta = attrs.get('delta')
+        entry_date = attrs.get('entry_date')
+        if delta is None or entry_date is None:
+            # Empty or incomplete row.
+            return None
+
+        if not delta:
+            # Ignore zero amount rows.
+            return None
+
+        sign = attrs.get('sign')
+        if sign:
+            # Force the sign of the amount.
+            delta = abs(delta) * sign
+
+        return (
+            sheet_name,
+            rowx + 1,
+            entry_date,
+            delta,
+            attrs.get('description') or '',
+        )
+
+    def parse_date(self, value):
+        return dateutil.parser.parse(str(value).strip()).date()
+
+    def parse_cell(self, value, column_name):
+        """Return (attr, value) or None.
+
+        Raise an exception in the event of a parse error.
+        """
+        if column_name in ('date', 'entry date', 'entry_date'):
+            return 'entry_date', self.parse_date(value)
+
+        if column_name in ('amount', 'delta'):
+            parsed = parse_amount(str(value).strip(), currency=self.currency)
+            return 'delta', parsed
+
+        if column_name in ('description', 'desc'):
+            return 'description', str(value).strip()
+
+        if column_name == 'sign':
+            v = str(value).strip().lower()
+            # Treat it as a liability account: credit = increase.
+            if v in ('+', 'c', 'cr', 'credit', 'deposit'):
+                return 'sign', 1
+            elif v in ('-', 'd', 'dr', 'debit', 'withdrawal'):
+                return 'sign', -1
+
+        return None
+
+
+@register_statement_parser(
+    content_types=(
+        'application/vnd.ms-excel',
+        'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+    ),
+    extensions=('.xls', '.xlsx'),
+)
+class ExcelParser(TableParser):
+    """Parse .xls and .xlsx spreadsheets, one row at a time."""
+    source = "Spreadsheet"
+
+    def open(self):
+        content = self.content
+        try:
+            if content[:4] == b'PK\x03\x04':
+                # The file is a zip archive, so it should be .xlsx.
+                self.tables = self.open_xlsx(content)
+            else:
+                self.tables = self.open_xls(content)
+        except EntitiesForbidden:
+            raise HTTPBadRequest(json_body={
+                'error': 'xee_forbidden',
+                'error_description': (
+                    "Please upload a file with no complex XML entities."),
+            })
+
+    def open_xlsx(self, content):
+        """Open an .xlsx workbook in read-only (streaming) mode."""
+        book = openpyxl.load_workbook(
+            io.BytesIO(content), read_only=True, data_only=True)
+        self.datemode = 1 if book.epoch == CALENDAR_MAC_1904 else 0
+
+        def generate_tables():
+            try:
+                for sheet in book.worksheets:
+                    yield sheet.title, sheet.iter_rows(values_only=True)
+            finally:
+                book.close()
+
+        return generate_tables()
+
+    def open_xls(self, content):
+        """Open a .xls workbook, loading one sheet at a time."""
+        book = xlrd.open_workbook(file_contents=content, on_demand=True)
+        self.datemode = book.datemode
+
+        def generate_tables():
+            try:
+                for sheetx in range(book.nsheets):
+                    sheet = book.sheet_by_index(sheetx)
+                    yield sheet.name, (
+                        sheet.row_values(rowx) for rowx in range(sheet.nrows))
+                    book.unload_sheet(sheetx)
+            finally:
+                book.release_resources()
+
+        return generate_tables()
+
+    def get_tables(self):
+        for sheetx, (sheet_name, rows) in enumerate(self.tables):
+            sheet_name = sheet_name.strip() or str(sheetx + 1)
+            if sheet_name.lower().startswith('sheet'):
+                # Remove the redundant word.
+                sheet_name = sheet_name[5:].strip()
+            yield sheet_name, rows
+
+    def describe_cell(self, sheet_name, rowx, colx):
+        return 'cell %s on sheet %s' % (cellname(rowx, colx), sheet_name)
+
+    def parse_date(self, value):
+        if isinstance(value, datetime.datetime):
+            return value.date()
+        if isinstance(value, datetime.date):
+            return value
+        if isinstance(value, (int, float)):
+            tup = xldate_as_tuple(value, self.datemode)
+            return datetime.date(*tup[:3])
+        return super(ExcelParser, self).parse_date(value)
+
+
+@register_statement_parser(
+    content_types=(
+        'text/csv',
+        'text/comma-separated-values',
+        'application/csv',
+        'text/tab-separated-values',
+    ),
+    extensions=('.csv', '.tsv'),
+)
+class CSVParser(TableParser):
+    """Parse a CSV file, one record at a time.
+
+    The delimiter is detected from the start of the file.
+    """
+    source = "CSV"
+
+    # sniff_size is the number of characters to examine to detect
+    # the delimiter.
+    sniff_size = 65536
+
+    def open(self):
+        self.encoding = detect_encoding(self.content)
+        sample = self.make_stream().read(self.sniff_size)
+        try:
+            self.dialect = csv.Sniffer().sniff(sample, delimiters=',;\t|')
+        except csv.Error:
+            self.dialect = csv.excel
+
+    def make_stream(self):
+        return io.TextIOWrapper(
+            io.BytesIO(self.content),
+            encoding=self.encoding,
+            errors='replace',
+            newline='')
+
+    def get_tables(self):
+        yield None, csv.reader(self.make_stream(), dialect=self.dialect)
+
+    def describe_cell(self, sheet_name, rowx, colx):
+        return 'in row %d, column %d' % (rowx + 1, colx + 1)
+
+
+ofx_tag_re = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<]*)')
+
+
+@register_statement_parser(
+    content_types=(
+        'application/x-ofx',
+        'application/ofx',
+        'application/vnd.intu.qfx',
+    ),
+    extensions=('.ofx', '.qfx'),
+)
+class OFXParser(StatementParser):
+    """Parse the transactions in an OFX (or QFX) file.
+
+    Handles both SGML (OFX 1.x) and XML (OFX 2.x) files by scanning for
+    tags rather than building a document tree. The row of each entry
+    is the position of the transaction in the file.
+    """
+    source = "OFX"
+
+    def open(self):
+        self.text = str(self.content, detect_encoding(self.content))
+        if ofx_tag_re.search(self.text) is None:
+            raise HTTPBadRequest(json_body={
+                'error': 'parse_error',
+                'error_description': "The file contains no OFX tags.",
+            })
+
+    def parse(self):
+        # trn holds the fields of the transaction being read.
+        trn = None
+        trn_index = 0
+        for match in ofx_tag_re.finditer(self.text):
+            closing, tag, value = match.groups()
+            tag = tag.upper()
+            value = html.unescape(value.strip())
+
+            if tag == 'STMTTRN':
+                if closing:
+                    if trn is not None:
+                        entry = self.parse_transaction(trn_index, trn)
+                        if entry is not None:
+                            yield entry
+                    trn = None
+                else:
+                    trn_index += 1
+                    trn = {}
+            elif closing:
+                continue
+            elif trn is not None:
+                trn[tag] = value
+            elif tag == 'CURDEF' and value.upper() != self.currency:
+                raise HTTPBadRequest(json_body={
+                    'error': 'currency_mismatch',
+                    'error_description': (
+                        "The OFX file is in %s, but this file uses %s." % (
+                            value, self.currency)),
+                })
+
+    def parse_transaction(self, trn_index, trn):
+        """Return the entry tuple for a transaction or None to skip it."""
+        date_input = trn.get('DTPOSTED', '')
+        amount_input = trn.get('TRNAMT', '')
+        try:
+            entry_date = datetime.datetime.strptime(
+                date_input[:8], '%Y%m%d').date()
+            if ',' in amount_input and '.' not in amount_input:
+                # Decimal comma
+                amount_input = amount_input.replace(',', '.')
+            delta = parse_amount(amount_input, currency=self.currency)
+            if delta is None:
+                raise ValueError("No amount")
+        except Exception as e:
+            self.parse_error(
+                "Unable to parse transaction %d (%s). "
+                "Date: '%s', amount: '%s', error: %s, %s" % (
+                    trn_index,
+                    trn.get('FITID', ''),
+                    date_input,
+                    amount_input,
+                    type(e),
+                    e,
+                ))
+
+        if not delta:
+            # Ignore zero amount transactions.
+            return None
+
+        description_parts = []
+        for key in ('NAME', 'MEMO'):
+            part = trn.get(key)
+            if part and part not in description_parts:
+                description_parts.append(part)
+
+        description = ' '.join(description_parts)
+        return (None, trn_index, entry_date, delta, description)
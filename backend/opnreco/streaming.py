@@ -0,0 +1,168 @@
+
+"""Stream large responses.
+
+A streaming view computes the small parts of its response up front,
+then returns a Response whose app_iter encodes the large part as rows
+arrive from a server-side cursor. The app_iter runs after pyramid_tm
+has finished the request transaction, so it reads through its own
+connection (see open_stream_connection()). The parts computed up front
+are read through the same connection, so they agree with the rows.
+"""
+
+from opnreco.render import encode_compact
+from pyramid.response import Response
+from pyramid.settings import asbool
+from sqlalchemy.engine import Connection
+from sqlalchemy.orm import Session
+
+# chunk_size is the approximate number of bytes to yield at a time.
+chunk_size = 65536
+
+# fetch_size is the number of rows to fetch from the cursor at a time.
+fetch_size = 1000
+
+
+def stream_requested(request):
+    """Return true if the request asks for a streaming response."""
+    return asbool(request.params.get('stream', False))
+
+
+def open_stream_connection(request):
+    """Open a connection for reading after the request transaction ends.
+
+    In production, the session is bound to the engine and this opens a
+    separate connection in a read only REPEATABLE READ transaction, so
+    every query through the connection reads the same snapshot. (When
+    the session is bound to a connection, as in tests, this returns a
+    branch of that connection, which shares its transaction.)
+    """
+    bind = request.dbsession.get_bind()
+    if isinstance(bind, Connection):
+        return bind.connect()
+    connection = bind.connect().execution_options(
+        isolation_level='REPEATABLE READ')
+    connection.begin()
+    connection.execute('SET TRANSACTION READ ONLY')
+    return connection
+
+
+def iter_row_batches(connection, statement):
+    """Execute a statement with a server-side cursor.
+
+    Yield lists of up to fetch_size rows.
+    """
+    result = (
+        connection.execution_options(stream_results=True)
+        .execute(statement))
+    try:
+        while True:
+            rows = result.fetchmany(fetch_size)
+            if not rows:
+                break
+            yield rows
+    finally:
+        result.close()
+
+
+def iter_rows(connection, statement):
+    """Execute a statement with a server-side cursor and yield its rows."""
+    for rows in iter_row_batches(connection, statement):
+        for row in rows:
+            yield row
+
+
+def iter_json_list(values):
+    """Encode an iterable of JSON-compatible values as a JSON list."""
+    yield b'['
+    first = True
+    for value in values:
+        if first:
+            first = False
+            yield encode_compact(value)
+        else:
+            yield b',' + encode_compact(value)
+    yield b']'
+
+
+def iter_json_object(head, tail):
+    """Encode a JSON object whose last members are streamed.
+
+    head is a dict of the members computed up front. tail is a list of
+    (name, iterable of bytes) for the streamed members.
+    """
+    encoded = encode_compact(head)
+    if head:
+        yield encoded[:-1]
+        sep = b','
+    else:
+        yield b'{'
+        sep = b''
+    for name, chunks in tail:
+        yield sep + encode_compact(name) + b':'
+        sep = b','
+        for chunk in chunks:
+            yield chunk
+    yield b'}'
+
+
+def join_chunks(chunks, size=chunk_size):
+    """Combine small chunks of bytes into chunks of about size bytes."""
+    buf = []
+    buf_size = 0
+    for chunk in chunks:
+        buf.append(chunk)
+        buf_size += len(chunk)
+        if buf_size >= size:
+            yield b''.join(buf)
+            buf = []
+            buf_size = 0
+    if buf:
+        yield b''.join(buf)
+
+
+class StreamIterator:
+    """A WSGI app_iter that closes its connection when done.
+
+    The WSGI server calls close() even if the client disconnects early.
+    """
+
+    def __init__(self, connection, chunks):
+        self.connection = connection
+        self.chunks = join_chunks(chunks)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.chunks)
+
+    def close(self):
+        try:
+            self.chunks.close()
+        finally:
+            self.connection.close()
+
+
+def make_stream_response(
+        request, make_chunks, content_type='application/json',
+        charset='UTF-8', headers=None):
+    """Create a Response that streams chunks (JSON by default).
+
+    make_chunks(dbsession, connection) computes the small parts of the
+    response through dbsession and returns an iterable of bytes that
+    reads the rest through connection. dbsession is bound to connection,
+    so both read the same snapshot.
+    """
+    connection = open_stream_connection(request)
+    try:
+        chunks = make_chunks(Session(bind=connection), connection)
+    except Exception:
+        connection.close()
+        raise
+    response = Response(
+        app_iter=StreamIterator(connection, chunks),
+        content_type=content_type,
+        charset=charset)
+    if headers:
+        response.headers.update(headers)
+    return response
@@ -10,6 +10,7 @@ from opnreco.models.db import TransferRecord
 from opnreco.mvinterp import MovementInterpreter
 from opnreco.util import check_requests_response
 from opnreco.util import to_datetime
+from opnreco.viewcommon import bump_owner_file_versions
 from pyramid.decorator import reify
 import collections
 import logging
@@ -24,9 +25,10 @@ null = None
 class VerificationFailure(Exception):
     """A transfer failed verification"""
 
-    def __init__(self, msg, transfer_id):
+    def __init__(self, msg, transfer_id, details=None):
         Exception.__init__(self, msg)
         self.transfer_id = transfer_id
+        self.details = details
 
 
 class SyncBase:
@@ -122,6 +124,10 @@ class SyncBase:
         if write_enabled:
             self.import_peer(self.owner_id, None)
 
+        # bundles_changed becomes true when the batch adds or changes
+        # a bundle or the bundle of a transfer.
+        bundles_changed = False
+
         for tsum in transfers_download['results']:
             if write_enabled:
                 self.import_peer(tsum['sender_id'], tsum['sender_info'])
@@ -179,6 +185,8 @@ class SyncBase:
                         owner_id=owner_id,
                         **kw)
                     changed.append(kw)
+                    if bundled_transfers or bundle_transfer_id:
+                        bundles_changed = True
                     dbsession.add(record)
                     dbsession.flush()  # Assign record.id
                     record_map[transfer_id] = record
@@ -209,6 +217,9 @@ class SyncBase:
                             setattr(record, attr, value)
                         changed_map[attr] = value
                 if changed_map:
+                    if ('bundled_transfers' in changed_map or
+                            'bundle_transfer_id' in changed_map):
+                        bundles_changed = True
                     changed.append(changed_map)
                     change_log.append({
                         'event_type': 'transfer_changes',
@@ -229,6 +240,16 @@ class SyncBase:
                     is_new_record=is_new_record,
                     existing_movements=existing_movements_map[record.id])
 
+        if write_enabled:
+            # Add the auto-recos found in the whole batch.
+            for interpreter in self.interpreters:
+                interpreter.save_autorecos()
+
+            if bundles_changed:
+                # Bundles can affect any file of the owner. Update the
+                # versions once per batch rather than once per record.
+                bump_owner_file_versions(dbsession, owner_id)
+
         dbsession.flush()
 
     def get_existing_movements_map(self, transfer_ids):
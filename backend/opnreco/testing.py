@@ -1,7 +1,10 @@
 
+from decimal import Decimal
 from pyramid.decorator import reify
+from sqlalchemy import func
 from sqlalchemy.engine import create_engine
 from sqlalchemy.orm.session import Session
+import datetime
 
 
 class DBSessionFixture:
@@ -83,3 +86,107 @@ class DBSessionFixture:
             txn.rollback()
 
         return dbsession, close_session
+
+
+def add_test_owner_file(dbsession):
+    """Add the Owner 102 and its open_circ File 1239 for API tests.
+
+    Also configure the database log for the test transaction.
+    Return the Owner.
+    """
+    from opnreco.models import db
+
+    owner = db.Owner(
+        id='102',
+        title="Testy Owner",
+        username='testowner',
+        tzname='UTC',
+    )
+    dbsession.add(owner)
+    dbsession.flush()
+
+    file = db.File(
+        id=1239,
+        owner_id=owner.id,
+        file_type='open_circ',
+        title='Test File',
+        currency='USD',
+        has_vault=True)
+    dbsession.add(file)
+    dbsession.flush()
+
+    dbsession.query(
+        func.set_config('opnreco.personal_id', '11', True),
+        func.set_config('opnreco.movement.event_type', 'test', True),
+        func.set_config('opnreco.account_entry.event_type', 'test', True),
+    ).one()
+
+    return owner
+
+
+def add_test_movement(
+        dbsession, period, transfer_id, day, vault_delta=Decimal(0),
+        wallet_delta=Decimal(0), workflow_type='redeem', reco_id=None):
+    """Add a transfer with one movement to a period of File 1239.
+
+    The movement happens on the given day of January 2018.
+    Return the FileMovement.
+    """
+    from opnreco.models import db
+
+    ts = datetime.datetime(2018, 1, day, 6, 0, 0)
+    amount = abs(vault_delta + wallet_delta)
+
+    r = db.TransferRecord(
+        owner_id='102',
+        transfer_id=transfer_id,
+        workflow_type=workflow_type,
+        start=ts,
+        currency='USD',
+        amount=amount,
+        timestamp=ts,
+        next_activity='completed',
+        completed=True,
+        canceled=False,
+        sender_id='11',
+        recipient_id='211',
+    )
+    dbsession.add(r)
+    dbsession.flush()
+
+    m = db.Movement(
+        owner_id='102',
+        transfer_record_id=r.id,
+        number=1,
+        amount_index=0,
+        loop_id='0',
+        currency='USD',
+        issuer_id='102',
+        from_id='102',
+        to_id='211',
+        amount=amount,
+        action='split',
+        ts=ts,
+    )
+    dbsession.add(m)
+    dbsession.flush()
+
+    fm = db.FileMovement(
+        owner_id='102',
+        movement_id=m.id,
+        file_id=1239,
+        peer_id='211',
+        loop_id=m.loop_id,
+        currency=m.currency,
+        issuer_id=m.issuer_id,
+        transfer_record_id=m.transfer_record_id,
+        ts=ts,
+        wallet_delta=wallet_delta,
+        vault_delta=vault_delta,
+        period_id=period.id,
+        surplus_delta=-wallet_delta,
+        reco_id=reco_id,
+    )
+    dbsession.add(fm)
+    dbsession.flush()
+    return fm
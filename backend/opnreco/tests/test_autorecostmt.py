@@ -74,12 +74,16 @@ class TestSortableMatch(unittest.TestCase):
 class Test_auto_reco_statement(unittest.TestCase):
 
     def setUp(self):
+        from opnreco import autorecostmt
         self.config = pyramid.testing.setUp()
         self.dbsession, self.close_session = dbsession_fixture.begin_session()
+        autorecostmt.bundle_index_cache.clear()
 
     def tearDown(self):
+        from opnreco import autorecostmt
         self.close_session()
         pyramid.testing.tearDown()
+        autorecostmt.bundle_index_cache.clear()
 
     def _call(self, *args, **kw):
         from ..autorecostmt import auto_reco_statement
@@ -742,3 +746,145 @@ class Test_auto_reco_statement(unittest.TestCase):
             expect_recos=2,
             expect_movements=4,
             expect_account_entries=2)
+
+    def test_reuse_bundle_index_for_next_statement(self):
+        from opnreco import autorecostmt
+        from opnreco.autorecostmt import BundleFinder
+        from opnreco.models import db
+
+        self.add_peer()
+        self.add_period()
+        self.add_transfer_6502(amount='-2.00', bundle_transfer_id='6512')
+        self.add_transfer_6510(amount='-10.00', bundle_transfer_id='6512')
+        self.add_transfer_6512()
+        self.add_transfer_6502(
+            amount='-2.50', transfer_id='7502', bundle_transfer_id='7512')
+        self.add_transfer_6510(
+            amount='-10.50', transfer_id='7510', bundle_transfer_id='7512')
+        self.add_transfer_6512(
+            transfer_id='7512',
+            bundled_transfer_ids=['7510', '7502'],
+            bundled_amounts=['10.50', '2.50'])
+        self.add_statement(e1value='12.00', e2value='3.14')
+        self._call(
+            dbsession=self.dbsession,
+            owner=self.owner,
+            period=self.period,
+            statement=self.statement,
+        )
+        self.assert_recos(
+            expect_recos=1,
+            expect_movements=4,
+            expect_account_entries=2)
+
+        # The updated index is cached when the transaction commits.
+        self.assertEqual({}, dict(autorecostmt.bundle_index_cache))
+        self.dbsession.commit()
+        cached = autorecostmt.bundle_index_cache[(self.owner.id, 1239)]
+
+        finder = BundleFinder(
+            dbsession=self.dbsession, owner=self.owner, period=self.period)
+        index = finder.get_index()
+        self.assertIs(cached, index)
+        self.assertEqual(
+            ['7512'], [row[0] for row in index.qualified_bundles])
+
+        # The next statement reuses the updated index.
+        self.add_statement(e1value='13.00', e2value='3.15')
+        statement2 = self.statement
+        self._call(
+            dbsession=self.dbsession,
+            owner=self.owner,
+            period=self.period,
+            statement=statement2,
+        )
+        self.assert_recos(
+            expect_recos=2,
+            expect_movements=4,
+            expect_account_entries=4)
+
+        entry = (
+            self.dbsession.query(db.AccountEntry)
+            .filter_by(statement_id=statement2.id, delta=Decimal('13.00'))
+            .one())
+        self.assertIsNotNone(entry.reco_id)
+
+        finder = BundleFinder(
+            dbsession=self.dbsession, owner=self.owner, period=self.period)
+        self.assertEqual([], finder.get_index().qualified_bundles)
+
+    def test_rebuild_bundle_index_after_movement_change(self):
+        from opnreco.autorecostmt import BundleFinder
+
+        self.add_peer()
+        self.add_period()
+        self.add_transfer_6502(amount='-2.00', bundle_transfer_id='6512')
+        self.add_transfer_6512()
+
+        finder = BundleFinder(
+            dbsession=self.dbsession, owner=self.owner, period=self.period)
+        index = finder.get_index()
+        self.assertEqual([], index.qualified_bundles)
+        self.assertEqual(1, len(index.unqualified_movement_ids))
+        self.assertIs(index, finder.get_index())
+
+        self.add_transfer_6510(amount='-10.00', bundle_transfer_id='6512')
+        index2 = finder.get_index()
+        self.assertIsNot(index, index2)
+        self.assertNotEqual(index.token, index2.token)
+        self.assertEqual(1, len(index2.qualified_bundles))
+        transfer_id, date, delta, movement_ids = index2.qualified_bundles[0]
+        self.assertEqual('6512', transfer_id)
+        self.assertEqual(datetime.date(2018, 1, 15), date)
+        self.assertEqual(Decimal('12.00'), delta)
+        self.assertEqual(2, len(movement_ids))
+        self.assertEqual(frozenset(), index2.unqualified_movement_ids)
+
+    def test_bundle_index_token_ignores_account_entries(self):
+        from opnreco.autorecostmt import get_bundle_index_token
+
+        self.add_peer()
+        self.add_period()
+        token = get_bundle_index_token(
+            dbsession=self.dbsession, owner=self.owner, file_id=1239)
+        self.add_statement(e1value='12.00', e2value='3.14')
+        self.assertEqual(token, get_bundle_index_token(
+            dbsession=self.dbsession, owner=self.owner, file_id=1239))
+
+        self.add_transfer_6502(amount='-2.00', bundle_transfer_id='6512')
+        self.assertNotEqual(token, get_bundle_index_token(
+            dbsession=self.dbsession, owner=self.owner, file_id=1239))
+
+
+class TestBundleIndex(unittest.TestCase):
+
+    def _make(self):
+        from ..autorecostmt import BundleIndex
+        return BundleIndex(
+            token=(1, 2, (3,), 'UTC'),
+            qualified_bundles=[
+                ('6512', datetime.date(2018, 1, 15), Decimal('12.00'),
+                    [51, 52]),
+                ('7512', datetime.date(2018, 1, 15), Decimal('13.00'),
+                    [53, 54]),
+            ],
+            unqualified_movement_ids=frozenset([55]),
+        )
+
+    def test_without_movements_of_qualified_bundle(self):
+        index = self._make()
+        new_index = index.without_movements([52], (4, 2, (3,), 'UTC'))
+        self.assertEqual((4, 2, (3,), 'UTC'), new_index.token)
+        self.assertEqual(
+            ['7512'], [row[0] for row in new_index.qualified_bundles])
+        # The original index is unchanged.
+        self.assertEqual(2, len(index.qualified_bundles))
+
+    def test_without_unrelated_movements(self):
+        index = self._make()
+        new_index = index.without_movements([56], None)
+        self.assertEqual(index.qualified_bundles, new_index.qualified_bundles)
+
+    def test_without_movements_of_unqualified_bundle(self):
+        index = self._make()
+        self.assertIsNone(index.without_movements([55], None))
@@ -0,0 +1,431 @@
+
+from decimal import Decimal
+from opnreco.testing import DBSessionFixture
+from sqlalchemy import func
+import datetime
+import pyramid.testing
+import unittest
+
+
+def setup_module():
+    global dbsession_fixture
+    dbsession_fixture = DBSessionFixture()
+
+
+def teardown_module():
+    dbsession_fixture.close()
+
+
+class Test_backfill_file(unittest.TestCase):
+
+    def setUp(self):
+        self.config = pyramid.testing.setUp()
+        self.dbsession, self.close_session = dbsession_fixture.begin_session()
+
+    def tearDown(self):
+        self.close_session()
+        pyramid.testing.tearDown()
+
+    def _setup(self, file_type):
+        from opnreco.models import db
+        dbsession = self.dbsession
+
+        self.owner = owner = db.Owner(
+            id='102',
+            title="Testy Owner",
+            username='testowner',
+            tzname='UTC',
+        )
+        dbsession.add(owner)
+        dbsession.flush()
+
+        dbsession.query(
+            func.set_config('opnreco.personal_id', '11', True),
+            func.set_config('opnreco.movement.event_type', 'test', True),
+            func.set_config('opnreco.account_entry.event_type', 'test', True),
+        ).one()
+
+        # Add two identical files: one synced in bulk and one synced
+        # a movement at a time.
+        files = []
+        for file_id in (1239, 1240):
+            file = db.File(
+                id=file_id,
+                owner_id=owner.id,
+                file_type=file_type,
+                title="Test File",
+                currency='USD',
+                has_vault=(file_type != 'account'),
+                peer_id=('200' if file_type == 'account' else None),
+                auto_enable_loops=(
+                    True if file_type == 'closed_circ' else None))
+            dbsession.add(file)
+            dbsession.flush()
+            files.append(file)
+
+            # The first open period covers January.
+            dbsession.add(db.Period(
+                owner_id=owner.id,
+                file_id=file.id,
+                start_date=datetime.date(2018, 1, 1),
+                end_date=datetime.date(2018, 1, 31),
+                start_circ=0,
+                start_surplus=0,
+            ))
+
+        if file_type == 'closed_circ':
+            # Disable a loop in both files.
+            for file in files:
+                dbsession.add(db.FileLoopConfig(
+                    owner_id=owner.id,
+                    file_id=file.id,
+                    loop_id='41',
+                    issuer_id='300',
+                    enabled=False))
+
+        # Each transfer: (day, [(loop_id, issuer_id, from_id, to_id, amount)])
+        transfers = [
+            (15, [
+                ('0', '300', '300', '102', '10.00'),
+                ('0', '300', '102', '200', '10.00'),
+            ]),
+            (20, [
+                ('0', '300', '200', '102', '4.25'),
+                ('0', '300', '102', '300', '4.25'),
+            ]),
+            (31, [
+                ('0', '300', None, '300', '7.00'),
+                ('0', '300', '300', '102', '0'),
+                ('0', '300', '102', '102', '1.00'),
+            ]),
+            (40, [
+                ('40', '300', '300', '102', '3.00'),
+                ('40', '300', '102', '200', '3.00'),
+                ('41', '300', '300', '200', '2.00'),
+                ('42', '102', '200', '102', '1.50'),
+            ]),
+            (45, [
+                ('0', '301', '301', '102', '6.00'),
+                ('0', '301', '102', '200', '6.00'),
+                ('0', '301', '200', '102', '6.00'),
+                ('0', '301', '102', '301', '6.00'),
+            ]),
+        ]
+        start = datetime.datetime(2018, 1, 1, 12)
+        movement_id = 1000
+        for record_id, (day, movements) in enumerate(transfers, 500):
+            ts = start + datetime.timedelta(days=day - 1)
+            record = db.TransferRecord(
+                id=record_id,
+                owner_id=owner.id,
+                transfer_id='1234%d' % record_id,
+                workflow_type='redeem',
+                start=ts,
+                currency='USD',
+                amount=Decimal('10.00'),
+                timestamp=ts,
+                next_activity='completed',
+                completed=True,
+                canceled=False,
+                sender_id='102',
+                recipient_id='200',
+            )
+            dbsession.add(record)
+            dbsession.flush()
+            for number, spec in enumerate(movements, 1):
+                loop_id, issuer_id, from_id, to_id, amount = spec
+                movement_id += 1
+                dbsession.add(db.Movement(
+                    id=movement_id,
+                    owner_id=owner.id,
+                    transfer_record_id=record_id,
+                    number=number,
+                    amount_index=0,
+                    loop_id=loop_id,
+                    currency='USD',
+                    issuer_id=issuer_id,
+                    from_id=from_id,
+                    to_id=to_id,
+                    amount=Decimal(amount),
+                    action='split',
+                    ts=ts,
+                ))
+        dbsession.flush()
+        return files
+
+    def _sync(self, file, use_backfill):
+        from opnreco.mvinterp import MovementInterpreter
+        request = pyramid.testing.DummyRequest(
+            dbsession=self.dbsession,
+            owner=self.owner,
+            personal_id='11')
+        change_log = []
+        interpreter = MovementInterpreter(
+            request=request, file=file, change_log=change_log)
+        interpreter.use_backfill = use_backfill
+        interpreter.sync_missing()
+        self.dbsession.flush()
+        return change_log
+
+    def _get_state(self, file):
+        from opnreco.models import db
+        dbsession = self.dbsession
+        periods = (
+            dbsession.query(db.Period)
+            .filter(db.Period.file_id == file.id)
+            .order_by(db.Period.id)
+            .all())
+        period_numbers = {period.id: i for i, period in enumerate(periods)}
+        reco_numbers = {}
+        file_movements = []
+        rows = (
+            dbsession.query(db.FileMovement)
+            .filter(db.FileMovement.file_id == file.id)
+            .order_by(db.FileMovement.movement_id)
+            .all())
+        for row in rows:
+            reco_number = None
+            if row.reco_id is not None:
+                reco_number = reco_numbers.setdefault(
+                    row.reco_id, len(reco_numbers))
+            file_movements.append((
+                row.movement_id,
+                row.loop_id,
+                row.issuer_id,
+                row.transfer_record_id,
+                row.ts,
+                row.peer_id,
+                row.wallet_delta,
+                row.vault_delta,
+                row.surplus_delta,
+                period_numbers[row.period_id],
+                reco_number,
+            ))
+        synced = sorted(
+            row[0] for row in (
+                dbsession.query(db.FileSync.transfer_record_id)
+                .filter(db.FileSync.file_id == file.id)
+                .all()))
+        loop_configs = sorted(
+            (row.loop_id, row.issuer_id, row.enabled) for row in (
+                dbsession.query(db.FileLoopConfig)
+                .filter(db.FileLoopConfig.file_id == file.id)
+                .all()))
+        return {
+            'periods': [
+                (p.start_date, p.end_date, p.closed) for p in periods],
+            'file_movements': file_movements,
+            'synced': synced,
+            'loop_configs': loop_configs,
+        }
+
+    def _check(self, file_type):
+        bulk_file, single_file = self._setup(file_type)
+        bulk_log = self._sync(bulk_file, use_backfill=True)
+        single_log = self._sync(single_file, use_backfill=False)
+        bulk_state = self._get_state(bulk_file)
+        single_state = self._get_state(single_file)
+        self.assertTrue(bulk_state['file_movements'])
+        self.assertEqual(single_state, bulk_state)
+        self.assertEqual(len(single_log), len(bulk_log))
+        return bulk_state
+
+    def test_open_circ(self):
+        state = self._check('open_circ')
+        # A period was added for February.
+        self.assertEqual(2, len(state['periods']))
+        self.assertEqual([500, 501, 502, 503, 504], state['synced'])
+        # Movements within transfers were auto-reconciled.
+        self.assertTrue(any(
+            row[-1] is not None for row in state['file_movements']))
+
+    def test_account(self):
+        self._check('account')
+
+    def test_closed_circ(self):
+        state = self._check('closed_circ')
+        self.assertEqual([
+            ('40', '300', True),
+            ('41', '300', False),
+            ('42', '102', True),
+        ], state['loop_configs'])
+
+    def test_backfill_only_when_never_synced(self):
+        from opnreco.backfill import backfill_needed
+        bulk_file, _single_file = self._setup('open_circ')
+        self.assertTrue(backfill_needed(self.dbsession, bulk_file))
+        self._sync(bulk_file, use_backfill=True)
+        self.assertFalse(backfill_needed(self.dbsession, bulk_file))
+
+    def test_autorecos_added_once_per_batch(self):
+        from opnreco.models import db
+        from sqlalchemy import event
+        _bulk_file, single_file = self._setup('open_circ')
+        connection = self.dbsession.connection()
+        reco_inserts = []
+
+        def before_cursor_execute(conn, cursor, statement, *args):
+            if statement.startswith('INSERT INTO reco '):
+                reco_inserts.append(statement)
+
+        event.listen(
+            connection, 'before_cursor_execute', before_cursor_execute)
+        try:
+            self._sync(single_file, use_backfill=False)
+        finally:
+            event.remove(
+                connection, 'before_cursor_execute', before_cursor_execute)
+
+        state = self._get_state(single_file)
+        reco_numbers = set(
+            row[-1] for row in state['file_movements'] if row[-1] is not None)
+        self.assertGreater(len(reco_numbers), 1)
+        self.assertEqual(1, len(reco_inserts))
+
+        # The triggers logged the reco assignments as autoreco.
+        event_types = set(
+            row[0] for row in (
+                self.dbsession.query(db.FileMovementLog.event_type)
+                .filter(
+                    db.FileMovementLog.file_id == single_file.id,
+                    db.FileMovementLog.reco_id.isnot(None))
+                .all()))
+        self.assertEqual({'autoreco'}, event_types)
+
+
+class Test_get_movement_rules(unittest.TestCase):
+    """Verify the SQL rules match MovementInterpreter.interpret()."""
+
+    def setUp(self):
+        self.config = pyramid.testing.setUp()
+        self.dbsession, self.close_session = dbsession_fixture.begin_session()
+
+    def tearDown(self):
+        self.close_session()
+        pyramid.testing.tearDown()
+
+    def _check(self, file_type):
+        from opnreco.backfill import get_movement_rules
+        from opnreco.models import db
+        from opnreco.mvinterp import MovementInterpreter
+        import itertools
+        dbsession = self.dbsession
+
+        owner = db.Owner(
+            id='102',
+            title="Testy Owner",
+            username='testowner',
+            tzname='UTC',
+        )
+        dbsession.add(owner)
+        dbsession.flush()
+
+        dbsession.query(
+            func.set_config('opnreco.personal_id', '11', True),
+            func.set_config('opnreco.movement.event_type', 'test', True),
+        ).one()
+
+        file = db.File(
+            id=1239,
+            owner_id=owner.id,
+            file_type=file_type,
+            title="Test File",
+            currency='USD',
+            has_vault=(file_type != 'account'),
+            peer_id=('200' if file_type == 'account' else None),
+        )
+        dbsession.add(file)
+        dbsession.flush()
+
+        # Configure every closed loop so that interpret() adds no configs.
+        for loop_id, issuer_id in itertools.product(
+                ('41', '42'), ('102', '300')):
+            dbsession.add(db.FileLoopConfig(
+                owner_id=owner.id,
+                file_id=file.id,
+                loop_id=loop_id,
+                issuer_id=issuer_id,
+                enabled=(loop_id == '41')))
+
+        ts = datetime.datetime(2018, 1, 15, 12)
+        dbsession.add(db.TransferRecord(
+            id=500,
+            owner_id=owner.id,
+            transfer_id='1234500',
+            workflow_type='redeem',
+            start=ts,
+            currency='USD',
+            amount=Decimal('10.00'),
+            timestamp=ts,
+            next_activity='completed',
+            completed=True,
+            canceled=False,
+            sender_id='102',
+            recipient_id='200',
+        ))
+        dbsession.flush()
+
+        ids = ('102', '200', '300', '301')
+        specs = itertools.product(
+            ids + (None,), ids, ('102', '300'), ('0', '41', '42'),
+            (Decimal('2.50'), Decimal('0')))
+        movements = []
+        for number, spec in enumerate(specs, 1):
+            from_id, to_id, issuer_id, loop_id, amount = spec
+            movement = db.Movement(
+                id=1000 + number,
+                owner_id=owner.id,
+                transfer_record_id=500,
+                number=number,
+                amount_index=0,
+                loop_id=loop_id,
+                currency='USD',
+                issuer_id=issuer_id,
+                from_id=from_id,
+                to_id=to_id,
+                amount=amount,
+                action='split',
+                ts=ts,
+            )
+            dbsession.add(movement)
+            movements.append(movement)
+        dbsession.flush()
+
+        request = pyramid.testing.DummyRequest(
+            dbsession=dbsession, owner=owner, personal_id='11')
+        interpreter = MovementInterpreter(
+            request=request, file=file, change_log=[])
+        expected = {}
+        for movement in movements:
+            kw = interpreter.interpret(movement)
+            if kw:
+                expected[movement.id] = (
+                    kw['peer_id'], kw['wallet_delta'], kw['vault_delta'])
+
+        rule_filter, peer_id, wallet_delta, vault_delta = (
+            get_movement_rules(file))
+        rows = (
+            dbsession.query(
+                db.Movement.id, peer_id, wallet_delta, vault_delta)
+            .filter(
+                db.Movement.owner_id == owner.id,
+                db.Movement.from_id != None,  # noqa
+                db.Movement.from_id != '',
+                db.Movement.amount != 0,
+                rule_filter)
+            .all())
+        actual = {
+            row[0]: (row[1], Decimal(row[2]), Decimal(row[3]))
+            for row in rows}
+
+        self.assertTrue(expected)
+        self.assertEqual(expected, actual)
+
+    def test_open_circ(self):
+        self._check('open_circ')
+
+    def test_account(self):
+        self._check('account')
+
+    def test_closed_circ(self):
+        self._check('closed_circ')
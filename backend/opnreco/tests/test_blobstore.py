@@ -0,0 +1,72 @@
+
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+
+class TestBlobStore(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _make(self):
+        from ..blobstore import BlobStore
+        return BlobStore(self.directory)
+
+    def test_put(self):
+        store = self._make()
+        sha256, size = store.put(b'hello')
+        self.assertEqual(hashlib.sha256(b'hello').hexdigest(), sha256)
+        self.assertEqual(5, size)
+        path = store.get_path(sha256)
+        self.assertEqual(
+            os.path.join(self.directory, sha256[:2], sha256[2:4], sha256),
+            path)
+        with open(path, 'rb') as f:
+            self.assertEqual(b'hello', f.read())
+        self.assertTrue(store.exists(sha256))
+
+    def test_put_identical_content_reuses_blob(self):
+        store = self._make()
+        sha256, size = store.put(b'hello')
+        mtime = os.path.getmtime(store.get_path(sha256))
+        os.utime(store.get_path(sha256), (mtime - 10, mtime - 10))
+        self.assertEqual((sha256, size), store.put(b'hello'))
+        # Reusing the blob updates its modification time.
+        self.assertGreaterEqual(
+            os.path.getmtime(store.get_path(sha256)), mtime)
+        self.assertEqual(
+            [], [name for name in os.listdir(os.path.dirname(
+                store.get_path(sha256))) if name.startswith('.tmp-')])
+
+    def test_get_path_rejects_invalid_hash(self):
+        store = self._make()
+        with self.assertRaises(ValueError):
+            store.get_path('../../etc/passwd')
+
+    def test_list_blobs(self):
+        store = self._make()
+        sha256, _size = store.put(b'hello')
+        dirname = os.path.dirname(store.get_path(sha256))
+        with open(os.path.join(dirname, '.tmp-x'), 'wb'):
+            pass
+        with open(os.path.join(self.directory, 'README'), 'wb'):
+            pass
+        self.assertEqual(
+            [(sha256, os.path.getmtime(store.get_path(sha256)))],
+            list(store.list_blobs()))
+
+    def test_remove(self):
+        store = self._make()
+        sha256, _size = store.put(b'hello')
+        mtime = os.path.getmtime(store.get_path(sha256))
+        self.assertFalse(store.remove(sha256, max_mtime=mtime - 1))
+        self.assertTrue(store.exists(sha256))
+        self.assertTrue(store.remove(sha256, max_mtime=mtime))
+        self.assertFalse(store.exists(sha256))
+        self.assertFalse(store.remove(sha256))
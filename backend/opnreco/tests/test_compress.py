@@ -0,0 +1,76 @@
+from pyramid.request import Request
+from pyramid.response import Response
+import gzip
+import pyramid.testing
+import unittest
+
+
+class Test_tween_factory(unittest.TestCase):
+
+    def _make(self, response, **settings):
+        from ..compress import tween_factory
+        registry = pyramid.testing.DummyResource(settings=settings)
+        return tween_factory(lambda request: response, registry)
+
+    def _make_response(self, size=2000):
+        return Response(
+            body=b'[' + b'0,' * (size // 2) + b'0]',
+            content_type='application/json')
+
+    def _make_request(self, accept_encoding='gzip'):
+        headers = {}
+        if accept_encoding:
+            headers['Accept-Encoding'] = accept_encoding
+        return Request.blank('/', headers=headers)
+
+    def test_gzip_large_json(self):
+        response = self._make_response()
+        body = response.body
+        tween = self._make(response)
+        res = tween(self._make_request())
+        self.assertEqual('gzip', res.content_encoding)
+        self.assertEqual(('Accept-Encoding',), res.vary)
+        self.assertLess(len(res.body), len(body))
+        self.assertEqual(body, gzip.decompress(res.body))
+
+    def test_brotli_preferred(self):
+        from .. import compress
+        if compress.brotli is None:
+            self.skipTest("brotli is not installed")
+        response = self._make_response()
+        body = response.body
+        tween = self._make(response)
+        res = tween(self._make_request('gzip, br'))
+        self.assertEqual('br', res.content_encoding)
+        self.assertEqual(body, compress.brotli.decompress(res.body))
+
+    def test_small_response_unchanged(self):
+        response = self._make_response(size=100)
+        tween = self._make(response)
+        res = tween(self._make_request())
+        self.assertIsNone(res.content_encoding)
+
+    def test_without_accept_encoding(self):
+        response = self._make_response()
+        tween = self._make(response)
+        res = tween(self._make_request(accept_encoding=None))
+        self.assertIsNone(res.content_encoding)
+
+    def test_not_json(self):
+        response = self._make_response()
+        response.content_type = 'application/pdf'
+        tween = self._make(response)
+        res = tween(self._make_request())
+        self.assertIsNone(res.content_encoding)
+
+    def test_min_size_setting(self):
+        response = self._make_response(size=100)
+        tween = self._make(response, **{'opnreco.compress_min_size': '10'})
+        res = tween(self._make_request())
+        self.assertEqual('gzip', res.content_encoding)
+
+    def test_disabled(self):
+        response = self._make_response()
+        tween = self._make(response, **{'opnreco.compress': 'false'})
+        res = tween(self._make_request())
+        self.assertIsNone(res.content_encoding)
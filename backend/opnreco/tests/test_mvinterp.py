@@ -1,10 +1,23 @@
 
 from decimal import Decimal
+from opnreco.testing import DBSessionFixture
+from sqlalchemy import func
+import datetime
+import pyramid.testing
 import unittest
 
 zero = Decimal()
 
 
+def setup_module():
+    global dbsession_fixture
+    dbsession_fixture = DBSessionFixture()
+
+
+def teardown_module():
+    dbsession_fixture.close()
+
+
 def vault_deltas(seqs):
     return [
         [file_movement.vault_delta for (file_movement, movement) in seq]
@@ -248,3 +261,133 @@ class Test_find_internal_movements(unittest.TestCase):
         self.assertEqual([
             [Decimal('-0.25'), Decimal('-99.75'), Decimal('100.00')],
         ], vault_deltas(iseqs))
+
+
+class TestMovementInterpreterAutoreco(unittest.TestCase):
+
+    def setUp(self):
+        self.config = pyramid.testing.setUp()
+        self.dbsession, self.close_session = dbsession_fixture.begin_session()
+
+    def tearDown(self):
+        self.close_session()
+        pyramid.testing.tearDown()
+
+    def _setup(self):
+        from opnreco.models import db
+        dbsession = self.dbsession
+
+        self.owner = owner = db.Owner(
+            id='102',
+            title="Testy Owner",
+            username='testowner',
+            tzname='UTC',
+        )
+        dbsession.add(owner)
+        dbsession.flush()
+
+        dbsession.query(
+            func.set_config('opnreco.personal_id', '11', True),
+            func.set_config('opnreco.movement.event_type', 'test', True),
+            func.set_config('opnreco.account_entry.event_type', 'test', True),
+        ).one()
+
+        self.file = file = db.File(
+            id=1239,
+            owner_id=owner.id,
+            file_type='open_circ',
+            title="Test File",
+            currency='USD',
+            has_vault=True)
+        dbsession.add(file)
+        dbsession.flush()
+
+        self.ts = ts = datetime.datetime(2018, 1, 15, 12)
+        self.record = record = db.TransferRecord(
+            id=500,
+            owner_id=owner.id,
+            transfer_id='12345',
+            workflow_type='redeem',
+            start=ts,
+            currency='USD',
+            amount=Decimal('10.00'),
+            timestamp=ts,
+            next_activity='completed',
+            completed=True,
+            canceled=False,
+            sender_id='102',
+            recipient_id='200',
+        )
+        dbsession.add(record)
+        dbsession.flush()
+        self.movements = []
+
+    def _add_movements(self, pair_count):
+        # Add pairs of movements that receive then send notes.
+        from opnreco.models import db
+        for i in range(pair_count):
+            for from_id, to_id in (('300', '102'), ('102', '200')):
+                number = len(self.movements) + 1
+                movement = db.Movement(
+                    id=1000 + number,
+                    owner_id=self.owner.id,
+                    transfer_record_id=self.record.id,
+                    number=number,
+                    amount_index=0,
+                    loop_id='0',
+                    currency='USD',
+                    issuer_id='300',
+                    from_id=from_id,
+                    to_id=to_id,
+                    amount=Decimal('%d.00' % (i + 1)),
+                    action='split',
+                    ts=self.ts,
+                )
+                self.dbsession.add(movement)
+                self.movements.append(movement)
+        self.dbsession.flush()
+
+    def _sync(self, is_new_record):
+        from ..mvinterp import MovementInterpreter
+        request = pyramid.testing.DummyRequest(
+            dbsession=self.dbsession,
+            owner=self.owner,
+            personal_id='11')
+        interp = MovementInterpreter(
+            request=request, file=self.file, change_log=[])
+        interp.sync_file_movements(
+            record=self.record,
+            movements=self.movements,
+            is_new_record=is_new_record)
+        interp.save_autorecos()
+        self.dbsession.flush()
+
+    def _get_recos(self):
+        from opnreco.models import db
+        rows = (
+            self.dbsession.query(db.FileMovement)
+            .filter(db.FileMovement.file_id == self.file.id)
+            .order_by(db.FileMovement.movement_id)
+            .all())
+        return [row.reco_id for row in rows]
+
+    def test_autoreco_appended_movements(self):
+        self._setup()
+        self._add_movements(12)
+        self._sync(is_new_record=True)
+
+        reco_ids = self._get_recos()
+        self.assertEqual(24, len(reco_ids))
+        self.assertEqual(12, len(set(reco_ids)))
+        self.assertNotIn(None, reco_ids)
+
+        self._add_movements(3)
+        self._sync(is_new_record=False)
+
+        # The existing recos are kept and the appended movements
+        # are reconciled.
+        new_reco_ids = self._get_recos()
+        self.assertEqual(30, len(new_reco_ids))
+        self.assertEqual(reco_ids, new_reco_ids[:24])
+        self.assertEqual(15, len(set(new_reco_ids)))
+        self.assertNotIn(None, new_reco_ids)
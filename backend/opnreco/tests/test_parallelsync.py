@@ -0,0 +1,160 @@
+
+from decimal import Decimal
+from opnreco.testing import DBSessionFixture
+from sqlalchemy import func
+import datetime
+import unittest
+
+
+def setup_module():
+    global dbsession_fixture
+    dbsession_fixture = DBSessionFixture()
+
+
+def teardown_module():
+    dbsession_fixture.close()
+
+
+class Test_sync_file(unittest.TestCase):
+
+    def setUp(self):
+        self.dbsession, self.close_session = dbsession_fixture.begin_session()
+
+    def tearDown(self):
+        self.close_session()
+
+    def _call(self, *args, **kw):
+        from ..parallelsync import sync_file
+        return sync_file(*args, **kw)
+
+    def _setup(self):
+        from opnreco.models import db
+        dbsession = self.dbsession
+
+        owner = db.Owner(
+            id='102',
+            title="Testy Owner",
+            username='testowner',
+            tzname='UTC',
+        )
+        dbsession.add(owner)
+        dbsession.flush()
+
+        dbsession.query(
+            func.set_config('opnreco.personal_id', '11', True),
+            func.set_config('opnreco.movement.event_type', 'test', True),
+            func.set_config('opnreco.account_entry.event_type', 'test', True),
+        ).one()
+
+        file = db.File(
+            id=1239,
+            owner_id=owner.id,
+            file_type='open_circ',
+            title="Test File",
+            currency='USD',
+            has_vault=True)
+        dbsession.add(file)
+
+        ts = datetime.datetime(2018, 1, 15, 12)
+        record = db.TransferRecord(
+            id=500,
+            owner_id=owner.id,
+            transfer_id='12345',
+            workflow_type='redeem',
+            start=ts,
+            currency='USD',
+            amount=Decimal('10.00'),
+            timestamp=ts,
+            next_activity='completed',
+            completed=True,
+            canceled=False,
+            sender_id='102',
+            recipient_id='200',
+        )
+        dbsession.add(record)
+        dbsession.flush()
+
+        dbsession.add(db.Movement(
+            id=1001,
+            owner_id=owner.id,
+            transfer_record_id=record.id,
+            number=1,
+            amount_index=0,
+            loop_id='0',
+            currency='USD',
+            issuer_id='102',
+            from_id='102',
+            to_id='200',
+            amount=Decimal('10.00'),
+            action='split',
+            ts=ts,
+        ))
+        dbsession.flush()
+        return file
+
+    def test_sync_file(self):
+        from opnreco.models import db
+        file = self._setup()
+        change_log = self._call(
+            dbsession=self.dbsession, file_id=file.id, personal_id='11')
+        self.assertEqual(
+            [{'event_type': 'add_period', 'period_id': change_log[0][
+                'period_id']}],
+            change_log)
+        rows = (
+            self.dbsession.query(db.FileMovement)
+            .filter(db.FileMovement.file_id == file.id)
+            .all())
+        self.assertEqual(1, len(rows))
+        self.assertEqual(Decimal('-10.00'), rows[0].vault_delta)
+        synced = (
+            self.dbsession.query(db.FileSync)
+            .filter(db.FileSync.file_id == file.id)
+            .count())
+        self.assertEqual(1, synced)
+
+    def test_list_owner_file_ids(self):
+        from ..parallelsync import list_owner_file_ids
+        file = self._setup()
+        self.assertEqual(
+            [file.id], list_owner_file_ids(self.dbsession, '102'))
+        file.archived = True
+        self.dbsession.flush()
+        self.assertEqual([], list_owner_file_ids(self.dbsession, '102'))
+
+
+class Test_run_file_sync(unittest.TestCase):
+
+    def setUp(self):
+        from opnreco import parallelsync
+        self.old_factory = parallelsync.worker_dbsession_factory
+
+    def tearDown(self):
+        from opnreco import parallelsync
+        parallelsync.worker_dbsession_factory = self.old_factory
+
+    def _call(self, *args, **kw):
+        from ..parallelsync import run_file_sync
+        return run_file_sync(*args, **kw)
+
+    def test_report_error(self):
+        from opnreco import parallelsync
+
+        calls = []
+
+        class DummySession:
+            def query(self, *args):
+                raise RuntimeError("database unavailable")
+
+            def rollback(self):
+                calls.append('rollback')
+
+            def close(self):
+                calls.append('close')
+
+        parallelsync.worker_dbsession_factory = DummySession
+        result = self._call(1239, '11')
+        self.assertEqual(1239, result.file_id)
+        self.assertEqual(
+            'RuntimeError: database unavailable', result.error)
+        self.assertEqual(['rollback', 'close'], calls)
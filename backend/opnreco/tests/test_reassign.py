@@ -0,0 +1,97 @@
+
+from opnreco.testing import DBSessionFixture
+import datetime
+import unittest
+
+
+def setup_module():
+    global dbsession_fixture
+    dbsession_fixture = DBSessionFixture()
+
+
+def teardown_module():
+    dbsession_fixture.close()
+
+
+class DummyPeriod:
+
+    def __init__(self, id, start_date, end_date):
+        self.id = id
+        self.start_date = start_date
+        self.end_date = end_date
+
+
+class Test_make_day_period_cte(unittest.TestCase):
+
+    def setUp(self):
+        self.dbsession, self.close_session = dbsession_fixture.begin_session()
+
+    def tearDown(self):
+        self.close_session()
+
+    def _call(self, *args, **kw):
+        from ..reassign import make_day_period_cte
+        return make_day_period_cte(*args, **kw)
+
+    def _query(self, day_period_cte):
+        return (
+            self.dbsession.query(
+                day_period_cte.c.day, day_period_cte.c.period_id)
+            .order_by(day_period_cte.c.day)
+            .all())
+
+    def test_map_days(self):
+        period_list = [
+            DummyPeriod(
+                5, datetime.date(2018, 1, 1), datetime.date(2018, 1, 31)),
+            DummyPeriod(6, datetime.date(2018, 2, 1), None),
+        ]
+        days = [
+            datetime.date(2018, 1, 1) + datetime.timedelta(days=i)
+            for i in range(365)]
+        day_periods, day_period_cte, missing_period = self._call(
+            days=days, period_list=period_list)
+        self.assertFalse(missing_period)
+        self.assertEqual(365, len(day_periods))
+        rows = self._query(day_period_cte)
+        self.assertEqual(365, len(rows))
+        self.assertEqual((datetime.date(2018, 1, 1), 5), tuple(rows[0]))
+        self.assertEqual((datetime.date(2018, 1, 31), 5), tuple(rows[30]))
+        self.assertEqual((datetime.date(2018, 2, 1), 6), tuple(rows[31]))
+        self.assertEqual((datetime.date(2018, 12, 31), 6), tuple(rows[-1]))
+
+    def test_statement_size_independent_of_day_count(self):
+        period_list = [DummyPeriod(5, datetime.date(2018, 1, 1), None)]
+
+        def compile_size(day_count):
+            days = [
+                datetime.date(2018, 1, 1) + datetime.timedelta(days=i)
+                for i in range(day_count)]
+            day_period_cte = self._call(
+                days=days, period_list=period_list)[1]
+            query = self.dbsession.query(day_period_cte.c.period_id)
+            return len(str(query.statement.compile(
+                bind=self.dbsession.get_bind())))
+
+        self.assertEqual(compile_size(1), compile_size(500))
+
+    def test_missing_period(self):
+        period_list = [
+            DummyPeriod(
+                5, datetime.date(2018, 1, 1), datetime.date(2018, 1, 31)),
+        ]
+        day_periods, day_period_cte, missing_period = self._call(
+            days=[datetime.date(2018, 1, 2), datetime.date(2018, 2, 2)],
+            period_list=period_list)
+        self.assertTrue(missing_period)
+        self.assertEqual([(datetime.date(2018, 1, 2), 5)], day_periods)
+        self.assertEqual(
+            [(datetime.date(2018, 1, 2), 5)],
+            [tuple(row) for row in self._query(day_period_cte)])
+
+    def test_no_periods(self):
+        day_periods, day_period_cte, missing_period = self._call(
+            days=[datetime.date(2018, 1, 2)], period_list=[])
+        self.assertTrue(missing_period)
+        self.assertEqual([], day_periods)
+        self.assertEqual([], self._query(day_period_cte))
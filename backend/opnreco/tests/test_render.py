@@ -0,0 +1,73 @@
+from decimal import Decimal
+import collections
+import colander
+import datetime
+import json
+import pyramid.testing
+import unittest
+
+
+class RendererInfo:
+
+    def __init__(self, settings):
+        self.settings = settings
+
+
+class TestCustomJSONRenderer(unittest.TestCase):
+
+    def _make(self, **settings):
+        from ..render import CustomJSONRenderer
+        return CustomJSONRenderer(RendererInfo(settings))
+
+    def _make_value(self):
+        return {
+            'amount': Decimal('1.50'),
+            'ts': datetime.datetime(2018, 1, 2, 3, 4, 5, 6),
+            'day': datetime.date(2018, 1, 1),
+            'missing': colander.null,
+            'map': collections.defaultdict(list, {'a': [1]}),
+        }
+
+    def _decode(self, data):
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        return data
+
+    def test_compact_json(self):
+        obj = self._make(**{'opnreco.json_orjson': 'false'})
+        data = self._decode(obj({'b': 1, 'a': [1, 2]}, {}))
+        self.assertEqual('{"b":1,"a":[1,2]}', data)
+
+    def test_pretty_json(self):
+        obj = self._make(**{
+            'opnreco.json_orjson': 'false',
+            'opnreco.json_pretty': 'true',
+        })
+        data = self._decode(obj({'b': 1, 'a': 2}, {}))
+        self.assertEqual('{\n  "a": 2, \n  "b": 1\n}', data)
+
+    def test_encoders_agree(self):
+        from ..render import orjson
+        if orjson is None:
+            self.skipTest("orjson is not installed")
+        value = self._make_value()
+        expect = json.loads(self._decode(
+            self._make(**{'opnreco.json_orjson': 'false'})(value, {})))
+        self.assertEqual({
+            'amount': '1.50',
+            'ts': '2018-01-02T03:04:05.000006Z',
+            'day': '2018-01-01',
+            'missing': None,
+            'map': {'a': [1]},
+        }, expect)
+        for pretty in ('false', 'true'):
+            obj = self._make(**{'opnreco.json_pretty': pretty})
+            actual = json.loads(self._decode(obj(value, {})))
+            self.assertEqual(expect, actual)
+
+    def test_sets_content_type(self):
+        request = pyramid.testing.DummyRequest()
+        obj = self._make()
+        obj({}, {'request': request})
+        self.assertEqual(
+            'application/json', request.response.content_type)
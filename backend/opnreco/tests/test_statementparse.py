@@ -0,0 +1,179 @@
+
+import unittest
+
+
+class Test_get_statement_parser(unittest.TestCase):
+
+    def _call(self, *args, **kw):
+        from ..statementparse import get_statement_parser
+        return get_statement_parser(*args, **kw)
+
+    def test_by_extension(self):
+        from ..statementparse import CSVParser
+        from ..statementparse import ExcelParser
+        from ..statementparse import OFXParser
+        self.assertIs(ExcelParser, self._call('', '.xlsx'))
+        self.assertIs(CSVParser, self._call('', '.csv'))
+        self.assertIs(OFXParser, self._call('', '.qfx'))
+
+    def test_extension_preferred_over_content_type(self):
+        from ..statementparse import CSVParser
+        self.assertIs(
+            CSVParser, self._call('application/vnd.ms-excel', '.csv'))
+
+    def test_by_content_type(self):
+        from ..statementparse import ExcelParser
+        from ..statementparse import OFXParser
+        self.assertIs(
+            ExcelParser, self._call('application/vnd.ms-excel', ''))
+        self.assertIs(OFXParser, self._call('application/x-ofx', '.txt'))
+
+    def test_not_supported(self):
+        self.assertIsNone(self._call('application/pdf', '.pdf'))
+
+
+class Test_register_statement_parser(unittest.TestCase):
+
+    def test_incomplete_parser_rejected(self):
+        from ..statementparse import register_statement_parser
+        from ..statementparse import statement_parsers
+        from ..statementparse import TableParser
+
+        class IncompleteParser(TableParser):
+            def get_tables(self):
+                return ()
+
+        count = len(statement_parsers)
+        with self.assertRaises(TypeError):
+            register_statement_parser(extensions=('.txt',))(IncompleteParser)
+        self.assertEqual(count, len(statement_parsers))
+        with self.assertRaises(TypeError):
+            IncompleteParser(b'', 'USD')
+
+
+class Test_detect_encoding(unittest.TestCase):
+
+    def _call(self, *args, **kw):
+        from ..statementparse import detect_encoding
+        return detect_encoding(*args, **kw)
+
+    def test_utf8(self):
+        self.assertEqual('utf-8', self._call('Caf\xe9'.encode('utf-8')))
+
+    def test_utf8_bom(self):
+        self.assertEqual(
+            'utf-8-sig', self._call('﻿Caf\xe9'.encode('utf-8')))
+
+    def test_cp1252(self):
+        self.assertEqual('cp1252', self._call('Caf\xe9'.encode('cp1252')))
+
+    def test_multibyte_character_across_chunks(self):
+        content = b'x' * 65535 + '\xe9'.encode('utf-8')
+        self.assertEqual('utf-8', self._call(content))
+
+
+class TestTableParser_parse_table(unittest.TestCase):
+
+    def _make(self):
+        from ..statementparse import CSVParser
+        return CSVParser(b'', 'USD')
+
+    def test_ignore_rows_before_heading(self):
+        import datetime
+        from decimal import Decimal
+        parser = self._make()
+        rows = [
+            ['Statement for account 123'],
+            ['Description', 'Amount', 'Date'],
+            ['Deposit', '12.50', '2018-01-16'],
+        ]
+        self.assertEqual([
+            (None, 3, datetime.date(2018, 1, 16), Decimal('12.50'),
+                'Deposit'),
+        ], list(parser.parse_table(None, rows)))
+
+    def test_without_heading_use_default_columns(self):
+        import datetime
+        from decimal import Decimal
+        parser = self._make()
+        rows = [
+            ['2018-01-16', '12.50', 'Deposit'],
+            ['2018-01-17', '-3.00', 'Fee'],
+        ]
+        self.assertEqual([
+            (None, 1, datetime.date(2018, 1, 16), Decimal('12.50'),
+                'Deposit'),
+            (None, 2, datetime.date(2018, 1, 17), Decimal('-3.00'), 'Fee'),
+        ], list(parser.parse_table(None, rows)))
+
+    def test_without_heading_read_ahead_is_bounded(self):
+        import itertools
+        parser = self._make()
+        consumed = []
+
+        def generate_rows():
+            for rowx in itertools.count():
+                consumed.append(rowx)
+                yield ['2018-01-16', '1.00', 'Row %d' % rowx]
+
+        entries = parser.parse_table(None, generate_rows())
+        self.assertEqual('Row 0', next(entries)[4])
+        self.assertEqual(parser.heading_search_rows, len(consumed))
+
+    def test_skip_preamble_longer_than_heading_search(self):
+        import datetime
+        from decimal import Decimal
+        parser = self._make()
+        preamble = [
+            ['Statement period: January 2018'],
+            ['Example Bank', '123 Main St.'],
+        ] * parser.heading_search_rows
+        rows = preamble + [
+            ['Description', 'Amount', 'Date'],
+            ['Deposit', '12.50', '2018-01-16'],
+        ]
+        self.assertEqual([
+            (None, len(rows), datetime.date(2018, 1, 16), Decimal('12.50'),
+                'Deposit'),
+        ], list(parser.parse_table(None, rows)))
+
+    def test_skip_preamble_without_heading(self):
+        import datetime
+        from decimal import Decimal
+        parser = self._make()
+        preamble = [['Example Bank']] * (parser.heading_search_rows + 1)
+        rows = preamble + [
+            ['2018-01-16', '12.50', 'Deposit'],
+        ]
+        self.assertEqual([
+            (None, len(rows), datetime.date(2018, 1, 16), Decimal('12.50'),
+                'Deposit'),
+        ], list(parser.parse_table(None, rows)))
+
+    def test_parse_error_after_valid_row(self):
+        from pyramid.httpexceptions import HTTPBadRequest
+        parser = self._make()
+        rows = [
+            ['Example Bank'],
+            ['2018-01-16', '12.50', 'Deposit'],
+            ['Total', '12.50'],
+        ]
+        with self.assertRaises(HTTPBadRequest) as cm:
+            list(parser.parse_table(None, rows))
+        self.assertEqual('parse_error', cm.exception.json_body['error'])
+
+    def test_later_heading_sets_columns(self):
+        import datetime
+        from decimal import Decimal
+        parser = self._make()
+        rows = [
+            ['Date', 'Amount', 'Description'],
+            ['2018-01-16', '12.50', 'Deposit'],
+            ['Amount', 'Date', 'Description'],
+            ['-3.00', '2018-01-17', 'Fee'],
+        ]
+        self.assertEqual([
+            (None, 2, datetime.date(2018, 1, 16), Decimal('12.50'),
+                'Deposit'),
+            (None, 4, datetime.date(2018, 1, 17), Decimal('-3.00'), 'Fee'),
+        ], list(parser.parse_table(None, rows)))
@@ -0,0 +1,67 @@
+
+from opnreco.testing import DBSessionFixture
+from sqlalchemy.orm import Session
+import pyramid.testing
+import unittest
+
+
+def setup_module():
+    global dbsession_fixture
+    dbsession_fixture = DBSessionFixture()
+
+
+def teardown_module():
+    dbsession_fixture.close()
+
+
+class Test_make_stream_response(unittest.TestCase):
+
+    def setUp(self):
+        self.config = pyramid.testing.setUp()
+        # Bind to the engine as in production.
+        self.dbsession = Session(bind=dbsession_fixture.engine)
+
+    def tearDown(self):
+        self.dbsession.close()
+        pyramid.testing.tearDown()
+
+    def _call(self, *args, **kw):
+        from ..streaming import make_stream_response
+        return make_stream_response(*args, **kw)
+
+    def test_head_and_rows_read_one_snapshot(self):
+        request = pyramid.testing.DummyRequest(dbsession=self.dbsession)
+
+        def make_chunks(dbsession, connection):
+            row = dbsession.execute(
+                "select current_setting('transaction_isolation'), "
+                "current_setting('transaction_read_only'), "
+                "pg_current_snapshot()::text").first()
+
+            def iter_chunks():
+                snapshot = connection.execute(
+                    "select pg_current_snapshot()::text").scalar()
+                yield ('%s,%s,%s' % (row[0], row[1], row[2] == snapshot)
+                       ).encode('utf-8')
+
+            return iter_chunks()
+
+        response = self._call(
+            request, make_chunks, content_type='text/plain')
+        try:
+            body = b''.join(response.app_iter)
+        finally:
+            response.app_iter.close()
+        self.assertEqual(b'repeatable read,on,True', body)
+
+    def test_close_connection_on_error(self):
+        request = pyramid.testing.DummyRequest(dbsession=self.dbsession)
+        pool = dbsession_fixture.engine.pool
+        checked_out = pool.checkedout()
+
+        def make_chunks(dbsession, connection):
+            raise ValueError("test")
+
+        with self.assertRaises(ValueError):
+            self._call(request, make_chunks)
+        self.assertEqual(checked_out, pool.checkedout())
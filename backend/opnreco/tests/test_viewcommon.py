@@ -0,0 +1,83 @@
+
+import datetime
+import unittest
+
+
+class DummyPeriod:
+
+    def __init__(self, id, start_date, end_date):
+        self.id = id
+        self.start_date = start_date
+        self.end_date = end_date
+
+
+class TestPeriodIndex(unittest.TestCase):
+
+    def _class(self):
+        from ..viewcommon import PeriodIndex
+        return PeriodIndex
+
+    def _make(self, *args, **kw):
+        return self._class()(*args, **kw)
+
+    def _make_periods(self):
+        # Monthly periods from 2010 through 2017, followed by an
+        # endless period, in no particular order. The first period
+        # has no start date.
+        month_starts = [
+            datetime.date(year, month, 1)
+            for year in range(2010, 2019)
+            for month in range(1, 13)][:97]
+        periods = []
+        for i in range(96):
+            periods.append(DummyPeriod(
+                i,
+                month_starts[i] if i else None,
+                month_starts[i + 1] - datetime.timedelta(days=1)))
+        periods.append(DummyPeriod(96, datetime.date(2018, 1, 1), None))
+        periods.reverse()
+        return periods
+
+    def test_matches_get_period_for_day(self):
+        from ..viewcommon import get_period_for_day
+        periods = self._make_periods()
+        for default_endless in (True, False):
+            index = self._make(periods, default_endless=default_endless)
+            day = datetime.date(2009, 12, 1)
+            while day < datetime.date(2018, 3, 1):
+                self.assertIs(
+                    get_period_for_day(
+                        periods, day, default_endless=default_endless),
+                    index.get(day))
+                day += datetime.timedelta(days=3)
+
+    def test_gap_between_periods(self):
+        p1 = DummyPeriod(1, datetime.date(2018, 1, 1),
+                         datetime.date(2018, 1, 31))
+        p2 = DummyPeriod(2, datetime.date(2018, 3, 1), None)
+        index = self._make([p1, p2])
+        self.assertIs(p1, index.get(datetime.date(2018, 1, 31)))
+        # Days in the gap fall back to the endless period.
+        self.assertIs(p2, index.get(datetime.date(2018, 2, 15)))
+        self.assertIs(p2, index.get(datetime.date(2017, 12, 31)))
+        self.assertIs(p2, index.get(None))
+
+        index = self._make([p1, p2], default_endless=False)
+        self.assertIsNone(index.get(datetime.date(2018, 2, 15)))
+        self.assertIs(p2, index.get(datetime.date(2018, 3, 1)))
+        self.assertIsNone(index.get(None))
+
+    def test_add(self):
+        p1 = DummyPeriod(1, None, datetime.date(2018, 1, 31))
+        index = self._make([p1])
+        self.assertIs(p1, index.get(datetime.date(2017, 1, 1)))
+        self.assertIsNone(index.get(datetime.date(2018, 2, 1)))
+
+        p2 = DummyPeriod(2, datetime.date(2018, 2, 1), None)
+        index.add(p2)
+        self.assertIs(p1, index.get(datetime.date(2018, 1, 31)))
+        self.assertIs(p2, index.get(datetime.date(2018, 2, 1)))
+
+    def test_no_periods(self):
+        index = self._make([])
+        self.assertIsNone(index.get(datetime.date(2018, 2, 1)))
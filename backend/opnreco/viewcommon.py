@@ -1,7 +1,9 @@
 
 from decimal import Decimal
 from opnreco.models.db import AccountEntry
+from opnreco.models.db import File
 from opnreco.models.db import FileMovement
+from opnreco.models.db import FileVersion
 from opnreco.models.db import Loop
 from opnreco.models.db import now_func
 from opnreco.models.db import OwnerLog
@@ -12,6 +14,9 @@ from opnreco.util import check_requests_response
 from pyramid.httpexceptions import HTTPBadRequest
 from sqlalchemy import func
 from sqlalchemy import literal
+from sqlalchemy import select
+from sqlalchemy.dialects.postgresql import ARRAY
+import bisect
 import datetime
 import os
 import requests
@@ -27,6 +32,45 @@ def get_tzname(owner):
     return owner.tzname or 'America/New_York'
 
 
+def get_file_versions(dbsession, file_id):
+    """Get the (movement_version, entry_version) of a file.
+
+    See opnreco.models.db.FileVersion.
+    """
+    row = (
+        dbsession.query(
+            FileVersion.movement_version,
+            FileVersion.entry_version)
+        .filter(FileVersion.file_id == file_id)
+        .first())
+    if row is None:
+        return (0, 0)
+    return (row.movement_version, row.entry_version)
+
+
+def bump_owner_file_versions(dbsession, owner_id):
+    """Increment the movement_version of every file of an owner.
+
+    Call this once per batch of transfer record changes that can affect
+    any file of the owner. See opnreco.models.db.FileVersion.
+    """
+    file_version_table = FileVersion.__table__
+    stmt = (
+        sqlalchemy.dialects.postgresql.insert(
+            file_version_table, bind=dbsession)
+        .from_select(
+            ['file_id', 'movement_version', 'entry_version'],
+            select([File.id, literal(1), literal(0)])
+            .where(File.owner_id == owner_id)
+            .order_by(File.id)))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[file_version_table.c.file_id],
+        set_={
+            'movement_version': file_version_table.c.movement_version + 1,
+        })
+    dbsession.execute(stmt)
+
+
 def fetch_peers(request, input_peers):
     """Fetch updates as necessary for all peers relevant to a request.
 
@@ -506,6 +550,90 @@ def get_period_for_day(period_list, day, default_endless=True):
     return default
 
 
+class PeriodIndex:
+    """Identify which period in a list matches a day in O(log n) time.
+
+    Produces the same results as get_period_for_day(), assuming the periods
+    don't overlap (periods in a file never overlap.) Use this when mapping
+    many days to a long list of periods.
+    """
+
+    def __init__(self, period_list=(), default_endless=True):
+        self.default_endless = default_endless
+        self.default = None
+        # unbounded: [Period] for periods with no start_date.
+        self.unbounded = []
+
+        bounded = []
+        for p in period_list:
+            if p.end_date is None and default_endless:
+                # Fall back to the last period with no end date.
+                self.default = p
+            if p.start_date is None:
+                self.unbounded.append(p)
+            else:
+                bounded.append(p)
+
+        # bounded: [Period] for periods with a start_date, sorted by
+        # start_date. starts is the parallel list of start dates.
+        bounded.sort(key=lambda p: p.start_date)
+        self.bounded = bounded
+        self.starts = [p.start_date for p in bounded]
+
+    def add(self, period):
+        """Add a period to the index."""
+        if period.end_date is None and self.default_endless:
+            self.default = period
+        start_date = period.start_date
+        if start_date is None:
+            self.unbounded.append(period)
+        else:
+            pos = bisect.bisect_right(self.starts, start_date)
+            self.starts.insert(pos, start_date)
+            self.bounded.insert(pos, period)
+
+    def get(self, day):
+        """Get the period that matches a day. day can be None.
+
+        If none of them match, return the default period, which is None
+        unless default_endless is true and there is an endless period.
+        """
+        if day is not None:
+            # Find the period with the latest start_date on or before day.
+            pos = bisect.bisect_right(self.starts, day)
+            if pos:
+                p = self.bounded[pos - 1]
+                if p.end_date is None or day <= p.end_date:
+                    return p
+
+            for p in self.unbounded:
+                if p.end_date is None or day <= p.end_date:
+                    return p
+
+        return self.default
+
+
+def make_array_cte(name, columns):
+    """Create a CTE (common table expr) from parallel lists of values.
+
+    columns is a list of (label, type_, values) tuples. All the value lists
+    must have the same length. Each list is bound as a single array
+    parameter and expanded using unnest(), so SQLAlchemy compiles the
+    same statement for any number of rows and PostgreSQL parses each
+    list as one array constant rather than a VALUES row per value.
+    psycopg2 still interpolates the array into the SQL text on the
+    client (as ARRAY[...]), so the size of the statement grows with
+    the number of rows.
+
+    Note: unnest() calls in the same select list expand in lockstep
+    (PostgreSQL 10+).
+    """
+    return select([
+        func.unnest(literal(list(values), ARRAY(type_))).label(label)
+        for (label, type_, values) in columns
+    ]).cte(name=name)
+
+
 def open_end_period_exists(request, file_id):
     """Return true if an open period exists with no end date."""
     dbsession = request.dbsession
@@ -523,6 +651,16 @@ def open_end_period_exists(request, file_id):
     return row[0]
 
 
+def expire_period_summary(dbsession, file):
+    """Expire the period summary of a File after flushing period changes.
+
+    The period_summary_trigger updates the summary in the database, so
+    reload it the next time it is read.
+    """
+    dbsession.expire(file, [
+        'period_count', 'last_period_end_date', 'has_endless_period'])
+
+
 def add_open_period(request, file_id, event_type):
     """Add a new period.
 
@@ -569,6 +707,7 @@ def add_open_period(request, file_id, event_type):
         start_surplus=next_start_surplus)
     dbsession.add(period)
     dbsession.flush()  # Assign period.id
+    expire_period_summary(dbsession, period.file)
 
     dbsession.add(OwnerLog(
         owner_id=owner_id,
@@ -5,6 +5,7 @@ from setuptools import setup, find_packages
 requires = [
     'colander',
     'defusedxml',
+    'openpyxl',
     'psycopg2',
     'pyramid',
     'pyramid_retry',
@@ -39,11 +40,16 @@ setup(
     install_requires=requires,
     extras_require={
         'test': ['responses'],
+        # Faster JSON encoding and brotli response compression.
+        'speedups': ['brotli', 'orjson'],
     },
     entry_points="""\
     [paste.app_factory]
     main = opnreco.main:main
     [console_scripts]
     initialize_opnreco_db = opnreco.scripts.initializedb:main
+    gc_opnreco_statement_blobs = opnreco.scripts.gcstatementblobs:main
+    move_opnreco_statement_blobs = opnreco.scripts.movestatementblobs:main
+    sync_opnreco_files = opnreco.scripts.syncfiles:main
     """,
 )
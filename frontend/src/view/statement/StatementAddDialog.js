@@ -217,7 +217,7 @@ class StatementAddDialog extends React.Component {
               >
                 <FormControlLabel value="upload" control={<Radio />} label={
                   <span>
-                    Import from a spreadsheet (<span
+                    Import a spreadsheet, CSV, or OFX file (<span
                       className={classes.downloadLink}
                       onClick={this.handleDownload}>
                         download template</span>)